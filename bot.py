@@ -3,14 +3,12 @@ import os
 import time # используется time.time()
 import asyncio
 import logging
+import dataclasses
 import datetime # используется datetime.datetime, datetime.timedelta
 import glob
-import io
-from io import BytesIO
 import json
 import re
 import signal # Для корректного завершения
-import shutil
 from asyncio import Lock # <--- ИЗМЕНЕНО: Убран RLock, т.к. используем кастомный
 from collections import defaultdict # Для user_processing_locks
 from typing import Optional, List, Dict, Any
@@ -19,11 +17,6 @@ from typing import Optional, List, Dict, Any
 import openai
 import chromadb
 from dotenv import load_dotenv, find_dotenv, dotenv_values
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseDownload
-import docx
-import PyPDF2
 
 from aiogram import Bot, Dispatcher, Router, types as aiogram_types, F
 from aiogram.filters import Command
@@ -31,24 +24,35 @@ from aiogram.enums import ChatAction # Для статуса "печатает"
 
 # LangChain components
 from langchain_openai import OpenAIEmbeddings # Не используется напрямую, но может понадобиться если OpenAI API клиент не будет использоваться для эмбеддингов
-from langchain_text_splitters import RecursiveCharacterTextSplitter, MarkdownHeaderTextSplitter
-from langchain_core.documents import Document # Langchain Document
 
 # Function Calling Tools
 from tools import (
     get_tools_for_api,
-    execute_tool_call,
+    execute_tool_calls,
     parse_tool_calls_from_response,
     format_tool_results_for_api,
     has_tool_calls,
     get_text_from_response,
     reset_verification,
     get_all_verifications,
+    load_verification_store,
+    flush_verifications,
+    close_pyrus_client,
+    format_failed_task_alert,
+    run_outbox_worker,
     get_conversation_topic,
     clear_conversation_topic,
     set_current_user_id,
     conversation_topics_storage as current_product_context,
 )
+from tools.request_context import RequestContext, use_request_context
+from tools.embedding_cache import QueryEmbeddingCache
+from tools.answer_cache import SemanticAnswerCache, answer_fingerprint
+from tools import kb_builder
+from tools.kb_builder import KB_CHROMA_BATCH_SIZE, KBBuildConfig
+from tools.kb_search import KeywordIndex, hybrid_search
+from tools.vector_index import NumpyVectorIndex
+from tools.kb_versions import KBHandle, KBRegistry, remove_kb_version
 
 # --- Custom AsyncRLock Implementation (for Python < 3.9) ---
 class AsyncRLock:
@@ -158,15 +162,46 @@ MESSAGE_BUFFER_SECONDS = int(os.getenv("MESSAGE_BUFFER_SECONDS", "4"))
 LOGS_DIR = os.getenv("LOGS_DIR", "./logs/context_logs_telegram")
 SILENCE_STATE_FILE = os.getenv("TELEGRAM_SILENCE_STATE_FILE", "telegram_silence_state.json")
 
-VECTOR_DB_BASE_PATH = os.getenv("VECTOR_DB_BASE_PATH_TELEGRAM", "./local_vector_db_telegram")
-ACTIVE_DB_INFO_FILE = os.getenv("ACTIVE_DB_INFO_FILE_TELEGRAM", "active_db_path_telegram.txt")
-OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-large")
-try:
-    _dim_str = os.getenv("OPENAI_EMBEDDING_DIMENSIONS")
-    OPENAI_EMBEDDING_DIMENSIONS = int(_dim_str) if _dim_str and _dim_str.lower() != 'none' else None
-except ValueError:
-    logging.warning(f"Некорректное значение OPENAI_EMBEDDING_DIMENSIONS ('{_dim_str}'), используется None.")
-    OPENAI_EMBEDDING_DIMENSIONS = None
+# Сборка базы знаний (tools/kb_builder.py): те же переменные окружения читает update_kb.py.
+# PDF/DOCX бот разбирает в потоках загрузки: процессы пула (spawn) заново
+# импортировали бы __main__, то есть весь бот; пул процессов — только в update_kb.py
+KB_BUILD_CONFIG = dataclasses.replace(KBBuildConfig.from_env(), parse_workers=0)
+VECTOR_DB_BASE_PATH = KB_BUILD_CONFIG.base_path
+ACTIVE_DB_INFO_FILE = KB_BUILD_CONFIG.active_info_file
+OPENAI_EMBEDDING_MODEL = KB_BUILD_CONFIG.embedding_model
+OPENAI_EMBEDDING_DIMENSIONS = KB_BUILD_CONFIG.embedding_dimensions
+# Кэш эмбеддингов поисковых запросов: размер LRU в памяти и файл на диске
+# (пустое значение — только память)
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "2000"))
+QUERY_EMBEDDING_CACHE_FILE = os.getenv(
+    "QUERY_EMBEDDING_CACHE_FILE", os.path.join(VECTOR_DB_BASE_PATH, "query_embeddings.sqlite")
+)
+KB_PROGRESS_INTERVAL_SECONDS = 10  # Как часто обновлять сообщение о прогрессе в чате
+# Как часто проверять файл-указатель активной базы: новую версию, собранную
+# другим процессом (update_kb.py), бот подхватывает без перезапуска; 0 — не следить
+KB_RELOAD_POLL_SECONDS = int(os.getenv("KB_RELOAD_POLL_SECONDS", "30"))
+# Гибридный поиск по базе знаний: BM25 + векторы (RRF) с переранжированием;
+# False — только векторный поиск, как раньше
+KB_HYBRID_SEARCH = KB_BUILD_CONFIG.hybrid_search
+KB_SEARCH_CANDIDATES = int(os.getenv("KB_SEARCH_CANDIDATES", "20"))  # Кандидатов из каждого поиска до переранжирования
+# Чем искать по активной базе: chroma — клиент ChromaDB, numpy — матрица эмбеддингов
+# в памяти (tools/vector_index.py); база в обоих случаях собирается в Chroma
+KB_VECTOR_BACKEND = KB_BUILD_CONFIG.vector_backend
+# Двухэтапный поиск в NumPy-индексе: первый этап по сжатой матрице (int8 — вчетверо
+# меньше памяти, float16 — вдвое, но медленнее) из первых KB_NUMPY_SEARCH_DIMS измерений
+# (0 — все), затем точный пересчёт KB_NUMPY_RESCORE_CANDIDATES кандидатов по полным векторам.
+# float32 и 0 — обычный точный поиск по полной матрице в памяти
+KB_NUMPY_DTYPE = KB_BUILD_CONFIG.numpy_dtype
+KB_NUMPY_SEARCH_DIMS = KB_BUILD_CONFIG.numpy_search_dims
+KB_NUMPY_RESCORE_CANDIDATES = int(os.getenv("KB_NUMPY_RESCORE_CANDIDATES", "50"))
+# Семантический кэш ответов на типовые вопросы (только для неверифицированных
+# пользователей в начале диалога; выключен по умолчанию)
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "False").lower() == 'true'
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))  # Минимальная косинусная близость вопросов
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(6 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500"))
+# Диалог считается новым, если пользователь не писал столько минут
+ANSWER_CACHE_DIALOG_GAP_MINUTES = int(os.getenv("ANSWER_CACHE_DIALOG_GAP_MINUTES", "60"))
 USE_OPENAI_RESPONSES_STR = os.getenv("USE_OPENAI_RESPONSES", "False")
 USE_OPENAI_RESPONSES = USE_OPENAI_RESPONSES_STR.lower() == 'true'
 
@@ -247,7 +282,7 @@ def load_system_instructions() -> str:
 # Загружаем инструкции при старте
 SYSTEM_INSTRUCTIONS = load_system_instructions()
 
-CHROMA_COLLECTION_NAME = os.getenv("CHROMA_COLLECTION_NAME_TELEGRAM", "documents_telegram")
+CHROMA_COLLECTION_NAME = KB_BUILD_CONFIG.collection_name
 RELEVANT_CONTEXT_COUNT = int(os.getenv("RELEVANT_CONTEXT_COUNT", "3"))
 OPENAI_RUN_TIMEOUT_SECONDS = int(os.getenv("OPENAI_RUN_TIMEOUT_SECONDS", "90"))
 LOG_RETENTION_SECONDS = int(os.getenv("LOG_RETENTION_SECONDS_TELEGRAM", "86400")) # 24 часа
@@ -358,73 +393,168 @@ current_child_context: Dict[int, str] = {}
 # Управляется через функцию set_conversation_topic (вызывается LLM) 
 
 # --- Vector Store (ChromaDB) ---
+# Коллекция Chroma или NumpyVectorIndex (см. KB_VECTOR_BACKEND) — интерфейс query/get/count общий
 vector_collection: Optional[chromadb.api.models.Collection.Collection] = None
+active_kb_version: Optional[str] = None  # Имя активной директории БД — версия базы знаний
+kb_keyword_index: Optional[KeywordIndex] = None  # BM25 по чанкам активной коллекции
+# Загруженные версии базы: запросы держат свою версию, пока выполняются (см. tools/kb_versions.py)
+kb_registry = KBRegistry()
+# Загрузка версии: /update и слежение за указателем не грузят её дважды
+# (создаётся в работающем event loop — asyncio.Lock до Python 3.10 привязан к циклу)
+kb_reload_lock: Optional[asyncio.Lock] = None
+
+# Эмбеддинги частых запросов не запрашиваются у OpenAI повторно
+query_embedding_cache = QueryEmbeddingCache(
+    OPENAI_EMBEDDING_MODEL,
+    OPENAI_EMBEDDING_DIMENSIONS,
+    max_entries=QUERY_EMBEDDING_CACHE_SIZE,
+    path=QUERY_EMBEDDING_CACHE_FILE or None,
+)
+
+# Готовые ответы на типовые вопросы (см. ANSWER_CACHE_*)
+answer_cache = SemanticAnswerCache(
+    threshold=ANSWER_CACHE_THRESHOLD,
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+    ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+)
 
 def _get_active_db_full_path_telegram() -> Optional[str]: # Renamed from _get_active_db_subpath_telegram
-    try:
-        active_db_info_filepath = os.path.join(VECTOR_DB_BASE_PATH, ACTIVE_DB_INFO_FILE)
-        if os.path.exists(active_db_info_filepath):
-            with open(active_db_info_filepath, "r", encoding="utf-8") as f:
-                active_subdir_or_fullname = f.read().strip() 
-            
-            if not active_subdir_or_fullname:
-                logger.warning(f"Файл '{ACTIVE_DB_INFO_FILE}' (TG) пуст.")
-                return None
+    return kb_builder.active_kb_path(KB_BUILD_CONFIG)
+
+def _load_keyword_index_sync(kb_path: str, collection) -> Optional[KeywordIndex]:
+    """BM25-индекс активной базы; для базы, собранной до гибридного поиска, строится по коллекции."""
+    index = KeywordIndex.load(kb_path)
+    if index is not None:
+        return index
+    chunks = {"ids": [], "documents": []}
+    total = collection.count()
+    for offset in range(0, total, KB_CHROMA_BATCH_SIZE):
+        batch = collection.get(include=["documents"], limit=KB_CHROMA_BATCH_SIZE, offset=offset)
+        chunks["ids"].extend(batch["ids"])
+        chunks["documents"].extend(batch["documents"])
+    index = KeywordIndex(chunks["ids"], chunks["documents"])
+    index.save(kb_path)
+    logger.info(f"BM25-индекс (TG) построен по {len(index)} чанкам текущей базы.")
+    return index
+
+def _load_numpy_index_sync(kb_path: str) -> NumpyVectorIndex:
+    """NumPy-индекс активной базы; для базы, собранной без него, строится по коллекции Chroma."""
+    def _load():
+        return NumpyVectorIndex.load(kb_path, KB_NUMPY_DTYPE, KB_NUMPY_SEARCH_DIMS or None, KB_NUMPY_RESCORE_CANDIDATES)
+    index = _load()
+    if index is not None:
+        return index
+    collection = chromadb.PersistentClient(path=kb_path).get_collection(CHROMA_COLLECTION_NAME)
+    NumpyVectorIndex.from_collection(collection, KB_NUMPY_DTYPE, KB_CHROMA_BATCH_SIZE, KB_NUMPY_SEARCH_DIMS or None).save(kb_path)
+    index = _load()
+    logger.info(f"NumPy-индекс (TG) построен по {index.count()} чанкам текущей базы.")
+    return index
+
+def _open_kb_version_sync(kb_path: str) -> KBHandle:
+    """Загружает версию базы: коллекция (Chroma или NumPy) и BM25-индекс."""
+    if KB_VECTOR_BACKEND == "numpy":
+        collection = _load_numpy_index_sync(kb_path)
+        logger.info(f"Загружен NumPy-индекс (TG): '{kb_path}' "
+                    f"({collection.nbytes / 2 ** 20:.1f} МБ в памяти, "
+                    f"{collection.search_dtype} × {collection.search_dims}).")
+    else:
+        collection = chromadb.PersistentClient(path=kb_path).get_or_create_collection(name=CHROMA_COLLECTION_NAME)
+        logger.info(f"Успешно подключено к ChromaDB (TG): '{kb_path}'. Коллекция: '{CHROMA_COLLECTION_NAME}'.")
+    logger.info(f"Документов в активной коллекции (TG): {collection.count()}")
+    keyword_index = None
+    if KB_HYBRID_SEARCH:
+        try:
+            keyword_index = _load_keyword_index_sync(kb_path, collection)
+        except Exception as e_index:
+            logger.error(f"BM25-индекс (TG) недоступен, поиск только векторный: {e_index}", exc_info=True)
+    return KBHandle(kb_path, collection, keyword_index)
 
-            # Проверяем, является ли сохраненное значение полным путем или относительным
-            # Это для обратной совместимости, если раньше сохранялся относительный путь
-            potential_full_path = active_subdir_or_fullname
-            if not os.path.isabs(potential_full_path): # Если это не абсолютный путь
-                 potential_full_path = os.path.join(VECTOR_DB_BASE_PATH, active_subdir_or_fullname)
-            
-            if os.path.isdir(potential_full_path): 
-                logger.info(f"Найдена активная директория БД (TG): '{potential_full_path}'")
-                return potential_full_path
-            else: 
-                logger.warning(f"В файле '{ACTIVE_DB_INFO_FILE}' (TG) указан путь '{active_subdir_or_fullname}', но директория '{potential_full_path}' не существует.")
-                return None
-        else: 
-            logger.info(f"Файл информации об активной БД '{ACTIVE_DB_INFO_FILE}' (TG) не найден.")
+async def _initialize_active_vector_collection_telegram(only_if_changed: bool = False) -> Optional[KBHandle]:
+    """
+    Загружает активную версию базы и подменяет ею текущую (kb_registry.swap).
+
+    Запросы, начатые до подмены, дочитывают старую версию; её директория
+    удаляется, когда они завершатся.
+
+    only_if_changed=True (слежение за указателем): ничего не делать, если
+    активна уже загруженная версия, и оставить текущую, если новая не загрузилась.
+
+    Returns:
+        Предыдущую версию (None, если её не было или подмены не было)
+    """
+    global vector_collection, active_kb_version, kb_keyword_index, kb_reload_lock
+    if kb_reload_lock is None:
+        kb_reload_lock = asyncio.Lock()
+    async with kb_reload_lock:
+        active_db_full_path = _get_active_db_full_path_telegram()
+        current = kb_registry.current
+        if only_if_changed and (not active_db_full_path or (current is not None and current.path == active_db_full_path)):
             return None
-    except Exception as e:
-        logger.error(f"Ошибка при чтении файла информации об активной БД (TG): {e}", exc_info=True)
-        return None
+        handle = None
+        if active_db_full_path:
+            try:
+                handle = await asyncio.to_thread(_open_kb_version_sync, active_db_full_path)
+            except Exception as e:
+                logger.error(f"Ошибка инициализации ChromaDB (TG) для пути '{active_db_full_path}': {e}. Поиск по базе знаний будет недоступен.", exc_info=True)
+        else:
+            logger.warning("Не удалось определить активную директорию БД (TG). База знаний будет недоступна.")
+        if handle is None and only_if_changed:
+            logger.error(f"Новая версия базы (TG) '{active_db_full_path}' не загрузилась — остаётся текущая.")
+            return None
+        previous = kb_registry.swap(handle)
+        # Глобальные переменные — для проверок «база есть» и отчётов; запросы берут версию через kb_registry.pin()
+        vector_collection = handle.collection if handle else None
+        kb_keyword_index = handle.keyword_index if handle else None
+        active_kb_version = os.path.basename(active_db_full_path) if active_db_full_path else None
+        return previous
+
+async def watch_active_kb_telegram():
+    """
+    Подхватывает базу, собранную другим процессом (update_kb.py), без перезапуска бота.
 
-async def _initialize_active_vector_collection_telegram():
-    global vector_collection
-    active_db_full_path = _get_active_db_full_path_telegram()
-    if active_db_full_path:
+    Раз в KB_RELOAD_POLL_SECONDS сравнивает отпечаток (stat) файла-указателя
+    активной базы; если он изменился и указывает на другую версию — загружает
+    её и подменяет текущую. Старую директорию удаляет kb_registry, когда её
+    дочитают запросы.
+    """
+    logger.info(f"Слежение за активной базой знаний (TG) запущено (раз в {KB_RELOAD_POLL_SECONDS} с).")
+    last_signature = kb_builder.active_pointer_signature(KB_BUILD_CONFIG)
+    while True:
         try:
-            def _init_chroma():
-                chroma_client_init = chromadb.PersistentClient(path=active_db_full_path)
-                return chroma_client_init.get_or_create_collection(
-                    name=CHROMA_COLLECTION_NAME,
-                )
-            vector_collection = await asyncio.to_thread(_init_chroma)
-            logger.info(f"Успешно подключено к ChromaDB (TG): '{active_db_full_path}'. Коллекция: '{CHROMA_COLLECTION_NAME}'.")
-            if vector_collection:
-                count = await asyncio.to_thread(vector_collection.count)
-                logger.info(f"Документов в активной коллекции (TG) при старте: {count}")
+            await asyncio.sleep(KB_RELOAD_POLL_SECONDS)
+            signature = kb_builder.active_pointer_signature(KB_BUILD_CONFIG)
+            if signature == last_signature:
+                continue
+            previous = await _initialize_active_vector_collection_telegram(only_if_changed=True)
+            # Отпечаток запоминаем, только когда загружена версия из указателя:
+            # если загрузка не удалась, на следующем опросе пробуем снова
+            active_db_full_path = _get_active_db_full_path_telegram()
+            current = kb_registry.current
+            if active_db_full_path and (current is None or current.path != active_db_full_path):
+                logger.warning(f"Версия '{active_db_full_path}' (TG) не загружена, повтор через {KB_RELOAD_POLL_SECONDS} с.")
+                continue
+            last_signature = signature
+            if previous is not None:
+                logger.info(f"Активная база знаний (TG): {active_kb_version} (была {previous.version}).")
+        except asyncio.CancelledError:
+            logger.info("Слежение за активной базой знаний (TG) остановлено.")
+            break
         except Exception as e:
-            logger.error(f"Ошибка инициализации ChromaDB (TG) для пути '{active_db_full_path}': {e}. Поиск по базе знаний будет недоступен.", exc_info=True)
-            vector_collection = None
-    else:
-        logger.warning("Не удалось определить активную директорию БД (TG). База знаний будет недоступна.")
-        vector_collection = None
+            logger.error(f"Ошибка слежения за активной базой знаний (TG): {e}", exc_info=True)
 
 # --- Google Drive ---
 drive_service_instance = None # Инициализируется в main
 
+def _build_drive_service_sync():
+    """Новый объект сервиса Google Drive (клиент не потокобезопасен — по одному на поток)."""
+    return kb_builder.build_drive_service(KB_BUILD_CONFIG)
+
 def get_drive_service_sync(): 
     global drive_service_instance
     if drive_service_instance:
         return drive_service_instance
     try:
-        credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE,
-            scopes=['https://www.googleapis.com/auth/drive.readonly']
-        )
-        drive_service_instance = build('drive', 'v3', credentials=credentials)
+        drive_service_instance = _build_drive_service_sync()
         logger.info("Сервис Google Drive инициализирован (синхронно).")
         return drive_service_instance
     except FileNotFoundError:
@@ -434,96 +564,28 @@ def get_drive_service_sync():
         logger.error(f"Ошибка при получении сервиса Google Drive: {e}", exc_info=True)
         return None
 
-def _download_file_content_sync(service, file_id, export_mime_type=None): 
-    if export_mime_type:
-        request = service.files().export_media(fileId=file_id, mimeType=export_mime_type)
-    else:
-        request = service.files().get_media(fileId=file_id)
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done: # Corrected loop condition
-        status, done = downloader.next_chunk()
-        if status: logger.debug(f"Загрузка файла {file_id} (TG): {int(status.progress() * 100)}%.")
-    fh.seek(0)
-    return fh
-
-def read_data_from_drive_sync() -> List[Dict[str,str]]: 
-    service = get_drive_service_sync()
-    if not service:
-        logger.error("Чтение из Google Drive (TG) невозможно: сервис не инициализирован.")
-        return []
-    
-    result_docs: List[Dict[str,str]] = []
-    try:
-        files_response = service.files().list(
-            q=f"'{FOLDER_ID}' in parents and trashed=false",
-            fields="files(id, name, mimeType)", pageSize=1000
-        ).execute()
-        files = files_response.get('files', [])
-        logger.info(f"Найдено {len(files)} файлов в папке Google Drive (TG).")
-
-        downloader_map = {
-            'application/vnd.google-apps.document': lambda s, f_id: download_google_doc_sync(s, f_id),
-            'application/pdf': lambda s, f_id: download_pdf_sync(s, f_id),
-            'application/vnd.openxmlformats-officedocument.wordprocessingml.document': lambda s, f_id: download_docx_sync(s, f_id),
-            'text/plain': lambda s, f_id: download_text_sync(s, f_id),
-            'text/markdown': lambda s, f_id: download_text_sync(s, f_id),
-        }
-
-        for file_item in files:
-            file_id, mime_type, file_name = file_item['id'], file_item['mimeType'], file_item['name']
-            if mime_type in downloader_map:
-                logger.info(f"Обработка файла (TG): '{file_name}' (ID: {file_id}, Type: {mime_type})")
-                try:
-                    content_str = downloader_map[mime_type](service, file_id)
-                    if content_str and content_str.strip():
-                        result_docs.append({'name': file_name, 'content': content_str})
-                        logger.info(f"Успешно прочитан файл (TG): '{file_name}' ({len(content_str)} симв)")
-                    else:
-                        logger.warning(f"Файл '{file_name}' (TG) пуст или не удалось извлечь контент.")
-                except Exception as e_read_file:
-                    logger.error(f"Ошибка чтения файла '{file_name}' (TG): {e_read_file}", exc_info=True)
-            else:
-                logger.debug(f"Файл '{file_name}' (TG) имеет неподдерживаемый тип ({mime_type}).")
-    except Exception as e:
-        logger.error(f"Критическая ошибка при чтении из Google Drive (TG): {e}", exc_info=True)
-        return []
-    logger.info(f"Чтение из Google Drive (TG) завершено. Прочитано {len(result_docs)} документов.")
-    return result_docs
-
-def download_google_doc_sync(service, file_id) -> str: 
-    fh = _download_file_content_sync(service, file_id, export_mime_type='text/plain')
-    return fh.getvalue().decode('utf-8', errors='ignore')
+def list_drive_files_sync(drive_state: Optional[Dict[str, Any]] = None) -> Optional[tuple]:
+    """
+    Поддерживаемые файлы папки базы знаний (со всеми подпапками), см. kb_builder.list_drive_files.
 
-def download_pdf_sync(service, file_id) -> str: 
-    fh = _download_file_content_sync(service, file_id)
-    try:
-        pdf_reader = PyPDF2.PdfReader(fh)
-        return "".join(page.extract_text() + "\n" for page in pdf_reader.pages if page.extract_text())
-    except Exception as e:
-         logger.error(f"Ошибка обработки PDF (ID: {file_id}, TG): {e}", exc_info=True)
-         return ""
+    Returns:
+        (файлы, новое состояние для манифеста) или None при ошибке Drive
+    """
+    return kb_builder.list_drive_files(get_drive_service_sync(), FOLDER_ID, drive_state)
 
-def download_docx_sync(service, file_id) -> str: 
-    fh = _download_file_content_sync(service, file_id)
-    try:
-        doc = docx.Document(fh)
-        return "\n".join(paragraph.text for paragraph in doc.paragraphs if paragraph.text)
-    except Exception as e:
-         logger.error(f"Ошибка обработки DOCX (ID: {file_id}, TG): {e}", exc_info=True)
-         return ""
+def read_data_from_drive_sync(files: Optional[List[Dict[str, str]]] = None) -> List[Dict[str,str]]: 
+    """
+    Скачивает файлы базы знаний (по умолчанию — все из папки) параллельно,
+    см. tools/drive_ingest.py.
 
-def download_text_sync(service, file_id) -> str: 
-    fh = _download_file_content_sync(service, file_id)
-    try:
-        return fh.getvalue().decode('utf-8')
-    except UnicodeDecodeError:
-         logger.warning(f"Не удалось декодировать {file_id} (TG) как UTF-8, пробуем cp1251.")
-         try: return fh.getvalue().decode('cp1251', errors='ignore')
-         except Exception as e_decode:
-              logger.error(f"Не удалось декодировать {file_id} (TG): {e_decode}")
-              return ""
+    Returns:
+        Описания файлов из списка Drive с добавленным 'content' (может быть
+        пустым); файлы, которые не удалось скачать, в результат не попадают
+    """
+    if files is None:
+        listing = list_drive_files_sync()
+        files = listing[0] if listing else []
+    return kb_builder.read_drive_files(files, _build_drive_service_sync, KB_BUILD_CONFIG)
 
 # --- Helper Functions ---
 
@@ -708,6 +770,17 @@ async def process_buffered_messages(user_id: int, chat_id: int, business_connect
 
 # --- OpenAI Assistant Interaction ---
 async def chat_with_assistant(user_id: int, user_input: str) -> str:
+    # Верификация, выбранный ребёнок и данные клиента разрешаются один раз
+    # на сообщение и переиспользуются всеми tool calls
+    request_ctx = RequestContext(user_id, current_child_context.get(user_id))
+    with use_request_context(request_ctx):
+        try:
+            return await _chat_with_assistant(user_id, user_input, request_ctx)
+        finally:
+            logger.info(f"chat_with_assistant(user:{user_id}): контекст запроса — {request_ctx.summary()}")
+
+
+async def _chat_with_assistant(user_id: int, user_input: str, request_ctx: RequestContext) -> str:
     log_prefix = f"chat_with_assistant(user:{user_id}):"
     logger.info(f"{log_prefix} Запрос: {user_input[:100]}...")
     
@@ -722,6 +795,32 @@ async def chat_with_assistant(user_id: int, user_input: str) -> str:
     if current_topic:
         logger.info(f"{log_prefix} Текущая тема диалога: '{current_topic}'")
     
+    # Типовой вопрос неверифицированного пользователя в начале диалога —
+    # ищем готовый ответ на близкий вопрос, не обращаясь к модели
+    cache_embedding = None
+    cache_fingerprint = None
+    if ANSWER_CACHE_ENABLED and USE_OPENAI_RESPONSES:
+        try:
+            is_verified_user = request_ctx.has_any_verification()
+        except Exception as e_verif:
+            # Файл верификаций не прочитался — общий кэш ответов такому пользователю не отдаём
+            logger.error(f"{log_prefix} Не удалось проверить верификацию: {e_verif}")
+            is_verified_user = True
+        if is_verified_user or not _is_fresh_dialog(user_id):
+            answer_cache.bypassed += 1
+        else:
+            cache_query = f"{current_topic} {user_input}" if current_topic else user_input
+            cache_embedding = await get_query_embedding_telegram(cache_query)
+            if cache_embedding is not None:
+                cache_fingerprint = answer_fingerprint(active_kb_version, SYSTEM_INSTRUCTIONS, OPENAI_MODEL)
+                cached_answer = answer_cache.get(cache_embedding, cache_fingerprint)
+                if cached_answer:
+                    logger.info(f"{log_prefix} ♻️ Ответ взят из кэша ответов")
+                    await add_message_to_history(user_id, "user", user_input)
+                    await add_message_to_history(user_id, "assistant", cached_answer)
+                    await log_context_telegram(user_id, user_input, "", f"[КЭШ ОТВЕТОВ] {cached_answer}")
+                    return cached_answer
+    
     context = ""
     if USE_VECTOR_STORE and vector_collection:
         logger.debug(f"{log_prefix} Попытка получить контекст из векторной базы...")
@@ -754,8 +853,7 @@ async def chat_with_assistant(user_id: int, user_input: str) -> str:
     # Проверяем, верифицирован ли клиент, и если да - добавляем данные о родителе и ребёнке
     client_context_info = ""
     try:
-        from tools.verification_tools import get_client_context
-        client_ctx = get_client_context(user_id)
+        client_ctx = request_ctx.client_context()
         
         if client_ctx.get("is_verified") and client_ctx.get("login"):
             # Клиент верифицирован - формируем контекст
@@ -868,6 +966,7 @@ async def chat_with_assistant(user_id: int, user_input: str) -> str:
             MAX_TOOL_ITERATIONS = 5  # Максимум итераций tool calls
             iteration = 0
             assistant_response_content = None
+            tools_used = False
             
             while iteration < MAX_TOOL_ITERATIONS:
                 iteration += 1
@@ -890,36 +989,21 @@ async def chat_with_assistant(user_id: int, user_input: str) -> str:
                 
                 # Проверяем, есть ли tool calls в ответе
                 if has_tool_calls(resp):
+                    tools_used = True
                     tool_calls = parse_tool_calls_from_response(resp)
                     logger.info(f"{log_prefix} Получено {len(tool_calls)} tool calls")
                     
                     # 🔑 Устанавливаем user_id для контекста выполнения tools
                     set_current_user_id(user_id)
                     
-                    # Выполняем все tool calls
-                    tool_results = []
-                    for tc in tool_calls:
-                        # 🔧 ВАРИАНТ 4: Проверяем, есть ли ошибка парсинга
-                        if "_error" in tc:
-                            # Возвращаем ошибку как результат tool call
-                            error_result = {
-                                "success": False,
-                                "error": tc["_error"],
-                                "message": "Не удалось обработать запрос. Попробуйте сформулировать короче."
-                            }
-                            tool_results.append(error_result)
-                            logger.warning(f"{log_prefix} Tool {tc['name']} имеет ошибку парсинга: {tc['_error'][:100]}")
-                            continue
-                        
-                        # 🔑 ПЕРЕДАЁМ ТЕКУЩИЙ КОНТЕКСТ РЕБЁНКА
-                        current_child = current_child_context.get(user_id)
-                        
-                        result = execute_tool_call(
-                            tc["name"], 
-                            tc["arguments"],
-                            current_child_login=current_child
-                        )
-                        
+                    # Выполняем tool calls вне event loop: независимые — параллельно
+                    tool_results = await execute_tool_calls(
+                        tool_calls,
+                        current_child_login=request_ctx.current_child_login,
+                        request_context=request_ctx
+                    )
+                    
+                    for tc, result in zip(tool_calls, tool_results):
                         # 💾 СОХРАНЯЕМ ВЫБОР РЕБЁНКА
                         if tc["name"] == "set_active_child" and result.get("success"):
                             selected_login = result.get("login")
@@ -927,7 +1011,6 @@ async def chat_with_assistant(user_id: int, user_input: str) -> str:
                                 current_child_context[user_id] = selected_login
                                 logger.info(f"✅ User {user_id} выбрал ребёнка: {selected_login}")
                         
-                        tool_results.append(result)
                         logger.debug(f"{log_prefix} Tool {tc['name']}: {json.dumps(result, ensure_ascii=False)[:200]}...")
                     
                     # Добавляем результаты в input для следующего запроса
@@ -959,6 +1042,9 @@ async def chat_with_assistant(user_id: int, user_input: str) -> str:
             if assistant_response_content:
                 await add_message_to_history(user_id, "assistant", assistant_response_content)
                 await log_context_telegram(user_id, user_input, context, assistant_response_content)
+                # Ответы с вызовом tools могут зависеть от пользователя — их не кэшируем
+                if cache_embedding is not None and not tools_used:
+                    answer_cache.put(cache_embedding, assistant_response_content, cache_fingerprint)
                 return assistant_response_content
             
             logger.warning(f"{log_prefix} Ответ от Responses API пуст.")
@@ -978,6 +1064,35 @@ async def chat_with_assistant(user_id: int, user_input: str) -> str:
     return "Ошибка конфигурации системы. Обратитесь к администратору."
 
 # --- Vector Store Management (ChromaDB) ---
+async def get_query_embedding_telegram(query: str) -> Optional[List[float]]:
+    """Эмбеддинг запроса (из кэша или через OpenAI); None при ошибке API."""
+    query_embedding = query_embedding_cache.get_from_memory(query)
+    if query_embedding is None:
+        query_embedding = await asyncio.to_thread(query_embedding_cache.get_from_disk, query)
+    if query_embedding is not None:
+        logger.debug(f"Эмбеддинг для запроса (TG) '{query[:50]}...' взят из кэша.")
+        return query_embedding
+    try:
+        query_embedding_response = await openai_client.embeddings.create(
+             input=[query], model=OPENAI_EMBEDDING_MODEL, dimensions=OPENAI_EMBEDDING_DIMENSIONS
+        )
+    except Exception as e_embed:
+        logger.error(f"Ошибка создания эмбеддинга (TG): {e_embed}", exc_info=True)
+        return None
+    query_embedding = query_embedding_response.data[0].embedding
+    query_embedding_cache.put_in_memory(query, query_embedding)
+    await asyncio.to_thread(query_embedding_cache.put_on_disk, query, query_embedding)
+    logger.debug(f"Эмбеддинг для запроса (TG) '{query[:50]}...' создан.")
+    return query_embedding
+
+def _is_fresh_dialog(user_id: int) -> bool:
+    """Пользователь давно не писал: прошлые сообщения не влияют на ответ по существу."""
+    history = user_messages.get(user_id)
+    if not history:
+        return True
+    gap = datetime.datetime.now() - history[-1]['timestamp']
+    return gap > datetime.timedelta(minutes=ANSWER_CACHE_DIALOG_GAP_MINUTES)
+
 async def get_relevant_context_telegram(
     query: str, 
     k: int,
@@ -1009,33 +1124,31 @@ async def get_relevant_context_telegram(
             logger.debug(f"   Исходный запрос: '{query}'")
             logger.debug(f"   Расширенный: '{enhanced_query}'")
         
-        try:
-            query_embedding_response = await openai_client.embeddings.create(
-                 input=[enhanced_query], model=OPENAI_EMBEDDING_MODEL, dimensions=OPENAI_EMBEDDING_DIMENSIONS
-            )
-            query_embedding = query_embedding_response.data[0].embedding
-            logger.debug(f"Эмбеддинг для запроса (TG) '{enhanced_query[:50]}...' создан.")
-        except Exception as e_embed:
-            logger.error(f"Ошибка создания эмбеддинга (TG): {e_embed}", exc_info=True)
+        query_embedding = await get_query_embedding_telegram(enhanced_query)
+        if query_embedding is None:
             return ""
 
-        def _query_chroma():
-            return vector_collection.query(query_embeddings=[query_embedding], n_results=k, include=["documents", "metadatas"]) # Убрали distances для упрощения
-        results = await asyncio.to_thread(_query_chroma)
-        logger.debug(f"Поиск в ChromaDB (TG) для '{enhanced_query[:50]}...' выполнен.")
-
-        if not results or not results.get("ids") or not results["ids"][0] or \
-           not results.get("documents") or not results["documents"][0]:
+        def _search():
+            # Версия базы закреплена на время поиска: подмена при обновлении её не удалит
+            with kb_registry.pin() as kb:
+                if kb is None:
+                    return [], "none"
+                # Точные обозначения (коды программ, филиалы) находит BM25, смысл — векторы
+                mode = "hybrid" if KB_HYBRID_SEARCH and kb.keyword_index is not None else "dense"
+                return hybrid_search(kb.collection, kb.keyword_index, enhanced_query, query_embedding, k,
+                                     candidates=KB_SEARCH_CANDIDATES, mode=mode), mode
+        found, search_mode = await asyncio.to_thread(_search)
+        logger.debug(f"Поиск в ChromaDB (TG, {search_mode}) для '{enhanced_query[:50]}...' выполнен.")
+
+        if not found:
             logger.info(f"Релевантных документов (TG) не найдено для: '{query[:50]}...'")
             return ""
 
-        documents = results["documents"][0]
-        metadatas = results["metadatas"][0] if results.get("metadatas") and results["metadatas"][0] else [{}] * len(documents)
         context_pieces = []
-        logger.info(f"Найдено {len(documents)} док-в (TG) для '{query[:50]}...'. Топ {k}:")
-        for i, doc_content in enumerate(documents):
-            meta = metadatas[i] if i < len(metadatas) else {}
-            source = meta.get('source', 'Неизвестный источник')
+        logger.info(f"Найдено {len(found)} док-в (TG) для '{query[:50]}...'. Топ {k}:")
+        for i, chunk in enumerate(found):
+            doc_content = chunk["document"]
+            source = chunk["metadata"].get('source', 'Неизвестный источник')
             logger.info(f"  #{i+1} (TG): Источник='{source}', Контент='{doc_content[:100]}...'")
             context_pieces.append(f"Из документа '{source}':\n{doc_content}")
 
@@ -1045,143 +1158,80 @@ async def get_relevant_context_telegram(
         logger.error(f"Непредвиденная ошибка при получении контекста (TG): {e}", exc_info=True)
         return ""
 
-async def update_vector_store_telegram(chat_id_to_notify: Optional[int] = None) -> Dict[str, Any]:
-    logger.info("--- Запуск обновления базы знаний (TG) ---")
-    os.makedirs(VECTOR_DB_BASE_PATH, exist_ok=True)
-    timestamp_dir_name = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f") + "_new_tg"
-    new_db_subpath = timestamp_dir_name 
-    new_db_full_path = os.path.join(VECTOR_DB_BASE_PATH, new_db_subpath)
-    logger.info(f"Новая директория для БД (TG): {new_db_full_path}")
+def _make_kb_progress_reporter(chat_id: int):
+    """Прогресс эмбеддингов одним сообщением в чате, которое обновляется не чаще KB_PROGRESS_INTERVAL_SECONDS."""
+    state = {"message": None, "last": 0.0, "done": -1}
+    # Пакеты эмбеддингов завершаются параллельно: без лока два первых отчёта
+    # успели бы отправить два сообщения, а поздний отчёт — откатить прогресс
+    lock = asyncio.Lock()
+
+    async def report(done: int, total: int):
+        async with lock:
+            now = time.time()
+            if done <= state["done"] or (done < total and now - state["last"] < KB_PROGRESS_INTERVAL_SECONDS):
+                return
+            state["last"], state["done"] = now, done
+            text = f"⏳ Эмбеддинги базы знаний: {done}/{total} чанков ({done / total:.0%})"
+            if state["message"] is None:
+                state["message"] = await bot.send_message(chat_id, text)
+            else:
+                await bot.edit_message_text(text, chat_id=chat_id, message_id=state["message"].message_id)
+
+    return report
+
+def _format_kb_update_details(update_result: Dict[str, Any]) -> str:
+    """Строки отчёта об обновлении БЗ про инкрементальный режим."""
+    mode = update_result.get("mode")
+    if mode == "unchanged":
+        return "♻️ Файлы на Google Drive не изменились, база не пересобиралась\n"
+    if mode == "incremental":
+        return (f"🔁 Изменено файлов: {update_result.get('changed_files', 0)}, удалено: {update_result.get('removed_files', 0)}, "
+                f"без изменений: {update_result.get('unchanged_files', 0)}\n"
+                f"🧮 Эмбеддингов запрошено: {update_result.get('embedded_chunks', 0)} "
+                f"(повторно использовано: {update_result.get('reused_embeddings', 0) + update_result.get('copied_chunks', 0)})\n"
+                + _format_chunk_cache_stats(update_result))
+    return _format_chunk_cache_stats(update_result)
+
+def _format_chunk_cache_stats(update_result: Dict[str, Any]) -> str:
+    cache_stats = update_result.get("embedding_cache")
+    if not cache_stats:
+        return ""
+    return (f"🗄 Кэш эмбеддингов чанков: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}, "
+            f"записей {cache_stats['entries']} ({cache_stats['size_mb']} МБ)\n")
 
-    previous_active_full_path = _get_active_db_full_path_telegram() 
+async def update_vector_store_telegram(chat_id_to_notify: Optional[int] = None, full_rebuild: bool = False) -> Dict[str, Any]:
+    """
+    Обновляет базу знаний из Google Drive (kb_builder.update_knowledge_base) и подменяет ею текущую.
 
-    try:
-        os.makedirs(new_db_full_path, exist_ok=True)
-    except Exception as e_mkdir:
-        logger.error(f"Не удалось создать директорию '{new_db_full_path}' (TG): {e_mkdir}.", exc_info=True)
-        return {"success": False, "error": f"Failed to create temp dir: {e_mkdir}", "added_chunks": 0, "total_chunks": 0}
+    По умолчанию (KB_INCREMENTAL_UPDATE) скачиваются и разбиваются только
+    изменённые файлы; если на Drive ничего не изменилось, база не
+    пересобирается. full_rebuild=True — собрать всё заново. Одновременно
+    базу обновляет только один писатель (в том числе update_kb.py).
+    """
+    update_result = await kb_builder.update_knowledge_base(
+        openai_client, KB_BUILD_CONFIG, full_rebuild=full_rebuild,
+        on_progress=_make_kb_progress_reporter(chat_id_to_notify) if chat_id_to_notify else None,
+        list_files=list_drive_files_sync, read_files=read_data_from_drive_sync,
+    )
+    if not update_result.get("success") or update_result.get("mode") == "unchanged":
+        return update_result
 
-    temp_vector_collection: Optional[chromadb.api.models.Collection.Collection] = None
-    try:
-        def _init_temp_chroma():
-            temp_chroma_client = chromadb.PersistentClient(path=new_db_full_path)
-            return temp_chroma_client.get_or_create_collection(name=CHROMA_COLLECTION_NAME)
-        temp_vector_collection = await asyncio.to_thread(_init_temp_chroma)
-        logger.info(f"Временная коллекция '{CHROMA_COLLECTION_NAME}' (TG) создана/получена в '{new_db_full_path}'.")
-
-        logger.info("Получение данных из Google Drive (TG)...")
-        documents_data = await asyncio.to_thread(read_data_from_drive_sync)
-        if not documents_data:
-            logger.warning("Документы в Google Drive (TG) не найдены. Обновление отменено.")
-            if os.path.exists(new_db_full_path):
-                await asyncio.to_thread(shutil.rmtree, new_db_full_path)
-            return {"success": False, "error": "No documents in Google Drive", "added_chunks": 0, "total_chunks": 0}
-        
-        logger.info(f"Получено {len(documents_data)} документов из Google Drive (TG).")
-        all_texts, all_metadatas = [], []
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=[("#", "h1"), ("##", "h2"), ("###", "h3")])
-        MD_SECTION_MAX_LEN = 2000 
-
-        for doc_info in documents_data:
-            doc_name, doc_content_str = doc_info['name'], doc_info['content']
-            if not doc_content_str or not doc_content_str.strip():
-                logger.warning(f"Документ '{doc_name}' (TG) пуст.")
-                continue
-            
-            enhanced_doc_content = f"Документ: {doc_name}\n\n{doc_content_str}" # ИСПРАВЛЕНО \n
-            chunk_idx = 0
-            is_md = doc_name.lower().endswith(('.md', '.markdown'))
-            try:
-                target_splits = markdown_splitter.split_text(enhanced_doc_content) if is_md else text_splitter.split_text(enhanced_doc_content)
-                
-                for item_split in target_splits:
-                    page_content = item_split.page_content if isinstance(item_split, Document) else item_split
-                    current_metadata = item_split.metadata if isinstance(item_split, Document) else {}
-                    
-                    if is_md and len(page_content) > MD_SECTION_MAX_LEN and not isinstance(item_split, Document): # Дополнительная проверка для MD без Document
-                        sub_chunks = text_splitter.split_text(page_content)
-                        for sub_chunk_text in sub_chunks:
-                            all_texts.append(sub_chunk_text)
-                            all_metadatas.append({"source": doc_name, **current_metadata, "type": "md_split", "chunk": chunk_idx})
-                            chunk_idx += 1
-                    elif isinstance(item_split, Document) and len(page_content) > MD_SECTION_MAX_LEN : # Если это Document и длинный
-                        sub_chunks = text_splitter.split_text(page_content)
-                        for sub_chunk_text in sub_chunks:
-                            all_texts.append(sub_chunk_text)
-                            all_metadatas.append({"source": doc_name, **current_metadata, "type": "doc_split", "chunk": chunk_idx}) # type: doc_split
-                            chunk_idx +=1
-                    else:
-                        all_texts.append(page_content)
-                        all_metadatas.append({"source": doc_name, **current_metadata, "type": "md" if is_md else "text", "chunk": chunk_idx})
-                        chunk_idx += 1
-                logger.info(f"Документ '{doc_name}' (TG) разбит на {chunk_idx} чанков.")
-            except Exception as e_split:
-                logger.error(f"Ошибка разбиения '{doc_name}' (TG): {e_split}", exc_info=True)
-                try: # Fallback
-                    chunks = text_splitter.split_text(enhanced_doc_content)
-                    chunk_idx_fb = 0 
-                    for chunk_text in chunks:
-                        all_texts.append(chunk_text)
-                        all_metadatas.append({"source": doc_name, "type": "text_fallback", "chunk": chunk_idx_fb})
-                        chunk_idx_fb += 1
-                    logger.info(f"Документ '{doc_name}' (TG) (fallback) разбит на {chunk_idx_fb} чанков.")
-                except Exception as e_fallback: logger.error(f"Ошибка fallback-разбиения '{doc_name}' (TG): {e_fallback}", exc_info=True)
-        
-        if not all_texts:
-            logger.warning("Нет текстовых данных для добавления в базу (TG).")
-            if os.path.exists(new_db_full_path):
-                await asyncio.to_thread(shutil.rmtree, new_db_full_path)
-            return {"success": False, "error": "No text data to add", "added_chunks": 0, "total_chunks": 0}
-
-        logger.info(f"Создание эмбеддингов для {len(all_texts)} чанков (TG)...")
-        embeddings_response = await openai_client.embeddings.create(
-            input=all_texts, model=OPENAI_EMBEDDING_MODEL, dimensions=OPENAI_EMBEDDING_DIMENSIONS
-        )
-        all_embeddings = [item.embedding for item in embeddings_response.data]
-        all_ids = [f"{meta['source']}_{meta.get('type','unk')}_{meta['chunk']}_{i}" for i, meta in enumerate(all_metadatas)] # Упрощенные ID
-
-        if temp_vector_collection:
-            def _add_to_chroma():
-                temp_vector_collection.add(ids=all_ids, embeddings=all_embeddings, metadatas=all_metadatas, documents=all_texts)
-                return temp_vector_collection.count()
-            final_total = await asyncio.to_thread(_add_to_chroma)
-            final_added = len(all_ids)
-            logger.info(f"Успешно добавлено {final_added} чанков (TG). Всего: {final_total}.")
-        else: # Не должно случиться
-            logger.error("temp_vector_collection (TG) не инициализирована!")
-            if os.path.exists(new_db_full_path):
-                await asyncio.to_thread(shutil.rmtree, new_db_full_path)
-            return {"success": False, "error": "temp_vector_collection is None", "added_chunks": 0, "total_chunks": 0}
-
-        active_db_info_filepath = os.path.join(VECTOR_DB_BASE_PATH, ACTIVE_DB_INFO_FILE)
-        with open(active_db_info_filepath, "w", encoding="utf-8") as f: f.write(new_db_subpath) # <--- ИЗМЕНЕНО: сохраняем только имя поддиректории
-        logger.info(f"Подпуть к новой активной базе (TG) '{new_db_subpath}' сохранен в '{active_db_info_filepath}'. Активная директория БД: '{new_db_full_path}'") # <--- ИЗМЕНЕНО: сообщение в логе
-
-        await _initialize_active_vector_collection_telegram()
-        if not vector_collection:
-             logger.error("Критическая ошибка (TG): не удалось перезагрузить vector_collection!")
-             return {"success": False, "error": "Failed to reload global vector_collection", "added_chunks": final_added, "total_chunks": final_total}
-        
-        if previous_active_full_path and previous_active_full_path != new_db_full_path and os.path.exists(previous_active_full_path):
-            try:
-                await asyncio.to_thread(shutil.rmtree, previous_active_full_path)
+    await _initialize_active_vector_collection_telegram()
+    if not vector_collection:
+        logger.error("Критическая ошибка (TG): не удалось перезагрузить vector_collection!")
+        return {**update_result, "success": False, "error": "Failed to reload global vector_collection"}
+
+    # Версии, загружавшиеся в этом процессе (в том числе подхваченные watch_active_kb_telegram),
+    # удаляет только kb_registry — когда их дочитают запросы. Здесь — лишь чужая предыдущая
+    # версия, и только если её не держит загруженной другой процесс (маркер чтения)
+    previous_active_full_path = update_result.get("previous_active_path")
+    if previous_active_full_path and previous_active_full_path != update_result["new_active_path"] \
+            and os.path.exists(previous_active_full_path) and not kb_registry.has_held(previous_active_full_path):
+        try:
+            if await asyncio.to_thread(remove_kb_version, previous_active_full_path):
                 logger.info(f"Удалена предыдущая директория БД (TG): '{previous_active_full_path}'")
-            except Exception as e_rm_old: logger.error(f"Не удалось удалить предыдущую БД (TG) '{previous_active_full_path}': {e_rm_old}", exc_info=True)
-        
-        logger.info("--- Обновление базы знаний (TG) успешно завершено ---")
-        return {"success": True, "added_chunks": final_added, "total_chunks": final_total, "new_active_path": new_db_full_path}
-
-    except openai.APIError as e_openai:
-         logger.error(f"OpenAI API ошибка (TG): {e_openai}", exc_info=True)
-         if os.path.exists(new_db_full_path):
-             await asyncio.to_thread(shutil.rmtree, new_db_full_path)
-         return {"success": False, "error": f"OpenAI API error: {e_openai}", "added_chunks": 0, "total_chunks": 0}
-    except Exception as e_main_update:
-        logger.error(f"Критическая ошибка обновления БЗ (TG): {e_main_update}", exc_info=True)
-        if os.path.exists(new_db_full_path):
-            await asyncio.to_thread(shutil.rmtree, new_db_full_path)
-        return {"success": False, "error": f"Critical update error: {e_main_update}", "added_chunks": 0, "total_chunks": 0}
+        except Exception as e_rm_old: logger.error(f"Не удалось удалить предыдущую БД (TG) '{previous_active_full_path}': {e_rm_old}", exc_info=True)
+    return update_result
 
 # --- Telegram Command Handlers ---
 @router.message(Command("start"))
@@ -1189,15 +1239,16 @@ async def start_command(message: aiogram_types.Message):
     await message.answer("👋 Здравствуйте! Обновляю базу знаний...")
     asyncio.create_task(run_update_and_notify_telegram(message.chat.id))
 
-async def run_update_and_notify_telegram(chat_id: int):
-    logger.info(f"Обновление БЗ (TG) для чата {chat_id}...")
-    update_result = await update_vector_store_telegram(chat_id_to_notify=chat_id)
+async def run_update_and_notify_telegram(chat_id: int, full_rebuild: bool = False):
+    logger.info(f"Обновление БЗ (TG) для чата {chat_id}{' (полная пересборка)' if full_rebuild else ''}...")
+    update_result = await update_vector_store_telegram(chat_id_to_notify=chat_id, full_rebuild=full_rebuild)
     current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     
     user_message = f"🔔 Отчет об обновлении БЗ ({current_time}):\n"
     if update_result.get("success"):
         user_message += (f"✅ Успешно!\n➕ Добавлено: {update_result.get('added_chunks', 'N/A')}\n"
                          f"📊 Всего: {update_result.get('total_chunks', 'N/A')}\n")
+        user_message += _format_kb_update_details(update_result)
         if update_result.get("new_active_path"): user_message += f"📁 Путь: {os.path.basename(update_result['new_active_path'])}" # Показываем только имя папки
     else:
         user_message += f"❌ Ошибка: {update_result.get('error', 'N/A')}"
@@ -1214,8 +1265,10 @@ async def update_knowledge_command(message: aiogram_types.Message):
     if message.from_user.id != ADMIN_USER_ID:
         await message.answer("❌ Нет прав!")
         return
-    await message.answer("🔄 Обновляю базу знаний (TG)...")
-    asyncio.create_task(run_update_and_notify_telegram(ADMIN_USER_ID))
+    # /update full — пересобрать базу целиком, не используя текущую
+    full_rebuild = "full" in (message.text or "").split()[1:]
+    await message.answer("🔄 Пересобираю базу знаний целиком (TG)..." if full_rebuild else "🔄 Обновляю базу знаний (TG)...")
+    asyncio.create_task(run_update_and_notify_telegram(ADMIN_USER_ID, full_rebuild=full_rebuild))
 
 
 @router.message(Command("update_groups"))
@@ -1402,6 +1455,26 @@ async def check_database_command(message: aiogram_types.Message):
             count_direct = await asyncio.to_thread(_direct_count)
             report.append(f"📊 Кол-во записей (прямое): {count_direct}")
         except Exception as e: report.append(f"❌ Ошибка прямого доступа: {e}")
+
+    kb_stats = kb_registry.stats()
+    draining = ', '.join(f"{version} ({refs} запр.)" for version, refs in kb_stats['draining']) or 'нет'
+    report.append(
+        f"🔁 Версия в памяти: {kb_stats['current']}, запросов сейчас: {kb_stats['current_refs']}, "
+        f"подмен: {kb_stats['swaps']}, ждут удаления: {draining}"
+    )
+
+    cache_stats = query_embedding_cache.stats()
+    report.append(
+        f"🧠 Кэш эмбеддингов запросов: попаданий {cache_stats['hits']} (+{cache_stats['disk_hits']} с диска), "
+        f"промахов {cache_stats['misses']}, hit rate {cache_stats['hit_rate']:.0%}"
+    )
+    if ANSWER_CACHE_ENABLED:
+        answer_stats = answer_cache.stats()
+        report.append(
+            f"💬 Кэш ответов: попаданий {answer_stats['hits']}, промахов {answer_stats['misses']}, "
+            f"в обход {answer_stats['bypassed']}, hit rate {answer_stats['hit_rate']:.0%}, "
+            f"записей {answer_stats['entries']}"
+        )
     
     await message.answer("\n".join(report))
 
@@ -1467,10 +1540,8 @@ async def current_child_command(message: aiogram_types.Message):
     current_login = current_child_context[user_id]
     
     # Загружаем данные ребёнка
-    from tools.client_tools import load_clients
-    clients = await asyncio.to_thread(load_clients)
-    
-    client = next((c for c in clients if c.get('login') == current_login), None)
+    from tools.client_tools import get_client_by_login
+    client = await asyncio.to_thread(get_client_by_login, current_login)
     
     if client:
         student = client.get('student', {})
@@ -1645,6 +1716,7 @@ async def daily_database_update_telegram():
                 if update_result.get("success"):
                     msg += (f"✅ Успешно!\n➕ Добавлено: {update_result.get('added_chunks', 'N/A')}\n"
                             f"📊 Всего: {update_result.get('total_chunks', 'N/A')}\n")
+                    msg += _format_kb_update_details(update_result)
                     if update_result.get("new_active_path"): msg += f"📁 Путь: {os.path.basename(update_result['new_active_path'])}"
                 else: msg += f"❌ Ошибка: {update_result.get('error', 'N/A')}"
                 try: await bot.send_message(ADMIN_USER_ID, msg)
@@ -1657,6 +1729,10 @@ async def daily_database_update_telegram():
             logger.error(f"Ошибка в цикле ежедневного обновления БД (TG): {e}", exc_info=True)
             await asyncio.sleep(3600)
 
+async def notify_admin_pyrus_failed(pending_id: int, task: dict, error: str):
+    """Задача снята с очереди Pyrus: клиенту уже ответили, что обращение передано, — сообщаем админу."""
+    await bot.send_message(ADMIN_USER_ID, format_failed_task_alert(pending_id, task, error))
+
 async def periodic_cleanup_telegram():
     logger.info("Задача периодической очистки (TG) запущена.")
     while True:
@@ -1819,6 +1895,12 @@ async def main():
 
     await load_silence_state_from_file()
     
+    # Верификации читаются с диска один раз (с миграцией старого формата)
+    try:
+        logger.info(f"🔐 Загружено верификаций: {load_verification_store()} пользователей")
+    except Exception as e:
+        logger.error(f"Файл верификаций не прочитан, повторим при первом обращении: {e}")
+    
     logger.info("📚 Загрузка векторной базы знаний (ChromaDB)...")
     await _initialize_active_vector_collection_telegram()
     logger.info("✅ Векторная база знаний готова")
@@ -1831,12 +1913,16 @@ async def main():
 
     dp.include_router(router) 
     cleanup_task = asyncio.create_task(periodic_cleanup_telegram())
+    # Отправка задач Pyrus из очереди (create_pyrus_task только ставит их в очередь)
+    pyrus_outbox_task = asyncio.create_task(run_outbox_worker(on_failed=notify_admin_pyrus_failed))
     daily_update_db_task = None
     if ENABLE_DAILY_KB_UPDATE:
         logger.info("Ежедневное авто-обновление БД (TG) включено флагом окружения.")
         daily_update_db_task = asyncio.create_task(daily_database_update_telegram())
     else:
         logger.info("Ежедневное авто-обновление БД (TG) отключено (ENABLE_DAILY_KB_UPDATE_TELEGRAM=False).")
+    # Базу, собранную update_kb.py (systemd/cron), бот подхватывает без перезапуска
+    kb_watch_task = asyncio.create_task(watch_active_kb_telegram()) if KB_RELOAD_POLL_SECONDS > 0 else None
     # --- Запуск автоочистки истории ---
     start_periodic_history_cleanup()
     
@@ -1851,12 +1937,16 @@ async def main():
         logger.info("--- 🛑 Завершение работы Telegram бота (из finally main) ---")
         # Отмена фоновых задач, если они еще не были отменены через shutdown
         if cleanup_task and not cleanup_task.done(): cleanup_task.cancel()
+        if pyrus_outbox_task and not pyrus_outbox_task.done(): pyrus_outbox_task.cancel()
         if daily_update_db_task and not daily_update_db_task.done(): daily_update_db_task.cancel()
+        if kb_watch_task and not kb_watch_task.done(): kb_watch_task.cancel()
 
         # Дожидаемся завершения отмены (учитываем, что daily_update_db_task может быть None)
-        tasks_to_wait = [cleanup_task]
+        tasks_to_wait = [cleanup_task, pyrus_outbox_task]
         if daily_update_db_task:
             tasks_to_wait.append(daily_update_db_task)
+        if kb_watch_task:
+            tasks_to_wait.append(kb_watch_task)
         await asyncio.gather(*tasks_to_wait, return_exceptions=True)
 
         # Закрытие сессии (на случай если shutdown не был вызван или не успел)
@@ -1868,6 +1958,15 @@ async def main():
         except Exception as e:
             logger.warning(f"Ошибка закрытия сессии бота (из finally): {e}")
             
+        # Закрываем соединения с Pyrus
+        try:
+            await close_pyrus_client()
+        except Exception as e:
+            logger.warning(f"Ошибка закрытия клиента Pyrus: {e}")
+        
+        # Дописываем отложенные изменения верификаций
+        flush_verifications()
+            
         # PID-файлы теперь управляются внешним супервизором (start_bot.sh)
         logger.info("--- Telegram бот остановлен ---")
 
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк хранения данных 1С: JSON, бинарный снимок и SQLite.
+
+Генерирует синтетические clients/contracts/transactions, сохраняет их
+во всех форматах и в отдельных процессах замеряет холодную загрузку
+ClientDataStore, время типовых запросов и пиковый RSS.
+
+Использование:
+    python scripts/bench_client_snapshot.py                   # 50 000 клиентов
+    python scripts/bench_client_snapshot.py --clients 5000 --transactions-per-contract 15
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Добавляем корень проекта в путь для импорта
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+from tools.bitrix_sync import JsonItemsWriter
+from tools.client_db import SqliteWriter, db_path
+from tools.client_store import ClientDataStore
+from tools.phone_utils import split_phones
+from tools.snapshot_format import write_snapshot, snapshot_path
+
+LAST_NAMES = ['Иванов', 'Петрова', 'Сидоров', 'Ёлкина', 'Смирнов', 'Кузнецова', 'Попов', 'Соколова']
+FIRST_NAMES = ['Анна', 'Иван', 'Пётр', 'Мария', 'Олег', 'София', 'Артём']
+
+
+def generate(data_dir: str, clients_count: int, per_contract: int):
+    """Пишет одинаковые данные в JSON, бинарный снимок и SQLite."""
+
+    def clients():
+        rng = random.Random(1)
+        for i in range(clients_count):
+            phone = f"8 (9{i % 100:02d}) {i % 10_000_000:07d}"
+            yield {
+                'id': f'client-{i}',
+                'login': str(10000 + i),
+                'student': {
+                    'last_name': f"{rng.choice(LAST_NAMES)}{i % 500}",
+                    'first_name': rng.choice(FIRST_NAMES),
+                    'middle_name': '',
+                    'account': str(10000 + i),
+                    'branch': 'Центр: Свердловский, 84Б',
+                    'group': f'№{i % 400} ОМ Pr4 вт/чт',
+                    'program': 'PE Future',
+                    'teacher': 'Преподаватель',
+                    'bonus': '0',
+                },
+                'contacts': {
+                    'contact_person': 'Иванова Анна Петровна',
+                    'phone': phone,
+                    'email': '',
+                    'phones': split_phones(phone),
+                }
+            }
+
+    def contracts():
+        rng = random.Random(2)
+        for i in range(clients_count):
+            yield {
+                'id': f'contract-{i}',
+                'name': f'Договор {i}',
+                'balance': str(rng.randint(-3000, 5000)),
+                'bonuses': str(rng.randint(0, 500)),
+                'client_id': f'client-{i}',
+            }
+
+    def transactions():
+        rng = random.Random(3)
+        for i in range(clients_count):
+            for j in range(per_contract):
+                yield {
+                    'id': f'trans-{i}-{j}',
+                    'date': f'2025-{j % 12 + 1:02d}-{j % 28 + 1:02d}T10:30:00',
+                    'amount': str(rng.choice([-800, -1200, 3000, 6400])),
+                    'description': 'Расходная накладная: занятие',
+                    'contract_id': f'contract-{i}',
+                }
+
+    for table, records in (('clients', clients), ('contracts', contracts), ('transactions', transactions)):
+        writer = JsonItemsWriter(os.path.join(data_dir, f'{table}.json'), 'bench')
+        for record in records():
+            writer.add(record)
+        writer.close()
+        write_snapshot(snapshot_path(data_dir, table), table, records(), 'bench')
+        writer = SqliteWriter(db_path(data_dir), table, 'bench')
+        for record in records():
+            writer.add(record)
+        writer.close()
+
+
+def run_single(data_format: str, data_dir: str, clients_count: int):
+    """Выполняется в дочернем процессе: загрузка + запросы + метрики."""
+    started = time.perf_counter()
+    snapshot = ClientDataStore(data_dir, data_format).get_snapshot()
+    load_seconds = time.perf_counter() - started
+
+    rng = random.Random(7)
+    logins = [str(10000 + rng.randrange(clients_count)) for _ in range(1000)]
+    digest = hashlib.sha256()
+
+    started = time.perf_counter()
+    for login in logins:
+        client = snapshot.get_client_by_login(login)
+        contract = snapshot.get_contract_for_client(client['id'])
+        transactions = snapshot.get_transactions_for_contract(contract['id'], since='2025-06-01', limit=10)
+        phone_matches = snapshot.find_clients_by_phone(client['contacts']['phones'][0])
+        digest.update(json.dumps([client, contract, transactions, len(phone_matches)], sort_keys=True).encode())
+    lookup_us = (time.perf_counter() - started) / len(logins) * 1e6
+
+    started = time.perf_counter()
+    matches, total = snapshot.name_index.search('Ёлкина12', limit=10)
+    first_name_search_ms = (time.perf_counter() - started) * 1000
+    digest.update(json.dumps([matches, total], sort_keys=True).encode())
+
+    # ru_maxrss в Linux — в килобайтах, в macOS — в байтах
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+
+    print(json.dumps({
+        'load_seconds': load_seconds,
+        'lookup_us': lookup_us,
+        'first_name_search_ms': first_name_search_ms,
+        'max_rss': max_rss,
+        'digest': digest.hexdigest(),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=50_000, help='Количество клиентов (и контрактов)')
+    parser.add_argument('--transactions-per-contract', type=int, default=10, help='Транзакций на контракт')
+    parser.add_argument('--run', choices=['generate', 'json', 'binary', 'sqlite'], help=argparse.SUPPRESS)
+    parser.add_argument('--data-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run == 'generate':
+        generate(args.data_dir, args.clients, args.transactions_per_contract)
+        return
+    if args.run:
+        run_single(args.run, args.data_dir, args.clients)
+        return
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        print(f"Генерация: {args.clients} клиентов, {args.clients * args.transactions_per_contract} транзакций...")
+        # Тоже в отдельном процессе: после fork/exec ru_maxrss дочернего процесса
+        # наследуется от родителя, поэтому родитель должен оставаться маленьким
+        subprocess.run(
+            [sys.executable, __file__, '--run', 'generate', '--data-dir', data_dir,
+             '--clients', str(args.clients),
+             '--transactions-per-contract', str(args.transactions_per_contract)],
+            check=True
+        )
+
+        print(
+            f"\n{'Формат':<8}{'Файлы, МБ':>11}{'Загрузка, мс':>14}"
+            f"{'Запрос, мкс':>13}{'Поиск ФИО*, мс':>16}{'Пик RSS, МБ':>13}"
+        )
+        digests = set()
+        for data_format in ('json', 'binary', 'sqlite'):
+            if data_format == 'sqlite':
+                paths = [db_path(data_dir)]
+            else:
+                ext = 'json' if data_format == 'json' else 'bin'
+                paths = [os.path.join(data_dir, f'{table}.{ext}') for table in ('clients', 'contracts', 'transactions')]
+            size = sum(os.path.getsize(path) for path in paths)
+            output = subprocess.run(
+                [sys.executable, __file__, '--run', data_format, '--data-dir', data_dir,
+                 '--clients', str(args.clients)],
+                check=True, capture_output=True, text=True
+            ).stdout
+            metrics = json.loads(output.strip().splitlines()[-1])
+            digests.add(metrics['digest'])
+
+            print(
+                f"{data_format:<8}{size / 1024 / 1024:>11.1f}"
+                f"{metrics['load_seconds'] * 1000:>14.1f}"
+                f"{metrics['lookup_us']:>13.1f}"
+                f"{metrics['first_name_search_ms']:>16.1f}"
+                f"{metrics['max_rss'] / 1024 / 1024:>13.1f}"
+            )
+
+        print("\n* первый поиск по фамилии (в binary и sqlite включает ленивую сборку индекса ФИО)")
+        print("✅ Результаты запросов совпадают" if len(digests) == 1 else "❌ Результаты запросов различаются")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк сжатия векторов NumpyVectorIndex на нашей базе знаний.
+
+Для каждой конфигурации «тип:измерения» (int8/float16/float32, обрезка
+до первых N измерений, 0 — без обрезки) строит сжатую матрицу первого
+этапа и замеряет:
+    - память под векторы поиска (полные векторы остаются на диске);
+    - recall@k только первого этапа и после точного пересчёта
+      --rescore кандидатов по полным векторам;
+    - p50/p95 времени двухэтапного запроса.
+Эталон — точный поиск по полным float32.
+
+Векторы берутся из активной базы (или --kb-path). Запросы — размеченные
+запросы из --queries (формат scripts/eval_kb_retrieval.py, эмбеддинги
+кэшируются) или, по умолчанию, --sample случайных чанков самой базы.
+Без базы можно прогнать на синтетических векторах (--synthetic).
+
+Использование:
+    python scripts/bench_kb_quantization.py
+    python scripts/bench_kb_quantization.py --queries kb_eval_queries.jsonl -k 3 --rescore 30
+    python scripts/bench_kb_quantization.py --synthetic 20000 --dim 3072 --configs int8:0 int8:512 float16:1024
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# Добавляем корень проекта в путь для импорта
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+import numpy as np
+
+from tools.vector_index import NumpyVectorIndex
+
+DEFAULT_CONFIGS = ['float16:0', 'int8:0', 'float32:256', 'int8:256', 'int8:512', 'float32:1024', 'int8:1024']
+
+
+def load_kb_index(kb_path: str) -> NumpyVectorIndex:
+    index = NumpyVectorIndex.load(kb_path)
+    if index is not None:
+        return index
+    import chromadb
+    collection = chromadb.PersistentClient(path=kb_path).get_collection(
+        os.getenv("CHROMA_COLLECTION_NAME_TELEGRAM", "documents_telegram")
+    )
+    print(f"Файлов NumPy-индекса в {kb_path} нет — векторы читаются из Chroma")
+    return NumpyVectorIndex.from_collection(collection)
+
+
+def synthetic_index(size: int, dim: int) -> NumpyVectorIndex:
+    """Кластеры с убывающей по измерениям дисперсией — грубое подобие эмбеддингов-«матрёшек»."""
+    rng = np.random.default_rng(1)
+    decay = (1.0 / np.sqrt(1 + np.arange(dim) / 64)).astype(np.float32)
+    centers = rng.standard_normal((max(1, size // 50), dim), dtype=np.float32) * decay
+    vectors = centers[rng.integers(0, len(centers), size)] + 0.5 * rng.standard_normal((size, dim), dtype=np.float32) * decay
+    ids = [f"chunk{i}" for i in range(size)]
+    return NumpyVectorIndex.from_embeddings(ids, [''] * size, [{}] * size, vectors)
+
+
+def recall(found, expected) -> float:
+    return float(np.mean([len(set(f) & set(e)) / len(e) for f, e in zip(found, expected)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kb-path', help='директория базы (по умолчанию — активная)')
+    parser.add_argument('--synthetic', type=int, help='вместо базы — столько синтетических векторов')
+    parser.add_argument('--dim', type=int, default=1536, help='размерность синтетических векторов')
+    parser.add_argument('--queries', help='JSONL с запросами (см. scripts/eval_kb_retrieval.py)')
+    parser.add_argument('--sample', type=int, default=200, help='чанков-запросов, если --queries не задан')
+    parser.add_argument('--configs', nargs='+', default=DEFAULT_CONFIGS, help='тип:измерения')
+    parser.add_argument('--rescore', type=int, default=50, help='кандидатов на точный пересчёт')
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        full = synthetic_index(args.synthetic, args.dim)
+        source = f"синтетика {args.synthetic} × {args.dim}"
+    else:
+        from eval_kb_retrieval import active_kb_path
+        kb_path = args.kb_path or active_kb_path()
+        full = load_kb_index(kb_path)
+        source = f"{kb_path} ({full.count()} чанков × {full.matrix.shape[1]})"
+    matrix = np.asarray(full.matrix, dtype=np.float32)
+
+    if args.queries:
+        from eval_kb_retrieval import load_queries, query_embeddings
+        queries = load_queries(args.queries)
+        texts = [f"{q['topic']} {q['query']}" if q.get('topic') else q['query'] for q in queries]
+        query_vectors = np.asarray(query_embeddings(texts, f"{args.queries}.embeddings.json"), dtype=np.float32)
+    else:
+        sample = np.random.default_rng(7).choice(len(matrix), min(args.sample, len(matrix)), replace=False)
+        query_vectors = matrix[sample]
+    k = min(args.k, len(matrix))
+    expected = [full.search(query, k)[0].tolist() for query in query_vectors]
+
+    print(f"Векторы: {source}, запросов: {len(query_vectors)}, top-{k}, пересчёт {args.rescore} кандидатов")
+    print(f"{'Конфигурация':<14}{'Память, МБ':>12}{'Экономия':>10}{'recall 1 этап':>15}"
+          f"{'recall итог':>13}{'p50, мс':>9}{'p95, мс':>9}")
+
+    with tempfile.TemporaryDirectory() as kb_dir:
+        full.save(kb_dir)
+        rows = [('float32:0', None)] + [(config, config.split(':')) for config in args.configs]
+        for config, parsed in rows:
+            dtype, dims = ('float32', 0) if parsed is None else (parsed[0], int(parsed[1]))
+            if dims >= matrix.shape[1]:
+                dims = 0
+            # Как в боте: полные векторы на диске, сжатая матрица в памяти
+            index = NumpyVectorIndex.load(kb_dir, dtype, dims or None, args.rescore)
+            coarse = [index.search(query, k, rescore=False)[0].tolist() for query in query_vectors]
+            latencies, found = [], []
+            for query in query_vectors:
+                started = time.perf_counter()
+                positions, _ = index.search(query, k)
+                latencies.append((time.perf_counter() - started) * 1000)
+                found.append(positions.tolist())
+            latencies.sort()
+            label = 'точный' if parsed is None else config
+            print(f"{label:<14}{index.nbytes / 2 ** 20:>12.1f}{matrix.nbytes / index.nbytes:>9.1f}×"
+                  f"{recall(coarse, expected):>15.3f}{recall(found, expected):>13.3f}"
+                  f"{latencies[len(latencies) // 2]:>9.2f}{latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]:>9.2f}")
+            for name in os.listdir(kb_dir):
+                if name.startswith('kb_search_vectors'):
+                    os.remove(os.path.join(kb_dir, name))
+
+
+if __name__ == '__main__':
+    main()
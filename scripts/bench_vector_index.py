@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк поиска по базе знаний: ChromaDB против NumpyVectorIndex.
+
+Для каждого размера базы генерирует случайные нормированные эмбеддинги,
+записывает их в коллекцию Chroma (как update_vector_store_telegram)
+и в файлы NumpyVectorIndex (точный float32 и двухэтапный int8), затем в отдельных
+процессах замеряет:
+    - импорт библиотеки и открытие базы (холодный старт бота);
+    - p50/p95 времени top-k запроса;
+    - пиковый RSS процесса;
+    - recall@k относительно точного поиска (HNSW в Chroma приближённый;
+      на случайных векторах его recall заметно ниже, чем на настоящих
+      эмбеддингах, у которых есть кластеры).
+
+Использование:
+    python scripts/bench_vector_index.py                       # 1k, 10k, 100k чанков
+    python scripts/bench_vector_index.py --sizes 1000 5000 --dim 3072 --queries 500
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+# Добавляем корень проекта в путь для импорта
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+COLLECTION_NAME = 'documents_telegram'
+BACKENDS = ('chroma', 'numpy', 'numpy8')
+
+
+def _vectors(rng, count: int, dim: int):
+    import numpy as np
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def generate(data_dir: str, size: int, dim: int):
+    """Коллекция Chroma и файлы NumPy-индекса с одинаковыми чанками."""
+    import chromadb
+    import numpy as np
+    from tools.vector_index import NumpyVectorIndex
+
+    rng = np.random.default_rng(1)
+    ids = [f"file{i // 10}_{i % 10}" for i in range(size)]
+    documents = [f"Чанк {i}: " + "текст базы знаний " * 50 for i in range(size)]
+    metadatas = [{"source": f"Документ {i // 10}.md", "file_id": f"file{i // 10}"} for i in range(size)]
+    embeddings = _vectors(rng, size, dim)
+
+    collection = chromadb.PersistentClient(path=data_dir).get_or_create_collection(COLLECTION_NAME)
+    for start in range(0, size, 500):
+        end = start + 500
+        collection.add(ids=ids[start:end], documents=documents[start:end],
+                       metadatas=metadatas[start:end], embeddings=embeddings[start:end])
+    # Полные векторы + сжатая int8-матрица первого этапа
+    NumpyVectorIndex.from_embeddings(ids, documents, metadatas, embeddings, 'int8').save(data_dir)
+
+
+def run_single(backend: str, data_dir: str, dim: int, queries_count: int, k: int):
+    """Выполняется в дочернем процессе: старт + запросы + метрики."""
+    started = time.perf_counter()
+    if backend == 'chroma':
+        import chromadb
+        import_seconds = time.perf_counter() - started
+        collection = chromadb.PersistentClient(path=data_dir).get_collection(COLLECTION_NAME)
+    else:
+        from tools.vector_index import NumpyVectorIndex
+        import_seconds = time.perf_counter() - started
+        collection = NumpyVectorIndex.load(data_dir, 'int8' if backend == 'numpy8' else 'float32')
+    open_seconds = time.perf_counter() - started - import_seconds
+
+    import numpy as np
+    queries = _vectors(np.random.default_rng(7), queries_count, dim)
+    latencies, results = [], []
+    for i, query in enumerate(queries):
+        started = time.perf_counter()
+        response = collection.query(query_embeddings=[query.tolist()], n_results=k, include=['documents', 'metadatas'])
+        latencies.append(time.perf_counter() - started)
+        if i == 0:
+            first_query_seconds = latencies[0]
+        results.append(response['ids'][0])
+
+    # ru_maxrss в Linux — в килобайтах, в macOS — в байтах
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+    latencies_ms = sorted(latency * 1000 for latency in latencies[1:] or latencies)
+    print(json.dumps({
+        'import_seconds': import_seconds,
+        'open_seconds': open_seconds,
+        'first_query_seconds': first_query_seconds,
+        'p50_ms': latencies_ms[len(latencies_ms) // 2],
+        'p95_ms': latencies_ms[min(len(latencies_ms) - 1, int(len(latencies_ms) * 0.95))],
+        'max_rss': max_rss,
+        'results': results,
+    }))
+
+
+def exact_results(data_dir: str, dim: int, queries_count: int, k: int):
+    """Точный top-k перебором — эталон для recall (тоже в дочернем процессе)."""
+    import numpy as np
+    from tools.vector_index import NumpyVectorIndex
+    index = NumpyVectorIndex.load(data_dir)
+    queries = _vectors(np.random.default_rng(7), queries_count, dim)
+    top = np.argsort(-(queries @ index.matrix.T), axis=1)[:, :k]
+    print(json.dumps([[index.ids[p] for p in row] for row in top]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10_000, 100_000], help='Чанков в базе')
+    parser.add_argument('--dim', type=int, default=1536, help='Размерность эмбеддингов')
+    parser.add_argument('--queries', type=int, default=200, help='Запросов на замер')
+    parser.add_argument('-k', type=int, default=10, help='top-k')
+    parser.add_argument('--run', choices=('generate', 'exact') + BACKENDS, help=argparse.SUPPRESS)
+    parser.add_argument('--data-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run == 'generate':
+        generate(args.data_dir, args.sizes[0], args.dim)
+        return
+    if args.run == 'exact':
+        exact_results(args.data_dir, args.dim, args.queries, args.k)
+        return
+    if args.run:
+        run_single(args.run, args.data_dir, args.dim, args.queries, args.k)
+        return
+
+    print(f"{'Чанков':>8} {'Бэкенд':<8}{'Файлы, МБ':>11}{'Импорт, мс':>12}{'Открытие, мс':>14}"
+          f"{'1-й запрос, мс':>16}{'p50, мс':>9}{'p95, мс':>9}{'Пик RSS, МБ':>13}{f'recall@{args.k}':>11}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as data_dir:
+            # Генерация и замеры — в отдельных процессах: ru_maxrss дочернего процесса
+            # наследуется от родителя, поэтому родитель должен оставаться маленьким
+            subprocess.run(
+                [sys.executable, __file__, '--run', 'generate', '--data-dir', data_dir,
+                 '--sizes', str(size), '--dim', str(args.dim)],
+                check=True
+            )
+            expected = json.loads(subprocess.run(
+                [sys.executable, __file__, '--run', 'exact', '--data-dir', data_dir, '--dim', str(args.dim),
+                 '--queries', str(args.queries), '-k', str(args.k)],
+                check=True, capture_output=True, text=True
+            ).stdout)
+            for backend in BACKENDS:
+                if backend == 'chroma':
+                    files = [os.path.join(root, name) for root, _, names in os.walk(data_dir)
+                             for name in names if not name.startswith('kb_')]
+                else:
+                    names = ['kb_vectors.npy', 'kb_chunks.json'] + (['kb_search_vectors.npz'] if backend == 'numpy8' else [])
+                    files = [os.path.join(data_dir, name) for name in names]
+                size_mb = sum(os.path.getsize(path) for path in files) / 2 ** 20
+                output = subprocess.run(
+                    [sys.executable, __file__, '--run', backend, '--data-dir', data_dir, '--dim', str(args.dim),
+                     '--queries', str(args.queries), '-k', str(args.k)],
+                    check=True, capture_output=True, text=True
+                ).stdout
+                metrics = json.loads(output.strip().splitlines()[-1])
+                recall = sum(
+                    len(set(found) & set(exact)) / len(exact) for found, exact in zip(metrics['results'], expected)
+                ) / len(expected)
+                print(
+                    f"{size:>8} {backend:<8}{size_mb:>11.1f}"
+                    f"{metrics['import_seconds'] * 1000:>12.0f}"
+                    f"{metrics['open_seconds'] * 1000:>14.0f}"
+                    f"{metrics['first_query_seconds'] * 1000:>16.1f}"
+                    f"{metrics['p50_ms']:>9.2f}{metrics['p95_ms']:>9.2f}"
+                    f"{metrics['max_rss'] / 2 ** 20:>13.1f}{recall:>11.3f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
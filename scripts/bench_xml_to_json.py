@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк конвертации выгрузки 1С XML → JSON.
+
+Сравнивает потоковый конвертер (BitrixSyncClient.xml_to_json, iterparse)
+с прежним способом (ET.parse всего файла + findall + json.dump(indent=2))
+на синтетическом transactions.xml. Каждый вариант запускается в отдельном
+процессе, чтобы пиковый RSS не смешивался (поэтому родительский процесс
+сам не загружает большие файлы: после fork/exec ru_maxrss наследуется).
+
+Использование:
+    python scripts/bench_xml_to_json.py                # 500 000 транзакций
+    python scripts/bench_xml_to_json.py --count 100000
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+# Добавляем корень проекта в путь для импорта
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+from tools.bitrix_sync import BitrixSyncClient, COMMERCEML_NS
+
+
+def generate_transactions_xml(path: str, count: int):
+    """Пишет синтетический transactions.xml в формате CommerceML."""
+    descriptions = [
+        'Расходная накладная: занятие',
+        'Платеж картой',
+        'Поступление в кассу',
+        'Начисление бонусов',
+    ]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(f'<КоммерческаяИнформация xmlns="{COMMERCEML_NS}" ВерсияСхемы="2.05">\n')
+        f.write('<Транзакции>\n')
+        for i in range(count):
+            f.write(
+                '<Транзакция>'
+                f'<Ид>{i:08d}-0000-0000-0000-000000000000</Ид>'
+                f'<Дата>2025-{i % 12 + 1:02d}-{i % 28 + 1:02d}T10:30:00</Дата>'
+                f'<Сумма>{(i % 50 - 25) * 100}</Сумма>'
+                f'<Описание>{escape(descriptions[i % len(descriptions)])}</Описание>'
+                f'<ИдКонтракта>{i % 3000:08d}-1111-1111-1111-111111111111</ИдКонтракта>'
+                '</Транзакция>\n'
+            )
+        f.write('</Транзакции>\n</КоммерческаяИнформация>\n')
+
+
+def convert_dom(xml_path: str, json_path: str):
+    """Прежний способ: всё дерево и весь список записей в памяти."""
+    client = BitrixSyncClient('', '', '')
+    ns = {'ns': COMMERCEML_NS}
+    root = ET.parse(xml_path).getroot()
+    items = [client._parse_transaction(t, ns) for t in root.findall('.//ns:Транзакция', ns)]
+    data = {'updated_at': datetime.now().isoformat(), 'count': len(items), 'items': items}
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def convert_streaming(xml_path: str, json_path: str):
+    """Потоковый конвертер из bitrix_sync."""
+    client = BitrixSyncClient('', '', '')
+    if not client.xml_to_json(xml_path, json_path, 'transactions'):
+        raise RuntimeError('Потоковая конвертация завершилась с ошибкой')
+
+
+def run_single(mode: str, xml_path: str, json_path: str):
+    """Выполняется в дочернем процессе: конвертирует и печатает метрики."""
+    started = time.perf_counter()
+    {'dom': convert_dom, 'streaming': convert_streaming}[mode](xml_path, json_path)
+    elapsed = time.perf_counter() - started
+
+    # ru_maxrss в Linux — в килобайтах, в macOS — в байтах
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+
+    # Проверяем результат уже после замера памяти
+    with open(json_path, 'r', encoding='utf-8') as f:
+        count = json.load(f)['count']
+
+    print(json.dumps({'seconds': elapsed, 'max_rss': max_rss, 'count': count}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=500_000, help='Количество транзакций')
+    parser.add_argument('--run', choices=['dom', 'streaming'], help=argparse.SUPPRESS)
+    parser.add_argument('--xml', help=argparse.SUPPRESS)
+    parser.add_argument('--json', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_single(args.run, args.xml, args.json)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        xml_path = os.path.join(tmp_dir, 'transactions.xml')
+        print(f"Генерация {args.count} транзакций...")
+        generate_transactions_xml(xml_path, args.count)
+        print(f"XML: {os.path.getsize(xml_path) / 1024 / 1024:.1f} МБ\n")
+
+        print(f"{'Режим':<12}{'Время, с':>12}{'Пик RSS, МБ':>15}{'JSON, МБ':>12}")
+        for mode in ('dom', 'streaming'):
+            json_path = os.path.join(tmp_dir, f'{mode}.json')
+            output = subprocess.run(
+                [sys.executable, __file__, '--run', mode, '--xml', xml_path, '--json', json_path],
+                check=True, capture_output=True, text=True
+            ).stdout
+            metrics = json.loads(output.strip().splitlines()[-1])
+            assert metrics['count'] == args.count
+
+            print(
+                f"{mode:<12}{metrics['seconds']:>12.2f}"
+                f"{metrics['max_rss'] / 1024 / 1024:>15.1f}"
+                f"{os.path.getsize(json_path) / 1024 / 1024:>12.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Проверка загрузки базы знаний из Google Drive на фейковом сервисе.
+
+FakeDriveService повторяет нужную часть API googleapiclient
+(files().list / get_media / export_media, changes().getStartPageToken /
+list(...).execute()): отдаёт список страницами по --page-size, отвечает
+на скачивание с задержкой --latency и ведёт журнал изменений.
+Скрипт проверяет, что tools.drive_ingest обходит все подпапки и страницы,
+скачивает файлы параллельно (время ≈ самого медленного файла, а не сумма),
+извлекает текст из DOCX в пуле процессов, пропускает файлы с ошибкой,
+а по журналу изменений получает тот же список, что и полным обходом.
+
+Использование:
+    python scripts/check_drive_ingest.py
+    python scripts/check_drive_ingest.py --files 200 --latency 0.2 --workers 16
+"""
+
+import argparse
+import io
+import os
+import sys
+import threading
+import time
+
+# Добавляем корень проекта в путь для импорта
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+from tools import drive_ingest
+
+
+class _Request:
+    def __init__(self, func):
+        self._func = func
+
+    def execute(self):
+        return self._func()
+
+
+class _FilesResource:
+    def __init__(self, drive: 'FakeDriveService'):
+        self._drive = drive
+
+    def list(self, q: str, fields: str, pageSize: int, pageToken=None, **kwargs):
+        def run():
+            # q вида "('a' in parents or 'b' in parents) and trashed=false"
+            folder_ids = set(q.split("'")[1::2])
+            items = [
+                self._drive.describe(item_id) for item_id, item in self._drive.items.items()
+                if folder_ids & set(item['parents'])
+            ]
+            start = int(pageToken or 0)
+            size = min(pageSize, self._drive.page_size)
+            response = {'files': items[start:start + size]}
+            if start + size < len(items):
+                response['nextPageToken'] = str(start + size)
+            self._drive.list_calls += 1
+            return response
+        return _Request(run)
+
+    def _download(self, file_id: str) -> bytes:
+        with self._drive.lock:
+            self._drive.active += 1
+            self._drive.max_active = max(self._drive.max_active, self._drive.active)
+        try:
+            time.sleep(self._drive.latency)
+            data = self._drive.items[file_id]['data']
+            if isinstance(data, Exception):
+                raise data
+            return data
+        finally:
+            with self._drive.lock:
+                self._drive.active -= 1
+
+    def get_media(self, fileId: str):
+        return _Request(lambda: self._download(fileId))
+
+    def export_media(self, fileId: str, mimeType: str):
+        return _Request(lambda: self._download(fileId))
+
+
+class _ChangesResource:
+    """page token — номер записи журнала, с которой читать."""
+
+    def __init__(self, drive: 'FakeDriveService'):
+        self._drive = drive
+
+    def getStartPageToken(self, **kwargs):
+        return _Request(lambda: {'startPageToken': str(len(self._drive.log))})
+
+    def list(self, pageToken: str, pageSize: int, **kwargs):
+        def run():
+            start = int(pageToken)
+            end = min(len(self._drive.log), start + min(pageSize, self._drive.page_size))
+            changes = []
+            for item_id in self._drive.log[start:end]:
+                if item_id in self._drive.items:
+                    changes.append({'fileId': item_id, 'removed': False,
+                                    'file': {**self._drive.describe(item_id), 'trashed': False}})
+                else:
+                    changes.append({'fileId': item_id, 'removed': True})
+            self._drive.change_calls += 1
+            if end < len(self._drive.log):
+                return {'changes': changes, 'nextPageToken': str(end)}
+            return {'changes': changes, 'newStartPageToken': str(end)}
+        return _Request(run)
+
+
+class FakeDriveService:
+    """Папки и файлы в памяти: items[id] = {'id', 'name', 'mimeType', 'modifiedTime', 'parents', 'data'}."""
+
+    def __init__(self, page_size: int = 100, latency: float = 0.1):
+        self.items = {}
+        self.page_size = page_size
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.list_calls = 0
+        self.change_calls = 0
+        self.log = []   # id изменённых элементов по порядку
+        self.active = 0
+        self.max_active = 0
+        self.instances = 0
+
+    def add_file(self, file_id: str, name: str, mime_type: str, data, parent: str = 'root', modified: str = '1'):
+        self.items[file_id] = {
+            'id': file_id, 'name': name, 'mimeType': mime_type,
+            'modifiedTime': modified, 'parents': [parent], 'data': data,
+        }
+        self.log.append(file_id)
+
+    def add_folder(self, folder_id: str, parent: str = 'root'):
+        self.add_file(folder_id, folder_id, drive_ingest.FOLDER_MIME_TYPE, None, parent)
+
+    def move(self, item_id: str, parent: str):
+        self.items[item_id]['parents'] = [parent]
+        self.log.append(item_id)
+
+    def delete(self, item_id: str):
+        del self.items[item_id]
+        self.log.append(item_id)
+
+    def describe(self, item_id: str) -> dict:
+        return {key: value for key, value in self.items[item_id].items() if key != 'data'}
+
+    def factory(self) -> 'FakeDriveService':
+        """Фабрика сервиса для read_files (считает созданные «клиенты»)."""
+        with self.lock:
+            self.instances += 1
+        return self
+
+    def files(self) -> _FilesResource:
+        return _FilesResource(self)
+
+    def changes(self) -> _ChangesResource:
+        return _ChangesResource(self)
+
+
+def make_docx(text: str) -> bytes:
+    import docx
+    document = docx.Document()
+    document.add_paragraph(text)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def check_changes(drive: 'FakeDriveService') -> dict:
+    """Изменения в дереве после полного обхода: результат должен совпасть с новым обходом."""
+    page_token = drive_ingest.get_start_page_token(drive)
+    files, folders = drive_ingest.list_tree(drive, 'root')
+
+    drive.add_folder('outside')                     # папка вне базы знаний
+    drive.add_file('out1', 'вне базы.txt', 'text/plain', b'x', parent='outside')
+    drive.add_file('new1', 'новый.txt', 'text/plain', b'x', parent='sub2')
+    drive.add_file('txt0', 'файл 0.txt', 'text/plain', b'x', modified='2')
+    drive.delete('txt1')
+    drive.move('outside', 'sub1')                   # папка с файлом переехала в базу
+    drive.move('sub2b', 'root_other')               # подпапка ушла из базы
+    list_calls_before = drive.list_calls
+
+    changes, new_token = drive_ingest.list_changes(drive, page_token)
+    files, folders = drive_ingest.apply_changes(drive, 'root', files, folders, changes)
+    # Дочитывается только перенесённая папка, остальное дерево не обходится
+    tree_walked = drive.list_calls - list_calls_before > 1
+    expected_files, expected_folders = drive_ingest.list_tree(drive, 'root')
+    return {
+        f"журнал изменений прочитан ({drive.change_calls} запросов)": new_token == str(len(drive.log)),
+        "список по изменениям совпадает с полным обходом": files == expected_files and set(folders) == set(expected_folders),
+        "содержимое перенесённой папки дочитано": 'out1' in files,
+        "файлы ушедшей папки удалены": not any(file_id.startswith('deep') for file_id in files),
+        "изменённый, новый и удалённый файлы учтены": (
+            files['txt0']['modifiedTime'] == '2' and 'new1' in files and 'txt1' not in files
+        ),
+        "дерево заново не обходилось": not tree_walked,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=60)
+    parser.add_argument('--page-size', type=int, default=25)
+    parser.add_argument('--latency', type=float, default=0.2, help='задержка скачивания файла, с')
+    parser.add_argument('--workers', type=int, default=drive_ingest.DRIVE_DOWNLOAD_WORKERS)
+    args = parser.parse_args()
+
+    drive = FakeDriveService(page_size=args.page_size, latency=args.latency)
+    for i in range(args.files):
+        drive.add_file(f"txt{i}", f"файл {i}.txt", 'text/plain', f"Текст файла {i}".encode('utf-8'))
+    drive.add_file('doc', 'Google Doc', drive_ingest.GOOGLE_DOC_MIME_TYPE, "Экспорт Google Doc".encode('utf-8'))
+    drive.add_file('docx1', 'a.docx', drive_ingest.DOCX_MIME_TYPE, make_docx("Текст DOCX 1"))
+    drive.add_file('docx2', 'b.docx', drive_ingest.DOCX_MIME_TYPE, make_docx("Текст DOCX 2"))
+    drive.add_file('broken', 'broken.txt', 'text/plain', IOError("Drive 500"))
+    # Подпапки: sub1, sub2 → sub2b (глубина 2)
+    drive.add_folder('sub1')
+    drive.add_folder('sub2')
+    drive.add_folder('sub2b', parent='sub2')
+    for i in range(3):
+        drive.add_file(f"deep{i}", f"вложенный {i}.txt", 'text/plain', f"Вложенный {i}".encode('utf-8'), parent='sub2b')
+    drive.add_file('sub1file', 'в подпапке.txt', 'text/plain', "В подпапке".encode('utf-8'), parent='sub1')
+
+    tree_files, tree_folders = drive_ingest.list_tree(drive, 'root')
+    files = list(tree_files.values())
+    started = time.perf_counter()
+    docs = drive_ingest.read_files(files, drive.factory, download_workers=args.workers)
+    elapsed = time.perf_counter() - started
+    contents = {doc['id']: doc['content'] for doc in docs}
+
+    rounds = -(-len(files) // args.workers)
+    checks = {
+        f"прочитаны все страницы и подпапки ({drive.list_calls} запросов)": (
+            len(files) == len(drive.items) - 3 and set(tree_folders) == {'root', 'sub1', 'sub2', 'sub2b'}
+        ),
+        "вложенный файл прочитан": contents.get('deep2') == "Вложенный 2",
+        "файлы скачиваются параллельно": drive.max_active > 1 and drive.max_active <= args.workers,
+        f"время ≈ {rounds} задержек, а не {len(files)}": elapsed < args.latency * rounds + 3,
+        "текст DOCX извлечён": contents.get('docx1', '').strip() == "Текст DOCX 1",
+        "Google Doc и txt прочитаны": contents.get('doc') == "Экспорт Google Doc" and contents.get('txt0') == "Текст файла 0",
+        "файл с ошибкой пропущен": 'broken' not in contents and len(docs) == len(files) - 1,
+        "порядок сохранён": [doc['id'] for doc in docs] == [f['id'] for f in files if f['id'] != 'broken'],
+    }
+    print(f"Файлов: {len(files)}, прочитано: {len(docs)}, одновременно: {drive.max_active}, "
+          f"клиентов Drive: {drive.instances}, время: {elapsed:.2f} с (последовательно ≈ {len(files) * args.latency:.1f} с)")
+    checks.update(check_changes(drive))
+    for name, ok in checks.items():
+        print(f"  {'✅' if ok else '❌'} {name}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Проверка пакетного создания эмбеддингов на локальном фейковом сервере.
+
+Поднимает HTTP-сервер с /v1/embeddings, который, как настоящий API,
+отклоняет слишком большие запросы (400), случайно отвечает 429
+(с Retry-After) и 500, перемешивает порядок data и считает одновременные
+запросы. Затем прогоняет tools.embedding_pipeline.embed_texts через
+openai.AsyncOpenAI и проверяет порядок, повторы, лимит параллельности
+и прогресс.
+
+Использование:
+    python scripts/check_embedding_pipeline.py
+    python scripts/check_embedding_pipeline.py --chunks 20000 --error-rate 0.3
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Добавляем корень проекта в путь для импорта
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+import openai
+
+from tools import embedding_pipeline
+from tools.embedding_pipeline import count_tokens, embed_texts
+
+DIMENSIONS = 8
+
+
+def fake_embedding(text: str):
+    """Детерминированный вектор: по нему проверяется, что эмбеддинг от своего текста."""
+    digest = hashlib.sha256(text.encode('utf-8')).digest()
+    return [b / 255 for b in digest[:DIMENSIONS]]
+
+
+class FakeEmbeddingsServer:
+    def __init__(self, max_inputs: int, max_tokens: int, error_rate: float, latency: float):
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self.error_rate = error_rate
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = {429: 0, 500: 0}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, body: dict, headers=None):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with fake.lock:
+                    fake.requests += 1
+                    fake.in_flight += 1
+                    fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+                try:
+                    time.sleep(fake.latency)
+                    texts = payload['input']
+                    tokens = sum(count_tokens(text) for text in texts)
+                    if len(texts) > fake.max_inputs or tokens > fake.max_tokens:
+                        self._reply(400, {"error": {"message": f"too large: {len(texts)} inputs, {tokens} tokens"}})
+                        return
+                    roll = random.random()
+                    if roll < fake.error_rate / 2:
+                        with fake.lock:
+                            fake.errors[429] += 1
+                        self._reply(429, {"error": {"message": "rate limited"}}, {"Retry-After": "0.05"})
+                        return
+                    if roll < fake.error_rate:
+                        with fake.lock:
+                            fake.errors[500] += 1
+                        self._reply(500, {"error": {"message": "server error"}})
+                        return
+                    data = [
+                        {"object": "embedding", "index": i, "embedding": fake_embedding(text)}
+                        for i, text in enumerate(texts)
+                    ]
+                    random.shuffle(data)
+                    self._reply(200, {
+                        "object": "list", "data": data, "model": payload['model'],
+                        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+                    })
+                finally:
+                    with fake.lock:
+                        fake.in_flight -= 1
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+
+async def run_check(args) -> bool:
+    random.seed(args.seed)
+    # Паузы между повторами в проверке не нужны
+    embedding_pipeline.EMBED_RETRY_BACKOFF = 0.01
+
+    words = ["занятие", "абонемент", "филиал", "расписание", "математика", "английский", "стоимость"]
+    texts = [
+        f"Чанк {i}: " + " ".join(random.choice(words) for _ in range(random.randint(20, 200)))
+        for i in range(args.chunks)
+    ]
+    progress = []
+
+    async def on_progress(done, total):
+        progress.append(done)
+
+    with FakeEmbeddingsServer(args.api_max_inputs, args.api_max_tokens, args.error_rate, args.latency) as fake:
+        client = openai.AsyncOpenAI(base_url=fake.base_url, api_key="test")
+        started = time.perf_counter()
+        embeddings = await embed_texts(
+            client, texts, "text-embedding-3-small", DIMENSIONS,
+            max_batch_tokens=args.batch_tokens,
+            max_batch_inputs=args.api_max_inputs,
+            concurrency=args.concurrency,
+            max_retries=20,
+            on_progress=on_progress,
+        )
+        elapsed = time.perf_counter() - started
+
+        # Неповторяемая ошибка: пакет больше лимита сервера отправляется один раз
+        requests_before = fake.requests
+        try:
+            await embed_texts(client, texts[:args.api_max_inputs + 1], "text-embedding-3-small", DIMENSIONS,
+                              max_batch_tokens=10 ** 9, max_batch_inputs=10 ** 9)
+            oversized_rejected = False
+        except openai.BadRequestError:
+            oversized_rejected = fake.requests == requests_before + 1
+        await client.close()
+
+    checks = {
+        "все эмбеддинги на своих местах": embeddings == [fake_embedding(text) for text in texts],
+        f"одновременных запросов ≤ {args.concurrency}": fake.max_in_flight <= args.concurrency,
+        "ошибки 429/500 были и повторены": args.error_rate == 0 or sum(fake.errors.values()) > 0,
+        "прогресс дошёл до конца": progress and progress[-1] == len(texts) and progress == sorted(progress),
+        "400 не повторяется": oversized_rejected,
+    }
+    print(f"Чанков: {len(texts)}, запросов: {fake.requests}, ошибок: {fake.errors}, "
+          f"макс. одновременно: {fake.max_in_flight}, время: {elapsed:.2f} с")
+    for name, ok in checks.items():
+        print(f"  {'✅' if ok else '❌'} {name}")
+    return all(checks.values())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=5000)
+    parser.add_argument('--batch-tokens', type=int, default=20_000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--api-max-inputs', type=int, default=256, help='лимит строк фейкового API')
+    parser.add_argument('--api-max-tokens', type=int, default=30_000, help='лимит токенов фейкового API')
+    parser.add_argument('--error-rate', type=float, default=0.2, help='доля ответов 429/500')
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа, с')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run_check(args)) else 1)
+
+
+if __name__ == '__main__':
+    main()
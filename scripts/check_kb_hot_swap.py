@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Нагрузочная проверка подмены версий базы знаний (tools/kb_versions.py).
+
+Потоки-читатели без пауз ищут по текущей версии так же, как
+get_relevant_context_telegram (KBRegistry.pin() + hybrid_search), а основной
+поток в это время собирает новые версии NumpyVectorIndex в отдельных
+директориях и подменяет их (swap), как update_vector_store_telegram.
+Проверяется, что:
+    - ни один запрос не упал и не остался без результатов;
+    - директория версии существует всё время, пока её читает запрос;
+    - выведенные версии удалены с диска после того, как их дочитали;
+    - текущая версия на месте;
+    - KBWriterLock не пускает второй процесс, пока блокировку держит первый;
+    - другой процесс (update_kb.py) не удаляет версию, загруженную в реестре,
+      и удаляет её, когда реестр её отпустил.
+
+Использование:
+    python scripts/check_kb_hot_swap.py
+    python scripts/check_kb_hot_swap.py --swaps 50 --readers 16 --chunks 5000
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Добавляем корень проекта в путь для импорта
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+import numpy as np
+
+from tools.kb_search import KeywordIndex, hybrid_search
+from tools.kb_versions import KBHandle, KBRegistry, KBWriterLock, remove_kb_version
+from tools.vector_index import NumpyVectorIndex
+
+
+def build_version(base_dir: str, number: int, chunks: int, dim: int) -> KBHandle:
+    """Новая версия базы в своей директории, загруженная как в боте (int8 + пересчёт с диска)."""
+    path = os.path.join(base_dir, f"kb_v{number}")
+    rng = np.random.default_rng(number)
+    ids = [f"v{number}_chunk{i}" for i in range(chunks)]
+    documents = [f"Версия {number}, чанк {i}: расписание филиала {i % 7}" for i in range(chunks)]
+    metadatas = [{"source": f"Документ {i // 10}.md", "version": number} for i in range(chunks)]
+    embeddings = rng.standard_normal((chunks, dim), dtype=np.float32)
+    os.makedirs(path)
+    NumpyVectorIndex.from_embeddings(ids, documents, metadatas, embeddings, 'int8').save(path)
+    collection = NumpyVectorIndex.load(path, 'int8')
+    return KBHandle(path, collection, KeywordIndex(ids, documents))
+
+
+def reader(registry: KBRegistry, stop: threading.Event, dim: int, stats: dict, lock: threading.Lock):
+    rng = np.random.default_rng(threading.get_ident() % 2 ** 32)
+    while not stop.is_set():
+        query = rng.standard_normal(dim, dtype=np.float32).tolist()
+        try:
+            with registry.pin() as kb:
+                if kb is None:
+                    continue
+                exists_before = os.path.isdir(kb.path)
+                found = hybrid_search(kb.collection, kb.keyword_index, "расписание филиала 3", query, 5)
+                # Медленный запрос: подмена успевает произойти, пока версия закреплена
+                time.sleep(0.002)
+                exists_after = os.path.isdir(kb.path)
+            with lock:
+                stats['queries'] += 1
+                if not (exists_before and exists_after):
+                    stats['missing_dir'] += 1
+                if not found or any(not item['id'].startswith(f"{kb.version.split('_')[1]}_") for item in found):
+                    stats['bad_results'] += 1
+        except Exception as e:
+            with lock:
+                stats['errors'] += 1
+                stats.setdefault('first_error', repr(e))
+
+
+def check_writer_lock(base_dir: str) -> dict:
+    """Блокировку держит этот процесс — второй процесс её получить не должен."""
+    lock_path = os.path.join(base_dir, '.kb_update.lock')
+    probe = [sys.executable, __file__, '--try-lock', lock_path]
+    held = KBWriterLock(lock_path)
+    acquired = held.acquire()
+    blocked = subprocess.run(probe, capture_output=True, text=True).stdout.strip()
+    same_process = KBWriterLock(lock_path).acquire()
+    holder = held.holder_pid()
+    held.release()
+    freed = subprocess.run(probe, capture_output=True, text=True).stdout.strip()
+    return {
+        "блокировка писателя взята": acquired,
+        "второй процесс не получил блокировку": blocked == 'busy',
+        "второй писатель в том же процессе не получил блокировку": not same_process,
+        "в файле блокировки PID владельца": holder == os.getpid(),
+        "после освобождения блокировку получает другой процесс": freed == 'acquired',
+    }
+
+
+def check_reader_lock(registry: KBRegistry, base_dir: str, chunks: int, dim: int) -> dict:
+    """Удаление версий из другого процесса (как prune_versions в update_kb.py) уважает маркер чтения."""
+    current_path = registry.current.path
+    probe = [sys.executable, __file__, '--try-remove', current_path]
+    loaded = subprocess.run(probe, capture_output=True, text=True).stdout.strip()
+    loaded_kept = loaded == 'in use' and os.path.isdir(current_path)
+
+    # Версия, которую реестр загрузил и вывел без удаления (новая не загрузилась)
+    extra = build_version(base_dir, 10 ** 6, chunks, dim)
+    registry.swap(extra)
+    registry.swap(None)
+    released = subprocess.run([sys.executable, __file__, '--try-remove', extra.path],
+                              capture_output=True, text=True).stdout.strip()
+    return {
+        "другой процесс не удаляет загруженную версию": loaded_kept,
+        "версию, отпущенную реестром, другой процесс удаляет": released == 'removed' and not os.path.isdir(extra.path),
+        "реестр помнит загружавшиеся версии": registry.has_held(current_path) and registry.has_held(extra.path)
+            and not registry.has_held(os.path.join(base_dir, 'kb_never_loaded')),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--swaps', type=int, default=20, help='сколько раз подменить версию')
+    parser.add_argument('--readers', type=int, default=8, help='потоков-читателей')
+    parser.add_argument('--chunks', type=int, default=2000, help='чанков в версии')
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--try-lock', help=argparse.SUPPRESS)
+    parser.add_argument('--try-remove', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.try_lock:
+        print('acquired' if KBWriterLock(args.try_lock).acquire() else 'busy')
+        return
+    if args.try_remove:
+        print('removed' if remove_kb_version(args.try_remove) else 'in use')
+        return
+
+    with tempfile.TemporaryDirectory() as base_dir:
+        registry = KBRegistry()
+        registry.swap(build_version(base_dir, 0, args.chunks, args.dim))
+        stats = {'queries': 0, 'missing_dir': 0, 'bad_results': 0, 'errors': 0}
+        stats_lock = threading.Lock()
+        stop = threading.Event()
+        threads = [threading.Thread(target=reader, args=(registry, stop, args.dim, stats, stats_lock))
+                   for _ in range(args.readers)]
+        for thread in threads:
+            thread.start()
+
+        started = time.perf_counter()
+        for number in range(1, args.swaps + 1):
+            registry.swap(build_version(base_dir, number, args.chunks, args.dim))
+            time.sleep(0.01)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        # Удаление выведенных версий идёт в фоновых потоках
+        deadline = time.time() + 10
+        while time.time() < deadline and len([n for n in os.listdir(base_dir) if n.startswith('kb_v')]) > 1:
+            time.sleep(0.05)
+        left = sorted(name for name in os.listdir(base_dir) if name.startswith('kb_v'))
+        registry_stats = registry.stats()
+
+        print(f"Подмен: {args.swaps} за {elapsed:.1f} с, запросов: {stats['queries']}, "
+              f"удаление отложено до завершения запросов: {registry_stats['deferred_deletions']} раз")
+        if 'first_error' in stats:
+            print(f"Первая ошибка: {stats['first_error']}")
+        checks = {
+            "запросы выполнялись во время подмен": stats['queries'] > args.swaps,
+            "ни один запрос не упал": stats['errors'] == 0,
+            "результаты всегда из закреплённой версии": stats['bad_results'] == 0,
+            "директория версии не исчезала во время запроса": stats['missing_dir'] == 0,
+            "выведенные версии удалены, текущая на месте": left == [f"kb_v{args.swaps}"],
+            "не осталось версий, ожидающих читателей": registry_stats['draining'] == [] and registry_stats['current_refs'] == 0,
+        }
+        checks.update(check_writer_lock(base_dir))
+        checks.update(check_reader_lock(registry, base_dir, args.chunks, args.dim))
+    for name, ok in checks.items():
+        print(f"  {'✅' if ok else '❌'} {name}")
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Проверка очереди задач Pyrus (tools/pyrus_outbox.py) на локальном фейковом сервере.
+
+Поднимает HTTP-сервер с /auth, /catalogs/<id> и /tasks. Ответ на создание
+задачи задаётся текстом обращения: сервер отвечает кодами из сценария
+(5xx, 429, 4xx) по порядку, затем 200. Задачи ставятся через
+create_pyrus_task и разбираются drain_outbox, как воркером бота.
+Проверяется, что:
+    - 5xx и 429 повторяются с растущей паузой, задача в итоге отправлена;
+    - после 5xx и таймаута чтения клиент сам POST tasks не повторяет (задача
+      могла быть создана) — на каждую попытку очереди ровно один запрос;
+    - 4xx не повторяется, задача сразу снимается с очереди;
+    - после OUTBOX_MAX_ATTEMPTS попыток задача снимается с очереди;
+    - о снятых задачах вызывается on_failed (бот уведомляет администратора);
+    - повтор того же обращения не ставит задачу второй раз, а одинаковый
+      текст двух разных клиентов (через execute_tool_call_async, как в боте,
+      где telegram_user_id убирается из аргументов) — две задачи;
+    - задача, отправка которой прервалась падением бота, после recover()
+      отправляется заново.
+
+Использование:
+    python scripts/check_pyrus_outbox.py
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Добавляем корень проекта в путь для импорта
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+MESSAGE_FIELD_ID = 6
+
+# Текст обращения → коды ответов на попытки создать задачу (дальше — 200)
+SCENARIOS = {
+    "сбой 500 и повтор": [500],
+    "долгий сбой 503": [503] * 3,
+    "лимит 429": [429, 429, 429],
+    "ошибка 400": [400],
+    "сервер лежит": [500] * 100,
+}
+
+# Задача создаётся, но ответ на первую попытку приходит позже таймаута клиента
+SLOW_TEXT = "медленный ответ"
+CLIENT_TIMEOUT = 0.3
+
+
+class FakePyrusServer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # текст обращения → время каждого запроса на создание задачи
+        self.attempts = {}
+        self.created = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, body: dict):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._reply(200, {"items": [{"item_id": 106, "values": ["Центр: Коммуны, 106/1"]}]})
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if self.path.endswith('/auth'):
+                    self._reply(200, {"access_token": "test-token"})
+                    return
+                text = next(f['value'] for f in payload['fields'] if f['id'] == MESSAGE_FIELD_ID)
+                with fake.lock:
+                    times = fake.attempts.setdefault(text, [])
+                    times.append(time.monotonic())
+                    plan = SCENARIOS.get(text, [])
+                    status = plan[len(times) - 1] if len(times) <= len(plan) else 200
+                    if status == 200:
+                        fake.created.append(text)
+                        task_id = len(fake.created)
+                if text == SLOW_TEXT and len(times) == 1:
+                    time.sleep(CLIENT_TIMEOUT * 2)
+                if status == 200:
+                    self._reply(200, {"task": {"id": task_id}})
+                else:
+                    self._reply(status, {"error_message": f"scripted {status}"})
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+
+
+SAME_TEXT = "прошу перезвонить"
+
+
+async def same_text_from_two_clients(base_dir: str) -> dict:
+    """Номера обращений: {пользователь: [первый вызов, повтор]}."""
+    from tools import verification_tools
+    from tools.request_context import RequestContext, use_request_context
+    from tools.tool_executor import execute_tool_call_async
+
+    verification_tools.VERIFICATIONS_FILE = os.path.join(base_dir, 'verified_clients.json')
+    users = {101: '11111', 202: '22222'}
+    for user_id, login in users.items():
+        verification_tools.save_verification(user_id, login)
+
+    pending_ids = {}
+    for user_id in users:
+        for _ in range(2):
+            context = RequestContext(user_id)
+            with use_request_context(context):
+                result = await execute_tool_call_async("create_pyrus_task", {
+                    "branch_name": "Коммуны", "message_text": SAME_TEXT, "telegram_user_id": user_id,
+                })
+            pending_ids.setdefault(user_id, []).append(result.get('pending_id'))
+    return pending_ids
+
+
+def rows(path: str) -> dict:
+    """Состояние очереди в базе: номер → (статус, попыток, ID в Pyrus)."""
+    with sqlite3.connect(path) as conn:
+        return {row[0]: row[1:] for row in conn.execute("SELECT id, status, attempts, task_id FROM outbox")}
+
+
+async def drain_until_idle(outbox, on_failed, timeout: float = 30.0):
+    """Разбирает очередь, пока в ней есть задачи, ожидающие повтора."""
+    from tools.pyrus_outbox import drain_outbox
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await drain_outbox(outbox, on_failed)
+        next_due = outbox.next_due_in()
+        if next_due is None:
+            return
+        await asyncio.sleep(next_due + 0.005)
+
+
+async def run_check(base_dir: str) -> bool:
+    from tools import pyrus_outbox, pyrus_tools
+    from tools.pyrus_outbox import PyrusOutbox
+    from tools.pyrus_tools import close_pyrus_client, create_pyrus_task, format_failed_task_alert
+
+    # Короткие паузы, чтобы проверка шла секунды, а не часы
+    pyrus_tools.PYRUS_MAX_RETRIES = 1
+    pyrus_tools.PYRUS_RETRY_BACKOFF = 0.001
+    pyrus_tools.PYRUS_REQUEST_TIMEOUT = CLIENT_TIMEOUT
+    pyrus_outbox.OUTBOX_RETRY_BASE = 0.05
+    pyrus_outbox.OUTBOX_RETRY_MAX = 0.4
+    pyrus_outbox.OUTBOX_MAX_ATTEMPTS = 5
+
+    path = os.path.join(base_dir, 'pyrus_outbox.db')
+    outbox = PyrusOutbox(path)
+    # create_pyrus_task ставит задачи в общую очередь процесса — подменяем её на временную
+    pyrus_outbox._outbox = outbox
+
+    alerts = []
+
+    async def on_failed(pending_id, task, error):
+        alerts.append((pending_id, format_failed_task_alert(pending_id, task, error)))
+
+    pending = {}
+    for text in list(SCENARIOS) + ["без ошибок", SLOW_TEXT]:
+        result = await create_pyrus_task("Коммуны", text, client_name="Иванова Анна", telegram_user_id=1)
+        pending[text] = result['pending_id']
+
+    # Повтор того же обращения (модель вызвала tool ещё раз)
+    duplicate = await create_pyrus_task("  коммуны ", "Без ошибок", client_name="Иванова Анна", telegram_user_id=1)
+
+    # Два верифицированных клиента с одинаковым текстом — путь бота через tool_executor
+    same_text = await same_text_from_two_clients(base_dir)
+
+    with FakePyrusServer() as fake:
+        pyrus_tools.PYRUS_API_URL = fake.base_url
+        pyrus_tools.PYRUS_LOGIN, pyrus_tools.PYRUS_SECURITY_KEY = "bot", "key"
+
+        await drain_until_idle(outbox, on_failed)
+        state = rows(path)
+
+        # Падение посреди отправки: задача забрана воркером (sending), но не отправлена
+        crashed = await create_pyrus_task("Коммуны", "упали посреди отправки", telegram_user_id=2)
+        claimed = outbox.claim_due()
+        outbox._conn.close()
+        restarted = PyrusOutbox(path)
+        recovered = restarted.recover()
+        await drain_until_idle(restarted, on_failed)
+        crashed_state = rows(path)[crashed['pending_id']]
+
+        await close_pyrus_client()
+
+    # Паузы между попытками очереди (5xx на POST tasks клиент не повторяет — запрос на попытку)
+    outage = fake.attempts["сервер лежит"]
+    gaps = [b - a for a, b in zip(outage, outage[1:])]
+    expected_gaps = [min(pyrus_outbox.OUTBOX_RETRY_MAX, pyrus_outbox.OUTBOX_RETRY_BASE * 2 ** i)
+                     for i in range(len(gaps))]
+    alerted = {pending_id: text for pending_id, text in alerts}
+
+    print(f"Запросов на создание задач: {sum(len(t) for t in fake.attempts.values())}, "
+          f"создано задач: {len(fake.created)}, паузы очереди: {', '.join(f'{g:.2f}' for g in gaps)} с")
+    checks = {
+        "5xx повторяется, задача отправлена":
+            state[pending["сбой 500 и повтор"]][0] == 'sent' and state[pending["долгий сбой 503"]][0] == 'sent',
+        "429 повторяется, задача отправлена": state[pending["лимит 429"]][0] == 'sent',
+        "5xx и таймаут POST tasks клиент не повторяет (запрос на попытку очереди)":
+            all(len(fake.attempts[text]) == state[pending[text]][1]
+                for text in ("сбой 500 и повтор", "долгий сбой 503", "сервер лежит", SLOW_TEXT)),
+        "после таймаута задача отправлена повторно очередью": state[pending[SLOW_TEXT]][:2] == ('sent', 2),
+        "задача без ошибок отправлена с первой попытки": state[pending["без ошибок"]][:2] == ('sent', 1),
+        "4xx не повторяется": state[pending["ошибка 400"]][:2] == ('failed', 1)
+            and len(fake.attempts["ошибка 400"]) == 1,
+        f"после {pyrus_outbox.OUTBOX_MAX_ATTEMPTS} попыток задача снята с очереди":
+            state[pending["сервер лежит"]][:2] == ('failed', pyrus_outbox.OUTBOX_MAX_ATTEMPTS),
+        "пауза между попытками растёт":
+            len(gaps) == pyrus_outbox.OUTBOX_MAX_ATTEMPTS - 1
+            and all(gap >= expected * 0.9 for gap, expected in zip(gaps, expected_gaps)),
+        "админ уведомлён о каждой снятой задаче, и только о них":
+            sorted(alerted) == sorted([pending["ошибка 400"], pending["сервер лежит"]]),
+        "в уведомлении номер обращения, филиал и текст":
+            all(f"№{pending_id}" in alerted.get(pending_id, '') and "Коммуны" in alerted.get(pending_id, '')
+                and text in alerted.get(pending_id, '')
+                for text, pending_id in pending.items() if text in ("ошибка 400", "сервер лежит")),
+        "повтор обращения не поставлен второй раз":
+            duplicate['pending_id'] == pending["без ошибок"] and fake.created.count("без ошибок") == 1,
+        "одинаковый текст двух клиентов — две задачи, повтор каждого не дублируется":
+            all(ids[0] is not None and ids[0] == ids[1] for ids in same_text.values())
+            and len({ids[0] for ids in same_text.values()}) == 2 and fake.created.count(SAME_TEXT) == 2,
+        "после падения задача возвращена в очередь и отправлена":
+            len(claimed) == 1 and recovered == 1 and crashed_state[0] == 'sent',
+    }
+    for name, ok in checks.items():
+        print(f"  {'✅' if ok else '❌'} {name}")
+    return all(checks.values())
+
+
+def main():
+    with tempfile.TemporaryDirectory() as base_dir:
+        ok = asyncio.run(run_check(base_dir))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+Офлайн-оценка поиска по базе знаний: recall@k, MRR и задержка.
+
+Прогоняет размеченные запросы через tools.kb_search.hybrid_search
+в режимах dense (только векторы), keyword (только BM25) и hybrid
+и печатает для каждого режима recall@k, MRR и p50/p95 времени поиска
+(без эмбеддинга запроса).
+
+Файл запросов — JSONL, по строке на запрос:
+    {"query": "сколько стоит Pr4", "relevant": ["Программы.md"], "topic": "английский язык"}
+relevant — имена файлов-источников (подстрока metadata.source, без учёта
+регистра) или id чанков; topic необязателен и добавляется к запросу, как
+в боте. Пример: scripts/kb_eval_queries.example.jsonl.
+
+Эмбеддинги запросов запрашиваются у OpenAI один раз и сохраняются
+в --embeddings-cache, повторные прогоны идут без сети.
+
+Использование:
+    python scripts/eval_kb_retrieval.py --queries kb_eval_queries.jsonl
+    python scripts/eval_kb_retrieval.py --queries q.jsonl --kb-path ./local_vector_db_telegram/<dir> -k 3 5 10
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+# Добавляем корень проекта в путь для импорта
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
+sys.path.insert(0, PROJECT_DIR)
+
+from dotenv import load_dotenv
+
+from tools.kb_search import SEARCH_MODES, KeywordIndex, hybrid_search
+
+load_dotenv(os.path.join(PROJECT_DIR, '.env'))
+
+
+def active_kb_path() -> str:
+    base_path = os.getenv("VECTOR_DB_BASE_PATH_TELEGRAM", "./local_vector_db_telegram")
+    info_file = os.path.join(base_path, os.getenv("ACTIVE_DB_INFO_FILE_TELEGRAM", "active_db_path_telegram.txt"))
+    with open(info_file, 'r', encoding='utf-8') as f:
+        subpath = f.read().strip()
+    return subpath if os.path.isabs(subpath) else os.path.join(base_path, subpath)
+
+
+def load_queries(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def query_embeddings(texts, cache_path: str):
+    """Эмбеддинги запросов из файла-кэша; недостающие — через OpenAI."""
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cache = json.load(f)
+    missing = [text for text in dict.fromkeys(texts) if text not in cache]
+    if missing:
+        import openai
+        dim_str = os.getenv("OPENAI_EMBEDDING_DIMENSIONS")
+        kwargs = {"model": os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-large")}
+        if dim_str and dim_str.lower() != 'none':
+            kwargs["dimensions"] = int(dim_str)
+        client = openai.OpenAI()
+        for start in range(0, len(missing), 256):
+            batch = missing[start:start + 256]
+            response = client.embeddings.create(input=batch, **kwargs)
+            for item in response.data:
+                cache[batch[item.index]] = item.embedding
+        with open(cache_path, 'w', encoding='utf-8') as f:
+            json.dump(cache, f)
+    return [cache[text] for text in texts]
+
+
+def is_relevant(chunk, labels) -> bool:
+    source = str(chunk['metadata'].get('source', '')).casefold()
+    return any(chunk['id'] == label or label.casefold() in source for label in labels)
+
+
+def percentile(values, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--queries', required=True, help='JSONL с размеченными запросами')
+    parser.add_argument('--kb-path', help='директория базы (по умолчанию — активная)')
+    parser.add_argument('-k', type=int, nargs='+', default=[3, 5, 10])
+    parser.add_argument('--candidates', type=int, default=20, help='кандидатов из каждого поиска (KB_SEARCH_CANDIDATES)')
+    parser.add_argument('--modes', nargs='+', choices=SEARCH_MODES, default=list(SEARCH_MODES))
+    parser.add_argument('--repeat', type=int, default=3, help='повторов каждого запроса для замера времени')
+    parser.add_argument('--embeddings-cache', help='файл эмбеддингов запросов (по умолчанию <queries>.embeddings.json)')
+    args = parser.parse_args()
+
+    import chromadb
+
+    kb_path = args.kb_path or active_kb_path()
+    collection = chromadb.PersistentClient(path=kb_path).get_collection(
+        os.getenv("CHROMA_COLLECTION_NAME_TELEGRAM", "documents_telegram")
+    )
+    index = KeywordIndex.load(kb_path)
+    if index is None:
+        data = collection.get(include=["documents"])
+        index = KeywordIndex(data["ids"], data["documents"])
+        print(f"BM25-индекс не найден в {kb_path} — построен в памяти")
+
+    queries = load_queries(args.queries)
+    texts = [f"{q['topic']} {q['query']}" if q.get('topic') else q['query'] for q in queries]
+    embeddings = query_embeddings(texts, args.embeddings_cache or f"{args.queries}.embeddings.json")
+    max_k = max(args.k)
+    print(f"База: {kb_path} ({collection.count()} чанков), запросов: {len(queries)}")
+
+    for mode in args.modes:
+        recalls = {k: [] for k in args.k}
+        reciprocal_ranks, latencies = [], []
+        for query, text, embedding in zip(queries, texts, embeddings):
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                found = hybrid_search(collection, index, text, embedding, max_k,
+                                      candidates=max(args.candidates, max_k), mode=mode)
+                latencies.append((time.perf_counter() - started) * 1000)
+            labels = query['relevant']
+            for k in args.k:
+                hit_labels = {label for label in labels for chunk in found[:k] if is_relevant(chunk, [label])}
+                recalls[k].append(len(hit_labels) / len(labels) if labels else 0.0)
+            first_hit = next((rank for rank, chunk in enumerate(found, 1) if is_relevant(chunk, labels)), None)
+            reciprocal_ranks.append(1 / first_hit if first_hit else 0.0)
+
+        recall_text = ', '.join(f"recall@{k}={sum(v) / len(v):.3f}" for k, v in recalls.items())
+        print(f"{mode:>8}: {recall_text}, MRR={sum(reciprocal_ranks) / len(reciprocal_ranks):.3f}, "
+              f"p50={percentile(latencies, 0.5):.1f} мс, p95={percentile(latencies, 0.95):.1f} мс")
+
+
+if __name__ == '__main__':
+    main()
@@ -22,7 +22,10 @@ from .pyrus_tools import (
     PYRUS_TOOL_DEFINITION,
     get_pyrus_tool_for_responses_api,
     get_available_branches_for_pyrus,
+    close_pyrus_client,
+    format_failed_task_alert,
 )
+from .pyrus_outbox import run_outbox_worker
 from .client_tools import (
     search_client_by_name,
     find_clients_by_phone,
@@ -30,6 +33,7 @@ from .client_tools import (
     get_recent_transactions,
     calculate_next_month_payment,
     get_verified_client_data,
+    get_client_by_login,
     normalize_phone,
     TOOLS as CLIENT_TOOLS_DEFINITIONS,
     get_search_client_tool_for_responses_api,
@@ -41,6 +45,8 @@ from .client_tools import (
 from .verification_tools import (
     reset_verification,
     get_all_verifications,
+    load_verification_store,
+    flush_verifications,
     check_verification,
     save_verification,
     get_check_verification_tool_for_responses_api,
@@ -59,6 +65,8 @@ from .conversation_tools import (
 from .tool_executor import (
     get_tools_for_api,
     execute_tool_call,
+    execute_tool_call_async,
+    execute_tool_calls,
     parse_tool_calls_from_response,
     format_tool_results_for_api,
     has_tool_calls,
@@ -89,10 +97,14 @@ __all__ = [
     "PYRUS_TOOL_DEFINITION",
     "get_pyrus_tool_for_responses_api",
     "get_available_branches_for_pyrus",
+    "close_pyrus_client",
+    "format_failed_task_alert",
+    "run_outbox_worker",
     # Client tools
     "search_client_by_name",
     "find_clients_by_phone",
     "get_verified_client_data",
+    "get_client_by_login",
     "normalize_phone",
     "get_client_balance",
     "get_recent_transactions",
@@ -106,6 +118,8 @@ __all__ = [
     # Verification tools
     "reset_verification",
     "get_all_verifications",
+    "load_verification_store",
+    "flush_verifications",
     "check_verification",
     "save_verification",
     "get_check_verification_tool_for_responses_api",
@@ -122,6 +136,8 @@ __all__ = [
     # Tool executor
     "get_tools_for_api",
     "execute_tool_call",
+    "execute_tool_call_async",
+    "execute_tool_calls",
     "parse_tool_calls_from_response",
     "format_tool_results_for_api",
     "has_tool_calls",
@@ -0,0 +1,104 @@
+"""
+Семантический кэш ответов на типовые вопросы (цены, адреса, расписание).
+
+Большая часть обращений — одни и те же вопросы от неверифицированных
+пользователей. Если новый вопрос по эмбеддингу достаточно близок к уже
+отвеченному (косинусная близость не ниже порога), бот возвращает прежний
+ответ без запроса к модели.
+
+Ответ переиспользуется только при совпадении «отпечатка» — версии базы
+знаний, системных инструкций и модели: после пересборки базы или правки
+инструкций старые ответы перестают находиться. Кэшируются только ответы,
+для которых модели не понадобились tools (личные данные в них не попадают).
+Используется из event loop бота (без блокировок).
+"""
+
+import hashlib
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+def answer_fingerprint(kb_version: Optional[str], instructions: str, model: str) -> str:
+    """Отпечаток всего, от чего зависит ответ, кроме самого вопроса."""
+    data = '\n'.join([kb_version or '', model, instructions]).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+class SemanticAnswerCache:
+    """Ответы, найденные по близости эмбеддинга вопроса."""
+
+    def __init__(self, threshold: float = 0.95, max_entries: int = 500, ttl_seconds: float = 6 * 3600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._fingerprint: Optional[str] = None
+        self._vectors: List[np.ndarray] = []
+        self._answers: List[str] = []
+        self._created: List[float] = []
+        # Матрица нормированных векторов собирается лениво после изменений
+        self._matrix: Optional[np.ndarray] = None
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm else vector
+
+    def _reset(self, fingerprint: str):
+        self._fingerprint = fingerprint
+        self._vectors, self._answers, self._created = [], [], []
+        self._matrix = None
+
+    def _drop_expired(self):
+        cutoff = time.time() - self.ttl_seconds
+        keep = [i for i, created in enumerate(self._created) if created >= cutoff]
+        if len(keep) != len(self._created):
+            self._vectors = [self._vectors[i] for i in keep]
+            self._answers = [self._answers[i] for i in keep]
+            self._created = [self._created[i] for i in keep]
+            self._matrix = None
+
+    def get(self, embedding: List[float], fingerprint: str) -> Optional[str]:
+        """Ответ на близкий вопрос или None."""
+        if fingerprint != self._fingerprint:
+            # База знаний, инструкции или модель сменились — старые ответы не годятся
+            self._reset(fingerprint)
+        self._drop_expired()
+        if not self._vectors:
+            self.misses += 1
+            return None
+
+        if self._matrix is None:
+            self._matrix = np.stack(self._vectors)
+        similarities = self._matrix @ self._normalize(embedding)
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.threshold:
+            self.hits += 1
+            return self._answers[best]
+        self.misses += 1
+        return None
+
+    def put(self, embedding: List[float], answer: str, fingerprint: str):
+        if fingerprint != self._fingerprint:
+            self._reset(fingerprint)
+        self._vectors.append(self._normalize(embedding))
+        self._answers.append(answer)
+        self._created.append(time.time())
+        if len(self._vectors) > self.max_entries:
+            del self._vectors[0], self._answers[0], self._created[0]
+        self._matrix = None
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self._answers),
+        }
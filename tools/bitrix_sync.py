@@ -6,13 +6,30 @@
 
 import requests
 from bs4 import BeautifulSoup
+import hashlib
 import os
 import json
 import xml.etree.ElementTree as ET
 from datetime import datetime
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional
 import logging
 
+try:
+    from .change_log import (
+        ChangeLogWriter, changes_path, read_base_revision, read_state, record_digest, reset_log, write_state
+    )
+    from .client_db import SqliteWriter, db_path
+    from .phone_utils import split_phones
+    from .snapshot_format import SnapshotWriter, snapshot_path
+except ImportError:
+    # Запуск как скрипт: python3 tools/bitrix_sync.py
+    from change_log import (
+        ChangeLogWriter, changes_path, read_base_revision, read_state, record_digest, reset_log, write_state
+    )
+    from client_db import SqliteWriter, db_path
+    from phone_utils import split_phones
+    from snapshot_format import SnapshotWriter, snapshot_path
+
 # Настройка логирования
 logging.basicConfig(
     level=logging.INFO,
@@ -20,6 +37,178 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Namespace выгрузок 1С
+COMMERCEML_NS = 'urn:1C.ru:commerceml_2'
+
+# Размер блока при потоковом скачивании выгрузок
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Форматы, в которые sync_file сохраняет выгрузки: json (читает бот по умолчанию,
+# удобен для отладки), binary (снимок для CLIENT_DATA_FORMAT=binary)
+# и sqlite (upsert в data/clients.db для CLIENT_DATA_FORMAT=sqlite)
+SYNC_OUTPUT_FORMATS = [
+    f.strip() for f in os.getenv('SYNC_OUTPUT_FORMATS', 'json,binary').split(',') if f.strip()
+]
+
+# Журнал изменений переписывается в базовый JSON, когда записей в нём больше
+# этой доли от размера таблицы (но не меньше CHANGE_LOG_MIN_COMPACT)
+CHANGE_LOG_COMPACT_RATIO = 0.2
+CHANGE_LOG_MIN_COMPACT = 1000
+
+# Тег одной записи в каждой выгрузке
+RECORD_TAGS = {
+    'clients': 'Контрагент',
+    'contracts': 'Контракт',
+    'transactions': 'Транзакция',
+}
+
+
+class JsonItemsWriter:
+    """
+    Потоковая запись JSON-выгрузки {"updated_at", "items", "count"}.
+
+    Записи пишутся по одной на строку во временный файл, который
+    атомарно переименовывается в close(). Ревизия (если задана) пишется
+    в первую строку — по ней журнал изменений сверяется с базовым файлом.
+    """
+    
+    def __init__(self, path: str, updated_at: str, revision: Optional[int] = None):
+        self.path = path
+        self._tmp_path = f"{path}.tmp"
+        self.count = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(self._tmp_path, 'w', encoding='utf-8')
+        # count известен только в конце, поэтому пишем его после items
+        self._file.write('{"updated_at": %s' % json.dumps(updated_at))
+        if revision is not None:
+            self._file.write(', "revision": %d' % revision)
+        self._file.write(', "items": [')
+    
+    def add(self, item: Dict):
+        self._file.write(',\n' if self.count else '\n')
+        self._file.write(json.dumps(item, ensure_ascii=False))
+        self.count += 1
+    
+    def close(self):
+        self._file.write('\n], "count": %d}\n' % self.count)
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+    
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+class IncrementalJsonWriter:
+    """
+    JSON-выгрузка с журналом изменений (см. tools/change_log.py).
+
+    Каждая запись сравнивается по хэшу с прошлой синхронизацией, в журнал
+    {table}.changes.jsonl попадают только новые, изменённые и исчезнувшие
+    записи. Базовый JSON переписывается целиком лишь при компактизации:
+    журнал разросся, базового файла нет или он не совпадает с состоянием
+    синхронизации, либо запрошена полная запись (full=True).
+    """
+    
+    def __init__(self, path: str, table: str, updated_at: str, full: bool = False):
+        self.path = path
+        self.table = table
+        self.updated_at = updated_at
+        self.data_dir = os.path.dirname(path) or '.'
+        self.count = 0
+        
+        state = read_state(self.data_dir, table)
+        # Хэши прошлой выгрузки; встреченные записи удаляются — в конце остаются удалённые
+        self._old_digests: Dict[str, int] = state.get('digests', {})
+        self._digests: Dict[str, int] = {}
+        self._log_records = state.get('log_records', 0)
+        self._base_revision = state.get('base_revision')
+        self.revision = state.get('revision', 0) + 1
+        
+        compact_at = max(CHANGE_LOG_MIN_COMPACT, CHANGE_LOG_COMPACT_RATIO * len(self._old_digests))
+        self.full = (
+            full
+            or not state
+            or read_base_revision(path) != self._base_revision
+            or self._log_records > compact_at
+        )
+        self._base = JsonItemsWriter(path, updated_at, self.revision) if self.full else None
+        self._log = None if self.full else ChangeLogWriter(changes_path(self.data_dir, table), self.revision)
+    
+    def add(self, item: Dict):
+        self.count += 1
+        if self._base is not None:
+            self._base.add(item)
+        
+        record_id = item.get('id')
+        if not record_id:
+            # Без Ид запись не сопоставить с прошлой выгрузкой — попадёт в JSON при компактизации
+            logger.warning(f"{self.table}: запись без id не попадёт в журнал изменений")
+            return
+        
+        digest = record_digest(item)
+        self._digests[record_id] = digest
+        if self._log is not None and self._old_digests.pop(record_id, None) != digest:
+            self._log.upsert(item)
+    
+    def close(self):
+        if self._base is not None:
+            # Сначала новый базовый файл, потом пустой журнал: бот, перечитавший базу
+            # раньше сброса журнала, пропустит старые записи по ревизии
+            self._base.close()
+            reset_log(changes_path(self.data_dir, self.table))
+            self._base_revision = self.revision
+            log_records = 0
+            logger.info(f"{self.table}: базовый JSON перезаписан (ревизия {self.revision}, {self.count} записей)")
+        else:
+            for record_id in self._old_digests:
+                self._log.delete(record_id)
+            if not self._log.changes:
+                self._log.abort()
+                logger.info(f"{self.table}: изменений нет")
+                return
+            self._log.close(self.updated_at)
+            log_records = self._log_records + self._log.changes
+            logger.info(f"{self.table}: в журнал записано изменений: {self._log.changes} (ревизия {self.revision})")
+        
+        write_state(self.data_dir, self.table, {
+            'revision': self.revision,
+            'base_revision': self._base_revision,
+            'log_records': log_records,
+            'updated_at': self.updated_at,
+            'digests': self._digests,
+        })
+    
+    def abort(self):
+        if self._base is not None:
+            self._base.abort()
+        if self._log is not None:
+            self._log.abort()
+
+
+def _meta_path(xml_path: str) -> str:
+    """Путь к файлу-спутнику с ETag/Last-Modified/sha256 выгрузки."""
+    return f"{xml_path}.meta.json"
+
+
+def _read_meta(xml_path: str) -> Dict:
+    """Метаданные последнего скачивания (пустой словарь если их нет)."""
+    try:
+        with open(_meta_path(xml_path), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_meta(xml_path: str, meta: Dict):
+    """Атомарно сохраняет метаданные скачивания."""
+    path = _meta_path(xml_path)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
 
 class BitrixSyncClient:
     """Клиент для синхронизации данных из Bitrix"""
@@ -102,6 +291,10 @@ class BitrixSyncClient:
         """
         Скачивание файла по типу
         
+        Файл пишется потоково во временный файл и атомарно переименовывается.
+        Отправляются If-None-Match/If-Modified-Since, на 304 файл не трогается.
+        ETag, Last-Modified и sha256 сохраняются в <save_path>.meta.json.
+        
         Args:
             file_type: Тип файла ('clients', 'contracts', 'transactions')
             save_path: Путь для сохранения файла
@@ -121,27 +314,61 @@ class BitrixSyncClient:
             return None
         
         url = file_urls[file_type]
+        meta = _read_meta(save_path)
+        
+        # Условный запрос: если файл на сервере не менялся, придёт 304 без тела
+        headers = {}
+        if os.path.exists(save_path):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        
+        tmp_path = f"{save_path}.tmp"
         
         try:
             logger.info(f"Скачивание {file_type}.xml...")
-            response = self.session.get(url, timeout=30)
-            
-            if response.status_code != 200:
-                logger.error(f"Ошибка скачивания {file_type}: HTTP {response.status_code}")
-                return None
-            
-            # Создаем директорию если не существует
-            os.makedirs(os.path.dirname(save_path), exist_ok=True)
-            
-            # Сохраняем файл
-            with open(save_path, 'wb') as f:
-                f.write(response.content)
+            with self.session.get(url, timeout=30, stream=True, headers=headers) as response:
+                if response.status_code == 304:
+                    logger.info(f"{file_type}.xml не изменился на сервере (304)")
+                    return save_path
+                
+                if response.status_code != 200:
+                    logger.error(f"Ошибка скачивания {file_type}: HTTP {response.status_code}")
+                    return None
+                
+                # Создаем директорию если не существует
+                os.makedirs(os.path.dirname(save_path), exist_ok=True)
+                
+                # Пишем по частям во временный файл, считая хэш на лету
+                digest = hashlib.sha256()
+                size = 0
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                os.replace(tmp_path, save_path)
+                
+                sha256 = digest.hexdigest()
+                if sha256 == meta.get('sha256'):
+                    logger.info(f"{file_type}.xml скачан, но содержимое не изменилось")
+                
+                meta.update({
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'sha256': sha256,
+                    'size': size,
+                })
+                _write_meta(save_path, meta)
             
-            logger.info(f"Сохранено: {save_path} ({len(response.content)} байт)")
+            logger.info(f"Сохранено: {save_path} ({size} байт)")
             return save_path
             
         except Exception as e:
             logger.error(f"Ошибка при скачивании файла {file_type}: {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
             return None
     
     def xml_to_json(self, xml_path: str, json_path: str, file_type: str) -> bool:
@@ -156,111 +383,154 @@ class BitrixSyncClient:
         Returns:
             True если успешно, False если ошибка
         """
-        try:
-            logger.info(f"Конвертация {file_type}.xml -> JSON...")
-            
-            # Парсим XML
-            tree = ET.parse(xml_path)
-            root = tree.getroot()
+        return self.convert_export(xml_path, file_type, {'json': json_path})
+    
+    def convert_export(
+        self,
+        xml_path: str,
+        file_type: str,
+        outputs: Dict[str, str],
+        incremental: bool = False,
+        full: bool = False
+    ) -> bool:
+        """
+        Конвертация XML в один или несколько форматов за один проход
+        
+        XML читается потоково (iterparse): каждая запись разбирается, сразу
+        передаётся писателям и удаляется из дерева, поэтому память не зависит
+        от размера выгрузки. Файлы записываются атомарно: бот перечитывает
+        их по смене inode/mtime и не должен увидеть наполовину записанными.
+        
+        Args:
+            xml_path: Путь к XML файлу
+            file_type: Тип файла для правильного парсинга
+            outputs: Формат ('json', 'binary' или 'sqlite') → путь для сохранения
+            incremental: Писать JSON через журнал изменений (IncrementalJsonWriter)
+            full: При incremental — всё равно переписать базовый JSON целиком
             
-            # Определяем namespace
-            ns = {'ns': 'urn:1C.ru:commerceml_2'}
+        Returns:
+            True если успешно, False если ошибка
+        """
+        if file_type not in RECORD_TAGS:
+            logger.error(f"Неизвестный тип для конвертации: {file_type}")
+            return False
+        
+        updated_at = datetime.now().isoformat()
+        writers = []
+        
+        try:
+            logger.info(f"Конвертация {file_type}.xml -> {', '.join(outputs)}...")
             
-            # Конвертируем в зависимости от типа
-            if file_type == 'clients':
-                data = self._parse_clients(root, ns)
-            elif file_type == 'contracts':
-                data = self._parse_contracts(root, ns)
-            elif file_type == 'transactions':
-                data = self._parse_transactions(root, ns)
-            else:
-                logger.error(f"Неизвестный тип для конвертации: {file_type}")
-                return False
+            for output_format, path in outputs.items():
+                if output_format == 'json' and incremental:
+                    writers.append(IncrementalJsonWriter(path, file_type, updated_at, full=full))
+                elif output_format == 'json':
+                    writers.append(JsonItemsWriter(path, updated_at))
+                elif output_format == 'binary':
+                    writers.append(SnapshotWriter(path, file_type, updated_at))
+                elif output_format == 'sqlite':
+                    writers.append(SqliteWriter(path, file_type, updated_at))
+                else:
+                    raise ValueError(f"Неизвестный формат: {output_format}")
             
-            # Сохраняем JSON
-            os.makedirs(os.path.dirname(json_path), exist_ok=True)
+            count = 0
+            for item in self.iter_records(xml_path, file_type):
+                for writer in writers:
+                    writer.add(item)
+                count += 1
             
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            for writer in writers:
+                writer.close()
             
-            logger.info(f"Сохранено: {json_path} ({len(data.get('items', []))} записей)")
+            logger.info(f"Сохранено: {', '.join(outputs.values())} ({count} записей)")
             return True
             
         except Exception as e:
             logger.error(f"Ошибка при конвертации {file_type}: {e}")
+            for writer in writers:
+                writer.abort()
             return False
     
-    def _parse_clients(self, root, ns) -> Dict:
-        """Парсинг файла clients.xml"""
-        clients = []
+    def iter_records(self, xml_path: str, file_type: str) -> Iterator[Dict]:
+        """
+        Потоковый разбор выгрузки 1С: по одной записи за раз
         
-        for client in root.findall('.//ns:Контрагент', ns):
-            client_data = {
-                'id': self._get_text(client, 'ns:Ид', ns),
-                'login': self._get_text(client, 'ns:Логин', ns),
-                'student': {
-                    'last_name': self._get_text(client, './/ns:Фамилия', ns),
-                    'first_name': self._get_text(client, './/ns:Имя', ns),
-                    'middle_name': self._get_text(client, './/ns:Отчество', ns),
-                    'account': self._get_text(client, './/ns:ЛицевойСчет', ns),
-                    'branch': self._get_text(client, './/ns:Филиал', ns),
-                    'group': self._get_text(client, './/ns:Группа', ns),
-                    'program': self._get_text(client, './/ns:ОсновнаяПрограмма', ns),
-                    'teacher': self._get_text(client, './/ns:Преподаватель', ns),
-                    'bonus': self._get_text(client, './/ns:Бонус', ns),
-                },
-                'contacts': {
-                    'contact_person': self._get_text(client, './/ns:КонтактноеЛицо', ns),
-                    'phone': self._get_text(client, './/ns:ТелефонДляСвязи', ns),
-                    'email': self._get_text(client, './/ns:ЭлектроннаяПочтаДляУведомлений', ns),
-                }
-            }
-            clients.append(client_data)
+        Args:
+            xml_path: Путь к XML файлу
+            file_type: Тип файла ('clients', 'contracts', 'transactions')
+            
+        Yields:
+            Словарь записи в формате JSON-файла
+        """
+        ns = {'ns': COMMERCEML_NS}
+        record_tag = f"{{{COMMERCEML_NS}}}{RECORD_TAGS[file_type]}"
+        parse_record = {
+            'clients': self._parse_client,
+            'contracts': self._parse_contract,
+            'transactions': self._parse_transaction,
+        }[file_type]
         
-        return {
-            'updated_at': datetime.now().isoformat(),
-            'count': len(clients),
-            'items': clients
-        }
+        # Стек открытых элементов: после разбора запись удаляется из родителя,
+        # иначе дерево целиком накопится в памяти
+        stack = []
+        for event, elem in ET.iterparse(xml_path, events=('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                continue
+            
+            stack.pop()
+            if elem.tag == record_tag:
+                yield parse_record(elem, ns)
+                elem.clear()
+                if stack:
+                    stack[-1].remove(elem)
     
-    def _parse_contracts(self, root, ns) -> Dict:
-        """Парсинг файла contracts.xml"""
-        contracts = []
+    def _parse_client(self, client, ns) -> Dict:
+        """Разбор записи Контрагент из clients.xml"""
+        phone = self._get_text(client, './/ns:ТелефонДляСвязи', ns)
         
-        for contract in root.findall('.//ns:Контракт', ns):
-            contract_data = {
-                'id': self._get_text(contract, 'ns:Ид', ns),
-                'name': self._get_text(contract, 'ns:Название', ns),
-                'balance': self._get_text(contract, 'ns:Баланс', ns),
-                'bonuses': self._get_text(contract, 'ns:Бонусы', ns),
-                'client_id': self._get_text(contract, 'ns:ИдКонтрагента', ns),
+        return {
+            'id': self._get_text(client, 'ns:Ид', ns),
+            'login': self._get_text(client, 'ns:Логин', ns),
+            'student': {
+                'last_name': self._get_text(client, './/ns:Фамилия', ns),
+                'first_name': self._get_text(client, './/ns:Имя', ns),
+                'middle_name': self._get_text(client, './/ns:Отчество', ns),
+                'account': self._get_text(client, './/ns:ЛицевойСчет', ns),
+                'branch': self._get_text(client, './/ns:Филиал', ns),
+                'group': self._get_text(client, './/ns:Группа', ns),
+                'program': self._get_text(client, './/ns:ОсновнаяПрограмма', ns),
+                'teacher': self._get_text(client, './/ns:Преподаватель', ns),
+                'bonus': self._get_text(client, './/ns:Бонус', ns),
+            },
+            'contacts': {
+                'contact_person': self._get_text(client, './/ns:КонтактноеЛицо', ns),
+                'phone': phone,
+                'email': self._get_text(client, './/ns:ЭлектроннаяПочтаДляУведомлений', ns),
+                # Нормализуем телефоны один раз при синхронизации, чтобы бот не делал
+                # этого на каждом поиске (в поле может быть несколько номеров)
+                'phones': split_phones(phone),
             }
-            contracts.append(contract_data)
-        
+        }
+    
+    def _parse_contract(self, contract, ns) -> Dict:
+        """Разбор записи Контракт из contracts.xml"""
         return {
-            'updated_at': datetime.now().isoformat(),
-            'count': len(contracts),
-            'items': contracts
+            'id': self._get_text(contract, 'ns:Ид', ns),
+            'name': self._get_text(contract, 'ns:Название', ns),
+            'balance': self._get_text(contract, 'ns:Баланс', ns),
+            'bonuses': self._get_text(contract, 'ns:Бонусы', ns),
+            'client_id': self._get_text(contract, 'ns:ИдКонтрагента', ns),
         }
     
-    def _parse_transactions(self, root, ns) -> Dict:
-        """Парсинг файла transactions.xml"""
-        transactions = []
-        
-        for trans in root.findall('.//ns:Транзакция', ns):
-            trans_data = {
-                'id': self._get_text(trans, 'ns:Ид', ns),
-                'date': self._get_text(trans, 'ns:Дата', ns),
-                'amount': self._get_text(trans, 'ns:Сумма', ns),
-                'description': self._get_text(trans, 'ns:Описание', ns),
-                'contract_id': self._get_text(trans, 'ns:ИдКонтракта', ns),
-            }
-            transactions.append(trans_data)
-        
+    def _parse_transaction(self, trans, ns) -> Dict:
+        """Разбор записи Транзакция из transactions.xml"""
         return {
-            'updated_at': datetime.now().isoformat(),
-            'count': len(transactions),
-            'items': transactions
+            'id': self._get_text(trans, 'ns:Ид', ns),
+            'date': self._get_text(trans, 'ns:Дата', ns),
+            'amount': self._get_text(trans, 'ns:Сумма', ns),
+            'description': self._get_text(trans, 'ns:Описание', ns),
+            'contract_id': self._get_text(trans, 'ns:ИдКонтракта', ns),
         }
     
     def _get_text(self, element, path: str, ns) -> str:
@@ -268,29 +538,56 @@ class BitrixSyncClient:
         found = element.find(path, ns)
         return found.text.strip() if found is not None and found.text else ''
     
-    def sync_file(self, file_type: str, data_dir: str = 'data') -> bool:
+    def sync_file(self, file_type: str, data_dir: str = 'data', force: bool = False) -> bool:
         """
-        Полная синхронизация файла: скачивание + конвертация в JSON
+        Полная синхронизация файла: скачивание + конвертация в JSON / бинарный снимок / SQLite
+        
+        Если XML не изменился с последней успешной конвертации (304 от сервера
+        или тот же sha256), JSON не перезаписывается — и бот не пересобирает
+        индексы. Иначе в JSON-журнал изменений пишется только разница
+        с прошлой выгрузкой, и бот применяет её без полной перезагрузки.
         
         Args:
             file_type: Тип файла ('clients', 'contracts', 'transactions')
             data_dir: Директория для сохранения данных
+            force: Конвертировать даже если XML не изменился (и переписать JSON целиком)
             
         Returns:
             True если успешно, False если ошибка
         """
         # Пути для сохранения
         xml_path = os.path.join(data_dir, 'xml', f'{file_type}.xml')
-        json_path = os.path.join(data_dir, f'{file_type}.json')
+        output_paths = {
+            'json': os.path.join(data_dir, f'{file_type}.json'),
+            'binary': snapshot_path(data_dir, file_type),
+            'sqlite': db_path(data_dir),
+        }
+        outputs = {fmt: output_paths[fmt] for fmt in SYNC_OUTPUT_FORMATS}
         
         # Скачиваем XML
         if not self.download_file(file_type, xml_path):
             return False
         
-        # Конвертируем в JSON
-        if not self.xml_to_json(xml_path, json_path, file_type):
+        meta = _read_meta(xml_path)
+        if (
+            not force
+            and meta.get('sha256')
+            and meta.get('converted_sha256') == meta['sha256']
+            # База общая для всех выгрузок — её наличие не значит, что таблица заполнена
+            and set(outputs) <= set(meta.get('converted_formats', ['json', 'binary']))
+            and all(os.path.exists(path) for path in outputs.values())
+        ):
+            logger.info(f"{file_type}: данные не изменились, конвертация пропущена")
+            return True
+        
+        # Конвертируем в JSON и/или бинарный снимок
+        if not self.convert_export(xml_path, file_type, outputs, incremental=True, full=force):
             return False
         
+        meta['converted_sha256'] = meta.get('sha256')
+        meta['converted_formats'] = sorted(outputs)
+        _write_meta(xml_path, meta)
+        
         return True
 
 
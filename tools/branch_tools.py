@@ -45,18 +45,20 @@ def _has_any_verification(telegram_user_id: int) -> bool:
         True если есть хотя бы один верифицированный логин, False иначе
     """
     try:
-        from tools.verification_tools import _load_verifications, is_client_verified
+        from tools.request_context import get_request_context
+        from tools.verification_tools import _get_user_logins, is_client_verified
         
-        verifications = _load_verifications()
-        user_key = str(telegram_user_id)
+        # В рамках сообщения пользователя проверка уже могла быть сделана
+        context = get_request_context()
+        if context is not None and context.is_for(telegram_user_id):
+            return context.has_any_verification()
         
-        if user_key not in verifications:
+        logins = _get_user_logins(telegram_user_id)
+        
+        if logins is None:
             logger.debug(f"Верификация НЕ найдена для telegram_user={telegram_user_id}")
             return False
         
-        user_data = verifications[user_key]
-        logins = user_data.get('logins', [])
-        
         # Проверяем, есть ли хотя бы один актуальный логин
         for login in logins:
             if is_client_verified(telegram_user_id, login):
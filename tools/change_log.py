@@ -0,0 +1,212 @@
+"""
+Журнал изменений выгрузок 1С (инкрементальная синхронизация JSON).
+
+Вместо полной перезаписи clients.json / contracts.json / transactions.json
+синхронизация сравнивает каждую запись (по Ид) с предыдущей выгрузкой
+и дописывает в {table}.changes.jsonl только вставки, изменения и удаления.
+Бот дочитывает журнал с того места, где остановился, и применяет дельту
+к индексам в памяти без полной перезагрузки.
+
+Формат журнала — по строке JSON на изменение, пачка закрывается строкой
+commit (читатель применяет только закрытые пачки):
+    {"revision": 7, "op": "upsert", "id": "...", "record": {...}}
+    {"revision": 7, "op": "delete", "id": "..."}
+    {"revision": 7, "op": "commit", "updated_at": "...", "changes": 2}
+
+Базовый JSON хранит ревизию, на которой он записан ("revision" в заголовке);
+записи журнала с ревизией не выше неё при загрузке пропускаются. Когда
+журнал разрастается, синхронизация переписывает базовый файл целиком
+и начинает журнал заново (компактизация).
+"""
+
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+
+def changes_path(data_dir: str, table: str) -> str:
+    """Путь к журналу изменений таблицы."""
+    return os.path.join(data_dir, f'{table}.changes.jsonl')
+
+
+def state_path(data_dir: str, table: str) -> str:
+    """Путь к состоянию синхронизации таблицы (ревизия и хэши записей)."""
+    return os.path.join(data_dir, f'{table}.sync_state.json')
+
+
+def record_digest(record: Dict) -> int:
+    """Короткий хэш записи для сравнения с предыдущей выгрузкой."""
+    data = json.dumps(record, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big')
+
+
+def read_state(data_dir: str, table: str) -> Dict:
+    """Состояние прошлой синхронизации или пустое, если его нет/оно битое."""
+    try:
+        with open(state_path(data_dir, table), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_state(data_dir: str, table: str, state: Dict):
+    """Атомарно сохраняет состояние синхронизации."""
+    path = state_path(data_dir, table)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+
+def read_base_revision(json_path: str) -> Optional[int]:
+    """
+    Ревизия базового JSON по его первой строке (весь файл не читается).
+
+    None — файла нет или он записан без ревизии (старый формат).
+    """
+    try:
+        with open(json_path, 'r', encoding='utf-8') as f:
+            header = f.readline()
+    except OSError:
+        return None
+    # Первая строка: {"updated_at": ..., "revision": N, "items": [
+    try:
+        return json.loads(header.rstrip() + ']}').get('revision')
+    except ValueError:
+        return None
+
+
+class ChangeLogWriter:
+    """
+    Дописывает одну пачку изменений в журнал.
+
+    Строки пишутся сразу, пачка становится видимой читателю только
+    после строки commit в close(); abort() обрезает журнал обратно.
+    """
+
+    def __init__(self, path: str, revision: int):
+        self.path = path
+        self.revision = revision
+        self.changes = 0
+        self._file = open(path, 'a', encoding='utf-8')
+        self._start = self._file.tell()
+
+    def _write(self, entry: Dict):
+        self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def upsert(self, record: Dict):
+        self._write({'revision': self.revision, 'op': 'upsert', 'id': record['id'], 'record': record})
+        self.changes += 1
+
+    def delete(self, record_id: str):
+        self._write({'revision': self.revision, 'op': 'delete', 'id': record_id})
+        self.changes += 1
+
+    def close(self, updated_at: str):
+        self._write({'revision': self.revision, 'op': 'commit', 'updated_at': updated_at, 'changes': self.changes})
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+        # Без лишнего truncate: он меняет mtime, и бот зря перечитал бы журнал
+        if os.path.getsize(self.path) != self._start:
+            os.truncate(self.path, self._start)
+
+
+def reset_log(path: str):
+    """Начинает журнал заново (после перезаписи базового файла)."""
+    tmp_path = f"{path}.tmp"
+    open(tmp_path, 'w').close()
+    os.replace(tmp_path, path)
+
+
+@dataclass
+class ChangeBatch:
+    """Объединённые изменения нескольких пачек журнала."""
+    upserts: Dict[str, Dict] = field(default_factory=dict)
+    deletes: Set[str] = field(default_factory=set)
+    revision: int = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.upserts or self.deletes)
+
+    @property
+    def changed_ids(self) -> Set[str]:
+        return self.deletes.union(self.upserts)
+
+    def add(self, entry: Dict):
+        record_id = entry['id']
+        if entry['op'] == 'upsert':
+            self.deletes.discard(record_id)
+            self.upserts[record_id] = entry['record']
+        else:
+            self.upserts.pop(record_id, None)
+            self.deletes.add(record_id)
+
+
+def read_changes(path: str, offset: int = 0, after_revision: int = 0) -> Tuple[ChangeBatch, int]:
+    """
+    Читает закрытые пачки журнала начиная с offset.
+
+    Returns:
+        (изменения с ревизией больше after_revision, смещение после последней
+        закрытой пачки — с него читать в следующий раз)
+    """
+    batch = ChangeBatch(revision=after_revision)
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return batch, 0
+
+    with f:
+        f.seek(offset)
+        pending: List[Dict] = []
+        for line in f:
+            if not line.endswith(b'\n'):
+                # Пачка ещё дописывается
+                break
+            entry = json.loads(line)
+            if entry['op'] != 'commit':
+                pending.append(entry)
+                continue
+            revision = entry['revision']
+            if revision > after_revision:
+                # Строки прерванной синхронизации (другая ревизия) отбрасываются
+                for change in pending:
+                    if change['revision'] == revision:
+                        batch.add(change)
+                batch.revision = max(batch.revision, revision)
+            pending = []
+            offset = f.tell()
+    return batch, offset
+
+
+def apply_changes(items: List[Dict], batch: ChangeBatch) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Применяет изменения к списку записей.
+
+    Изменённые записи остаются на своих местах, новые добавляются в конец,
+    удалённые убираются. Исходный список не меняется.
+
+    Returns:
+        (новый список, прежние версии изменённых и удалённых записей)
+    """
+    changed = batch.changed_ids
+    replaced: List[Dict] = []
+    result: List[Dict] = []
+    seen: Set[str] = set()
+    for item in items:
+        record_id = item.get('id')
+        if record_id not in changed:
+            result.append(item)
+            continue
+        replaced.append(item)
+        seen.add(record_id)
+        if record_id in batch.upserts:
+            result.append(batch.upserts[record_id])
+    result.extend(record for record_id, record in batch.upserts.items() if record_id not in seen)
+    return result, replaced
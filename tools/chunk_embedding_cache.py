@@ -0,0 +1,218 @@
+"""
+Кэш эмбеддингов чанков базы знаний, общий для всех пересборок.
+
+Большинство чанков после разбиения документов совпадают байт в байт
+от сборки к сборке, поэтому update_vector_store_telegram перед запросом
+к embeddings API ищет вектор здесь. Ключ — хэш модели, размерности
+и текста чанка (content-addressed), так что смена модели не даёт
+«чужих» векторов.
+
+Формат файла (компактный, без JSON):
+    MAGIC (8 байт) | записи
+    запись: ключ (16 байт blake2b) | used_at uint32 | размерность uint32 | float32 × размерность
+
+Файл открывается через mmap, векторы читаются по мере запросов. При flush
+время использования обновляется на месте, новые записи дописываются
+в конец, а если файл превысил лимит — он переписывается, и в нём остаются
+последние использованные записи (примерно 90% лимита).
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'EMBCACH1'
+_HEAD = struct.Struct('<16sII')   # ключ, used_at, размерность
+
+# После вытеснения файл занимает не больше этой доли лимита
+COMPACT_TARGET = 0.9
+
+
+def chunk_cache_key(text: str, model: str, dimensions: Optional[int]) -> bytes:
+    data = f"{model}\n{dimensions or 0}\n".encode('utf-8') + text.encode('utf-8')
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class ChunkEmbeddingCache:
+    """
+    Эмбеддинги чанков по хэшу текста.
+
+    Используется одним процессом обновления базы за раз: get_many/put_many
+    работают с памятью и mmap, на диск изменения попадают в flush().
+    """
+
+    def __init__(self, path: str, model: str, dimensions: Optional[int], max_bytes: int):
+        self.path = path
+        self.model = model
+        self.dimensions = dimensions
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # ключ → (смещение записи в файле, used_at)
+        self._index: Dict[bytes, Tuple[int, int]] = {}
+        self._touched: Dict[bytes, int] = {}
+        self._new: Dict[bytes, bytes] = {}
+        self._file = None
+        self._mmap: Optional[mmap.mmap] = None
+        self._valid_size = len(MAGIC)
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._open()
+
+    def _open(self):
+        try:
+            if not os.path.exists(self.path) or os.path.getsize(self.path) <= len(MAGIC):
+                return
+            self._file = open(self.path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except OSError as e:
+            logger.warning(f"Кэш эмбеддингов чанков недоступен ({self.path}): {e}")
+            self._close()
+            return
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            logger.warning(f"Кэш эмбеддингов чанков {self.path}: неизвестный формат, будет создан заново")
+            self._close()
+            return
+
+        data, offset, size = self._mmap, len(MAGIC), len(self._mmap)
+        while offset + _HEAD.size <= size:
+            key, used_at, dim = _HEAD.unpack_from(data, offset)
+            end = offset + _HEAD.size + dim * 4
+            if end > size:
+                break  # запись оборвана (обновление прервалось при дописывании)
+            self._index[key] = (offset, used_at)
+            offset = end
+        self._valid_size = offset
+
+    def _close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _read_vector(self, offset: int) -> bytes:
+        _, _, dim = _HEAD.unpack_from(self._mmap, offset)
+        start = offset + _HEAD.size
+        return self._mmap[start:start + dim * 4]
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Векторы для текстов (None — нет в кэше)."""
+        now = int(time.time())
+        result: List[Optional[List[float]]] = []
+        with self._lock:
+            for text in texts:
+                key = chunk_cache_key(text, self.model, self.dimensions)
+                blob = self._new.get(key)
+                if blob is None and key in self._index:
+                    blob = self._read_vector(self._index[key][0])
+                    self._touched[key] = now
+                if blob is None:
+                    self.misses += 1
+                    result.append(None)
+                else:
+                    self.hits += 1
+                    result.append(array('f', blob).tolist())
+        return result
+
+    def put_many(self, texts: List[str], embeddings: List[List[float]]):
+        """Запоминает векторы; для уже известных текстов только отмечает использование."""
+        now = int(time.time())
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                key = chunk_cache_key(text, self.model, self.dimensions)
+                if key in self._index:
+                    self._touched[key] = now
+                elif key not in self._new:
+                    self._new[key] = array('f', embedding).tobytes()
+
+    def _size_after_flush(self) -> int:
+        return self._valid_size + sum(_HEAD.size + len(blob) for blob in self._new.values())
+
+    def flush(self):
+        """Записывает изменения на диск; при превышении лимита вытесняет старые записи."""
+        with self._lock:
+            try:
+                if self._size_after_flush() > self.max_bytes:
+                    self._compact()
+                else:
+                    self._append()
+            except OSError as e:
+                logger.warning(f"Не удалось сохранить кэш эмбеддингов чанков: {e}")
+            finally:
+                self._touched.clear()
+                self._new.clear()
+                self._close()
+                self._index.clear()
+                self._valid_size = len(MAGIC)
+                self._open()
+
+    def _append(self):
+        if not self._touched and not self._new:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        mode = 'r+b' if self._mmap is not None else 'wb'
+        self._close()
+        with open(self.path, mode) as f:
+            if mode == 'wb':
+                f.write(MAGIC)
+            for key, used_at in self._touched.items():
+                f.seek(self._index[key][0] + 16)
+                f.write(struct.pack('<I', used_at))
+            # Оборванный хвост от прерванной записи затираем
+            f.seek(self._valid_size if mode == 'r+b' else len(MAGIC))
+            f.truncate()
+            now = int(time.time())
+            for key, blob in self._new.items():
+                f.write(_HEAD.pack(key, now, len(blob) // 4))
+                f.write(blob)
+
+    def _compact(self):
+        now = int(time.time())
+        records = [(now, key, None, blob) for key, blob in self._new.items()]
+        for key, (offset, used_at) in self._index.items():
+            records.append((self._touched.get(key, used_at), key, offset, None))
+        records.sort(key=lambda record: record[0], reverse=True)
+
+        tmp_path = f"{self.path}.tmp"
+        budget = int(self.max_bytes * COMPACT_TARGET) - len(MAGIC)
+        kept = 0
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            for used_at, key, offset, blob in records:
+                if blob is None:
+                    blob = self._read_vector(offset)
+                record_size = _HEAD.size + len(blob)
+                if record_size > budget:
+                    break
+                budget -= record_size
+                f.write(_HEAD.pack(key, used_at, len(blob) // 4))
+                f.write(blob)
+                kept += 1
+        self._close()
+        os.replace(tmp_path, self.path)
+        self.evicted += len(records) - kept
+        logger.info(f"Кэш эмбеддингов чанков: вытеснено {len(records) - kept} записей, осталось {kept}")
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted': self.evicted,
+                'entries': len(self._index) + len(self._new),
+                'size_mb': round(self._size_after_flush() / 2 ** 20, 2),
+            }
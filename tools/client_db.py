@@ -0,0 +1,335 @@
+"""
+SQLite-хранилище данных 1С (clients / contracts / transactions).
+
+Одна база data/clients.db в режиме WAL: bitrix_sync вставляет выгрузки
+через upsert (перезаписываются только изменившиеся строки), а бот в это
+время читает из той же базы — до коммита синхронизации он видит прежние
+данные. Запросы идут по индексам: логин, телефон, id клиента и
+(id контракта, дата) — окно «транзакции за N дней» это диапазон индекса.
+
+Используется bitrix_sync (SqliteWriter) и client_store (ClientDatabase
+при CLIENT_DATA_FORMAT=sqlite).
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import abc
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DB_FILENAME = 'clients.db'
+
+# Сколько ждать блокировку записи, мс (синхронизации могут пересечься)
+BUSY_TIMEOUT_MS = 30_000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    login TEXT,
+    last_name TEXT,
+    first_name TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS clients_login ON clients (login, seq);
+CREATE INDEX IF NOT EXISTS clients_seq ON clients (seq);
+
+CREATE TABLE IF NOT EXISTS client_phones (
+    phone TEXT NOT NULL,
+    client_id TEXT NOT NULL,
+    PRIMARY KEY (phone, client_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS client_phones_client ON client_phones (client_id);
+
+CREATE TABLE IF NOT EXISTS contracts (
+    id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    client_id TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS contracts_client ON contracts (client_id, seq);
+CREATE INDEX IF NOT EXISTS contracts_seq ON contracts (seq);
+
+CREATE TABLE IF NOT EXISTS transactions (
+    id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    contract_id TEXT,
+    date TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_contract_date ON transactions (contract_id, date DESC, seq);
+CREATE INDEX IF NOT EXISTS transactions_seq ON transactions (seq);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    table_name TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    updated_at TEXT
+);
+"""
+
+# Колонки таблиц помимо id, seq и data (путь к полю записи через точку)
+TABLE_COLUMNS = {
+    'clients': {'login': 'login', 'last_name': 'student.last_name', 'first_name': 'student.first_name'},
+    'contracts': {'client_id': 'client_id'},
+    'transactions': {'contract_id': 'contract_id', 'date': 'date'},
+}
+
+
+def db_path(data_dir: str) -> str:
+    """Путь к базе данных 1С."""
+    return os.path.join(data_dir, DB_FILENAME)
+
+
+def _get_path(record: Dict, path: str) -> str:
+    value = record
+    for key in path.split('.'):
+        value = value.get(key, '') if isinstance(value, dict) else ''
+    return value if isinstance(value, str) else str(value)
+
+
+# Таблицы, где важна позиция в выгрузке: при дублях логина/клиента берётся
+# первая запись, как в JSON. Для транзакций seq — только порядок при равной
+# дате, и сдвиг позиций (новая транзакция в середине файла) не должен
+# перезаписывать всю таблицу
+_SEQ_TRACKED = {'clients', 'contracts'}
+
+
+def _upsert_sql(table: str) -> str:
+    columns = ['id', 'seq', *TABLE_COLUMNS[table], 'data']
+    updates = ', '.join(f'{name} = excluded.{name}' for name in columns[1:])
+    # Строка перезаписывается только если запись (или её позиция) изменилась
+    changed = f'{table}.data IS NOT excluded.data'
+    if table in _SEQ_TRACKED:
+        changed += f' OR {table}.seq IS NOT excluded.seq'
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT (id) DO UPDATE SET {updates} WHERE {changed}"
+    )
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, isolation_level=None, timeout=BUSY_TIMEOUT_MS / 1000)
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    return conn
+
+
+class SqliteWriter:
+    """
+    Запись выгрузки в базу: add() для каждой записи, затем close().
+
+    Вся выгрузка — одна транзакция. Неизменившиеся строки не трогаются,
+    записи, которых нет в новой выгрузке, удаляются в close(). Версия
+    таблицы в sync_state растёт только если что-то изменилось — по ней
+    бот понимает, что индексы в памяти пора пересобрать.
+    """
+
+    def __init__(self, path: str, table: str, updated_at: str = ''):
+        if table not in TABLE_COLUMNS:
+            raise ValueError(f"Неизвестная таблица: {table}")
+        self.path = path
+        self.table = table
+        self.updated_at = updated_at
+        self.count = 0
+        self.changed = 0
+        self._upsert = _upsert_sql(table)
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = _connect(path)
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.execute('PRAGMA synchronous = NORMAL')
+        self._conn.executescript(_SCHEMA)
+        self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS seen (id TEXT PRIMARY KEY)')
+        self._conn.execute('BEGIN IMMEDIATE')
+        self._conn.execute('DELETE FROM temp.seen')
+
+    def add(self, record: Dict):
+        record_id = record.get('id')
+        if not record_id:
+            # Без Ид запись нельзя сопоставить со следующей выгрузкой
+            logger.warning(f"{self.table}: запись без id пропущена")
+            return
+
+        self._conn.execute('INSERT OR IGNORE INTO temp.seen (id) VALUES (?)', (record_id,))
+        values = [record_id, self.count]
+        values.extend(_get_path(record, path) for path in TABLE_COLUMNS[self.table].values())
+        values.append(json.dumps(record, ensure_ascii=False))
+
+        if self._conn.execute(self._upsert, values).rowcount:
+            self.changed += 1
+            if self.table == 'clients':
+                self._conn.execute('DELETE FROM client_phones WHERE client_id = ?', (record_id,))
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO client_phones (phone, client_id) VALUES (?, ?)',
+                    [(phone, record_id) for phone in record.get('contacts', {}).get('phones', [])]
+                )
+        self.count += 1
+
+    def close(self):
+        conn = self._conn
+        deleted = conn.execute(
+            f'DELETE FROM {self.table} WHERE id NOT IN (SELECT id FROM temp.seen)'
+        ).rowcount
+        if self.table == 'clients' and deleted:
+            conn.execute('DELETE FROM client_phones WHERE client_id NOT IN (SELECT id FROM clients)')
+        self.changed += deleted
+
+        (count,) = conn.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()
+        conn.execute(
+            'INSERT INTO sync_state (table_name, version, count, updated_at) VALUES (?, 1, ?, ?) '
+            'ON CONFLICT (table_name) DO UPDATE SET version = version + ?, '
+            'count = excluded.count, updated_at = excluded.updated_at',
+            (self.table, count, self.updated_at, 1 if self.changed else 0)
+        )
+        conn.execute('COMMIT')
+        conn.close()
+        logger.info(f"{self.table}: изменено строк в базе {self.changed} (удалено {deleted})")
+
+    def abort(self):
+        """Откатывает транзакцию — в базе остаются прежние данные."""
+        if self._conn.in_transaction:
+            self._conn.execute('ROLLBACK')
+        self._conn.close()
+
+
+class ClientDatabase:
+    """
+    Запросы к базе данных 1С.
+
+    У каждого потока своё соединение (tools вызываются из asyncio.to_thread),
+    соединения только читают.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = _connect(self.path)
+            conn.execute('PRAGMA query_only = ON')
+            self._local.conn = conn
+        return conn
+
+    def _query(self, sql: str, params: Sequence = ()) -> List[Tuple]:
+        return self._conn().execute(sql, params).fetchall()
+
+    def table_state(self) -> Dict[str, Tuple[int, int]]:
+        """Таблица → (версия, число записей); пусто, если база ещё не создана."""
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            rows = self._query('SELECT table_name, version, count FROM sync_state')
+        except sqlite3.Error as e:
+            logger.warning(f"Не удалось прочитать {self.path}: {e}")
+            return {}
+        return {name: (version, count) for name, version, count in rows}
+
+    def client_by_login(self, login: str) -> Optional[Dict]:
+        rows = self._query('SELECT data FROM clients WHERE login = ? ORDER BY seq LIMIT 1', (login,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def client_by_id(self, client_id: str) -> Optional[Dict]:
+        rows = self._query('SELECT data FROM clients WHERE id = ?', (client_id,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def clients_by_phone(self, phone: str) -> List[Dict]:
+        rows = self._query(
+            'SELECT c.data FROM client_phones p JOIN clients c ON c.id = p.client_id '
+            'WHERE p.phone = ? ORDER BY c.seq',
+            (phone,)
+        )
+        return [json.loads(data) for (data,) in rows]
+
+    def client_names(self) -> List[Tuple[str, str, str]]:
+        """(id, фамилия, имя) всех клиентов в порядке выгрузки."""
+        return self._query('SELECT id, last_name, first_name FROM clients ORDER BY seq')
+
+    def contract_for_client(self, client_id: str) -> Optional[Dict]:
+        rows = self._query(
+            'SELECT data FROM contracts WHERE client_id = ? ORDER BY seq LIMIT 1', (client_id,)
+        )
+        return json.loads(rows[0][0]) if rows else None
+
+    def transactions_for_contract(
+        self,
+        contract_id: str,
+        since: Optional[str] = None,
+        limit: Optional[int] = None
+    ) -> List[Dict]:
+        """Транзакции контракта (последние сначала), при since — с даты since включительно."""
+        sql = 'SELECT data FROM transactions WHERE contract_id = ?'
+        params: list = [contract_id]
+        if since:
+            sql += ' AND date >= ?'
+            params.append(since)
+        sql += ' ORDER BY date DESC, seq'
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        return [json.loads(data) for (data,) in self._query(sql, params)]
+
+    def iter_table(self, table: str) -> Iterator[Dict]:
+        """Все записи таблицы в порядке выгрузки."""
+        if table not in TABLE_COLUMNS:
+            raise ValueError(f"Неизвестная таблица: {table}")
+        for (data,) in self._conn().execute(f'SELECT data FROM {table} ORDER BY seq'):
+            yield json.loads(data)
+
+    def record_at(self, table: str, position: int) -> Optional[Dict]:
+        if table not in TABLE_COLUMNS:
+            raise ValueError(f"Неизвестная таблица: {table}")
+        rows = self._query(f'SELECT data FROM {table} ORDER BY seq LIMIT 1 OFFSET ?', (position,))
+        return json.loads(rows[0][0]) if rows else None
+
+
+class TableRecords(abc.Sequence):
+    """
+    Таблица базы как список словарей (для load_clients и проверок на пустоту).
+
+    Длина берётся из sync_state на момент загрузки снимка, итерация —
+    один запрос по всей таблице.
+    """
+
+    def __init__(self, db: Optional[ClientDatabase], table: str, count: int = 0):
+        self._db = db
+        self._table = table
+        self._count = count if db is not None else 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[Dict]:
+        if self._db is not None:
+            yield from self._db.iter_table(self._table)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        record = self._db.record_at(self._table, i) if 0 <= i < len(self) else None
+        if record is None:
+            raise IndexError(i)
+        return record
+
+
+class ClientsById(abc.Sequence):
+    """Клиенты по списку id (позиции — как в индексе ФИО)."""
+
+    def __init__(self, db: ClientDatabase, ids: Sequence[str]):
+        self._db = db
+        self._ids = ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self._db.client_by_id(self._ids[i]) or {}
@@ -0,0 +1,553 @@
+"""
+Хранилище данных 1С в памяти процесса.
+
+Файлы clients.json / contracts.json / transactions.json читаются один раз,
+по ним строятся индексы (логин → клиент, клиент → контракт,
+контракт → транзакции, телефон → клиенты, ФИО → клиенты). Когда скрипты синхронизации
+перезаписывают файлы, снимок пересобирается и атомарно подменяется
+(проверка inode/mtime/size на каждом обращении).
+
+При CLIENT_DATA_FORMAT=binary вместо JSON открываются бинарные снимки
+(clients.bin и т.д.), которые пишет bitrix_sync: загрузка — это mmap,
+а индексы уже лежат в файлах. При CLIENT_DATA_FORMAT=sqlite запросы идут
+в базу clients.db (tools/client_db.py), а вместо сигнатуры файла
+сравнивается версия таблицы, которую повышает синхронизация.
+
+JSON-файлы синхронизация обновляет через журнал изменений
+({table}.changes.jsonl, см. tools/change_log.py): если вырос только журнал,
+новые записи применяются к текущему снимку, а индексы пересобираются лишь
+для изменившихся таблиц (для транзакций — лишь для затронутых контрактов).
+"""
+
+import json
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from .change_log import ChangeBatch, apply_changes, changes_path, read_changes
+from .client_db import ClientDatabase, ClientsById, TableRecords, db_path
+from .name_index import NameIndex
+from .phone_utils import normalize_phones
+from .snapshot_format import RecordList, SnapshotTable, snapshot_path
+
+logger = logging.getLogger(__name__)
+
+# Путь к данным 1С (относительно рабочей директории бота, как в client_tools)
+DATA_DIR = 'data'
+
+# Формат данных 1С, из которых читает бот: json (clients.json и т.д.),
+# binary (clients.bin и т.д., см. tools/snapshot_format.py)
+# или sqlite (clients.db, см. tools/client_db.py)
+CLIENT_DATA_FORMAT = os.getenv('CLIENT_DATA_FORMAT', 'json')
+
+# Файлы, из которых собирается снимок
+DATA_FILES = ('clients', 'contracts', 'transactions')
+
+# Дельта таблицы из журнала: (изменения, прежние версии затронутых записей)
+TableDelta = Tuple[ChangeBatch, List[Dict]]
+
+# Сигнатура файла: (inode, mtime_ns, size) или None если файла нет;
+# для sqlite — (версия таблицы,)
+FileSignature = Optional[Tuple[int, ...]]
+
+
+def _file_signature(path: str) -> FileSignature:
+    """Возвращает сигнатуру файла для проверки изменений."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _read_items(path: str) -> Tuple[List[Dict], int]:
+    """Читает список записей и ревизию из JSON-файла синхронизации."""
+    if not os.path.exists(path):
+        return [], 0
+
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+        return data.get('items', []), data.get('revision', 0)
+
+
+def _client_phones(clients: List[Dict]) -> List[List[str]]:
+    """
+    Нормализованные телефоны каждого клиента.
+
+    Берутся из поля contacts.phones, которое пишет bitrix_sync; для файлов
+    старого формата номера нормализуются здесь одним пакетом.
+    """
+    if all('phones' in client.get('contacts', {}) for client in clients):
+        return [client['contacts']['phones'] for client in clients]
+    return normalize_phones(client.get('contacts', {}).get('phone', '') for client in clients)
+
+
+def _take_since(transactions: Sequence[Dict], since: Optional[str], limit: Optional[int]) -> List[Dict]:
+    """Начало списка транзакций (последние сначала) не старше since."""
+    end = len(transactions)
+    if since:
+        # Даты ISO сравниваются как строки; пустые даты в конце списка
+        end = next((i for i, trans in enumerate(transactions) if trans.get('date', '') < since), end)
+    if limit is not None:
+        end = min(end, limit)
+    return list(transactions[:end])
+
+
+class ClientDataSnapshot:
+    """
+    Неизменяемый снимок данных 1С с индексами.
+
+    Все списки и словари общие для всех потоков — их нельзя модифицировать.
+    Индексы таблиц, которые не изменились с предыдущего снимка, берутся
+    из него как есть.
+    """
+
+    def __init__(
+        self,
+        sources: Dict[str, List[Dict]],
+        signatures: Dict[str, FileSignature],
+        previous: Optional['ClientDataSnapshot'] = None,
+        deltas: Optional[Dict[str, TableDelta]] = None,
+        log_positions: Optional[Dict[str, Tuple[int, int]]] = None
+    ):
+        self.sources = sources
+        self.signatures = signatures
+        # таблица → (ревизия базового JSON, смещение в журнале изменений)
+        self.log_positions = log_positions or {}
+        self.clients = sources['clients']
+        self.contracts = sources['contracts']
+        self.transactions = sources['transactions']
+        deltas = deltas or {}
+
+        def unchanged(name: str) -> bool:
+            return previous is not None and previous.sources[name] is sources[name]
+
+        if unchanged('clients'):
+            self.client_by_login = previous.client_by_login
+            self.clients_by_phone = previous.clients_by_phone
+            self.name_index = previous.name_index
+        else:
+            self._index_clients()
+
+        if unchanged('contracts'):
+            self.contract_by_client_id = previous.contract_by_client_id
+        else:
+            self._index_contracts()
+
+        if unchanged('transactions'):
+            self.transactions_by_contract = previous.transactions_by_contract
+        elif previous is not None and 'transactions' in deltas:
+            self._update_transactions(previous.transactions_by_contract, deltas['transactions'])
+        else:
+            self._index_transactions()
+
+    def _index_clients(self):
+        # логин → клиент (первое вхождение, как при линейном поиске)
+        self.client_by_login: Dict[str, Dict] = {}
+        # нормализованный телефон (+7XXXXXXXXXX) → клиенты (порядок как в файле)
+        self.clients_by_phone: Dict[str, List[Dict]] = {}
+
+        for client, phones in zip(self.clients, _client_phones(self.clients)):
+            login = client.get('login')
+            if login and login not in self.client_by_login:
+                self.client_by_login[login] = client
+
+            for phone in phones:
+                self.clients_by_phone.setdefault(phone, []).append(client)
+
+        # индекс фамилий/имён учеников
+        self.name_index = NameIndex(self.clients)
+
+    def _index_contracts(self):
+        # id клиента → первый контракт
+        self.contract_by_client_id: Dict[str, Dict] = {}
+        for contract in self.contracts:
+            self.contract_by_client_id.setdefault(contract.get('client_id'), contract)
+
+    def _index_transactions(self):
+        # id контракта → транзакции, отсортированные по дате (последние сначала)
+        self.transactions_by_contract: Dict[str, List[Dict]] = {}
+        for trans in self.transactions:
+            self.transactions_by_contract.setdefault(trans.get('contract_id'), []).append(trans)
+        for items in self.transactions_by_contract.values():
+            items.sort(key=lambda x: x.get('date', ''), reverse=True)
+
+    def _update_transactions(self, previous_index: Dict[str, List[Dict]], delta: TableDelta):
+        """Пересобирает списки транзакций только у затронутых дельтой контрактов."""
+        batch, replaced = delta
+        changed_ids = batch.changed_ids
+        added: Dict[str, List[Dict]] = {}
+        for trans in batch.upserts.values():
+            added.setdefault(trans.get('contract_id'), []).append(trans)
+        affected = set(added)
+        affected.update(trans.get('contract_id') for trans in replaced)
+
+        self.transactions_by_contract = dict(previous_index)
+        for contract_id in affected:
+            items = [
+                trans for trans in previous_index.get(contract_id, ())
+                if trans.get('id') not in changed_ids
+            ]
+            items.extend(added.get(contract_id, ()))
+            if items:
+                items.sort(key=lambda x: x.get('date', ''), reverse=True)
+                self.transactions_by_contract[contract_id] = items
+            else:
+                self.transactions_by_contract.pop(contract_id, None)
+
+    def get_client_by_login(self, login: str) -> Optional[Dict]:
+        """Клиент по логину (лицевому счёту)."""
+        return self.client_by_login.get(login)
+
+    def get_contract_for_client(self, client_id: str) -> Optional[Dict]:
+        """Контракт клиента по его id."""
+        return self.contract_by_client_id.get(client_id)
+
+    def get_transactions_for_contract(
+        self,
+        contract_id: str,
+        since: Optional[str] = None,
+        limit: Optional[int] = None
+    ) -> List[Dict]:
+        """Транзакции контракта по дате (последние сначала), с даты since включительно."""
+        transactions = self.transactions_by_contract.get(contract_id, [])
+        if since is None and limit is None:
+            return transactions
+        return _take_since(transactions, since, limit)
+
+    def find_clients_by_phone(self, normalized_phone: str) -> List[Dict]:
+        """Клиенты с данным телефоном (телефон уже нормализован)."""
+        return self.clients_by_phone.get(normalized_phone, [])
+
+
+class BinaryClientSnapshot:
+    """
+    Снимок данных 1С поверх бинарных файлов (tools/snapshot_format).
+
+    Файлы открываются через mmap без разбора, поиск идёт по индексам
+    в самих файлах, а словарь записи создаётся только для найденных строк.
+    Интерфейс совпадает с ClientDataSnapshot.
+    """
+
+    def __init__(
+        self,
+        sources: Dict[str, Optional[SnapshotTable]],
+        signatures: Dict[str, FileSignature],
+        previous: Optional['BinaryClientSnapshot'] = None
+    ):
+        self.sources = sources
+        self.signatures = signatures
+        self._clients_table = sources['clients']
+        self._contracts_table = sources['contracts']
+        self._transactions_table = sources['transactions']
+        self.clients = RecordList(self._clients_table)
+        self.contracts = RecordList(self._contracts_table)
+        self.transactions = RecordList(self._transactions_table)
+        self._name_index: Optional[NameIndex] = None
+        if previous is not None and previous.sources['clients'] is sources['clients']:
+            self._name_index = previous._name_index
+
+    @property
+    def name_index(self) -> NameIndex:
+        """Индекс ФИО строится при первом поиске по фамилии."""
+        if self._name_index is None:
+            table = self._clients_table
+            if table is None:
+                self._name_index = NameIndex([])
+            else:
+                self._name_index = NameIndex(
+                    self.clients,
+                    last_names=table.column('student.last_name'),
+                    first_names=table.column('student.first_name')
+                )
+        return self._name_index
+
+    @staticmethod
+    def _rows(table: Optional[SnapshotTable], index: str, key: str) -> List[Dict]:
+        if table is None or not key:
+            return []
+        return [table.row(i) for i in table.lookup(index, key)]
+
+    def get_client_by_login(self, login: str) -> Optional[Dict]:
+        """Клиент по логину (лицевому счёту)."""
+        table = self._clients_table
+        if table is None or not login:
+            return None
+        rows = table.lookup('login', login)
+        return table.row(rows[0]) if rows else None
+
+    def get_contract_for_client(self, client_id: str) -> Optional[Dict]:
+        """Контракт клиента по его id."""
+        table = self._contracts_table
+        if table is None or not client_id:
+            return None
+        rows = table.lookup('client_id', client_id)
+        return table.row(rows[0]) if rows else None
+
+    def get_transactions_for_contract(
+        self,
+        contract_id: str,
+        since: Optional[str] = None,
+        limit: Optional[int] = None
+    ) -> List[Dict]:
+        """Транзакции контракта по дате (последние сначала), с даты since включительно."""
+        table = self._transactions_table
+        if table is None or not contract_id:
+            return []
+        rows = table.lookup('contract_id', contract_id)
+        if since:
+            # Строки контракта в файле уже идут по убыванию даты — словари не нужны
+            dates = table.column('date')
+            rows = rows[:next((n for n, i in enumerate(rows) if dates[i] < since), len(rows))]
+        if limit is not None:
+            rows = rows[:limit]
+        return [table.row(i) for i in rows]
+
+    def find_clients_by_phone(self, normalized_phone: str) -> List[Dict]:
+        """Клиенты с данным телефоном (телефон уже нормализован)."""
+        return self._rows(self._clients_table, 'phone', normalized_phone)
+
+
+class SqliteClientSnapshot:
+    """
+    Данные 1С в SQLite (tools/client_db): каждый запрос — запрос по индексу.
+
+    В памяти только индекс ФИО (строится при первом поиске по фамилии).
+    Снимок фиксирует версии таблиц, но сами запросы видят последний
+    коммит синхронизации. Интерфейс совпадает с ClientDataSnapshot.
+    """
+
+    def __init__(
+        self,
+        sources: Dict[str, TableRecords],
+        signatures: Dict[str, FileSignature],
+        db: ClientDatabase,
+        previous: Optional['SqliteClientSnapshot'] = None
+    ):
+        self.sources = sources
+        self.signatures = signatures
+        self._db = db
+        self.clients = sources['clients']
+        self.contracts = sources['contracts']
+        self.transactions = sources['transactions']
+        self._name_index: Optional[NameIndex] = None
+        if previous is not None and previous.sources['clients'] is sources['clients']:
+            self._name_index = previous._name_index
+
+    @property
+    def name_index(self) -> NameIndex:
+        """Индекс ФИО строится при первом поиске по фамилии."""
+        if self._name_index is None:
+            names = self._db.client_names() if self.clients else []
+            self._name_index = NameIndex(
+                ClientsById(self._db, [client_id for client_id, _, _ in names]),
+                last_names=[last_name or '' for _, last_name, _ in names],
+                first_names=[first_name or '' for _, _, first_name in names]
+            )
+        return self._name_index
+
+    def get_client_by_login(self, login: str) -> Optional[Dict]:
+        """Клиент по логину (лицевому счёту)."""
+        return self._db.client_by_login(login) if self.clients and login else None
+
+    def get_contract_for_client(self, client_id: str) -> Optional[Dict]:
+        """Контракт клиента по его id."""
+        return self._db.contract_for_client(client_id) if self.contracts and client_id else None
+
+    def get_transactions_for_contract(
+        self,
+        contract_id: str,
+        since: Optional[str] = None,
+        limit: Optional[int] = None
+    ) -> List[Dict]:
+        """Транзакции контракта по дате (последние сначала), с даты since включительно."""
+        if not self.transactions or not contract_id:
+            return []
+        return self._db.transactions_for_contract(contract_id, since, limit)
+
+    def find_clients_by_phone(self, normalized_phone: str) -> List[Dict]:
+        """Клиенты с данным телефоном (телефон уже нормализован)."""
+        return self._db.clients_by_phone(normalized_phone) if self.clients and normalized_phone else []
+
+
+# Любой из снимков: интерфейс запросов у них общий
+ClientSnapshot = Union[ClientDataSnapshot, BinaryClientSnapshot, SqliteClientSnapshot]
+
+
+class ClientDataStore:
+    """
+    Процессный кэш данных 1С с горячей подменой снимка.
+
+    Читатели получают снимок без блокировок; пересборка идёт под локом
+    и заканчивается присваиванием новой ссылки, поэтому читатель всегда
+    видит либо старый, либо новый снимок целиком.
+    """
+
+    def __init__(self, data_dir: str = DATA_DIR, data_format: str = CLIENT_DATA_FORMAT):
+        if data_format not in ('json', 'binary', 'sqlite'):
+            raise ValueError(f"Неизвестный формат данных 1С: {data_format}")
+        self.data_dir = data_dir
+        self.data_format = data_format
+        self._lock = threading.Lock()
+        self._snapshot: Optional[ClientSnapshot] = None
+        self.reload_count = 0
+        self._db = ClientDatabase(db_path(data_dir)) if data_format == 'sqlite' else None
+
+    def _path(self, name: str) -> str:
+        if self.data_format == 'binary':
+            return snapshot_path(self.data_dir, name)
+        if self.data_format == 'sqlite':
+            return db_path(self.data_dir)
+        return os.path.join(self.data_dir, f'{name}.json')
+
+    def _load_source(self, name: str):
+        """Читает один файл данных в представление выбранного формата."""
+        path = self._path(name)
+        if self.data_format == 'binary':
+            return SnapshotTable(path) if os.path.exists(path) else None
+        if self.data_format == 'sqlite':
+            _, count = self._db.table_state().get(name, (None, 0))
+            return TableRecords(self._db, name, count)
+        items, _ = self._load_json(name)
+        return items
+
+    def _load_json(self, name: str) -> Tuple[List[Dict], Tuple[int, int]]:
+        """Базовый JSON + журнал изменений. Возвращает (записи, (ревизия, смещение в журнале))."""
+        items, revision = _read_items(self._path(name))
+        batch, offset = read_changes(changes_path(self.data_dir, name), 0, revision)
+        if batch:
+            items, _ = apply_changes(items, batch)
+        return items, (revision, offset)
+
+    def _log_appended(self, previous: ClientDataSnapshot, signatures: Dict[str, FileSignature], name: str) -> bool:
+        """Журнал таблицы только дописан с прошлого снимка (не заменён и не обрезан)."""
+        key = f'{name}.changes'
+        old, new = previous.signatures.get(key), signatures.get(key)
+        if new is None or name not in previous.log_positions:
+            return False
+        _, offset = previous.log_positions[name]
+        return (old is None or old[0] == new[0]) and new[2] >= offset
+
+    def _read_log_delta(self, previous: ClientDataSnapshot, name: str):
+        """Применяет к таблице предыдущего снимка новые пачки журнала."""
+        revision, offset = previous.log_positions[name]
+        batch, offset = read_changes(changes_path(self.data_dir, name), offset, revision)
+        items, replaced = previous.sources[name], []
+        if batch:
+            items, replaced = apply_changes(items, batch)
+        return items, (batch, replaced), (revision, offset)
+
+    def _current_signatures(self) -> Dict[str, FileSignature]:
+        if self.data_format == 'sqlite':
+            # База обновляется на месте — сравниваем версии таблиц из sync_state
+            state = self._db.table_state()
+            return {name: (state[name][0],) if name in state else None for name in DATA_FILES}
+        signatures = {name: _file_signature(self._path(name)) for name in DATA_FILES}
+        if self.data_format == 'json':
+            for name in DATA_FILES:
+                signatures[f'{name}.changes'] = _file_signature(changes_path(self.data_dir, name))
+        return signatures
+
+    def get_snapshot(self) -> ClientSnapshot:
+        """Возвращает актуальный снимок, пересобирая его если файлы изменились."""
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.signatures == self._current_signatures():
+            return snapshot
+
+        with self._lock:
+            # Другой поток мог уже пересобрать снимок, пока мы ждали лок
+            signatures = self._current_signatures()
+            snapshot = self._snapshot
+            if snapshot is None or snapshot.signatures != signatures:
+                snapshot = self._build(snapshot, signatures)
+                self._snapshot = snapshot
+            return snapshot
+
+    def _build(
+        self,
+        previous: Optional[ClientSnapshot],
+        signatures: Dict[str, FileSignature]
+    ) -> ClientSnapshot:
+        """
+        Собирает новый снимок, перечитывая только изменившиеся файлы.
+
+        Для JSON, если базовый файл тот же, а журнал изменений дописан,
+        читаются только новые пачки журнала.
+        """
+        empty = {
+            'binary': None,
+            'sqlite': TableRecords(None, ''),
+        }.get(self.data_format, [])
+        sources = {}
+        deltas: Dict[str, TableDelta] = {}
+        log_positions = dict(getattr(previous, 'log_positions', {}))
+        for name in DATA_FILES:
+            log_key = f'{name}.changes'
+            base_unchanged = previous is not None and previous.signatures.get(name) == signatures[name]
+            if base_unchanged and previous.signatures.get(log_key) == signatures.get(log_key):
+                sources[name] = previous.sources[name]
+                continue
+            try:
+                if self.data_format != 'json':
+                    sources[name] = self._load_source(name)
+                elif base_unchanged and self._log_appended(previous, signatures, name):
+                    sources[name], deltas[name], log_positions[name] = self._read_log_delta(previous, name)
+                else:
+                    sources[name], log_positions[name] = self._load_json(name)
+            except (OSError, ValueError) as e:
+                # Файл мог быть перезаписан посреди чтения — оставляем старые данные
+                # и сбрасываем сигнатуру, чтобы попробовать снова при следующем обращении
+                logger.warning(f"Не удалось прочитать {self._path(name)}: {e}")
+                sources[name] = previous.sources[name] if previous is not None else empty
+                signatures = dict(signatures, **{name: None})
+
+        if self.data_format == 'binary':
+            snapshot = BinaryClientSnapshot(sources, signatures, previous)
+        elif self.data_format == 'sqlite':
+            snapshot = SqliteClientSnapshot(sources, signatures, self._db, previous)
+        else:
+            snapshot = ClientDataSnapshot(sources, signatures, previous, deltas, log_positions)
+        self.reload_count += 1
+        changes = sum(len(batch.upserts) + len(batch.deletes) for batch, _ in deltas.values())
+        action = f"обновлены из журнала ({changes} изменений)" if deltas else "загружены"
+        logger.info(
+            f"Данные 1С {action}: клиентов {len(snapshot.clients)}, "
+            f"контрактов {len(snapshot.contracts)}, транзакций {len(snapshot.transactions)}"
+        )
+        return snapshot
+
+    def invalidate(self) -> None:
+        """Сбрасывает снимок — следующее обращение перечитает все файлы."""
+        with self._lock:
+            self._snapshot = None
+
+
+_store: Optional[ClientDataStore] = None
+_store_lock = threading.Lock()
+
+
+def get_client_store() -> ClientDataStore:
+    """Возвращает общее для процесса хранилище данных 1С."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = ClientDataStore()
+    return _store
+
+
+def get_client_snapshot() -> ClientSnapshot:
+    """
+    Актуальный снимок данных 1С.
+
+    Внутри обработки сообщения возвращается снимок, зафиксированный
+    в RequestContext: все инструменты одного ответа видят одни данные
+    и не проверяют файлы повторно.
+    """
+    from .request_context import get_request_context
+
+    context = get_request_context()
+    if context is not None:
+        return context.client_snapshot
+    return get_client_store().get_snapshot()
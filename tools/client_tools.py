@@ -2,87 +2,36 @@
 Инструменты для работы с данными клиентов из 1С
 """
 
-import json
 import os
 import re
 from typing import List, Dict, Optional, Any
 from datetime import datetime, timedelta
 
+from .client_store import get_client_snapshot
+from .phone_utils import normalize_phone
+
+# Сколько учеников показывать в результатах поиска по ФИО
+NAME_SEARCH_RESULTS_LIMIT = 10
+
 
 def load_clients() -> List[Dict]:
-    """Загрузка данных клиентов из JSON"""
-    clients_path = os.path.join('data', 'clients.json')
-    
-    if not os.path.exists(clients_path):
-        return []
-    
-    with open(clients_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-        return data.get('items', [])
+    """Данные клиентов из общего снимка 1С (список только для чтения)"""
+    return get_client_snapshot().clients
 
 
 def load_contracts() -> List[Dict]:
-    """Загрузка данных контрактов из JSON"""
-    contracts_path = os.path.join('data', 'contracts.json')
-    
-    if not os.path.exists(contracts_path):
-        return []
-    
-    with open(contracts_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-        return data.get('items', [])
+    """Данные контрактов из общего снимка 1С (список только для чтения)"""
+    return get_client_snapshot().contracts
 
 
 def load_transactions() -> List[Dict]:
-    """Загрузка данных транзакций из JSON"""
-    transactions_path = os.path.join('data', 'transactions.json')
-    
-    if not os.path.exists(transactions_path):
-        return []
-    
-    with open(transactions_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-        return data.get('items', [])
+    """Данные транзакций из общего снимка 1С (список только для чтения)"""
+    return get_client_snapshot().transactions
 
 
-def normalize_phone(phone: str) -> str:
-    """
-    Нормализация телефонного номера к формату +7XXXXXXXXXX
-    
-    Args:
-        phone: Телефон в любом формате
-    
-    Returns:
-        Нормализованный телефон в формате +7XXXXXXXXXX
-    
-    Examples:
-        +79001234567 → +79001234567
-        89001234567 → +79001234567
-        9001234567 → +79001234567
-        +7 900 123 45 67 → +79001234567
-        8 (900) 123-45-67 → +79001234567
-    """
-    # Удаляем все символы кроме цифр и +
-    cleaned = re.sub(r'[^\d+]', '', phone)
-    
-    # Удаляем + в начале (если есть)
-    if cleaned.startswith('+'):
-        cleaned = cleaned[1:]
-    
-    # Приводим к формату 7XXXXXXXXXX
-    if cleaned.startswith('8') and len(cleaned) == 11:
-        # 89001234567 → 79001234567
-        cleaned = '7' + cleaned[1:]
-    elif cleaned.startswith('9') and len(cleaned) == 10:
-        # 9001234567 → 79001234567
-        cleaned = '7' + cleaned
-    elif not cleaned.startswith('7'):
-        # Если не начинается с 7, добавляем 7 (для случаев когда только 10 цифр)
-        if len(cleaned) == 10:
-            cleaned = '7' + cleaned
-    
-    # Добавляем +
-    return '+' + cleaned
+def get_client_by_login(login: str) -> Optional[Dict]:
+    """Клиент по логину (лицевому счёту) или None"""
+    return get_client_snapshot().get_client_by_login(login)
 
 
 def get_verified_client_data(login: str) -> Optional[Dict]:
@@ -107,67 +56,62 @@ def get_verified_client_data(login: str) -> Optional[Dict]:
             'teacher': str  # ФИО преподавателя
         }
     """
-    clients = load_clients()
+    client = get_client_by_login(login)
     
-    if not clients:
+    if not client:
         return None
     
-    # Ищем клиента по логину
-    for client in clients:
-        if client.get('login') == login:
-            student = client.get('student', {})
-            contacts = client.get('contacts', {})
-            
-            # Формируем полное ФИО ребёнка
-            student_name = f"{student.get('last_name', '')} {student.get('first_name', '')} {student.get('middle_name', '')}".strip()
-            
-            # Извлекаем ФИО родителя из поля contact_person
-            # Формат: "Фамилия Имя Отчество" → извлекаем "Имя Отчество" для обращения
-            contact_person = contacts.get('contact_person', '').strip()
-            
-            if contact_person:
-                # Разделяем на части
-                name_parts = contact_person.split()
-                
-                if len(name_parts) >= 3:
-                    # Стандартный формат "Фамилия Имя Отчество" → берём "Имя Отчество"
-                    client_name = f"{name_parts[1]} {name_parts[2]}"
-                elif len(name_parts) == 2:
-                    # "Имя Отчество" (без фамилии)
-                    client_name = f"{name_parts[0]} {name_parts[1]}"
-                else:
-                    # Одно слово (например, "Ольга")
-                    client_name = name_parts[0]
-            else:
-                # Fallback: если контактное лицо не указано, берём ФИО ребёнка
-                client_name = student_name
-            
-            # Парсим номер группы (может быть строкой вида "Группа 123" или просто "123")
-            group_str = student.get('group', '')
-            group_number = None
-            if group_str:
-                # Пытаемся извлечь число из строки
-                import re
-                match = re.search(r'\d+', str(group_str))
-                if match:
-                    try:
-                        group_number = int(match.group())
-                    except ValueError:
-                        pass
-            
-            return {
-                'login': client.get('login'),
-                'client_name': client_name,
-                'client_phone': contacts.get('phone', ''),
-                'student_name': student_name,
-                'student_first_name': student.get('first_name', ''),
-                'student_last_name': student.get('last_name', ''),
-                'group_number': group_number,
-                'branch_name': student.get('branch', ''),
-                'teacher': student.get('teacher', '')
-            }
+    student = client.get('student', {})
+    contacts = client.get('contacts', {})
+    
+    # Формируем полное ФИО ребёнка
+    student_name = f"{student.get('last_name', '')} {student.get('first_name', '')} {student.get('middle_name', '')}".strip()
+    
+    # Извлекаем ФИО родителя из поля contact_person
+    # Формат: "Фамилия Имя Отчество" → извлекаем "Имя Отчество" для обращения
+    contact_person = contacts.get('contact_person', '').strip()
+    
+    if contact_person:
+        # Разделяем на части
+        name_parts = contact_person.split()
+        
+        if len(name_parts) >= 3:
+            # Стандартный формат "Фамилия Имя Отчество" → берём "Имя Отчество"
+            client_name = f"{name_parts[1]} {name_parts[2]}"
+        elif len(name_parts) == 2:
+            # "Имя Отчество" (без фамилии)
+            client_name = f"{name_parts[0]} {name_parts[1]}"
+        else:
+            # Одно слово (например, "Ольга")
+            client_name = name_parts[0]
+    else:
+        # Fallback: если контактное лицо не указано, берём ФИО ребёнка
+        client_name = student_name
+    
+    # Парсим номер группы (может быть строкой вида "Группа 123" или просто "123")
+    group_str = student.get('group', '')
+    group_number = None
+    if group_str:
+        # Пытаемся извлечь число из строки
+        import re
+        match = re.search(r'\d+', str(group_str))
+        if match:
+            try:
+                group_number = int(match.group())
+            except ValueError:
+                pass
     
-    return None
+    return {
+        'login': client.get('login'),
+        'client_name': client_name,
+        'client_phone': contacts.get('phone', ''),
+        'student_name': student_name,
+        'student_first_name': student.get('first_name', ''),
+        'student_last_name': student.get('last_name', ''),
+        'group_number': group_number,
+        'branch_name': student.get('branch', ''),
+        'teacher': student.get('teacher', '')
+    }
 
 
 def find_clients_by_phone(phone: str) -> Dict[str, Any]:
@@ -195,9 +139,9 @@ def find_clients_by_phone(phone: str) -> Dict[str, Any]:
             "formatted_message": str
         }
     """
-    clients = load_clients()
+    snapshot = get_client_snapshot()
     
-    if not clients:
+    if not snapshot.clients:
         return {
             "success": False,
             "data": {"found": False},
@@ -208,18 +152,8 @@ def find_clients_by_phone(phone: str) -> Dict[str, Any]:
     # Нормализуем введённый телефон
     normalized_phone = normalize_phone(phone)
     
-    # Ищем клиентов с таким телефоном
-    results = []
-    for client in clients:
-        contacts = client.get('contacts', {})
-        client_phone = contacts.get('phone', '')
-        
-        if client_phone:
-            # Нормализуем телефон из базы
-            normalized_client_phone = normalize_phone(client_phone)
-            
-            if normalized_client_phone == normalized_phone:
-                results.append(client)
+    # Ищем клиентов с таким телефоном (телефоны из базы нормализованы при загрузке)
+    results = snapshot.find_clients_by_phone(normalized_phone)
     
     if not results:
         return {
@@ -324,9 +258,9 @@ def search_client_by_name(last_name: str, first_name: str = None) -> Dict[str, A
             "formatted_message": str
         }
     """
-    clients = load_clients()
+    snapshot = get_client_snapshot()
     
-    if not clients:
+    if not snapshot.clients:
         return {
             "success": False,
             "data": {},
@@ -334,25 +268,18 @@ def search_client_by_name(last_name: str, first_name: str = None) -> Dict[str, A
             "error": "no_data"
         }
     
-    # Приводим к нижнему регистру для поиска
-    last_name_lower = last_name.lower()
-    first_name_lower = first_name.lower() if first_name else None
+    # Ищем совпадения (фамилия и, если указано, имя)
+    results, total_found = snapshot.name_index.search(
+        last_name, first_name, limit=NAME_SEARCH_RESULTS_LIMIT
+    )
     
-    # Ищем совпадения
-    results = []
-    for client in clients:
-        student = client.get('student', {})
-        client_last = student.get('last_name', '').lower()
-        client_first = student.get('first_name', '').lower()
-        
-        # Проверяем фамилию
-        if last_name_lower in client_last:
-            # Если указано имя, проверяем и его
-            if first_name_lower:
-                if first_name_lower in client_first:
-                    results.append(client)
-            else:
-                results.append(client)
+    # Точных совпадений нет — пробуем фамилии с опечатками
+    is_similar = False
+    if not results:
+        results, total_found = snapshot.name_index.search_similar(
+            last_name, first_name, limit=NAME_SEARCH_RESULTS_LIMIT
+        )
+        is_similar = bool(results)
     
     if not results:
         query_str = f"фамилией '{last_name}'" + (f" и именем '{first_name}'" if first_name else "")
@@ -369,7 +296,7 @@ def search_client_by_name(last_name: str, first_name: str = None) -> Dict[str, A
     
     # Форматируем структурированные данные
     clients_data = []
-    for client in results[:10]:  # Ограничиваем 10 результатами
+    for client in results:
         student = client.get('student', {})
         contacts = client.get('contacts', {})
         
@@ -388,7 +315,10 @@ def search_client_by_name(last_name: str, first_name: str = None) -> Dict[str, A
         })
     
     # Форматируем текстовое сообщение
-    output = [f"✅ Найдено клиентов: {len(results)}\n"]
+    if is_similar:
+        output = [f"🔎 Точных совпадений нет. Похожие фамилии: {total_found}\n"]
+    else:
+        output = [f"✅ Найдено клиентов: {total_found}\n"]
     
     for i, client_info in enumerate(clients_data, 1):
         output.append(f"\n{i}. {client_info['full_name']}")
@@ -400,15 +330,16 @@ def search_client_by_name(last_name: str, first_name: str = None) -> Dict[str, A
         output.append(f"   📧 Email: {client_info['email']}")
         output.append(f"   🎁 Бонусы: {client_info['bonus']}")
     
-    if len(results) > 10:
-        output.append(f"\n... и еще {len(results) - 10} результатов")
+    if total_found > len(clients_data):
+        output.append(f"\n... и еще {total_found - len(clients_data)} результатов")
     
     return {
         "success": True,
         "data": {
             "clients": clients_data,
-            "total_found": len(results),
+            "total_found": total_found,
             "showing": len(clients_data),
+            "similar": is_similar,
             "query": {"last_name": last_name, "first_name": first_name}
         },
         "formatted_message": '\n'.join(output)
@@ -446,10 +377,9 @@ def get_client_balance(login: str = None, last_name: str = None) -> Dict[str, An
             "error": "missing_parameters"
         }
     
-    clients = load_clients()
-    contracts = load_contracts()
+    snapshot = get_client_snapshot()
     
-    if not clients or not contracts:
+    if not snapshot.clients or not snapshot.contracts:
         return {
             "success": False,
             "data": {},
@@ -461,26 +391,22 @@ def get_client_balance(login: str = None, last_name: str = None) -> Dict[str, An
     target_client = None
     
     if login:
-        for client in clients:
-            if client.get('login') == login:
-                target_client = client
-                break
+        target_client = snapshot.get_client_by_login(login)
     else:
         # Поиск по фамилии
-        last_name_lower = last_name.lower()
-        matches = [c for c in clients if last_name_lower in c.get('student', {}).get('last_name', '').lower()]
+        matches, total_found = snapshot.name_index.search(last_name, limit=5)
         
-        if len(matches) == 0:
+        if total_found == 0:
             return {
                 "success": False,
                 "data": {},
                 "formatted_message": f"❌ Клиент с фамилией '{last_name}' не найден",
                 "error": "not_found"
             }
-        elif len(matches) > 1:
+        elif total_found > 1:
             # Несколько клиентов — нужно уточнение
             matches_data = []
-            for c in matches[:5]:
+            for c in matches:
                 student = c.get('student', {})
                 matches_data.append({
                     "login": c.get('login'),
@@ -511,12 +437,7 @@ def get_client_balance(login: str = None, last_name: str = None) -> Dict[str, An
     
     # Находим контракт клиента
     client_id = target_client.get('id')
-    client_contract = None
-    
-    for contract in contracts:
-        if contract.get('client_id') == client_id:
-            client_contract = contract
-            break
+    client_contract = snapshot.get_contract_for_client(client_id)
     
     if not client_contract:
         return {
@@ -597,11 +518,9 @@ def get_recent_transactions(login: str = None, last_name: str = None, limit: int
             "error": "missing_parameters"
         }
     
-    clients = load_clients()
-    contracts = load_contracts()
-    transactions = load_transactions()
+    snapshot = get_client_snapshot()
     
-    if not clients or not contracts or not transactions:
+    if not snapshot.clients or not snapshot.contracts or not snapshot.transactions:
         return {
             "success": False,
             "data": {},
@@ -613,17 +532,13 @@ def get_recent_transactions(login: str = None, last_name: str = None, limit: int
     target_client = None
     
     if login:
-        for client in clients:
-            if client.get('login') == login:
-                target_client = client
-                break
+        target_client = snapshot.get_client_by_login(login)
     else:
-        last_name_lower = last_name.lower()
-        matches = [c for c in clients if last_name_lower in c.get('student', {}).get('last_name', '').lower()]
+        matches, total_found = snapshot.name_index.search(last_name, limit=1)
         
-        if len(matches) == 1:
+        if total_found == 1:
             target_client = matches[0]
-        elif len(matches) > 1:
+        elif total_found > 1:
             return {
                 "success": False,
                 "data": {},
@@ -648,12 +563,8 @@ def get_recent_transactions(login: str = None, last_name: str = None, limit: int
     
     # Находим контракт
     client_id = target_client.get('id')
-    contract_id = None
-    
-    for contract in contracts:
-        if contract.get('client_id') == client_id:
-            contract_id = contract.get('id')
-            break
+    client_contract = snapshot.get_contract_for_client(client_id)
+    contract_id = client_contract.get('id') if client_contract else None
     
     if not contract_id:
         return {
@@ -665,10 +576,15 @@ def get_recent_transactions(login: str = None, last_name: str = None, limit: int
             "error": "no_contract"
         }
     
-    # Находим транзакции
-    client_transactions = [t for t in transactions if t.get('contract_id') == contract_id]
+    # Находим транзакции за последние N дней. Хранилище отдаёт их отсортированными
+    # по дате (последние сначала) и само отсекает старые — в SQLite это диапазон
+    # индекса (contract_id, date), в снимках — начало готового списка
+    since = (datetime.now() - timedelta(days=days)).isoformat(timespec='seconds') if days else None
+    client_transactions = snapshot.get_transactions_for_contract(contract_id, since=since)
     
     if not client_transactions:
+        # Отличаем «за период ничего нет» от «транзакций нет вообще»
+        has_older = bool(since) and bool(snapshot.get_transactions_for_contract(contract_id, limit=1))
         return {
             "success": True,
             "data": {
@@ -679,45 +595,12 @@ def get_recent_transactions(login: str = None, last_name: str = None, limit: int
                 "showing_count": 0,
                 "period_days": days
             },
-            "formatted_message": "ℹ️ Транзакций не найдено"
+            "formatted_message": (
+                f"ℹ️ Транзакций за последние {days} дней не найдено" if has_older
+                else "ℹ️ Транзакций не найдено"
+            )
         }
     
-    # Сортируем по дате (последние сначала)
-    client_transactions.sort(key=lambda x: x.get('date', ''), reverse=True)
-    
-    # Фильтруем по дате (за последние N дней)
-    if days:
-        cutoff_date = datetime.now() - timedelta(days=days)
-        filtered_transactions = []
-        
-        for trans in client_transactions:
-            trans_date_str = trans.get('date', '')
-            if trans_date_str:
-                try:
-                    # Парсим дату в формате ISO (2024-12-22T10:30:00)
-                    trans_date = datetime.fromisoformat(trans_date_str.replace('Z', '+00:00'))
-                    if trans_date >= cutoff_date:
-                        filtered_transactions.append(trans)
-                except (ValueError, AttributeError):
-                    # Если не удалось распарсить дату, пропускаем транзакцию
-                    continue
-        
-        client_transactions = filtered_transactions
-        
-        if not client_transactions:
-            return {
-                "success": True,
-                "data": {
-                    "login": target_client.get('login'),
-                    "student_name": f"{target_client.get('student', {}).get('last_name')} {target_client.get('student', {}).get('first_name')}",
-                    "transactions": [],
-                    "total_count": 0,
-                    "showing_count": 0,
-                    "period_days": days
-                },
-                "formatted_message": f"ℹ️ Транзакций за последние {days} дней не найдено"
-            }
-    
     # Форматируем структурированные данные транзакций
     transactions_data = []
     for trans in client_transactions[:limit]:
@@ -861,10 +744,9 @@ def calculate_next_month_payment(login: str = None, last_name: str = None) -> Di
             "error": "missing_parameters"
         }
     
-    clients = load_clients()
-    contracts = load_contracts()
+    snapshot = get_client_snapshot()
     
-    if not clients or not contracts:
+    if not snapshot.clients or not snapshot.contracts:
         return {
             "success": False,
             "data": {},
@@ -876,25 +758,21 @@ def calculate_next_month_payment(login: str = None, last_name: str = None) -> Di
     target_client = None
     
     if login:
-        for client in clients:
-            if client.get('login') == login:
-                target_client = client
-                break
+        target_client = snapshot.get_client_by_login(login)
     else:
         # Поиск по фамилии
-        last_name_lower = last_name.lower()
-        matches = [c for c in clients if last_name_lower in c.get('student', {}).get('last_name', '').lower()]
+        matches, total_found = snapshot.name_index.search(last_name, limit=5)
         
-        if len(matches) == 0:
+        if total_found == 0:
             return {
                 "success": False,
                 "data": {},
                 "formatted_message": f"❌ Клиент с фамилией '{last_name}' не найден",
                 "error": "not_found"
             }
-        elif len(matches) > 1:
+        elif total_found > 1:
             matches_data = []
-            for c in matches[:5]:
+            for c in matches:
                 student = c.get('student', {})
                 matches_data.append({
                     "login": c.get('login'),
@@ -925,12 +803,7 @@ def calculate_next_month_payment(login: str = None, last_name: str = None) -> Di
     
     # Получаем баланс
     client_id = target_client.get('id')
-    client_contract = None
-    
-    for contract in contracts:
-        if contract.get('client_id') == client_id:
-            client_contract = contract
-            break
+    client_contract = snapshot.get_contract_for_client(client_id)
     
     if not client_contract:
         return {
@@ -22,7 +22,8 @@ def set_current_user_id(user_id: int):
     Устанавливает текущий user_id для контекста выполнения tool.
     
     Вызывается из bot.py перед execute_tool_call, чтобы функции
-    знали, для какого пользователя они выполняются.
+    знали, для какого пользователя они выполняются. Если вызов идёт
+    внутри RequestContext, пользователь берётся из него.
     
     Args:
         user_id: Telegram user ID
@@ -73,7 +74,14 @@ def set_conversation_topic(topic: str) -> Dict[str, Any]:
             "previous_topic": "..." | None
         }
     """
-    if not _current_user_id:
+    # Tool calls выполняются в потоках параллельно для разных пользователей,
+    # поэтому пользователь берётся из контекста сообщения, а не из глобальной переменной
+    from .request_context import get_request_context
+    
+    context = get_request_context()
+    user_id = context.telegram_user_id if context is not None else _current_user_id
+    
+    if not user_id:
         logger.error("set_conversation_topic вызван без установленного user_id!")
         return {
             "success": False,
@@ -89,17 +97,17 @@ def set_conversation_topic(topic: str) -> Dict[str, Any]:
             "error": "Тема не может быть пустой"
         }
     
-    old_topic = _conversation_topics.get(_current_user_id)
-    _conversation_topics[_current_user_id] = normalized_topic
+    old_topic = _conversation_topics.get(user_id)
+    _conversation_topics[user_id] = normalized_topic
     
     if old_topic and old_topic != normalized_topic:
-        logger.info(f"🎯 User {_current_user_id}: тема изменена с '{old_topic}' на '{normalized_topic}'")
+        logger.info(f"🎯 User {user_id}: тема изменена с '{old_topic}' на '{normalized_topic}'")
         message = f"Тема диалога изменена: {normalized_topic}. Все последующие запросы будут фокусироваться на этой услуге."
     elif old_topic == normalized_topic:
-        logger.debug(f"✅ User {_current_user_id}: тема подтверждена '{normalized_topic}'")
+        logger.debug(f"✅ User {user_id}: тема подтверждена '{normalized_topic}'")
         message = f"Тема диалога подтверждена: {normalized_topic}."
     else:
-        logger.info(f"🆕 User {_current_user_id}: установлена новая тема '{normalized_topic}'")
+        logger.info(f"🆕 User {user_id}: установлена новая тема '{normalized_topic}'")
         message = f"Тема диалога установлена: {normalized_topic}."
     
     return {
@@ -0,0 +1,278 @@
+"""
+Загрузка документов базы знаний из Google Drive.
+
+Раньше файлы скачивались и разбирались по одному, поэтому время
+обновления базы было суммой времён всех файлов. Теперь:
+    - папка обходится рекурсивно (list_tree), список читается постранично
+      (nextPageToken), а не только первые pageSize файлов;
+    - после первого полного обхода список обновляется через Changes API
+      (list_changes + apply_changes): Drive отдаёт только изменения
+      с сохранённого page token, и обходить дерево заново не нужно;
+    - файлы скачиваются параллельно в DRIVE_DOWNLOAD_WORKERS потоках,
+      у каждого потока свой объект сервиса (клиент googleapiclient
+      не потокобезопасен);
+    - текст из PDF и DOCX извлекается в пуле процессов (разбор упирается
+      в CPU и под GIL не распараллеливается), Google Docs и текстовые
+      файлы — сразу в потоке загрузки.
+
+Сервис Drive передаётся снаружи (фабрикой), поэтому модуль можно
+проверять на фейковом сервисе без сети.
+"""
+
+import io
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_DOC_MIME_TYPE = 'application/vnd.google-apps.document'
+PDF_MIME_TYPE = 'application/pdf'
+DOCX_MIME_TYPE = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+# Типы файлов Google Drive, которые попадают в базу знаний
+DRIVE_SUPPORTED_MIME_TYPES = {
+    GOOGLE_DOC_MIME_TYPE,
+    PDF_MIME_TYPE,
+    DOCX_MIME_TYPE,
+    'text/plain',
+    'text/markdown',
+}
+
+# Форматы, текст из которых извлекается в пуле процессов
+_PROCESS_MIME_TYPES = {PDF_MIME_TYPE, DOCX_MIME_TYPE}
+
+DRIVE_FILE_FIELDS = 'id, name, mimeType, modifiedTime, md5Checksum, parents'
+DRIVE_PAGE_SIZE = 1000
+# Сколько папок запрашивать одним files.list при обходе дерева
+DRIVE_FOLDERS_PER_QUERY = 20
+DRIVE_DOWNLOAD_WORKERS = 8
+DRIVE_PARSE_WORKERS = min(4, os.cpu_count() or 1)
+
+
+def _list_query(service, query: str) -> List[Dict[str, Any]]:
+    items: List[Dict[str, Any]] = []
+    page_token = None
+    while True:
+        response = service.files().list(
+            q=query,
+            fields=f"nextPageToken, files({DRIVE_FILE_FIELDS})",
+            pageSize=DRIVE_PAGE_SIZE,
+            pageToken=page_token,
+        ).execute()
+        items.extend(response.get('files', []))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return items
+
+
+def list_tree(service, root_id: str) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, List[str]]]:
+    """
+    Обходит папку со всеми подпапками. Ошибки Drive пробрасываются.
+
+    Returns:
+        (файлы {id: описание}, папки дерева {id: родители}, включая root_id)
+    """
+    files: Dict[str, Dict[str, Any]] = {}
+    folders: Dict[str, List[str]] = {root_id: []}
+    pending = [root_id]
+    while pending:
+        batch, pending = pending[:DRIVE_FOLDERS_PER_QUERY], pending[DRIVE_FOLDERS_PER_QUERY:]
+        parents_query = ' or '.join(f"'{folder_id}' in parents" for folder_id in batch)
+        for item in _list_query(service, f"({parents_query}) and trashed=false"):
+            if item['mimeType'] == FOLDER_MIME_TYPE:
+                if item['id'] not in folders:
+                    folders[item['id']] = item.get('parents', [])
+                    pending.append(item['id'])
+            else:
+                files[item['id']] = item
+    return files, folders
+
+
+def get_start_page_token(service) -> str:
+    """Текущая позиция журнала изменений Drive."""
+    return service.changes().getStartPageToken().execute()['startPageToken']
+
+
+def list_changes(service, page_token: str) -> Tuple[List[Dict[str, Any]], str]:
+    """Изменения с page_token: (изменения, новый page token)."""
+    changes: List[Dict[str, Any]] = []
+    while True:
+        response = service.changes().list(
+            pageToken=page_token,
+            spaces='drive',
+            includeRemoved=True,
+            pageSize=DRIVE_PAGE_SIZE,
+            fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file({DRIVE_FILE_FIELDS}, trashed))",
+        ).execute()
+        changes.extend(response.get('changes', []))
+        if 'newStartPageToken' in response:
+            return changes, response['newStartPageToken']
+        page_token = response['nextPageToken']
+
+
+def apply_changes(
+    service,
+    root_id: str,
+    files: Dict[str, Dict[str, Any]],
+    folders: Dict[str, List[str]],
+    changes: List[Dict[str, Any]],
+) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, List[str]]]:
+    """
+    Применяет изменения к сохранённому списку файлов и папок дерева.
+
+    Журнал изменений охватывает весь Drive, поэтому принадлежность к дереву
+    определяется по родителям. Папка, перенесённая в дерево, приходит одним
+    изменением без своего содержимого — её содержимое дочитывается обходом.
+    Файлы папок, которые ушли из дерева, из списка удаляются.
+    """
+    files = dict(files)
+    folders = dict(folders)
+    folders.setdefault(root_id, [])
+    known_folders = set(folders)
+
+    for change in changes:
+        item = change.get('file')
+        item_id = change['fileId']
+        if change.get('removed') or not item or item.get('trashed'):
+            files.pop(item_id, None)
+            if item_id != root_id:
+                folders.pop(item_id, None)
+        elif item['mimeType'] == FOLDER_MIME_TYPE:
+            if item_id != root_id:
+                folders[item_id] = item.get('parents', [])
+        else:
+            files[item_id] = {key: value for key, value in item.items() if key != 'trashed'}
+
+    # Папки, достижимые от корня через родителей
+    reachable = {root_id}
+    grown = True
+    while grown:
+        grown = False
+        for folder_id, parents in folders.items():
+            if folder_id not in reachable and any(parent in reachable for parent in parents):
+                reachable.add(folder_id)
+                grown = True
+    folders = {folder_id: folders[folder_id] for folder_id in reachable}
+
+    for folder_id in reachable - known_folders:
+        sub_files, sub_folders = list_tree(service, folder_id)
+        files.update(sub_files)
+        for sub_id, parents in sub_folders.items():
+            folders.setdefault(sub_id, parents)
+
+    files = {
+        file_id: item for file_id, item in files.items()
+        if any(parent in folders for parent in item.get('parents', []))
+    }
+    return files, folders
+
+
+def download_file_bytes(service, file_item: Dict[str, Any]) -> bytes:
+    """Содержимое файла; Google Docs экспортируются в text/plain."""
+    if file_item['mimeType'] == GOOGLE_DOC_MIME_TYPE:
+        request = service.files().export_media(fileId=file_item['id'], mimeType='text/plain')
+    else:
+        request = service.files().get_media(fileId=file_item['id'])
+    return request.execute()
+
+
+def _decode_text(data: bytes, file_id: str) -> str:
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        logger.warning(f"Не удалось декодировать {file_id} (TG) как UTF-8, пробуем cp1251.")
+        return data.decode('cp1251', errors='ignore')
+
+
+def extract_text(mime_type: str, data: bytes, file_id: str = '') -> str:
+    """Текст файла по его типу (вызывается и в дочерних процессах)."""
+    if mime_type == PDF_MIME_TYPE:
+        import PyPDF2
+        try:
+            pdf_reader = PyPDF2.PdfReader(io.BytesIO(data))
+            return "".join(page.extract_text() + "\n" for page in pdf_reader.pages if page.extract_text())
+        except Exception as e:
+            logger.error(f"Ошибка обработки PDF (ID: {file_id}, TG): {e}", exc_info=True)
+            return ""
+    if mime_type == DOCX_MIME_TYPE:
+        import docx
+        try:
+            doc = docx.Document(io.BytesIO(data))
+            return "\n".join(paragraph.text for paragraph in doc.paragraphs if paragraph.text)
+        except Exception as e:
+            logger.error(f"Ошибка обработки DOCX (ID: {file_id}, TG): {e}", exc_info=True)
+            return ""
+    if mime_type == GOOGLE_DOC_MIME_TYPE:
+        return data.decode('utf-8', errors='ignore')
+    return _decode_text(data, file_id)
+
+
+def read_files(
+    files: List[Dict[str, Any]],
+    service_factory: Callable[[], Any],
+    download_workers: int = DRIVE_DOWNLOAD_WORKERS,
+    parse_workers: int = DRIVE_PARSE_WORKERS,
+) -> List[Dict[str, Any]]:
+    """
+    Скачивает и разбирает файлы параллельно.
+
+    Args:
+        files: Описания файлов из list_tree
+        service_factory: Создаёт сервис Drive (вызывается по разу в каждом потоке)
+        parse_workers: Процессов для PDF/DOCX (0 — разбирать в потоках загрузки)
+
+    Returns:
+        Описания файлов с добавленным 'content' в исходном порядке; файлы,
+        которые не удалось скачать, в результат не попадают
+    """
+    if not files:
+        return []
+    local = threading.local()
+
+    def _service():
+        if not hasattr(local, 'service'):
+            local.service = service_factory()
+        return local.service
+
+    # Запуск пула стоит ~1 с, поэтому ради одного PDF/DOCX он не создаётся;
+    # spawn, а не fork: у вызывающего могут работать другие потоки. spawn
+    # заново импортирует __main__ в каждом процессе, поэтому бот передаёт
+    # parse_workers=0, а пул используют только отдельные скрипты (update_kb.py)
+    needs_processes = parse_workers > 0 and sum(f['mimeType'] in _PROCESS_MIME_TYPES for f in files) > 1
+    process_pool = ProcessPoolExecutor(
+        max_workers=parse_workers, mp_context=multiprocessing.get_context('spawn')
+    ) if needs_processes else None
+
+    def _read(file_item: Dict[str, Any]):
+        logger.info(f"Обработка файла (TG): '{file_item['name']}' (ID: {file_item['id']}, Type: {file_item['mimeType']})")
+        data = download_file_bytes(_service(), file_item)
+        if process_pool is not None and file_item['mimeType'] in _PROCESS_MIME_TYPES:
+            return process_pool.submit(extract_text, file_item['mimeType'], data, file_item['id'])
+        return extract_text(file_item['mimeType'], data, file_item['id'])
+
+    result_docs: List[Dict[str, Any]] = []
+    try:
+        with ThreadPoolExecutor(max_workers=download_workers, thread_name_prefix='drive-download') as downloads:
+            futures = [downloads.submit(_read, file_item) for file_item in files]
+            for file_item, future in zip(files, futures):
+                try:
+                    content = future.result()
+                    if isinstance(content, Future):
+                        content = content.result()
+                except Exception as e_read_file:
+                    logger.error(f"Ошибка чтения файла '{file_item['name']}' (TG): {e_read_file}", exc_info=True)
+                    continue
+                result_docs.append({**file_item, 'content': content or ""})
+                if content and content.strip():
+                    logger.info(f"Успешно прочитан файл (TG): '{file_item['name']}' ({len(content)} симв)")
+                else:
+                    logger.warning(f"Файл '{file_item['name']}' (TG) пуст или не удалось извлечь контент.")
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown(wait=True, cancel_futures=True)
+    return result_docs
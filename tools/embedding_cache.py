@@ -0,0 +1,191 @@
+"""
+Кэш эмбеддингов поисковых запросов к базе знаний.
+
+Одни и те же вопросы («сколько стоит», «расписание») приходят постоянно,
+и для каждого get_relevant_context_telegram заново вызывал embeddings API.
+Кэш держит последние запросы в памяти (LRU) и, если задан файл, на диске
+(SQLite) — так он переживает перезапуск бота.
+
+Ключ — нормализованный текст запроса + модель + размерность. Эмбеддинг
+запроса не зависит от содержимого базы знаний, поэтому пересборка базы
+кэш не сбрасывает; при смене модели или размерности старые записи с диска
+удаляются.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Сколько записей хранить на диске; при превышении удаляются давно не использованные
+DISK_CACHE_MAX_ENTRIES = 50_000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS query_embeddings (
+    model TEXT NOT NULL,
+    dimensions INTEGER NOT NULL,
+    query TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    used_at REAL NOT NULL,
+    PRIMARY KEY (model, dimensions, query)
+);
+CREATE INDEX IF NOT EXISTS query_embeddings_used ON query_embeddings (used_at);
+"""
+
+
+def normalize_query(query: str) -> str:
+    """Текст запроса для ключа: регистр, лишние пробелы и знаки в конце не важны."""
+    return ' '.join(query.casefold().split()).rstrip('?!. ')
+
+
+class QueryEmbeddingCache:
+    """
+    LRU-кэш эмбеддингов запросов с необязательным уровнем на диске.
+
+    get_from_memory/put_in_memory не трогают диск и вызываются прямо из
+    event loop; get_from_disk/put_on_disk блокирующие — бот вызывает их
+    через asyncio.to_thread.
+
+    Векторы на диске хранятся как float32 (для поиска по косинусной
+    близости точности хватает с запасом).
+    """
+
+    def __init__(self, model: str, dimensions: Optional[int], max_entries: int = 2000, path: Optional[str] = None):
+        self.model = model
+        self.dimensions = dimensions or 0
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, List[float]]" = OrderedDict()
+        # Память и диск под разными локами: поиск в памяти из event loop
+        # не ждёт, пока поток пишет в SQLite
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if path:
+            self._open_disk(path)
+
+    def _open_disk(self, path: str):
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode = WAL')
+            # В WAL-режиме NORMAL не рискует целостностью базы, а fsync не ждёт каждая запись
+            db.execute('PRAGMA synchronous = NORMAL')
+            db.executescript(_SCHEMA)
+            removed = db.execute(
+                "DELETE FROM query_embeddings WHERE model != ? OR dimensions != ?",
+                (self.model, self.dimensions)
+            ).rowcount
+            if removed:
+                logger.info(f"Кэш эмбеддингов запросов: удалено {removed} записей другой модели/размерности")
+            self._db = db
+        except sqlite3.Error as e:
+            logger.warning(f"Кэш эмбеддингов запросов на диске недоступен ({path}): {e}")
+
+    def get_from_memory(self, query: str) -> Optional[List[float]]:
+        """Поиск только в памяти: без обращения к диску, можно вызывать из event loop."""
+        key = normalize_query(query)
+        with self._lock:
+            embedding = self._memory.get(key)
+            if embedding is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+            return embedding
+
+    def get_from_disk(self, query: str) -> Optional[List[float]]:
+        """
+        Поиск на диске (после промаха в памяти); найденное поднимается в память.
+
+        Блокирующий вызов — из асинхронного кода через asyncio.to_thread.
+        """
+        key = normalize_query(query)
+        embedding = None
+        if self._db is not None:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT embedding FROM query_embeddings WHERE model = ? AND dimensions = ? AND query = ?",
+                    (self.model, self.dimensions, key)
+                ).fetchone()
+                if row is not None:
+                    self._db.execute(
+                        "UPDATE query_embeddings SET used_at = ? WHERE model = ? AND dimensions = ? AND query = ?",
+                        (time.time(), self.model, self.dimensions, key)
+                    )
+            if row is not None:
+                embedding = array('f', row[0]).tolist()
+        with self._lock:
+            if embedding is None:
+                self.misses += 1
+            else:
+                self._remember(key, embedding)
+                self.disk_hits += 1
+        return embedding
+
+    def get(self, query: str) -> Optional[List[float]]:
+        """Поиск в памяти, затем на диске (блокирующий вызов)."""
+        embedding = self.get_from_memory(query)
+        if embedding is None:
+            embedding = self.get_from_disk(query)
+        return embedding
+
+    def put_in_memory(self, query: str, embedding: List[float]):
+        """Запоминает эмбеддинг в памяти (без обращения к диску)."""
+        with self._lock:
+            self._remember(normalize_query(query), embedding)
+
+    def put_on_disk(self, query: str, embedding: List[float]):
+        """Сохраняет эмбеддинг на диск (блокирующий вызов — через asyncio.to_thread)."""
+        if self._db is None:
+            return
+        key = normalize_query(query)
+        try:
+            with self._db_lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?, ?)",
+                    (self.model, self.dimensions, key, array('f', embedding).tobytes(), time.time())
+                )
+                # Размер проверяем раз в 1000 промахов, а лимит превышаем
+                # на 10% — чтобы не удалять по записи на каждый новый запрос
+                if self.misses % 1000 == 0:
+                    self._prune_disk()
+        except sqlite3.Error as e:
+            logger.warning(f"Не удалось сохранить эмбеддинг запроса на диск: {e}")
+
+    def put(self, query: str, embedding: List[float]):
+        """Запоминает эмбеддинг в памяти и на диске (блокирующий вызов)."""
+        self.put_in_memory(query, embedding)
+        self.put_on_disk(query, embedding)
+
+    def _remember(self, key: str, embedding: List[float]):
+        self._memory[key] = embedding
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _prune_disk(self):
+        (count,) = self._db.execute("SELECT COUNT(*) FROM query_embeddings").fetchone()
+        if count > DISK_CACHE_MAX_ENTRIES * 1.1:
+            self._db.execute(
+                "DELETE FROM query_embeddings WHERE rowid IN "
+                "(SELECT rowid FROM query_embeddings ORDER BY used_at LIMIT ?)",
+                (count - DISK_CACHE_MAX_ENTRIES,)
+            )
+
+    def stats(self) -> Dict[str, float]:
+        """Счётчики попаданий (hit_rate — доля запросов без обращения к API)."""
+        total = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.disk_hits) / total if total else 0.0,
+            'memory_entries': len(self._memory),
+        }
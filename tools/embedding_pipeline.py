@@ -0,0 +1,173 @@
+"""
+Пакетное создание эмбеддингов для базы знаний.
+
+Раньше update_vector_store_telegram отправлял все чанки одним запросом
+embeddings.create — при росте папки на Google Drive запрос упирается
+в лимит API (2048 строк и ~300 000 токенов на запрос). embed_texts делит
+тексты на пакеты по числу токенов, отправляет до EMBED_CONCURRENCY
+пакетов одновременно, повторяет пакет при 429/5xx/обрыве соединения
+с растущей паузой (с учётом Retry-After) и сообщает о прогрессе.
+"""
+
+import asyncio
+import logging
+import random
+from typing import Awaitable, Callable, List, Optional
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+# Размер пакета: сумма токенов и количество строк в одном запросе
+EMBED_BATCH_MAX_TOKENS = 100_000
+EMBED_BATCH_MAX_INPUTS = 2048
+
+# Сколько пакетов отправлять одновременно
+EMBED_CONCURRENCY = 4
+
+# Повторы пакета: пауза EMBED_RETRY_BACKOFF * 2^попытка (+ случайная добавка),
+# но не больше EMBED_RETRY_MAX_DELAY
+EMBED_MAX_RETRIES = 6
+EMBED_RETRY_BACKOFF = 1.0
+EMBED_RETRY_MAX_DELAY = 60.0
+
+# (готово чанков, всего чанков)
+ProgressCallback = Callable[[int, int], Awaitable[None]]
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """
+    Количество токенов в тексте.
+
+    Если установлен tiktoken (ставится вместе с langchain-openai) — точный
+    подсчёт, иначе оценка с запасом (кириллица — около 2.5 символа на токен).
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 2 + 1
+
+
+def make_batches(texts: List[str], max_tokens: int = EMBED_BATCH_MAX_TOKENS,
+                 max_inputs: int = EMBED_BATCH_MAX_INPUTS) -> List[range]:
+    """
+    Делит тексты на идущие подряд пакеты (диапазоны индексов).
+
+    Текст длиннее max_tokens попадает в пакет один (обрезать его — дело API).
+    """
+    batches = []
+    start, tokens = 0, 0
+    for i, text in enumerate(texts):
+        text_tokens = count_tokens(text)
+        if i > start and (tokens + text_tokens > max_tokens or i - start >= max_inputs):
+            batches.append(range(start, i))
+            start, tokens = i, 0
+        tokens += text_tokens
+    if start < len(texts):
+        batches.append(range(start, len(texts)))
+    return batches
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+def _retry_delay(error: Exception, attempt: int) -> float:
+    delay = EMBED_RETRY_BACKOFF * 2 ** attempt
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            delay = max(delay, float(retry_after))
+        except ValueError:
+            pass
+    return min(EMBED_RETRY_MAX_DELAY, delay) + random.uniform(0, EMBED_RETRY_BACKOFF)
+
+
+async def embed_texts(
+    client: openai.AsyncOpenAI,
+    texts: List[str],
+    model: str,
+    dimensions: Optional[int] = None,
+    *,
+    max_batch_tokens: int = EMBED_BATCH_MAX_TOKENS,
+    max_batch_inputs: int = EMBED_BATCH_MAX_INPUTS,
+    concurrency: int = EMBED_CONCURRENCY,
+    max_retries: int = EMBED_MAX_RETRIES,
+    on_progress: Optional[ProgressCallback] = None,
+) -> List[List[float]]:
+    """
+    Эмбеддинги для всех текстов в исходном порядке.
+
+    Raises:
+        openai.APIError: пакет не удалось отправить за max_retries повторов
+            или API вернул неповторяемую ошибку (400, 401 и т.п.);
+            остальные пакеты при этом отменяются
+    """
+    if not texts:
+        return []
+
+    # Повторы делаем сами (с общим прогрессом и Retry-After), без встроенных в клиент
+    client = client.with_options(max_retries=0)
+    batches = make_batches(texts, max_batch_tokens, max_batch_inputs)
+    embeddings: List[Optional[List[float]]] = [None] * len(texts)
+    semaphore = asyncio.Semaphore(concurrency)
+    done = 0
+    logger.info(f"Эмбеддинги: {len(texts)} чанков, пакетов {len(batches)}, одновременно до {concurrency}")
+
+    async def _embed_batch(number: int, batch: range):
+        nonlocal done
+        kwargs = {"input": [texts[i] for i in batch], "model": model}
+        if dimensions:
+            kwargs["dimensions"] = dimensions
+        async with semaphore:
+            attempt = 0
+            while True:
+                try:
+                    response = await client.embeddings.create(**kwargs)
+                    break
+                except openai.APIError as e:
+                    if not _is_retryable(e) or attempt >= max_retries:
+                        logger.error(f"Эмбеддинги: пакет {number + 1}/{len(batches)} не отправлен: {e}")
+                        raise
+                    delay = _retry_delay(e, attempt)
+                    attempt += 1
+                    logger.warning(
+                        f"Эмбеддинги: пакет {number + 1}/{len(batches)} — {type(e).__name__}, "
+                        f"повтор {attempt}/{max_retries} через {delay:.1f} с"
+                    )
+                    await asyncio.sleep(delay)
+
+        # data может прийти не по порядку — раскладываем по index
+        for item in response.data:
+            embeddings[batch.start + item.index] = item.embedding
+        done += len(batch)
+        if on_progress:
+            try:
+                await on_progress(done, len(texts))
+            except Exception as e:
+                logger.warning(f"Эмбеддинги: ошибка отправки прогресса: {e}")
+
+    tasks = [asyncio.ensure_future(_embed_batch(n, batch)) for n, batch in enumerate(batches)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    missing = sum(1 for embedding in embeddings if embedding is None)
+    if missing:
+        raise ValueError(f"API вернул не все эмбеддинги: нет {missing} из {len(texts)}")
+    return embeddings
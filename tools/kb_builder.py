@@ -0,0 +1,636 @@
+"""
+Сборка базы знаний из Google Drive — без зависимости от bot.py.
+
+Раньше сборка жила в bot.py, и update_kb.py (one-shot под systemd)
+импортировал весь модуль бота: при импорте создавались Telegram Bot и
+клиент OpenAI, а запущенный бот не видел новую базу до перезапуска.
+Теперь:
+    - KBBuildConfig.from_env() читает те же переменные окружения, что и бот;
+    - update_knowledge_base() собирает новую версию в отдельной директории
+      под KBWriterLock и атомарно переписывает файл-указатель на активную
+      версию (ACTIVE_DB_INFO_FILE);
+    - бот следит за указателем (active_pointer_signature — дешёвый stat)
+      и подгружает новую версию сам, без перезапуска (см. bot.py,
+      watch_active_kb_telegram);
+    - предыдущую активную версию сборка не удаляет — её может ещё читать
+      бот; её удалит бот после подмены (kb_registry), а если бот не
+      запущен — следующая сборка (prune_versions).
+"""
+
+import asyncio
+import datetime
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import chromadb
+import openai
+from langchain_core.documents import Document
+from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
+
+from tools import drive_ingest
+from tools.chunk_embedding_cache import ChunkEmbeddingCache
+from tools.embedding_pipeline import EMBED_BATCH_MAX_TOKENS, EMBED_CONCURRENCY, embed_texts
+from tools.kb_manifest import KBManifest, KBUpdatePlan, chunk_hash
+from tools.kb_search import KeywordIndex
+from tools.kb_versions import KBWriterLock, remove_kb_version
+from tools.vector_index import VECTOR_DTYPES, NumpyVectorIndex
+
+logger = logging.getLogger(__name__)
+
+# Разбиение документов на чанки (изменение параметров вызывает полную пересборку)
+KB_CHUNK_SIZE = 1000
+KB_CHUNK_OVERLAP = 200
+KB_MD_SECTION_MAX_LEN = 2000
+KB_CHROMA_BATCH_SIZE = 500  # Чанков в одном запросе к Chroma (add/get)
+KB_UPDATE_LOCK_FILE = ".kb_update.lock"  # В base_path: базу обновляет один процесс за раз
+KB_VERSION_SUFFIX = "_new_tg"  # Директории версий: <время>_new_tg
+KB_VECTOR_BACKENDS = ("chroma", "numpy")
+
+
+def _env_bool(name: str, default: str = "True") -> bool:
+    return os.getenv(name, default).lower() == 'true'
+
+
+@dataclass
+class KBBuildConfig:
+    """Параметры сборки базы знаний (по умолчанию — из переменных окружения бота)."""
+
+    base_path: str = "./local_vector_db_telegram"
+    active_info_file: str = "active_db_path_telegram.txt"
+    collection_name: str = "documents_telegram"
+    folder_id: Optional[str] = None
+    service_account_file: str = 'service-account-key.json'
+    embedding_model: str = "text-embedding-3-large"
+    embedding_dimensions: Optional[int] = None
+    incremental: bool = True
+    download_workers: int = drive_ingest.DRIVE_DOWNLOAD_WORKERS
+    parse_workers: int = drive_ingest.DRIVE_PARSE_WORKERS
+    embedding_cache_file: Optional[str] = None  # Кэш эмбеддингов чанков; None — выключен
+    embedding_cache_max_mb: int = 512
+    embed_batch_tokens: int = EMBED_BATCH_MAX_TOKENS
+    embed_concurrency: int = EMBED_CONCURRENCY
+    hybrid_search: bool = True
+    vector_backend: str = "chroma"
+    numpy_dtype: str = "float32"
+    numpy_search_dims: int = 0
+
+    @classmethod
+    def from_env(cls) -> 'KBBuildConfig':
+        """Читает переменные окружения (вызывать после load_dotenv)."""
+        base_path = os.getenv("VECTOR_DB_BASE_PATH_TELEGRAM", "./local_vector_db_telegram")
+        dim_str = os.getenv("OPENAI_EMBEDDING_DIMENSIONS")
+        try:
+            dimensions = int(dim_str) if dim_str and dim_str.lower() != 'none' else None
+        except ValueError:
+            logger.warning(f"Некорректное значение OPENAI_EMBEDDING_DIMENSIONS ('{dim_str}'), используется None.")
+            dimensions = None
+        vector_backend = os.getenv("KB_VECTOR_BACKEND", "chroma").lower()
+        if vector_backend not in KB_VECTOR_BACKENDS:
+            logger.warning(f"Неизвестный KB_VECTOR_BACKEND ('{vector_backend}'), используется chroma.")
+            vector_backend = "chroma"
+        numpy_dtype = os.getenv("KB_NUMPY_DTYPE", "float32")
+        if numpy_dtype not in VECTOR_DTYPES:
+            logger.warning(f"Неизвестный KB_NUMPY_DTYPE ('{numpy_dtype}'), используется float32.")
+            numpy_dtype = "float32"
+        return cls(
+            base_path=base_path,
+            active_info_file=os.getenv("ACTIVE_DB_INFO_FILE_TELEGRAM", "active_db_path_telegram.txt"),
+            collection_name=os.getenv("CHROMA_COLLECTION_NAME_TELEGRAM", "documents_telegram"),
+            folder_id=os.getenv("GOOGLE_DRIVE_FOLDER_ID"),
+            service_account_file=os.getenv("SERVICE_ACCOUNT_FILE", 'service-account-key.json'),
+            embedding_model=os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-large"),
+            embedding_dimensions=dimensions,
+            incremental=_env_bool("KB_INCREMENTAL_UPDATE"),
+            download_workers=int(os.getenv("KB_DRIVE_DOWNLOAD_WORKERS", str(drive_ingest.DRIVE_DOWNLOAD_WORKERS))),
+            parse_workers=int(os.getenv("KB_DRIVE_PARSE_WORKERS", str(drive_ingest.DRIVE_PARSE_WORKERS))),
+            embedding_cache_file=os.getenv(
+                "KB_EMBEDDING_CACHE_FILE", os.path.join(base_path, "chunk_embeddings.bin")
+            ) or None,
+            embedding_cache_max_mb=int(os.getenv("KB_EMBEDDING_CACHE_MAX_MB", "512")),
+            embed_batch_tokens=int(os.getenv("KB_EMBED_BATCH_TOKENS", str(EMBED_BATCH_MAX_TOKENS))),
+            embed_concurrency=int(os.getenv("KB_EMBED_CONCURRENCY", str(EMBED_CONCURRENCY))),
+            hybrid_search=_env_bool("KB_HYBRID_SEARCH"),
+            vector_backend=vector_backend,
+            numpy_dtype=numpy_dtype,
+            numpy_search_dims=int(os.getenv("KB_NUMPY_SEARCH_DIMS", "0")),
+        )
+
+    @property
+    def active_info_path(self) -> str:
+        return os.path.join(self.base_path, self.active_info_file)
+
+    @property
+    def lock_path(self) -> str:
+        return os.path.join(self.base_path, KB_UPDATE_LOCK_FILE)
+
+    def build_settings(self) -> Dict[str, Any]:
+        """Параметры сборки базы: при их изменении инкрементальное обновление невозможно."""
+        return {
+            "embedding_model": self.embedding_model,
+            "dimensions": self.embedding_dimensions,
+            "chunking": [KB_CHUNK_SIZE, KB_CHUNK_OVERLAP, KB_MD_SECTION_MAX_LEN],
+        }
+
+
+# --- Указатель на активную версию ---
+
+def active_kb_path(config: KBBuildConfig) -> Optional[str]:
+    """Полный путь активной версии базы из файла-указателя (None — не задана или не существует)."""
+    try:
+        if not os.path.exists(config.active_info_path):
+            logger.info(f"Файл информации об активной БД '{config.active_info_file}' (TG) не найден.")
+            return None
+        with open(config.active_info_path, "r", encoding="utf-8") as f:
+            active_subdir_or_fullname = f.read().strip()
+        if not active_subdir_or_fullname:
+            logger.warning(f"Файл '{config.active_info_file}' (TG) пуст.")
+            return None
+        # Раньше в файл мог сохраняться полный путь — поддерживаем оба варианта
+        potential_full_path = active_subdir_or_fullname
+        if not os.path.isabs(potential_full_path):
+            potential_full_path = os.path.join(config.base_path, active_subdir_or_fullname)
+        if os.path.isdir(potential_full_path):
+            logger.info(f"Найдена активная директория БД (TG): '{potential_full_path}'")
+            return potential_full_path
+        logger.warning(f"В файле '{config.active_info_file}' (TG) указан путь '{active_subdir_or_fullname}', "
+                       f"но директория '{potential_full_path}' не существует.")
+        return None
+    except Exception as e:
+        logger.error(f"Ошибка при чтении файла информации об активной БД (TG): {e}", exc_info=True)
+        return None
+
+
+def write_active_kb_path(config: KBBuildConfig, subdir: str):
+    """Атомарно переключает указатель: читатель видит либо старое, либо новое имя целиком."""
+    tmp_path = f"{config.active_info_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(subdir)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, config.active_info_path)
+
+
+def active_pointer_signature(config: KBBuildConfig) -> Optional[tuple]:
+    """Отпечаток файла-указателя (inode, mtime, размер) — меняется при каждом переключении версии."""
+    try:
+        stat = os.stat(config.active_info_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def prune_versions(config: KBBuildConfig, keep: List[Optional[str]]) -> List[str]:
+    """
+    Удаляет директории версий, кроме keep (активной и предыдущей).
+
+    Предыдущую версию может ещё читать запущенный бот, поэтому её сборка
+    оставляет; лишние остаются, например, если бот не был запущен. Версии,
+    которые бот держит загруженными (маркер чтения, см. kb_versions),
+    не удаляются.
+
+    Returns:
+        Удалённые директории
+    """
+    keep_names = {os.path.basename(path) for path in keep if path}
+    removed = []
+    try:
+        names = os.listdir(config.base_path)
+    except FileNotFoundError:
+        return removed
+    for name in names:
+        path = os.path.join(config.base_path, name)
+        if name in keep_names or not name.endswith(KB_VERSION_SUFFIX) or not os.path.isdir(path):
+            continue
+        try:
+            if remove_kb_version(path):
+                removed.append(path)
+                logger.info(f"Удалена устаревшая директория БД (TG): '{path}'")
+        except Exception as e:
+            logger.error(f"Не удалось удалить устаревшую БД (TG) '{path}': {e}", exc_info=True)
+    return removed
+
+
+# --- Google Drive ---
+
+def build_drive_service(config: KBBuildConfig):
+    """Новый объект сервиса Google Drive (клиент не потокобезопасен — по одному на поток)."""
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
+    credentials = service_account.Credentials.from_service_account_file(
+        config.service_account_file,
+        scopes=['https://www.googleapis.com/auth/drive.readonly']
+    )
+    return build('drive', 'v3', credentials=credentials, cache_discovery=False)
+
+
+def list_drive_files(service, folder_id: str, drive_state: Optional[Dict[str, Any]] = None) -> Optional[tuple]:
+    """
+    Поддерживаемые файлы папки базы знаний (со всеми подпапками).
+
+    Если передано состояние прошлого обновления (drive_state из манифеста
+    базы), Drive отдаёт только изменения с сохранённого page token;
+    иначе — полный обход дерева.
+
+    Returns:
+        (файлы, новое состояние для манифеста) или None при ошибке Drive
+    """
+    if not service:
+        logger.error("Чтение из Google Drive (TG) невозможно: сервис не инициализирован.")
+        return None
+    try:
+        incremental = bool(drive_state and drive_state.get("root") == folder_id and drive_state.get("page_token"))
+        if incremental:
+            try:
+                changes, page_token = drive_ingest.list_changes(service, drive_state["page_token"])
+                files, folders = drive_ingest.apply_changes(
+                    service, folder_id, drive_state["files"], drive_state["folders"], changes
+                )
+                logger.info(f"Google Drive (TG): изменений с прошлого обновления: {len(changes)}.")
+            except Exception as e_changes:
+                logger.warning(f"Не удалось получить изменения Google Drive (TG), полный обход: {e_changes}")
+                incremental = False
+        if not incremental:
+            # Позицию журнала берём до обхода, чтобы не потерять изменения, сделанные во время него
+            page_token = drive_ingest.get_start_page_token(service)
+            files, folders = drive_ingest.list_tree(service, folder_id)
+    except Exception as e:
+        logger.error(f"Критическая ошибка при чтении списка файлов Google Drive (TG): {e}", exc_info=True)
+        return None
+    logger.info(f"Найдено {len(files)} файлов в {len(folders)} папках Google Drive (TG).")
+    supported = []
+    for file_item in files.values():
+        if file_item['mimeType'] in drive_ingest.DRIVE_SUPPORTED_MIME_TYPES:
+            supported.append(file_item)
+        else:
+            logger.debug(f"Файл '{file_item['name']}' (TG) имеет неподдерживаемый тип ({file_item['mimeType']}).")
+    new_state = {"root": folder_id, "page_token": page_token, "folders": folders, "files": files}
+    return supported, new_state
+
+
+def read_drive_files(files: List[Dict[str, Any]], service_factory: Callable[[], Any],
+                     config: KBBuildConfig) -> List[Dict[str, Any]]:
+    """
+    Скачивает файлы базы знаний параллельно, см. tools/drive_ingest.py.
+
+    Returns:
+        Описания файлов из списка Drive с добавленным 'content' (может быть
+        пустым); файлы, которые не удалось скачать, в результат не попадают
+    """
+    if not files:
+        return []
+    started = time.time()
+    result_docs = drive_ingest.read_files(
+        files, service_factory,
+        download_workers=config.download_workers,
+        parse_workers=config.parse_workers,
+    )
+    logger.info(f"Чтение из Google Drive (TG) завершено за {time.time() - started:.1f} с. Прочитано {len(result_docs)} документов.")
+    return result_docs
+
+
+# --- Чанки и эмбеддинги ---
+
+def split_document(doc_name: str, doc_content_str: str) -> List[tuple]:
+    """Разбивает документ на чанки: [(текст, метаданные)]."""
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=KB_CHUNK_SIZE, chunk_overlap=KB_CHUNK_OVERLAP)
+    markdown_splitter = MarkdownHeaderTextSplitter(headers_to_split_on=[("#", "h1"), ("##", "h2"), ("###", "h3")])
+
+    enhanced_doc_content = f"Документ: {doc_name}\n\n{doc_content_str}"
+    is_md = doc_name.lower().endswith(('.md', '.markdown'))
+    chunks = []
+    try:
+        target_splits = markdown_splitter.split_text(enhanced_doc_content) if is_md else text_splitter.split_text(enhanced_doc_content)
+
+        for item_split in target_splits:
+            page_content = item_split.page_content if isinstance(item_split, Document) else item_split
+            current_metadata = item_split.metadata if isinstance(item_split, Document) else {}
+
+            if is_md and len(page_content) > KB_MD_SECTION_MAX_LEN and not isinstance(item_split, Document): # Дополнительная проверка для MD без Document
+                for sub_chunk_text in text_splitter.split_text(page_content):
+                    chunks.append((sub_chunk_text, {"source": doc_name, **current_metadata, "type": "md_split", "chunk": len(chunks)}))
+            elif isinstance(item_split, Document) and len(page_content) > KB_MD_SECTION_MAX_LEN : # Если это Document и длинный
+                for sub_chunk_text in text_splitter.split_text(page_content):
+                    chunks.append((sub_chunk_text, {"source": doc_name, **current_metadata, "type": "doc_split", "chunk": len(chunks)})) # type: doc_split
+            else:
+                chunks.append((page_content, {"source": doc_name, **current_metadata, "type": "md" if is_md else "text", "chunk": len(chunks)}))
+        logger.info(f"Документ '{doc_name}' (TG) разбит на {len(chunks)} чанков.")
+    except Exception as e_split:
+        logger.error(f"Ошибка разбиения '{doc_name}' (TG): {e_split}", exc_info=True)
+        chunks = []
+        try: # Fallback
+            for chunk_idx_fb, chunk_text in enumerate(text_splitter.split_text(enhanced_doc_content)):
+                chunks.append((chunk_text, {"source": doc_name, "type": "text_fallback", "chunk": chunk_idx_fb}))
+            logger.info(f"Документ '{doc_name}' (TG) (fallback) разбит на {len(chunks)} чанков.")
+        except Exception as e_fallback: logger.error(f"Ошибка fallback-разбиения '{doc_name}' (TG): {e_fallback}", exc_info=True)
+    return chunks
+
+
+def _as_float_list(embedding) -> List[float]:
+    # Chroma >= 0.5 возвращает numpy-массивы
+    return embedding.tolist() if hasattr(embedding, 'tolist') else list(embedding)
+
+
+def get_chunks(collection, field_name: str, values: List[str]) -> Dict[str, list]:
+    """Чанки коллекции, у которых метаданное field_name входит в values (запросы порциями)."""
+    result = {"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+    for start in range(0, len(values), KB_CHROMA_BATCH_SIZE):
+        part = collection.get(
+            where={field_name: {"$in": values[start:start + KB_CHROMA_BATCH_SIZE]}},
+            include=["documents", "metadatas", "embeddings"]
+        )
+        result["ids"].extend(part["ids"])
+        result["documents"].extend(part["documents"])
+        result["metadatas"].extend(part["metadatas"])
+        result["embeddings"].extend(_as_float_list(e) for e in part["embeddings"])
+    return result
+
+
+async def embed_chunks(
+    client,
+    texts: List[str],
+    known_texts: List[str],
+    known_embeddings: List[List[float]],
+    config: KBBuildConfig,
+    on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+) -> tuple:
+    """
+    Эмбеддинги для texts: сначала из кэша чанков (config.embedding_cache_file), остальные — через API.
+
+    known_texts/known_embeddings — чанки новой базы, векторы которых уже есть
+    (скопированы из текущей базы): они тоже сохраняются в кэш, чтобы
+    их не вытеснили, пока они используются.
+
+    Returns:
+        (эмбеддинги в порядке texts, статистика кэша)
+    """
+    chunk_cache = None
+    if config.embedding_cache_file:
+        chunk_cache = await asyncio.to_thread(
+            ChunkEmbeddingCache, config.embedding_cache_file, config.embedding_model,
+            config.embedding_dimensions, config.embedding_cache_max_mb * 2 ** 20
+        )
+    try:
+        embeddings: List[Optional[List[float]]] = [None] * len(texts)
+        if chunk_cache and texts:
+            embeddings = await asyncio.to_thread(chunk_cache.get_many, texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if missing:
+            logger.info(f"Создание эмбеддингов для {len(missing)} чанков (TG), из кэша чанков: {len(texts) - len(missing)}...")
+            fresh_embeddings = await embed_texts(
+                client, [texts[i] for i in missing], config.embedding_model, config.embedding_dimensions,
+                max_batch_tokens=config.embed_batch_tokens,
+                concurrency=config.embed_concurrency,
+                on_progress=on_progress,
+            )
+            for i, embedding in zip(missing, fresh_embeddings):
+                embeddings[i] = embedding
+        if not chunk_cache:
+            return embeddings, {}
+
+        def _save_cache():
+            chunk_cache.put_many(known_texts + texts, known_embeddings + embeddings)
+            chunk_cache.flush()
+        await asyncio.to_thread(_save_cache)
+        return embeddings, chunk_cache.stats()
+    finally:
+        if chunk_cache:
+            chunk_cache.close()
+
+
+# --- Сборка ---
+
+async def update_knowledge_base(
+    client,
+    config: KBBuildConfig,
+    full_rebuild: bool = False,
+    on_progress: Optional[Callable[[int, int], Awaitable[None]]] = None,
+    list_files: Optional[Callable[[Optional[Dict[str, Any]]], Optional[tuple]]] = None,
+    read_files: Optional[Callable[[List[Dict[str, Any]]], List[Dict[str, Any]]]] = None,
+) -> Dict[str, Any]:
+    """
+    Собирает базу знаний из Google Drive в новой директории Chroma и делает её активной.
+
+    По умолчанию (config.incremental) скачиваются и разбиваются только
+    изменённые файлы, эмбеддинги остальных чанков берутся из текущей базы
+    (см. tools/kb_manifest.py); если на Drive ничего не изменилось, база
+    не пересобирается. full_rebuild=True — собрать всё заново.
+
+    Одновременно базу обновляет только один писатель (в том числе среди
+    процессов): если обновление уже идёт, возвращается ошибка.
+
+    Args:
+        client: openai.AsyncOpenAI для эмбеддингов
+        on_progress: корутина (готово, всего) — прогресс эмбеддингов
+        list_files / read_files: список и скачивание файлов Drive (по умолчанию —
+            list_drive_files / read_drive_files с сервисом из config)
+
+    Returns:
+        Словарь с success, added_chunks, total_chunks, new_active_path,
+        previous_active_path и статистикой инкрементального режима
+    """
+    writer_lock = KBWriterLock(config.lock_path)
+    if not writer_lock.acquire():
+        holder = writer_lock.holder_pid()
+        logger.warning(f"Обновление базы знаний (TG) уже выполняется (PID {holder}) — пропускаем.")
+        return {"success": False, "error": f"KB update already in progress (PID {holder})", "added_chunks": 0, "total_chunks": 0}
+    try:
+        if list_files is None:
+            def list_files(drive_state):
+                return list_drive_files(build_drive_service(config), config.folder_id, drive_state)
+        if read_files is None:
+            def read_files(files):
+                return read_drive_files(files, lambda: build_drive_service(config), config)
+        return await _update_locked(client, config, full_rebuild, on_progress, list_files, read_files)
+    finally:
+        writer_lock.release()
+
+
+async def _update_locked(client, config: KBBuildConfig, full_rebuild: bool, on_progress, list_files, read_files) -> Dict[str, Any]:
+    logger.info("--- Запуск обновления базы знаний (TG) ---")
+    os.makedirs(config.base_path, exist_ok=True)
+    previous_active_full_path = active_kb_path(config)
+
+    settings = config.build_settings()
+    previous_manifest = None
+    drive_state = None
+    if config.incremental and not full_rebuild:
+        previous_manifest = KBManifest.load(previous_active_full_path)
+        # Состояние списка Drive не зависит от параметров сборки
+        drive_state = previous_manifest.drive if previous_manifest else None
+        if previous_manifest is None:
+            logger.info("Манифест текущей базы (TG) не найден — полная пересборка.")
+        elif previous_manifest.settings != settings:
+            logger.info("Параметры сборки базы (TG) изменились — полная пересборка.")
+            previous_manifest = None
+
+    logger.info("Получение списка файлов Google Drive (TG)...")
+    listing = await asyncio.to_thread(list_files, drive_state)
+    if listing is None:
+        return {"success": False, "error": "Failed to list Google Drive files", "added_chunks": 0, "total_chunks": 0}
+    drive_files, new_drive_state = listing
+    if not drive_files:
+        logger.warning("Документы в Google Drive (TG) не найдены. Обновление отменено.")
+        return {"success": False, "error": "No documents in Google Drive", "added_chunks": 0, "total_chunks": 0}
+
+    plan = previous_manifest.plan(drive_files) if previous_manifest else KBUpdatePlan(changed=list(drive_files))
+    stats = {
+        "mode": "incremental" if previous_manifest else "full",
+        "changed_files": len(plan.changed),
+        "unchanged_files": len(plan.unchanged),
+        "removed_files": len(plan.removed),
+        "copied_chunks": 0,
+        "reused_embeddings": 0,
+        "embedded_chunks": 0,
+    }
+    if previous_manifest and not plan.has_changes:
+        logger.info("Файлы на Google Drive (TG) не изменились — обновление базы не требуется.")
+        if new_drive_state != previous_manifest.drive:
+            # Сдвигаем page token в манифесте текущей базы, чтобы не перечитывать те же изменения
+            previous_manifest.drive = new_drive_state
+            await asyncio.to_thread(previous_manifest.save, previous_active_full_path)
+        return {"success": True, "added_chunks": 0, "total_chunks": previous_manifest.total_chunks,
+                "new_active_path": previous_active_full_path, "previous_active_path": previous_active_full_path,
+                **stats, "mode": "unchanged"}
+    logger.info(f"Файлы Google Drive (TG): изменено/новых {len(plan.changed)}, без изменений {len(plan.unchanged)}, удалено {len(plan.removed)}.")
+
+    new_db_subpath = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f") + KB_VERSION_SUFFIX
+    new_db_full_path = os.path.join(config.base_path, new_db_subpath)
+    logger.info(f"Новая директория для БД (TG): {new_db_full_path}")
+
+    try:
+        os.makedirs(new_db_full_path, exist_ok=True)
+    except Exception as e_mkdir:
+        logger.error(f"Не удалось создать директорию '{new_db_full_path}' (TG): {e_mkdir}.", exc_info=True)
+        return {"success": False, "error": f"Failed to create temp dir: {e_mkdir}", "added_chunks": 0, "total_chunks": 0}
+
+    async def _discard_new_dir():
+        if os.path.exists(new_db_full_path):
+            await asyncio.to_thread(shutil.rmtree, new_db_full_path)
+
+    try:
+        def _init_temp_chroma():
+            return chromadb.PersistentClient(path=new_db_full_path).get_or_create_collection(name=config.collection_name)
+        temp_vector_collection = await asyncio.to_thread(_init_temp_chroma)
+        logger.info(f"Временная коллекция '{config.collection_name}' (TG) создана/получена в '{new_db_full_path}'.")
+
+        previous_collection = None
+        if previous_manifest:
+            def _open_previous_chroma():
+                return chromadb.PersistentClient(path=previous_active_full_path).get_collection(config.collection_name)
+            previous_collection = await asyncio.to_thread(_open_previous_chroma)
+
+        logger.info(f"Скачивание {len(plan.changed)} файлов из Google Drive (TG)...")
+        documents_data = await asyncio.to_thread(read_files, plan.changed)
+        downloaded_ids = {doc['id'] for doc in documents_data}
+        # Изменённый файл не скачался — оставляем его прежнюю версию из текущей базы
+        failed_files = [
+            f for f in plan.changed
+            if f['id'] not in downloaded_ids and previous_manifest and f['id'] in previous_manifest.files
+        ]
+        kept_files = plan.unchanged + failed_files
+        if not documents_data and not kept_files:
+            logger.warning("Документы в Google Drive (TG) не найдены. Обновление отменено.")
+            await _discard_new_dir()
+            return {"success": False, "error": "No documents in Google Drive", "added_chunks": 0, "total_chunks": 0}
+
+        new_manifest = KBManifest(settings, drive=new_drive_state)
+        copied = {"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+        if kept_files:
+            copied = await asyncio.to_thread(get_chunks, previous_collection, "file_id", [f['id'] for f in kept_files])
+            for f in kept_files:
+                new_manifest.files[f['id']] = previous_manifest.files[f['id']]
+            logger.info(f"Из текущей базы (TG) скопировано {len(copied['ids'])} чанков {len(kept_files)} файлов.")
+
+        all_texts, all_metadatas, all_ids = [], [], []
+        for doc_info in documents_data:
+            chunks = []
+            if doc_info['content'].strip():
+                chunks = split_document(doc_info['name'], doc_info['content'])
+            else:
+                logger.warning(f"Документ '{doc_info['name']}' (TG) пуст.")
+            for idx, (text, metadata) in enumerate(chunks):
+                all_texts.append(text)
+                all_metadatas.append({**metadata, "file_id": doc_info['id'], "chunk_hash": chunk_hash(text)})
+                all_ids.append(f"{doc_info['id']}_{idx}")
+            new_manifest.record_file(doc_info, len(chunks))
+
+        if not all_texts and not copied["ids"]:
+            logger.warning("Нет текстовых данных для добавления в базу (TG).")
+            await _discard_new_dir()
+            return {"success": False, "error": "No text data to add", "added_chunks": 0, "total_chunks": 0}
+
+        # Чанки с тем же текстом, что и в текущей базе, не отправляем в API
+        all_embeddings: List[Optional[List[float]]] = [None] * len(all_texts)
+        if previous_collection is not None and all_texts:
+            hashes = list({metadata["chunk_hash"] for metadata in all_metadatas})
+            known = await asyncio.to_thread(get_chunks, previous_collection, "chunk_hash", hashes)
+            known_embeddings = {metadata["chunk_hash"]: embedding for metadata, embedding in zip(known["metadatas"], known["embeddings"])}
+            for i, metadata in enumerate(all_metadatas):
+                all_embeddings[i] = known_embeddings.get(metadata["chunk_hash"])
+        to_embed = [i for i, embedding in enumerate(all_embeddings) if embedding is None]
+        stats["copied_chunks"] = len(copied["ids"])
+        stats["reused_embeddings"] = len(all_texts) - len(to_embed)
+        if stats["reused_embeddings"]:
+            logger.info(f"Эмбеддинги {stats['reused_embeddings']} чанков (TG) взяты из текущей базы.")
+
+        reused = [i for i, embedding in enumerate(all_embeddings) if embedding is not None]
+        fresh_embeddings, stats["embedding_cache"] = await embed_chunks(
+            client,
+            [all_texts[i] for i in to_embed],
+            known_texts=copied["documents"] + [all_texts[i] for i in reused],
+            known_embeddings=copied["embeddings"] + [all_embeddings[i] for i in reused],
+            config=config,
+            on_progress=on_progress,
+        )
+        for i, embedding in zip(to_embed, fresh_embeddings):
+            all_embeddings[i] = embedding
+        stats["embedded_chunks"] = len(to_embed) - stats["embedding_cache"].get("hits", 0)
+
+        ids = copied["ids"] + all_ids
+        documents = copied["documents"] + all_texts
+        metadatas = copied["metadatas"] + all_metadatas
+        embeddings = copied["embeddings"] + all_embeddings
+
+        def _add_to_chroma():
+            for start in range(0, len(ids), KB_CHROMA_BATCH_SIZE):
+                end = start + KB_CHROMA_BATCH_SIZE
+                temp_vector_collection.add(ids=ids[start:end], embeddings=embeddings[start:end],
+                                           metadatas=metadatas[start:end], documents=documents[start:end])
+            return temp_vector_collection.count()
+        final_total = await asyncio.to_thread(_add_to_chroma)
+        final_added = len(all_ids)
+        logger.info(f"Успешно добавлено {final_added} чанков (TG), скопировано {len(copied['ids'])}. Всего: {final_total}.")
+
+        await asyncio.to_thread(new_manifest.save, new_db_full_path)
+        if config.hybrid_search:
+            keyword_index = await asyncio.to_thread(KeywordIndex, ids, documents)
+            await asyncio.to_thread(keyword_index.save, new_db_full_path)
+        if config.vector_backend == "numpy":
+            numpy_index = await asyncio.to_thread(
+                NumpyVectorIndex.from_embeddings, ids, documents, metadatas, embeddings,
+                config.numpy_dtype, config.numpy_search_dims or None,
+            )
+            await asyncio.to_thread(numpy_index.save, new_db_full_path)
+
+        await asyncio.to_thread(write_active_kb_path, config, new_db_subpath)
+        logger.info(f"Подпуть к новой активной базе (TG) '{new_db_subpath}' сохранен в '{config.active_info_path}'. "
+                    f"Активная директория БД: '{new_db_full_path}'")
+        # Предыдущую версию может читать запущенный бот — её удалит он после подмены
+        await asyncio.to_thread(prune_versions, config, [new_db_full_path, previous_active_full_path])
+
+        logger.info("--- Обновление базы знаний (TG) успешно завершено ---")
+        return {"success": True, "added_chunks": final_added, "total_chunks": final_total,
+                "new_active_path": new_db_full_path, "previous_active_path": previous_active_full_path, **stats}
+
+    except openai.APIError as e_openai:
+        logger.error(f"OpenAI API ошибка (TG): {e_openai}", exc_info=True)
+        await _discard_new_dir()
+        return {"success": False, "error": f"OpenAI API error: {e_openai}", "added_chunks": 0, "total_chunks": 0}
+    except Exception as e_main_update:
+        logger.error(f"Критическая ошибка обновления БЗ (TG): {e_main_update}", exc_info=True)
+        await _discard_new_dir()
+        return {"success": False, "error": f"Critical update error: {e_main_update}", "added_chunks": 0, "total_chunks": 0}
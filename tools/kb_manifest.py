@@ -0,0 +1,111 @@
+"""
+Манифест базы знаний для инкрементального обновления.
+
+В каждой директории Chroma рядом с коллекцией лежит kb_manifest.json:
+параметры сборки (модель эмбеддингов, размерность, настройки разбиения)
+и для каждого файла Google Drive — modifiedTime, md5Checksum и число
+чанков. При следующем обновлении список файлов Drive сравнивается
+с манифестом:
+    - неизменённые файлы не скачиваются, их чанки вместе с эмбеддингами
+      копируются из предыдущей коллекции;
+    - изменённые и новые скачиваются и разбиваются заново, но эмбеддинги
+      чанков с тем же текстом (chunk_hash в метаданных) тоже берутся
+      из предыдущей коллекции — к API уходят только новые тексты;
+    - чанки удалённых файлов в новую коллекцию не попадают.
+
+Если параметры сборки изменились или манифеста нет (база собрана старой
+версией бота), выполняется полная пересборка.
+
+Там же хранится состояние списка Drive (drive): page token журнала
+изменений, папки дерева и все файлы — по нему следующее обновление
+запрашивает у Drive только изменения (см. tools/drive_ingest.py).
+"""
+
+import hashlib
+import json
+import os
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+MANIFEST_FILE = 'kb_manifest.json'
+
+
+def chunk_hash(text: str) -> str:
+    """Хэш текста чанка (ключ повторного использования эмбеддинга)."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _file_changed(old: Dict[str, Any], new: Dict[str, Any]) -> bool:
+    # У Google Docs нет md5Checksum — для них решает только modifiedTime
+    if old.get('md5Checksum') and new.get('md5Checksum'):
+        return old['md5Checksum'] != new['md5Checksum'] or old.get('name') != new.get('name')
+    return old.get('modifiedTime') != new.get('modifiedTime') or old.get('name') != new.get('name')
+
+
+@dataclass
+class KBUpdatePlan:
+    """Что делать с файлами Drive при обновлении."""
+    unchanged: List[Dict[str, Any]] = field(default_factory=list)
+    changed: List[Dict[str, Any]] = field(default_factory=list)   # изменённые и новые
+    removed: List[str] = field(default_factory=list)              # id файлов
+
+    @property
+    def has_changes(self) -> bool:
+        return bool(self.changed or self.removed)
+
+
+class KBManifest:
+    """Состояние файлов, из которых собрана коллекция."""
+
+    def __init__(self, settings: Dict[str, Any], files: Optional[Dict[str, Dict[str, Any]]] = None,
+                 drive: Optional[Dict[str, Any]] = None):
+        self.settings = settings
+        self.files: Dict[str, Dict[str, Any]] = files or {}
+        self.drive = drive
+
+    @classmethod
+    def load(cls, kb_path: Optional[str]) -> Optional['KBManifest']:
+        """Манифест из директории базы или None (нет, битый)."""
+        if not kb_path:
+            return None
+        try:
+            with open(os.path.join(kb_path, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return cls(data['settings'], data['files'], data.get('drive'))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, kb_path: str):
+        """Атомарно записывает манифест в директорию базы."""
+        path = os.path.join(kb_path, MANIFEST_FILE)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'settings': self.settings, 'files': self.files, 'drive': self.drive}, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+
+    def record_file(self, file_item: Dict[str, Any], chunks: int):
+        self.files[file_item['id']] = {
+            'name': file_item.get('name'),
+            'mimeType': file_item.get('mimeType'),
+            'modifiedTime': file_item.get('modifiedTime'),
+            'md5Checksum': file_item.get('md5Checksum'),
+            'chunks': chunks,
+        }
+
+    @property
+    def total_chunks(self) -> int:
+        return sum(info.get('chunks', 0) for info in self.files.values())
+
+    def plan(self, drive_files: List[Dict[str, Any]]) -> KBUpdatePlan:
+        """Сравнивает текущий список файлов Drive с манифестом."""
+        plan = KBUpdatePlan()
+        current_ids = set()
+        for file_item in drive_files:
+            current_ids.add(file_item['id'])
+            old = self.files.get(file_item['id'])
+            if old is not None and not _file_changed(old, file_item):
+                plan.unchanged.append(file_item)
+            else:
+                plan.changed.append(file_item)
+        plan.removed = [file_id for file_id in self.files if file_id not in current_ids]
+        return plan
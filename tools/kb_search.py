@@ -0,0 +1,246 @@
+"""
+Гибридный поиск по базе знаний: BM25 + векторы + локальное переранжирование.
+
+Чистый векторный поиск плохо находит запросы с точными обозначениями —
+коды программ («Pr4», «PE Future»), аббревиатуры («ОГЭ»), названия
+филиалов: в эмбеддинге такие токены почти не весят. Поэтому:
+    - при сборке базы по тем же чанкам строится инвертированный индекс
+      (KeywordIndex, BM25) и сохраняется рядом с коллекцией Chroma;
+    - hybrid_search берёт с запасом кандидатов из обоих поисков
+      и объединяет списки через reciprocal rank fusion (RRF);
+    - кандидаты переранжируются локально (rerank): косинусная близость
+      эмбеддингов плюс доля «веса» (IDF) слов запроса, найденных в чанке.
+
+Всё считается на CPU без внешних сервисов; к OpenAI уходит только
+эмбеддинг запроса, как и раньше.
+"""
+
+import heapq
+import json
+import math
+import os
+import re
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+KEYWORD_INDEX_FILE = 'kb_keyword_index.json'
+
+# Параметры BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Сглаживание RRF: score = Σ 1 / (RRF_K + ранг)
+RRF_K = 60
+
+# Вес совпадения слов запроса при переранжировании (к косинусной близости 0..1)
+RERANK_KEYWORD_WEIGHT = 0.3
+
+SEARCH_MODES = ('dense', 'keyword', 'hybrid')
+
+_TOKEN_RE = re.compile(r'\w+')
+
+# Окончания русских слов, которые отбрасываются при индексации (от длинных к коротким)
+_RU_ENDINGS = sorted({
+    'иями', 'ями', 'ами', 'ием', 'ией', 'иях', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими',
+    'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ый', 'ий', 'ой', 'ей', 'ом', 'ем', 'ам', 'ям',
+    'ах', 'ях', 'ов', 'ев', 'ую', 'юю', 'ью', 'ия', 'ие', 'ии', 'ть',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь',
+}, key=len, reverse=True)
+_MIN_STEM = 4
+
+
+def _stem(token: str) -> str:
+    # Токены с цифрами и латиница (коды программ) остаются как есть
+    if not token.isalpha() or not ('а' <= token[0] <= 'я'):
+        return token
+    for ending in _RU_ENDINGS:
+        if token.endswith(ending) and len(token) - len(ending) >= _MIN_STEM:
+            return token[:-len(ending)]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """Слова текста в нижнем регистре (ё → е) с отброшенными окончаниями."""
+    return [_stem(token) for token in _TOKEN_RE.findall(text.casefold().replace('ё', 'е'))]
+
+
+class KeywordIndex:
+    """BM25 по чанкам коллекции: постинг-листы термин → [(номер чанка, частота)]."""
+
+    def __init__(self, ids: Sequence[str], documents: Sequence[str]):
+        self.ids: List[str] = list(ids)
+        self.lengths: List[int] = []
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        for number, document in enumerate(documents):
+            tokens = tokenize(document or '')
+            self.lengths.append(len(tokens))
+            counts: Dict[str, int] = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                self.postings.setdefault(token, []).append((number, count))
+        self._prepare()
+
+    def _prepare(self):
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        total = len(self.ids)
+        self.idf = {
+            term: math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self.postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, n: int) -> List[Tuple[str, float]]:
+        """До n чанков по убыванию BM25: [(id, score)]."""
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for number, tf in self.postings[term]:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[number] / (self.avg_length or 1))
+                scores[number] = scores.get(number, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+        best = heapq.nlargest(n, scores.items(), key=lambda item: item[1])
+        return [(self.ids[number], score) for number, score in best]
+
+    def coverage(self, query_terms: Sequence[str], document: str) -> float:
+        """Доля IDF слов запроса, которые есть в тексте (0..1)."""
+        weights = {term: self.idf.get(term, 0.0) for term in set(query_terms)}
+        total = sum(weights.values())
+        if not total:
+            return 0.0
+        document_terms = set(tokenize(document or ''))
+        return sum(weight for term, weight in weights.items() if term in document_terms) / total
+
+    def save(self, kb_path: str):
+        """Атомарно записывает индекс в директорию базы."""
+        path = os.path.join(kb_path, KEYWORD_INDEX_FILE)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'ids': self.ids, 'lengths': self.lengths, 'postings': self.postings},
+                      f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, kb_path: Optional[str]) -> Optional['KeywordIndex']:
+        """Индекс из директории базы или None (нет, битый)."""
+        if not kb_path:
+            return None
+        try:
+            with open(os.path.join(kb_path, KEYWORD_INDEX_FILE), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            index = cls.__new__(cls)
+            index.ids = data['ids']
+            index.lengths = data['lengths']
+            index.postings = {term: [tuple(p) for p in postings] for term, postings in data['postings'].items()}
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        index._prepare()
+        return index
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = RRF_K) -> List[Tuple[str, float]]:
+    """Объединяет ранжированные списки id: score = Σ 1 / (k + ранг)."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item_id in enumerate(ranking, 1):
+            scores[item_id] = scores.get(item_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def rerank(
+    index: KeywordIndex,
+    query: str,
+    query_embedding: Sequence[float],
+    candidates: List[Dict[str, Any]],
+    keyword_weight: float = RERANK_KEYWORD_WEIGHT,
+) -> List[Dict[str, Any]]:
+    """Сортирует кандидатов ({'document', 'embedding', ...}) по близости к запросу; добавляет 'score'."""
+    if not candidates:
+        return []
+    query_vector = np.asarray(query_embedding, dtype=np.float32)
+    vectors = np.asarray([candidate['embedding'] for candidate in candidates], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1) * (np.linalg.norm(query_vector) or 1.0)
+    cosine = vectors @ query_vector / np.where(norms == 0, 1.0, norms)
+    query_terms = tokenize(query)
+    for candidate, similarity in zip(candidates, cosine):
+        candidate['score'] = float(similarity) + keyword_weight * index.coverage(query_terms, candidate['document'])
+    return sorted(candidates, key=lambda candidate: candidate['score'], reverse=True)
+
+
+def _rows(result: Dict[str, Any], nested: bool) -> List[Dict[str, Any]]:
+    """Ответ Chroma (query — списки в списке, get — плоские) → [{'id', 'document', 'metadata', 'embedding'}]."""
+    def column(name):
+        values = result.get(name)
+        if values is None:
+            return None
+        return values[0] if nested else values
+    ids = column('ids') or []
+    documents = column('documents')
+    metadatas = column('metadatas')
+    embeddings = column('embeddings')
+    return [
+        {
+            'id': item_id,
+            'document': documents[i] if documents is not None else '',
+            'metadata': (metadatas[i] if metadatas is not None else None) or {},
+            'embedding': embeddings[i] if embeddings is not None else None,
+        }
+        for i, item_id in enumerate(ids)
+    ]
+
+
+def hybrid_search(
+    collection,
+    index: Optional[KeywordIndex],
+    query: str,
+    query_embedding: Sequence[float],
+    k: int,
+    candidates: int = 20,
+    mode: str = 'hybrid',
+    rrf_k: int = RRF_K,
+) -> List[Dict[str, Any]]:
+    """
+    Лучшие k чанков для запроса (синхронно — вызывать через asyncio.to_thread).
+
+    Args:
+        collection: Коллекция Chroma
+        index: BM25-индекс той же коллекции; без него поиск только векторный
+        candidates: Сколько кандидатов брать из каждого поиска до переранжирования
+        mode: 'dense' — только векторы (как раньше), 'keyword' — только BM25,
+              'hybrid' — RRF обоих списков и переранжирование
+
+    Returns:
+        [{'id', 'document', 'metadata', 'embedding', 'score'?}] по убыванию релевантности
+    """
+    if index is None or not len(index):
+        mode = 'dense'
+    include = ['documents', 'metadatas', 'embeddings']
+
+    dense: List[Dict[str, Any]] = []
+    if mode in ('dense', 'hybrid'):
+        n_results = k if mode == 'dense' else candidates
+        dense = _rows(collection.query(query_embeddings=[list(query_embedding)], n_results=n_results,
+                                       include=include), nested=True)
+        if mode == 'dense':
+            return dense[:k]
+
+    keyword_ids = [item_id for item_id, _ in index.search(query, candidates)]
+    if mode == 'keyword':
+        fused_ids = keyword_ids[:k]
+    else:
+        fused = reciprocal_rank_fusion([[row['id'] for row in dense], keyword_ids], rrf_k)
+        fused_ids = [item_id for item_id, _ in fused[:candidates]]
+
+    rows = {row['id']: row for row in dense}
+    missing = [item_id for item_id in fused_ids if item_id not in rows]
+    if missing:
+        for row in _rows(collection.get(ids=missing, include=include), nested=False):
+            rows[row['id']] = row
+    found = [rows[item_id] for item_id in fused_ids if item_id in rows]
+    if mode == 'keyword':
+        return found
+    return rerank(index, query, query_embedding, found)[:k]
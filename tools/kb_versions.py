@@ -0,0 +1,240 @@
+"""
+Версии базы знаний: атомарная подмена без простоя и единственный писатель.
+
+Раньше обновление записывало указатель на новую директорию, переназначало
+глобальную vector_collection и сразу удаляло предыдущую директорию —
+а запросы, которые в этот момент выполнялись в потоках, ещё читали старую
+коллекцию. Теперь:
+    - каждая загруженная версия — KBHandle (путь, коллекция, BM25-индекс)
+      со счётчиком ссылок;
+    - читатель берёт версию через KBRegistry.pin() и держит её до конца
+      запроса; подмена (swap) только переключает текущую версию;
+    - старая версия помечается выведенной и удаляется с диска, когда
+      последний читатель её отпустит (сразу, если читателей нет);
+    - обновление базы выполняет только один писатель: KBWriterLock —
+      flock на файле в директории баз, поэтому /update, /start, ежедневная
+      задача и update_kb.py (отдельный процесс) не собирают базу одновременно;
+    - пока версия загружена, KBHandle держит разделяемый flock на
+      KB_READER_LOCK_FILE в её директории: удаление устаревших версий
+      (remove_kb_version, в том числе из update_kb.py) пропускает версии,
+      которые ещё читает бот.
+"""
+
+import fcntl
+import logging
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Файл в директории версии: разделяемый flock — версию читает процесс бота
+KB_READER_LOCK_FILE = '.kb_reader.lock'
+
+
+class KBHandle:
+    """Загруженная версия базы знаний."""
+
+    def __init__(self, path: str, collection: Any, keyword_index: Any = None):
+        self.path = path
+        self.version = os.path.basename(path)
+        self.collection = collection
+        self.keyword_index = keyword_index
+        self.refs = 0
+        self.retired = False
+        self.delete_on_drain = False
+        self._reader_fd = _lock_reader(path)
+
+    def release_reader_lock(self):
+        """Версия больше не читается этим процессом — её можно удалять."""
+        fd, self._reader_fd = self._reader_fd, None
+        if fd is not None:
+            os.close(fd)
+
+
+def _lock_reader(path: str) -> Optional[int]:
+    """Разделяемый flock на файле-маркере версии (None — версию сейчас удаляют или директории нет)."""
+    try:
+        fd = os.open(os.path.join(path, KB_READER_LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as e:
+        logger.warning(f"База знаний {os.path.basename(path)}: не удалось создать маркер чтения: {e}")
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        logger.warning(f"База знаний {os.path.basename(path)}: версия удаляется другим процессом")
+        return None
+    return fd
+
+
+def remove_kb_version(path: str) -> bool:
+    """
+    Удаляет директорию версии, если её не читает ни один процесс.
+
+    Удаление идёт под эксклюзивным flock на маркере чтения: версия, которую
+    загружает бот, либо уже закреплена (и не удаляется), либо не загрузится.
+
+    Returns:
+        True — директория удалена (или её уже не было), False — версия используется
+    """
+    lock_path = os.path.join(path, KB_READER_LOCK_FILE)
+    try:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    except FileNotFoundError:
+        return True
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info(f"База знаний {os.path.basename(path)} ещё загружена в боте — не удаляем")
+            return False
+        shutil.rmtree(path)
+        return True
+    finally:
+        os.close(fd)
+
+
+class KBRegistry:
+    """Текущая версия базы и выведенные версии, которые ещё читают."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current: Optional[KBHandle] = None
+        self._draining: List[KBHandle] = []
+        # Пути всех версий, которые загружались в этом процессе: их удаляет только реестр
+        self._held_paths: Set[str] = set()
+        self.swaps = 0
+        self.deferred_deletions = 0
+
+    @property
+    def current(self) -> Optional[KBHandle]:
+        return self._current
+
+    def has_held(self, path: str) -> bool:
+        """Загружалась ли версия с этим путём в этом процессе."""
+        with self._lock:
+            return os.path.abspath(path) in self._held_paths
+
+    @contextmanager
+    def pin(self) -> Iterator[Optional[KBHandle]]:
+        """Текущая версия, которая не будет удалена до выхода из блока (None — базы нет)."""
+        with self._lock:
+            handle = self._current
+            if handle is not None:
+                handle.refs += 1
+        try:
+            yield handle
+        finally:
+            if handle is not None:
+                self._release(handle)
+
+    def _release(self, handle: KBHandle):
+        with self._lock:
+            handle.refs -= 1
+            drained = handle.retired and handle.refs == 0
+            if drained and handle in self._draining:
+                self._draining.remove(handle)
+        if drained:
+            self._dispose(handle)
+
+    def swap(self, handle: Optional[KBHandle], delete_previous: bool = True) -> Optional[KBHandle]:
+        """
+        Делает handle текущей версией.
+
+        Предыдущая версия (если у неё другой путь и delete_previous) удаляется
+        с диска, когда её отпустит последний читатель; handle=None только
+        выводит её из обращения.
+
+        Returns:
+            Предыдущую версию
+        """
+        with self._lock:
+            previous, self._current = self._current, handle
+            if handle is not None:
+                self._held_paths.add(os.path.abspath(handle.path))
+            self.swaps += 1
+            drained = False
+            if previous is not None and previous is not handle:
+                previous.retired = True
+                # Без новой версии (не загрузилась) старую директорию не трогаем
+                previous.delete_on_drain = delete_previous and handle is not None and previous.path != handle.path
+                drained = previous.refs == 0
+                if not drained:
+                    self._draining.append(previous)
+                    self.deferred_deletions += 1
+        if drained:
+            self._dispose(previous)
+        elif previous is not None and previous.retired:
+            logger.info(f"База знаний {previous.version}: ждём завершения {previous.refs} запросов перед удалением")
+        return previous
+
+    def _dispose(self, handle: KBHandle):
+        handle.release_reader_lock()
+        if not handle.delete_on_drain:
+            return
+        # Удаление в отдельном потоке: последний читатель может отпускать версию из event loop
+        threading.Thread(target=_remove_kb_dir, args=(handle.path,), name='kb-delete', daemon=True).start()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'current': self._current.version if self._current else None,
+                'current_refs': self._current.refs if self._current else 0,
+                'draining': [(handle.version, handle.refs) for handle in self._draining],
+                'swaps': self.swaps,
+                'deferred_deletions': self.deferred_deletions,
+            }
+
+
+def _remove_kb_dir(path: str):
+    try:
+        if remove_kb_version(path):
+            logger.info(f"Удалена выведенная директория базы знаний: '{path}'")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Не удалось удалить директорию базы знаний '{path}': {e}", exc_info=True)
+
+
+class KBWriterLock:
+    """
+    Межпроцессная блокировка обновления базы (flock, не блокирует ожиданием).
+
+    Блокировка снимается ядром при завершении процесса, поэтому упавшее
+    обновление не оставляет «вечный» замок.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def acquire(self) -> bool:
+        """True — блокировка взята; False — базу уже обновляет другой писатель."""
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def holder_pid(self) -> Optional[int]:
+        """PID процесса, записавшего блокировку последним (для сообщений)."""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
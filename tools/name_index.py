@@ -0,0 +1,177 @@
+"""
+Индекс ФИО учеников для быстрого поиска по фамилии/имени.
+
+Фамилии приводятся к нижнему регистру с заменой ё → е, по ним строятся
+постинг-листы всех подстрок длиной 1–3 символа. Поиск по подстроке берёт
+самый короткий постинг-лист из n-грамм запроса и проверяет только его,
+вместо прохода по всем клиентам. Поиск похожих фамилий (опечатки)
+отбирает кандидатов по общим триграммам и проверяет расстояние Левенштейна.
+"""
+
+import heapq
+from array import array
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+# Максимальная длина n-граммы в индексе
+_MAX_GRAM = 3
+
+
+def normalize_name(name: str) -> str:
+    """Нормализация ФИО для поиска: регистр, ё → е, лишние пробелы."""
+    if not name:
+        return ''
+    return ' '.join(name.casefold().replace('ё', 'е').split())
+
+
+def _ngrams(text: str, size: int) -> Set[str]:
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def _levenshtein(a: str, b: str, max_distance: int) -> int:
+    """Расстояние Левенштейна с отсечкой: больше max_distance → max_distance + 1."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char_a != char_b)
+            ))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class NameIndex:
+    """
+    Индекс клиентов по фамилии ученика.
+
+    Результаты ранжируются: точное совпадение фамилии, затем начало фамилии,
+    затем вхождение в середине; при равенстве — порядок в выгрузке 1С.
+    """
+
+    def __init__(
+        self,
+        clients: Sequence[Dict],
+        last_names: Optional[Sequence[str]] = None,
+        first_names: Optional[Sequence[str]] = None
+    ):
+        """
+        Args:
+            clients: Клиенты (возвращаются в результатах поиска)
+            last_names: Фамилии по позициям клиентов — если заданы вместе
+                с first_names, словари клиентов при построении не читаются
+            first_names: Имена по позициям клиентов
+        """
+        self._clients = clients
+        self._last_names: List[str] = []
+        self._first_names: List[str] = []
+        # n-грамма фамилии → позиции клиентов (по возрастанию)
+        self._postings: Dict[str, array] = {}
+
+        if last_names is None or first_names is None:
+            students = [client.get('student', {}) for client in clients]
+            last_names = [student.get('last_name', '') for student in students]
+            first_names = [student.get('first_name', '') for student in students]
+
+        for pos in range(len(clients)):
+            last_name = normalize_name(last_names[pos])
+            self._last_names.append(last_name)
+            self._first_names.append(normalize_name(first_names[pos]))
+
+            for size in range(1, _MAX_GRAM + 1):
+                for gram in _ngrams(last_name, size):
+                    posting = self._postings.get(gram)
+                    if posting is None:
+                        posting = self._postings[gram] = array('I')
+                    posting.append(pos)
+
+    def _substring_positions(self, query: str) -> List[int]:
+        """Позиции клиентов, в фамилии которых есть подстрока query."""
+        if not query:
+            return list(range(len(self._clients)))
+
+        if len(query) <= _MAX_GRAM:
+            return list(self._postings.get(query, ()))
+
+        # Кандидаты — самый редкий из триграмм запроса, проверяем вхождение целиком
+        rarest = min(
+            (self._postings.get(gram, ()) for gram in _ngrams(query, _MAX_GRAM)),
+            key=len
+        )
+        return [pos for pos in rarest if query in self._last_names[pos]]
+
+    def _filter_first_name(self, positions: List[int], first_name: Optional[str]) -> List[int]:
+        first = normalize_name(first_name)
+        if not first:
+            return positions
+        return [pos for pos in positions if first in self._first_names[pos]]
+
+    def _take(self, ranked: List[Tuple], limit: Optional[int]) -> List[Dict]:
+        top = heapq.nsmallest(limit, ranked) if limit is not None else sorted(ranked)
+        return [self._clients[item[-1]] for item in top]
+
+    def search(
+        self,
+        last_name: str,
+        first_name: Optional[str] = None,
+        limit: Optional[int] = None
+    ) -> Tuple[List[Dict], int]:
+        """
+        Поиск по вхождению фамилии (и имени, если указано).
+
+        Returns:
+            (найденные клиенты не больше limit, общее число совпадений)
+        """
+        query = normalize_name(last_name)
+        positions = self._filter_first_name(self._substring_positions(query), first_name)
+
+        ranked = []
+        for pos in positions:
+            name = self._last_names[pos]
+            rank = 0 if name == query else 1 if name.startswith(query) else 2
+            ranked.append((rank, pos))
+
+        return self._take(ranked, limit), len(ranked)
+
+    def search_similar(
+        self,
+        last_name: str,
+        first_name: Optional[str] = None,
+        limit: Optional[int] = None
+    ) -> Tuple[List[Dict], int]:
+        """
+        Поиск фамилий с опечатками (1 ошибка до 5 букв, 2 — для длинных).
+
+        Returns:
+            (похожие клиенты не больше limit, общее число похожих)
+        """
+        query = normalize_name(last_name)
+        if len(query) < _MAX_GRAM:
+            return [], 0
+
+        max_distance = 1 if len(query) <= 5 else 2
+        query_grams = _ngrams(query, _MAX_GRAM)
+        # Одна правка меняет не больше трёх триграмм
+        min_shared = max(1, len(query_grams) - _MAX_GRAM * max_distance)
+
+        shared: Dict[int, int] = {}
+        for gram in query_grams:
+            for pos in self._postings.get(gram, ()):
+                shared[pos] = shared.get(pos, 0) + 1
+
+        candidates = [pos for pos, count in shared.items() if count >= min_shared]
+        candidates = self._filter_first_name(candidates, first_name)
+
+        ranked = []
+        for pos in candidates:
+            distance = _levenshtein(query, self._last_names[pos], max_distance)
+            if distance <= max_distance:
+                ranked.append((distance, pos))
+
+        return self._take(ranked, limit), len(ranked)
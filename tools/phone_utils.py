@@ -0,0 +1,100 @@
+"""
+Нормализация телефонных номеров к формату +7XXXXXXXXXX.
+
+Используется ботом (поиск по телефону) и синхронизацией 1С (bitrix_sync),
+которая сохраняет уже нормализованные телефоны в clients.json.
+"""
+
+import re
+from typing import Dict, Iterable, List
+
+# Символы, которые не относятся к номеру (всё кроме цифр и +)
+_NON_PHONE_CHARS = re.compile(r'[^\d+]')
+
+# Разделители нескольких номеров в одном поле 1С ("+7900..., 8912...")
+_PHONE_SEPARATORS = re.compile(r'[,;/\n]')
+
+
+def normalize_phone(phone: str) -> str:
+    """
+    Нормализация телефонного номера к формату +7XXXXXXXXXX
+
+    Args:
+        phone: Телефон в любом формате
+
+    Returns:
+        Нормализованный телефон в формате +7XXXXXXXXXX
+
+    Examples:
+        +79001234567 → +79001234567
+        89001234567 → +79001234567
+        9001234567 → +79001234567
+        +7 900 123 45 67 → +79001234567
+        8 (900) 123-45-67 → +79001234567
+    """
+    # Удаляем все символы кроме цифр и +
+    cleaned = _NON_PHONE_CHARS.sub('', phone)
+
+    # Удаляем + в начале (если есть)
+    if cleaned.startswith('+'):
+        cleaned = cleaned[1:]
+
+    # Приводим к формату 7XXXXXXXXXX
+    if cleaned.startswith('8') and len(cleaned) == 11:
+        # 89001234567 → 79001234567
+        cleaned = '7' + cleaned[1:]
+    elif cleaned.startswith('9') and len(cleaned) == 10:
+        # 9001234567 → 79001234567
+        cleaned = '7' + cleaned
+    elif not cleaned.startswith('7'):
+        # Если не начинается с 7, добавляем 7 (для случаев когда только 10 цифр)
+        if len(cleaned) == 10:
+            cleaned = '7' + cleaned
+
+    # Добавляем +
+    return '+' + cleaned
+
+
+def split_phones(value: str) -> List[str]:
+    """
+    Разбивает поле с телефонами на нормализованные номера.
+
+    Пустые части отбрасываются, дубликаты убираются с сохранением порядка.
+
+    Examples:
+        "8 (900) 123-45-67; +7 912 000 00 00" → ["+79001234567", "+79120000000"]
+    """
+    if not value:
+        return []
+
+    phones = []
+    for part in _PHONE_SEPARATORS.split(value):
+        if not _NON_PHONE_CHARS.sub('', part).strip('+'):
+            continue
+        phone = normalize_phone(part)
+        if phone not in phones:
+            phones.append(phone)
+    return phones
+
+
+def normalize_phones(values: Iterable[str]) -> List[List[str]]:
+    """
+    Пакетная нормализация телефонных полей.
+
+    Одинаковые поля (у братьев и сестёр обычно общий телефон родителя)
+    разбираются один раз.
+
+    Args:
+        values: Сырые значения поля телефона
+
+    Returns:
+        Для каждого значения — список нормализованных номеров
+    """
+    memo: Dict[str, List[str]] = {}
+    result = []
+    for value in values:
+        phones = memo.get(value)
+        if phones is None:
+            phones = memo[value] = split_phones(value)
+        result.append(phones)
+    return result
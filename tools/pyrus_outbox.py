@@ -0,0 +1,280 @@
+"""
+Очередь исходящих задач Pyrus (outbox).
+
+create_pyrus_task не ждёт Pyrus: задача записывается в SQLite-базу
+data/pyrus_outbox.db и клиент сразу получает номер обращения. Фоновый
+воркер (run_outbox_worker, запускается ботом) отправляет задачи пачками,
+при ошибках повторяет с растущей паузой, а после OUTBOX_MAX_ATTEMPTS
+помечает задачу как failed — она остаётся в базе для ручного разбора,
+а бот получает вызов on_failed (уведомляет администратора: клиенту уже
+ответили, что обращение передано).
+
+Доставка «хотя бы один раз»: если бот упал посреди запроса к Pyrus,
+задача после перезапуска отправится повторно. Повторный вызов tool
+с тем же обращением (ключ идемпотентности) в очередь второй раз не попадает.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_PATH = os.path.join('data', 'pyrus_outbox.db')
+
+# Сколько задач отправлять за раз (параллельно, через общий клиент Pyrus)
+OUTBOX_BATCH_SIZE = 5
+
+# Как часто воркер проверяет очередь без сигнала о новых задачах (секунды)
+OUTBOX_POLL_INTERVAL = 30.0
+
+# Повторы: пауза OUTBOX_RETRY_BASE * 2^попытка, но не больше OUTBOX_RETRY_MAX
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE = 30.0
+OUTBOX_RETRY_MAX = 3600.0
+
+# Одинаковое обращение в течение этого окна (секунды) считается повтором
+OUTBOX_DEDUP_WINDOW = 600
+
+# Корутина (номер в очереди, задача, ошибка) — задача снята с очереди как failed
+FailedTaskCallback = Callable[[int, Dict[str, Any], str], Awaitable[None]]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    idempotency_key TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    task_id INTEGER,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at);
+CREATE INDEX IF NOT EXISTS outbox_key ON outbox (idempotency_key, created_at);
+"""
+
+
+def make_idempotency_key(requester: str, branch_name: str, message_text: str) -> str:
+    """
+    Ключ обращения: один отправитель, филиал и текст (без учёта пробелов и регистра).
+
+    requester — устойчивый идентификатор отправителя (Telegram ID, логин или телефон).
+    """
+    parts = [requester or '', ' '.join(branch_name.lower().split()), ' '.join(message_text.lower().split())]
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+class PyrusOutbox:
+    """Очередь задач в SQLite (WAL); методы можно вызывать из любых потоков."""
+
+    def __init__(self, path: str = OUTBOX_PATH):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def enqueue(self, task: Dict[str, Any], idempotency_key: str) -> int:
+        """
+        Ставит задачу в очередь.
+
+        Returns:
+            Номер задачи в очереди (для повтора того же обращения — прежний)
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id FROM outbox WHERE idempotency_key = ? AND created_at >= ? AND status != 'failed' "
+                "ORDER BY id DESC LIMIT 1",
+                (idempotency_key, now - OUTBOX_DEDUP_WINDOW)
+            ).fetchone()
+            if row:
+                logger.info(f"📥 Pyrus outbox: обращение уже в очереди (№{row[0]})")
+                return row[0]
+            cursor = self._conn.execute(
+                "INSERT INTO outbox (idempotency_key, payload, next_attempt_at, created_at) VALUES (?, ?, ?, ?)",
+                (idempotency_key, json.dumps(task, ensure_ascii=False), now, now)
+            )
+        logger.info(f"📥 Pyrus outbox: задача №{cursor.lastrowid} поставлена в очередь")
+        return cursor.lastrowid
+
+    def claim_due(self, limit: int = OUTBOX_BATCH_SIZE) -> List[Tuple[int, Dict[str, Any], int]]:
+        """Забирает задачи, которые пора отправлять: [(id, задача, попыток)]."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, payload, attempts FROM outbox "
+                    "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+                    (time.time(), limit)
+                ).fetchall()
+                self._conn.executemany(
+                    "UPDATE outbox SET status = 'sending' WHERE id = ?",
+                    [(row[0],) for row in rows]
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return [(row_id, json.loads(payload), attempts) for row_id, payload, attempts in rows]
+
+    def mark_sent(self, row_id: int, task_id: Optional[int]):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = 'sent', task_id = ?, attempts = attempts + 1, last_error = NULL WHERE id = ?",
+                (task_id, row_id)
+            )
+
+    def mark_failed(self, row_id: int, attempts: int, error: str, retryable: bool = True) -> bool:
+        """
+        Записывает неудачную попытку.
+
+        Returns:
+            True — задача будет отправлена ещё раз, False — попытки исчерпаны
+        """
+        attempts += 1
+        retry = retryable and attempts < OUTBOX_MAX_ATTEMPTS
+        delay = min(OUTBOX_RETRY_MAX, OUTBOX_RETRY_BASE * 2 ** (attempts - 1))
+        with self._lock:
+            self._conn.execute(
+                "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                ('pending' if retry else 'failed', attempts, time.time() + delay, error, row_id)
+            )
+        return retry
+
+    def recover(self) -> int:
+        """Возвращает в очередь задачи, отправка которых прервалась остановкой бота."""
+        with self._lock:
+            cursor = self._conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+        return cursor.rowcount
+
+    def next_due_in(self) -> Optional[float]:
+        """Через сколько секунд наступит ближайшая попытка (None — очередь пуста)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(next_attempt_at) FROM outbox WHERE status = 'pending'"
+            ).fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+    def stats(self) -> Dict[str, int]:
+        """Количество задач по статусам."""
+        with self._lock:
+            return dict(self._conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall())
+
+
+_outbox: Optional[PyrusOutbox] = None
+_outbox_lock = threading.Lock()
+
+# Сигнал воркеру о новой задаче (создаётся в цикле воркера)
+_wakeup: Optional[asyncio.Event] = None
+_worker_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_pyrus_outbox() -> PyrusOutbox:
+    """Общая для процесса очередь задач Pyrus."""
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = PyrusOutbox()
+    return _outbox
+
+
+def notify_outbox_worker():
+    """Будит воркер, чтобы новая задача ушла сразу, а не по таймеру."""
+    if _worker_loop is not None and _wakeup is not None and not _worker_loop.is_closed():
+        _worker_loop.call_soon_threadsafe(_wakeup.set)
+
+
+async def _deliver(outbox: PyrusOutbox, row_id: int, task: Dict[str, Any], attempts: int,
+                   on_failed: Optional[FailedTaskCallback] = None):
+    from .pyrus_tools import deliver_queued_task
+
+    try:
+        result = await deliver_queued_task(task)
+    except Exception as e:
+        logger.error(f"❌ Pyrus outbox: исключение при отправке задачи №{row_id}: {e}", exc_info=True)
+        result = {"success": False, "error": str(e), "retryable": True}
+
+    if result.get("success"):
+        outbox.mark_sent(row_id, result.get("task_id"))
+        logger.info(f"✅ Pyrus outbox: задача №{row_id} отправлена (Pyrus ID: {result.get('task_id')})")
+        return
+
+    error = result.get("error", "Unknown error")
+    if outbox.mark_failed(row_id, attempts, error, result.get("retryable", True)):
+        logger.warning(f"⚠️ Pyrus outbox: задача №{row_id} не отправлена ({error}), попытка {attempts + 1}")
+    else:
+        logger.error(f"❌ Pyrus outbox: задача №{row_id} не отправлена и снята с очереди: {error}")
+        if on_failed:
+            try:
+                await on_failed(row_id, task, error)
+            except Exception as e:
+                logger.error(f"❌ Pyrus outbox: не удалось уведомить о задаче №{row_id}: {e}", exc_info=True)
+
+
+async def drain_outbox(outbox: Optional[PyrusOutbox] = None,
+                       on_failed: Optional[FailedTaskCallback] = None) -> int:
+    """
+    Отправляет все задачи, которым подошёл срок.
+
+    Args:
+        outbox: очередь (по умолчанию общая для процесса)
+        on_failed: вызывается для задач, снятых с очереди без отправки
+
+    Returns:
+        Сколько задач обработано (отправлено или отложено)
+    """
+    outbox = outbox or get_pyrus_outbox()
+    processed = 0
+    while True:
+        batch = outbox.claim_due(OUTBOX_BATCH_SIZE)
+        if not batch:
+            return processed
+        await asyncio.gather(*(_deliver(outbox, row_id, task, attempts, on_failed) for row_id, task, attempts in batch))
+        processed += len(batch)
+
+
+async def run_outbox_worker(on_failed: Optional[FailedTaskCallback] = None):
+    """
+    Фоновая задача бота: разбирает очередь до отмены.
+
+    Args:
+        on_failed: корутина (номер в очереди, задача, ошибка) для задач,
+            которые отправить не удалось (бот уведомляет администратора)
+    """
+    global _wakeup, _worker_loop
+    _wakeup = asyncio.Event()
+    _worker_loop = asyncio.get_running_loop()
+    outbox = get_pyrus_outbox()
+
+    recovered = outbox.recover()
+    if recovered:
+        logger.warning(f"⚠️ Pyrus outbox: {recovered} задач(и) возвращено в очередь после перезапуска")
+    logger.info(f"📮 Pyrus outbox: воркер запущен, очередь: {outbox.stats()}")
+
+    try:
+        while True:
+            try:
+                await drain_outbox(outbox, on_failed)
+            except Exception as e:
+                logger.error(f"❌ Pyrus outbox: ошибка обработки очереди: {e}", exc_info=True)
+
+            next_due = outbox.next_due_in()
+            timeout = OUTBOX_POLL_INTERVAL if next_due is None else min(OUTBOX_POLL_INTERVAL, next_due)
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            _wakeup.clear()
+    finally:
+        _worker_loop = None
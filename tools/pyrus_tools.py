@@ -1,15 +1,26 @@
 """
 Инструменты для работы с Pyrus API.
 Создание задач для администраторов филиалов.
+
+Запросы идут через общий асинхронный клиент (PyrusClient): соединения
+переиспользуются, токен и каталог филиалов кэшируются. create_pyrus_task
+не ждёт Pyrus: задача ставится в очередь (pyrus_outbox), а отправляет её
+фоновый воркер.
 """
 
+import asyncio
 import os
 import json
 import logging
+import random
+import time
 import httpx
 from typing import Optional, Dict, Any, List
 from dotenv import load_dotenv
 
+from .pyrus_outbox import get_pyrus_outbox, make_idempotency_key, notify_outbox_worker
+from .request_context import get_request_context
+
 load_dotenv()
 
 logger = logging.getLogger(__name__)
@@ -96,135 +107,275 @@ BRANCH_DISPLAY_TO_PYRUS = {
 }
 
 
-# --- Кэш для каталога филиалов Pyrus (item_id mapping) ---
-_pyrus_branch_catalog_cache: Optional[Dict[str, int]] = None
-_pyrus_access_token: Optional[str] = None
+# --- Асинхронный клиент Pyrus API ---
 
+# Таймаут одного HTTP-запроса (секунды)
+PYRUS_REQUEST_TIMEOUT = 15.0
 
-def _join_url(path: str) -> str:
-    """Безопасная склейка base_url и path."""
-    base = PYRUS_API_URL.rstrip('/')
-    path = path.lstrip('/')
-    return f"{base}/{path}"
+# Повторы при сетевых ошибках, 429 и 5xx: пауза PYRUS_RETRY_BACKOFF * 2^попытка
+PYRUS_MAX_RETRIES = 3
+PYRUS_RETRY_BACKOFF = 0.5
 
+# Ошибки, при которых запрос точно не дошёл до Pyrus: только их (и 429)
+# повторяем для неидемпотентных запросов (POST tasks) — после таймаута
+# чтения или 5xx задача могла быть уже создана, повтор дал бы дубль
+_UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+_IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
 
-def _authenticate_sync() -> Optional[str]:
-    """
-    Синхронная авторизация в Pyrus API.
-    Возвращает access_token или None при ошибке.
-    """
-    global _pyrus_access_token
-    
-    if not PYRUS_LOGIN or not PYRUS_SECURITY_KEY:
-        logger.error("❌ Pyrus: PYRUS_LOGIN или PYRUS_SECURITY_KEY не заданы в .env")
-        return None
-    
-    logger.info(f"🔐 Pyrus: Авторизация ({PYRUS_API_URL})...")
-    
+# Сколько живёт кэш каталога филиалов (секунды)
+PYRUS_CATALOG_TTL = 3600
+
+
+def _response_json(response: httpx.Response) -> Optional[Dict[str, Any]]:
+    """Тело ответа как JSON-объект; None, если это не JSON (например, HTML-страница прокси)."""
     try:
-        with httpx.Client(timeout=30.0) as client:
-            response = client.post(
-                _join_url("auth"),
-                json={
-                    "login": PYRUS_LOGIN,
-                    "security_key": PYRUS_SECURITY_KEY
-                }
-            )
-            
-            if response.status_code != 200:
-                error_data = response.json() if response.text else {}
-                logger.error(f"❌ Pyrus: Ошибка авторизации HTTP {response.status_code}: {error_data}")
-                return None
-            
-            data = response.json()
-            token = data.get("access_token")
-            
-            if not token:
-                logger.error("❌ Pyrus: Токен не найден в ответе API")
-                return None
-            
-            _pyrus_access_token = token
-            logger.info("✅ Pyrus: Авторизация успешна!")
-            return token
-            
-    except Exception as e:
-        logger.error(f"❌ Pyrus: Исключение при авторизации: {e}", exc_info=True)
+        data = response.json()
+    except ValueError:
         return None
+    return data if isinstance(data, dict) else None
 
 
-def _get_token_sync() -> Optional[str]:
-    """Получить access_token (с кешированием)."""
-    global _pyrus_access_token
-    if _pyrus_access_token:
-        return _pyrus_access_token
-    return _authenticate_sync()
+def _error_details(response: httpx.Response) -> str:
+    """Текст ошибки из ответа Pyrus: error_message из JSON или начало тела ответа."""
+    data = _response_json(response)
+    if data is not None:
+        return str(data.get('error_message') or data.get('error') or 'Unknown error')
+    return response.text[:200] or 'Unknown error'
 
 
-def _load_branch_catalog_sync() -> Dict[str, int]:
+class PyrusClient:
     """
-    Загружает каталог филиалов из Pyrus API.
-    Возвращает словарь: название филиала → item_id
+    Клиент Pyrus API поверх общего httpx.AsyncClient.
+
+    Соединения переиспользуются (keep-alive), токен обновляется одним
+    запросом на все параллельные задачи, каталог филиалов кэшируется
+    на PYRUS_CATALOG_TTL секунд.
     """
-    global _pyrus_branch_catalog_cache
-    
-    if _pyrus_branch_catalog_cache is not None:
-        return _pyrus_branch_catalog_cache
-    
-    token = _get_token_sync()
-    if not token:
-        logger.error("❌ Pyrus: Не удалось получить токен для загрузки каталога")
-        return {}
-    
-    logger.info(f"📂 Pyrus: Загрузка каталога филиалов (ID: {PYRUS_BRANCH_CATALOG_ID})...")
-    
-    try:
-        with httpx.Client(timeout=30.0) as client:
-            response = client.get(
-                _join_url(f"catalogs/{PYRUS_BRANCH_CATALOG_ID}"),
-                headers={"Authorization": f"Bearer {token}"}
+
+    def __init__(self):
+        self._http = httpx.AsyncClient(
+            base_url=PYRUS_API_URL.rstrip('/') + '/',
+            timeout=PYRUS_REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+        )
+        self.loop = asyncio.get_running_loop()
+        self._token: Optional[str] = None
+        self._token_lock = asyncio.Lock()
+        self._catalog: Optional[Dict[str, int]] = None
+        self._catalog_loaded_at = 0.0
+        self._catalog_lock = asyncio.Lock()
+
+    async def close(self):
+        await self._http.aclose()
+
+    async def _authenticate(self) -> Optional[str]:
+        if not PYRUS_LOGIN or not PYRUS_SECURITY_KEY:
+            logger.error("❌ Pyrus: PYRUS_LOGIN или PYRUS_SECURITY_KEY не заданы в .env")
+            return None
+
+        logger.info(f"🔐 Pyrus: Авторизация ({PYRUS_API_URL})...")
+        try:
+            # Авторизация ничего не создаёт — повторять её безопасно
+            response = await self._send(
+                "POST", "auth", idempotent=True,
+                json={"login": PYRUS_LOGIN, "security_key": PYRUS_SECURITY_KEY}
             )
-            
-            if response.status_code == 401:
-                # Токен протух — переавторизуемся
-                logger.warning("⚠️ Pyrus: Токен протух, переавторизация...")
-                global _pyrus_access_token
-                _pyrus_access_token = None
-                token = _get_token_sync()
-                if not token:
-                    return {}
-                response = client.get(
-                    _join_url(f"catalogs/{PYRUS_BRANCH_CATALOG_ID}"),
-                    headers={"Authorization": f"Bearer {token}"}
-                )
-            
-            if response.status_code != 200:
-                logger.error(f"❌ Pyrus: Ошибка загрузки каталога HTTP {response.status_code}")
-                return {}
-            
-            data = response.json()
-            items = data.get("items", [])
-            
-            # Строим mapping: название → item_id
-            catalog_mapping = {}
-            for item in items:
-                # item обычно имеет структуру: {"item_id": 123, "values": ["Название"]}
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Pyrus: Исключение при авторизации: {e}")
+            return None
+
+        if response.status_code != 200:
+            logger.error(f"❌ Pyrus: Ошибка авторизации HTTP {response.status_code}: {_error_details(response)}")
+            return None
+
+        token = (_response_json(response) or {}).get("access_token")
+        if not token:
+            logger.error(f"❌ Pyrus: Токен не найден в ответе API: {response.text[:200]}")
+            return None
+
+        logger.info("✅ Pyrus: Авторизация успешна!")
+        return token
+
+    async def _get_token(self, expired: Optional[str] = None) -> Optional[str]:
+        """
+        Текущий токен; expired — токен, на который сервер ответил 401.
+
+        Переавторизуется только первая из параллельных задач: остальные,
+        дождавшись лока, видят, что токен уже сменился, и берут новый.
+        """
+        async with self._token_lock:
+            if self._token is None or self._token == expired:
+                self._token = await self._authenticate()
+            return self._token
+
+    async def _send(self, method: str, path: str, idempotent: Optional[bool] = None, **kwargs) -> httpx.Response:
+        """
+        HTTP-запрос с повторами.
+
+        Идемпотентные запросы повторяются при сетевых ошибках, 429 и 5xx;
+        остальные (по умолчанию — все, кроме _IDEMPOTENT_METHODS) — только
+        при 429 и ошибках соединения, когда запрос заведомо не отправлен.
+        Прочие сбои таких запросов повторяет очередь pyrus_outbox.
+        """
+        if idempotent is None:
+            idempotent = method.upper() in _IDEMPOTENT_METHODS
+        retry_errors = httpx.TransportError if idempotent else _UNSENT_ERRORS
+        for attempt in range(PYRUS_MAX_RETRIES + 1):
+            try:
+                response = await self._http.request(method, path, **kwargs)
+                retryable = response.status_code == 429 or (idempotent and response.status_code >= 500)
+                if not retryable or attempt == PYRUS_MAX_RETRIES:
+                    return response
+                logger.warning(f"⚠️ Pyrus: HTTP {response.status_code} на {path}, повтор {attempt + 1}/{PYRUS_MAX_RETRIES}")
+            except retry_errors as e:
+                if attempt == PYRUS_MAX_RETRIES:
+                    raise
+                logger.warning(f"⚠️ Pyrus: {type(e).__name__} на {path}, повтор {attempt + 1}/{PYRUS_MAX_RETRIES}")
+            await asyncio.sleep(PYRUS_RETRY_BACKOFF * 2 ** attempt * random.uniform(0.8, 1.2))
+
+    async def request(self, method: str, path: str, **kwargs) -> Optional[httpx.Response]:
+        """
+        Авторизованный запрос. При 401 токен обновляется и запрос повторяется.
+
+        Returns:
+            Ответ API или None, если не удалось авторизоваться
+        """
+        token = await self._get_token()
+        if not token:
+            return None
+        response = await self._send(method, path, headers={"Authorization": f"Bearer {token}"}, **kwargs)
+        if response.status_code == 401:
+            logger.warning("⚠️ Pyrus: Токен протух, переавторизация...")
+            token = await self._get_token(expired=token)
+            if not token:
+                return None
+            response = await self._send(method, path, headers={"Authorization": f"Bearer {token}"}, **kwargs)
+        return response
+
+    async def get_branch_catalog(self) -> Dict[str, int]:
+        """
+        Каталог филиалов: название → item_id.
+
+        Если обновить каталог не удалось, возвращается устаревшая копия.
+        """
+        async with self._catalog_lock:
+            if self._catalog is not None and time.monotonic() - self._catalog_loaded_at < PYRUS_CATALOG_TTL:
+                return self._catalog
+
+            logger.info(f"📂 Pyrus: Загрузка каталога филиалов (ID: {PYRUS_BRANCH_CATALOG_ID})...")
+            try:
+                response = await self.request("GET", f"catalogs/{PYRUS_BRANCH_CATALOG_ID}")
+            except httpx.HTTPError as e:
+                logger.error(f"❌ Pyrus: Исключение при загрузке каталога: {e}")
+                response = None
+
+            if response is None or response.status_code != 200:
+                if response is not None:
+                    logger.error(f"❌ Pyrus: Ошибка загрузки каталога HTTP {response.status_code}")
+                return self._catalog or {}
+
+            data = _response_json(response)
+            if data is None:
+                logger.error(f"❌ Pyrus: Некорректный ответ при загрузке каталога: {response.text[:200]}")
+                return self._catalog or {}
+
+            # item обычно имеет структуру: {"item_id": 123, "values": ["Название"]}
+            catalog = {}
+            for item in data.get("items", []):
                 item_id = item.get("item_id")
                 values = item.get("values", [])
                 if item_id and values:
-                    name = values[0]  # Первое значение — название
-                    catalog_mapping[name] = item_id
-                    logger.debug(f"  Филиал: '{name}' → item_id={item_id}")
-            
-            _pyrus_branch_catalog_cache = catalog_mapping
-            logger.info(f"✅ Pyrus: Загружено {len(catalog_mapping)} филиалов из каталога")
-            return catalog_mapping
-            
-    except Exception as e:
-        logger.error(f"❌ Pyrus: Исключение при загрузке каталога: {e}", exc_info=True)
-        return {}
+                    catalog[values[0]] = item_id
+                    logger.debug(f"  Филиал: '{values[0]}' → item_id={item_id}")
+
+            self._catalog = catalog
+            self._catalog_loaded_at = time.monotonic()
+            logger.info(f"✅ Pyrus: Загружено {len(catalog)} филиалов из каталога")
+            return catalog
+
+    async def create_task(
+        self,
+        form_id: int,
+        fields: List[Dict[str, Any]],
+        text: Optional[str] = None,
+        subject: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Создаёт задачу в Pyrus.
+
+        Returns:
+            {"success": True, "task_id": ..., "task_url": ...} или
+            {"success": False, "error": ..., "retryable": bool} — retryable=False
+            для ошибок, которые не исправятся повтором (HTTP 4xx)
+        """
+        payload = {
+            "form_id": form_id,
+            "fields": fields
+        }
+        if text:
+            payload["text"] = text
+        if subject:
+            payload["subject"] = subject
+
+        logger.info(f"📤 Pyrus: Создание задачи по форме {form_id}...")
+        logger.debug(f"  Payload: {json.dumps(payload, ensure_ascii=False)}")
+
+        try:
+            response = await self.request("POST", "tasks", json=payload)
+        except httpx.HTTPError as e:
+            logger.error(f"❌ Pyrus: Исключение при создании задачи: {e}")
+            return {"success": False, "error": str(e), "retryable": True}
+
+        if response is None:
+            return {"success": False, "error": "Не удалось авторизоваться в Pyrus", "retryable": True}
+
+        if response.status_code != 200:
+            error_details = _error_details(response)
+            logger.error(f"❌ Pyrus: Ошибка создания задачи HTTP {response.status_code}: {error_details}")
+            return {
+                "success": False,
+                "error": f"HTTP {response.status_code}: {error_details}",
+                "retryable": response.status_code == 429 or response.status_code >= 500
+            }
 
+        # HTTP 200 — задача создана; повтор из-за нечитаемого тела создал бы дубль
+        data = _response_json(response)
+        if data is None:
+            logger.warning(f"⚠️ Pyrus: Задача создана, но ответ не JSON: {response.text[:200]}")
+        task_id = (data or {}).get("task", {}).get("id")
+        logger.info(f"✅ Pyrus: Задача создана! ID: {task_id}")
+        return {
+            "success": True,
+            "task_id": task_id,
+            "task_url": f"https://pyrus.com/t#{task_id}" if task_id else None
+        }
+
+
+_pyrus_client: Optional[PyrusClient] = None
+
+
+def get_pyrus_client() -> PyrusClient:
+    """
+    Общий клиент Pyrus для текущего event loop.
 
-def _resolve_branch_to_pyrus_item_id(branch_name: str) -> Optional[int]:
+    httpx.AsyncClient привязан к циклу, в котором создан, поэтому при вызове
+    из другого цикла (например, asyncio.run в скрипте) создаётся новый клиент.
+    """
+    global _pyrus_client
+    if _pyrus_client is None or _pyrus_client.loop is not asyncio.get_running_loop():
+        _pyrus_client = PyrusClient()
+    return _pyrus_client
+
+
+async def close_pyrus_client():
+    """Закрывает соединения клиента Pyrus (при остановке бота)."""
+    global _pyrus_client
+    client, _pyrus_client = _pyrus_client, None
+    if client is not None and client.loop is asyncio.get_running_loop():
+        await client.close()
+
+
+async def _resolve_branch_to_pyrus_item_id(branch_name: str) -> Optional[int]:
     """
     Преобразует название филиала в item_id каталога Pyrus.
     
@@ -255,7 +406,7 @@ def _resolve_branch_to_pyrus_item_id(branch_name: str) -> Optional[int]:
         pyrus_name = branch_name
     
     # 3. Загружаем каталог и ищем item_id
-    catalog = _load_branch_catalog_sync()
+    catalog = await get_pyrus_client().get_branch_catalog()
     if not catalog:
         logger.warning(f"⚠️ Pyrus: Каталог пуст, возвращаем None для '{branch_name}'")
         return None
@@ -279,91 +430,19 @@ def _resolve_branch_to_pyrus_item_id(branch_name: str) -> Optional[int]:
     return None
 
 
-def _create_task_sync(
-    form_id: int,
-    fields: List[Dict[str, Any]],
-    text: Optional[str] = None,
-    subject: Optional[str] = None
-) -> Dict[str, Any]:
-    """
-    Создаёт задачу в Pyrus (синхронно).
-    
-    Args:
-        form_id: ID формы
-        fields: Список полей формы
-        text: Комментарий к задаче
-        subject: Тема задачи
-    
-    Returns:
-        Результат создания задачи
-    """
-    token = _get_token_sync()
-    if not token:
-        return {"success": False, "error": "Не удалось авторизоваться в Pyrus"}
-    
-    payload = {
-        "form_id": form_id,
-        "fields": fields
-    }
-    
-    if text:
-        payload["text"] = text
-    if subject:
-        payload["subject"] = subject
-    
-    logger.info(f"📤 Pyrus: Создание задачи по форме {form_id}...")
-    logger.debug(f"  Payload: {json.dumps(payload, ensure_ascii=False)}")
-    
-    try:
-        with httpx.Client(timeout=30.0) as client:
-            response = client.post(
-                _join_url("tasks"),
-                headers={"Authorization": f"Bearer {token}"},
-                json=payload
-            )
-            
-            if response.status_code == 401:
-                # Токен протух
-                logger.warning("⚠️ Pyrus: Токен протух при создании задачи, переавторизация...")
-                global _pyrus_access_token
-                _pyrus_access_token = None
-                token = _get_token_sync()
-                if not token:
-                    return {"success": False, "error": "Не удалось переавторизоваться"}
-                response = client.post(
-                    _join_url("tasks"),
-                    headers={"Authorization": f"Bearer {token}"},
-                    json=payload
-                )
-            
-            if response.status_code != 200:
-                error_data = response.json() if response.text else {}
-                logger.error(f"❌ Pyrus: Ошибка создания задачи HTTP {response.status_code}: {error_data}")
-                return {
-                    "success": False, 
-                    "error": f"HTTP {response.status_code}: {error_data.get('error_message', 'Unknown error')}"
-                }
-            
-            result = response.json()
-            task = result.get("task", {})
-            task_id = task.get("id")
-            
-            logger.info(f"✅ Pyrus: Задача создана! ID: {task_id}")
-            
-            return {
-                "success": True,
-                "task_id": task_id,
-                "task_url": f"https://pyrus.com/t#{task_id}" if task_id else None
-            }
-            
-    except Exception as e:
-        logger.error(f"❌ Pyrus: Исключение при создании задачи: {e}", exc_info=True)
-        return {"success": False, "error": str(e)}
+def _requester_identity(telegram_user_id: Optional[int], login: Optional[str], client_phone: Optional[str]) -> str:
+    """Кто отправил обращение: Telegram ID, иначе логин, иначе цифры телефона."""
+    if telegram_user_id:
+        return f"tg:{telegram_user_id}"
+    if login:
+        return f"login:{login}"
+    phone_digits = ''.join(ch for ch in client_phone or '' if ch.isdigit())
+    return f"phone:{phone_digits[-10:]}" if phone_digits else ''
 
 
 # --- Основная функция для Function Calling ---
 
-def create_pyrus_task(
+async def create_pyrus_task(
     branch_name: str,
     message_text: str,
     client_name: Optional[str] = None,
@@ -389,20 +468,30 @@ def create_pyrus_task(
         telegram_user_id: ID пользователя Telegram (для автозаполнения из базы)
         login: Логин клиента/лицевой счёт (для автозаполнения из базы)
     
+    Задача не отправляется сразу, а ставится в очередь (pyrus_outbox) —
+    ответ не зависит от доступности Pyrus.
+    
     Returns:
         Словарь с результатом:
         - success: True/False
-        - task_id: ID созданной задачи (если успех)
+        - pending_id: номер обращения в очереди (если успех)
         - message: Сообщение для клиента
     """
     logger.info(f"🎯 create_pyrus_task: branch='{branch_name}', message='{message_text[:50]}...', login={login}")
     
+    # Для верифицированного пользователя tool_executor убирает telegram_user_id из
+    # аргументов (подставив логин) — берём его из контекста сообщения
+    context = get_request_context()
+    if not telegram_user_id and context is not None:
+        telegram_user_id = context.telegram_user_id
+    
     # Автозаполнение данных из базы если переданы telegram_user_id и login
     if telegram_user_id and login:
         from .client_tools import get_verified_client_data
         
         logger.info(f"📋 Автозаполнение данных для login={login}")
-        client_data = get_verified_client_data(login)
+        # Поиск по снимку данных 1С — синхронный, уводим его с event loop
+        client_data = await asyncio.to_thread(get_verified_client_data, login)
         
         if client_data:
             # Заполняем только те поля, которые не были переданы явно
@@ -444,21 +533,9 @@ def create_pyrus_task(
             "message": "Для создания задачи необходимо указать текст сообщения."
         }
     
-    # Получаем item_id филиала
-    branch_item_id = _resolve_branch_to_pyrus_item_id(branch_name)
-    
-    # Формируем поля задачи
+    # Формируем поля задачи (филиал подставит воркер очереди по каталогу Pyrus)
     fields = []
     
-    # Поле 1: Филиал (catalog)
-    if branch_item_id:
-        fields.append({
-            "id": FORM_FIELDS["branch"],
-            "value": {"item_id": branch_item_id}
-        })
-    else:
-        logger.warning(f"⚠️ Pyrus: Филиал '{branch_name}' не найден в каталоге, пропускаем поле")
-    
     # Поле 2: ФИО клиента (text)
     if client_name and client_name.strip():
         fields.append({
@@ -506,32 +583,93 @@ def create_pyrus_task(
         subject_parts.append(f"от {client_name.strip()}")
     subject = " ".join(subject_parts)
     
-    # Создаём задачу
-    result = _create_task_sync(
-        form_id=PYRUS_FORM_ID,
-        fields=fields,
-        subject=subject
+    # Ставим задачу в очередь: в Pyrus её отправит воркер, клиент не ждёт ответа API
+    task = {
+        "form_id": PYRUS_FORM_ID,
+        "branch_name": branch_name,
+        "fields": fields,
+        "subject": subject,
+    }
+    # Отправитель в ключе обязателен: без него одинаковый короткий текст
+    # («прошу перезвонить») двух клиентов склеился бы в одно обращение
+    idempotency_key = make_idempotency_key(
+        _requester_identity(telegram_user_id, login, client_phone), branch_name, message_text
     )
-    
-    if result.get("success"):
-        return {
-            "success": True,
-            "task_id": result.get("task_id"),
-            "message": (
-                f"✅ Ваше обращение передано администратору филиала «{branch_name}». "
-                f"Если потребуется, администратор передаст информацию старшему педагогу. "
-                f"Задача создана и взята в работу — с вами свяжутся в ближайшее время!"
-            )
-        }
-    else:
+    try:
+        pending_id = await asyncio.to_thread(get_pyrus_outbox().enqueue, task, idempotency_key)
+    except Exception as e:
+        logger.error(f"❌ Pyrus: Не удалось поставить задачу в очередь: {e}", exc_info=True)
         return {
             "success": False,
-            "error": result.get("error", "Unknown error"),
+            "error": str(e),
             "message": (
                 "К сожалению, не удалось создать задачу. "
                 "Скоро в чат подключится менеджер и поможет вам."
             )
         }
+    notify_outbox_worker()
+    
+    return {
+        "success": True,
+        "pending_id": pending_id,
+        "status": "queued",
+        "message": (
+            f"✅ Ваше обращение №{pending_id} передано администратору филиала «{branch_name}». "
+            f"Если потребуется, администратор передаст информацию старшему педагогу. "
+            f"С вами свяжутся в ближайшее время!"
+        )
+    }
+
+
+async def deliver_queued_task(task: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Отправляет в Pyrus задачу из очереди (вызывается воркером pyrus_outbox).
+    
+    Returns:
+        Результат PyrusClient.create_task
+    """
+    fields = list(task["fields"])
+    
+    # Поле 1: Филиал (catalog)
+    branch_item_id = await _resolve_branch_to_pyrus_item_id(task["branch_name"])
+    if branch_item_id:
+        fields.insert(0, {
+            "id": FORM_FIELDS["branch"],
+            "value": {"item_id": branch_item_id}
+        })
+    else:
+        logger.warning(f"⚠️ Pyrus: Филиал '{task['branch_name']}' не найден в каталоге, пропускаем поле")
+    
+    return await get_pyrus_client().create_task(
+        form_id=task["form_id"],
+        fields=fields,
+        subject=task.get("subject")
+    )
+
+
+def format_failed_task_alert(pending_id: int, task: Dict[str, Any], error: str) -> str:
+    """
+    Текст уведомления администратору о задаче, которую не удалось отправить в Pyrus.
+    
+    Клиент уже получил ответ «обращение №… передано», поэтому в уведомлении
+    есть всё, чтобы передать обращение в филиал вручную.
+    """
+    field_names = {
+        FORM_FIELDS["client_name"]: "Клиент",
+        FORM_FIELDS["client_phone"]: "Телефон",
+        FORM_FIELDS["student_name"]: "Ребёнок",
+        FORM_FIELDS["group_number"]: "Группа",
+        FORM_FIELDS["message"]: "Сообщение",
+    }
+    lines = [
+        f"❗ Pyrus: обращение №{pending_id} не отправлено ({error})",
+        f"Филиал: {task.get('branch_name') or '—'}",
+    ]
+    for field in task.get("fields", []):
+        name = field_names.get(field.get("id"))
+        if name:
+            lines.append(f"{name}: {field.get('value')}")
+    return "\n".join(lines)
 
 
 # --- Определение функции для OpenAI Tools ---
@@ -0,0 +1,127 @@
+"""
+Контекст обработки одного сообщения пользователя.
+
+За один ответ модель вызывает несколько инструментов, и каждый заново
+проверял верификацию, выбирал логин ребёнка и искал запись клиента.
+RequestContext создаётся в chat_with_assistant на каждое сообщение,
+разрешает эти данные один раз и передаётся в execute_tool_call;
+инструменты получают его через get_request_context().
+
+Результаты проверок кэшируются до изменения верификаций (save_verification
+или reset_verification в том же сообщении сбрасывают кэш), снимок данных 1С
+фиксируется на всё сообщение.
+"""
+
+import contextvars
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .client_store import ClientSnapshot, get_client_store
+from .verification_tools import (
+    get_client_context,
+    get_verification_file_stats,
+    get_verified_login_with_context,
+    get_verified_logins,
+    verifications_version,
+)
+
+_current_context: contextvars.ContextVar = contextvars.ContextVar('request_context', default=None)
+
+
+def _file_loads() -> int:
+    """Чтения файла верификаций + пересборки снимка 1С с начала работы процесса."""
+    return get_verification_file_stats()['reads'] + get_client_store().reload_count
+
+
+class RequestContext:
+    """Данные пользователя, разрешённые один раз на сообщение."""
+
+    def __init__(self, telegram_user_id: int, current_child_login: Optional[str] = None):
+        self.telegram_user_id = telegram_user_id
+        self.current_child_login = current_child_login
+        # ключ → (версия верификаций, результат)
+        self._cache: Dict[Any, Tuple[int, Any]] = {}
+        self._snapshot: Optional[ClientSnapshot] = None
+        # Инструменты одного сообщения выполняются в параллельных потоках:
+        # заполнение кэша под локом, чтобы одно значение не вычислялось дважды
+        self._lock = threading.RLock()
+        self.resolves = 0
+        self.cache_hits = 0
+        self._file_loads_start = _file_loads()
+
+    def is_for(self, telegram_user_id) -> bool:
+        """Относится ли контекст к этому пользователю (LLM может передать id строкой)."""
+        return str(telegram_user_id) == str(self.telegram_user_id)
+
+    def _memo(self, key, compute: Callable[[], Any]):
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] == verifications_version():
+                self.cache_hits += 1
+                return cached[1]
+            self.resolves += 1
+            value = compute()
+            # compute мог сам удалить истёкшие верификации — запоминаем версию после него
+            self._cache[key] = (verifications_version(), value)
+            return value
+
+    def set_current_child(self, login: str):
+        """Пользователь выбрал ребёнка (set_active_child) посреди сообщения."""
+        self.current_child_login = login
+
+    def verified_logins(self) -> List[str]:
+        """Актуальные верифицированные логины пользователя."""
+        return self._memo('logins', lambda: get_verified_logins(self.telegram_user_id))
+
+    def is_verified(self, login: str) -> bool:
+        return login in self.verified_logins()
+
+    def has_any_verification(self) -> bool:
+        return bool(self.verified_logins())
+
+    def verified_login(self) -> Dict[str, Any]:
+        """Результат get_verified_login_with_context для выбранного ребёнка."""
+        child = self.current_child_login
+        return self._memo(
+            ('login', child),
+            lambda: get_verified_login_with_context(self.telegram_user_id, child)
+        )
+
+    def client_context(self) -> Dict[str, Any]:
+        """Результат get_client_context (данные клиента для промпта)."""
+        return self._memo('client_context', lambda: get_client_context(self.telegram_user_id))
+
+    @property
+    def client_snapshot(self) -> ClientSnapshot:
+        """Снимок данных 1С, общий для всех инструментов сообщения."""
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = get_client_store().get_snapshot()
+            return self._snapshot
+
+    @property
+    def file_loads(self) -> int:
+        """Сколько раз за сообщение читались файлы верификаций и данных 1С."""
+        return _file_loads() - self._file_loads_start
+
+    def summary(self) -> str:
+        return (
+            f"разрешений {self.resolves}, из кэша {self.cache_hits}, "
+            f"загрузок файлов {self.file_loads}"
+        )
+
+
+def get_request_context() -> Optional[RequestContext]:
+    """Контекст текущего сообщения или None (вызов вне chat_with_assistant)."""
+    return _current_context.get()
+
+
+@contextmanager
+def use_request_context(context: RequestContext) -> Iterator[RequestContext]:
+    """Делает контекст текущим на время блока (в том числе для вложенных вызовов)."""
+    token = _current_context.set(context)
+    try:
+        yield context
+    finally:
+        _current_context.reset(token)
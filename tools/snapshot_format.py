@@ -0,0 +1,310 @@
+"""
+Компактный бинарный снимок выгрузок 1С (clients / contracts / transactions).
+
+Таблица хранится по колонкам: для каждой колонки — массив смещений uint32
+и общий UTF-8 блоб строк. Индексы (логин, телефон, id клиента, id контракта)
+лежат в том же файле как отсортированные ключи + номера строк. Файл
+открывается через mmap без разбора: запись превращается в словарь только
+когда её запрашивают, поиск по индексу — бинарный поиск по смещениям.
+
+Формат файла:
+    MAGIC (8 байт) | длина заголовка uint32 | заголовок JSON | секции
+
+Используется bitrix_sync (запись) и client_store (чтение при
+CLIENT_DATA_FORMAT=binary).
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections import abc
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+MAGIC = b'1CSNAP01'
+
+# Колонки таблиц: путь к полю в словаре записи (вложенность через точку)
+TABLE_COLUMNS = {
+    'clients': [
+        'id', 'login',
+        'student.last_name', 'student.first_name', 'student.middle_name',
+        'student.account', 'student.branch', 'student.group', 'student.program',
+        'student.teacher', 'student.bonus',
+        'contacts.contact_person', 'contacts.phone', 'contacts.email', 'contacts.phones',
+    ],
+    'contracts': ['id', 'name', 'balance', 'bonuses', 'client_id'],
+    'transactions': ['id', 'date', 'amount', 'description', 'contract_id'],
+}
+
+# Колонки-списки (хранятся через перевод строки)
+LIST_COLUMNS = {'contacts.phones'}
+
+# Индексы таблиц: имя индекса → колонка ключа
+TABLE_INDEXES = {
+    'clients': {'login': 'login', 'phone': 'contacts.phones'},
+    'contracts': {'client_id': 'client_id'},
+    'transactions': {'contract_id': 'contract_id'},
+}
+
+# Порядок строк в файле: транзакции контракта идут подряд, последние сначала
+_ROW_ORDER = {
+    'transactions': ('date', True),
+}
+
+_ALIGN = 8
+
+
+def snapshot_path(data_dir: str, table: str) -> str:
+    """Путь к бинарному снимку таблицы."""
+    return os.path.join(data_dir, f'{table}.bin')
+
+
+def _get_path(record: Dict, path: str):
+    value = record
+    for key in path.split('.'):
+        value = value.get(key, '') if isinstance(value, dict) else ''
+    return value
+
+
+def _set_path(record: Dict, path: str, value):
+    keys = path.split('.')
+    for key in keys[:-1]:
+        record = record.setdefault(key, {})
+    record[keys[-1]] = value
+
+
+def _encode_strings(values: Sequence[str]) -> Tuple[bytes, bytes]:
+    """Колонка строк → (смещения uint32, блоб)."""
+    offsets = array('I', [0])
+    chunks = []
+    position = 0
+    for value in values:
+        data = value.encode('utf-8')
+        chunks.append(data)
+        position += len(data)
+        offsets.append(position)
+    return offsets.tobytes(), b''.join(chunks)
+
+
+class SnapshotWriter:
+    """
+    Потоковая запись таблицы: add() для каждой записи, затем close().
+
+    В памяти держатся только колонки строк (без словарей), файл
+    записывается во временный и атомарно переименовывается.
+    """
+
+    def __init__(self, path: str, table: str, updated_at: str = ''):
+        if table not in TABLE_COLUMNS:
+            raise ValueError(f"Неизвестная таблица: {table}")
+        self.path = path
+        self.table = table
+        self.updated_at = updated_at
+        self._columns: Dict[str, List[str]] = {name: [] for name in TABLE_COLUMNS[table]}
+        self.count = 0
+
+    def add(self, record: Dict):
+        for name, values in self._columns.items():
+            value = _get_path(record, name)
+            if name in LIST_COLUMNS:
+                value = '\n'.join(value or [])
+            values.append(value if isinstance(value, str) else str(value))
+        self.count += 1
+
+    def _row_order(self) -> List[int]:
+        rows = list(range(self.count))
+        order = _ROW_ORDER.get(self.table)
+        if order:
+            column, reverse = order
+            values = self._columns[column]
+            rows.sort(key=values.__getitem__, reverse=reverse)
+        # Индексы используют стабильную сортировку — порядок строк сохраняется
+        # для одинаковых ключей (первый контракт клиента, свежие транзакции)
+        return rows
+
+    def close(self):
+        rows = self._row_order()
+        columns = {name: [values[i] for i in rows] for name, values in self._columns.items()}
+
+        sections: List[bytes] = []
+        position = 0
+
+        def add_section(data: bytes) -> int:
+            nonlocal position
+            start = position
+            padding = (-len(data)) % _ALIGN
+            sections.append(data + b'\0' * padding)
+            position += len(data) + padding
+            return start
+
+        def add_strings(values: Sequence[str]) -> Dict:
+            offsets, blob = _encode_strings(values)
+            return {
+                'count': len(values),
+                'offsets': add_section(offsets),
+                'blob': add_section(blob),
+            }
+
+        header = {
+            'table': self.table,
+            'count': self.count,
+            'updated_at': self.updated_at,
+            'byteorder': sys.byteorder,
+            'columns': {},
+            'indexes': {},
+        }
+        for name, values in columns.items():
+            header['columns'][name] = add_strings(values)
+
+        for index_name, column in TABLE_INDEXES[self.table].items():
+            entries = []
+            for row, value in enumerate(columns[column]):
+                keys = value.split('\n') if column in LIST_COLUMNS else [value]
+                entries.extend((key, row) for key in keys if key)
+            entries.sort(key=lambda entry: entry[0])
+            header['indexes'][index_name] = {
+                'keys': add_strings([key for key, _ in entries]),
+                'rows': add_section(array('I', [row for _, row in entries]).tobytes()),
+            }
+
+        header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        prefix_len = len(MAGIC) + 4 + len(header_bytes)
+        prefix_len += (-prefix_len) % _ALIGN
+
+        # Смещения секций в заголовке — относительно начала области данных
+        tmp_path = f"{self.path}.tmp"
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b'\0' * (prefix_len - len(MAGIC) - 4 - len(header_bytes)))
+            for section in sections:
+                f.write(section)
+        os.replace(tmp_path, self.path)
+
+    def abort(self):
+        """Отменяет запись (файл создаётся только в close())."""
+        tmp_path = f"{self.path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_snapshot(path: str, table: str, records: Iterable[Dict], updated_at: str = '') -> int:
+    """Записывает таблицу целиком. Возвращает количество записей."""
+    writer = SnapshotWriter(path, table, updated_at)
+    for record in records:
+        writer.add(record)
+    writer.close()
+    return writer.count
+
+
+class _StringColumn:
+    """Колонка строк поверх mmap: строка декодируется только при обращении."""
+
+    def __init__(self, mm: mmap.mmap, base: int, meta: Dict):
+        self._mm = mm
+        self._count = meta['count']
+        start = base + meta['offsets']
+        self._offsets = memoryview(mm)[start:start + 4 * (self._count + 1)].cast('I')
+        self._blob = base + meta['blob']
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, i: int) -> str:
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return self.raw(i).decode('utf-8')
+
+    def raw(self, i: int) -> bytes:
+        """Строка без декодирования (порядок байт UTF-8 совпадает с порядком строк)."""
+        return self._mm[self._blob + self._offsets[i]:self._blob + self._offsets[i + 1]]
+
+
+class SnapshotTable:
+    """Таблица снимка, открытая только для чтения через mmap."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path}: неизвестный формат снимка")
+        (header_len,) = struct.unpack_from('<I', self._mm, len(MAGIC))
+        header_start = len(MAGIC) + 4
+        header = json.loads(self._mm[header_start:header_start + header_len].decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError(f"{path}: снимок записан с другим порядком байт")
+
+        base = header_start + header_len
+        base += (-base) % _ALIGN
+
+        self.table = header['table']
+        self.count = header['count']
+        self.updated_at = header['updated_at']
+        self._columns = {
+            name: _StringColumn(self._mm, base, meta)
+            for name, meta in header['columns'].items()
+        }
+        self._indexes = {}
+        for name, meta in header['indexes'].items():
+            keys = _StringColumn(self._mm, base, meta['keys'])
+            start = base + meta['rows']
+            rows = memoryview(self._mm)[start:start + 4 * len(keys)].cast('I')
+            self._indexes[name] = (keys, rows)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def column(self, name: str) -> Sequence[str]:
+        """Колонка как ленивая последовательность строк."""
+        return self._columns[name]
+
+    def row(self, i: int) -> Dict:
+        """Запись в том же виде, что в JSON-выгрузке."""
+        record: Dict = {}
+        for name, column in self._columns.items():
+            value = column[i]
+            if name in LIST_COLUMNS:
+                value = value.split('\n') if value else []
+            _set_path(record, name, value)
+        return record
+
+    def lookup(self, index: str, key: str) -> List[int]:
+        """Номера строк с данным ключом (в порядке строк файла)."""
+        keys, rows = self._indexes[index]
+        target = key.encode('utf-8')
+        lo, hi = 0, len(keys)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if keys.raw(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        result = []
+        while lo < len(keys) and keys.raw(lo) == target:
+            result.append(rows[lo])
+            lo += 1
+        return result
+
+
+class RecordList(abc.Sequence):
+    """Записи таблицы как список словарей, создаваемых по требованию."""
+
+    def __init__(self, table: Optional[SnapshotTable]):
+        self._table = table
+
+    def __len__(self) -> int:
+        return len(self._table) if self._table is not None else 0
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._table.row(i)
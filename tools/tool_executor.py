@@ -3,8 +3,13 @@
 Централизованная обработка всех tool calls.
 """
 
+import asyncio
+import contextvars
+import functools
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from typing import Dict, Any, List, Optional, Callable
 
 from .branch_tools import (
@@ -64,6 +69,7 @@ from .verification_tools import (
     SAVE_VERIFICATION_FUNCTION_NAME,
     SET_ACTIVE_CHILD_FUNCTION_NAME,
 )
+from .request_context import RequestContext, get_request_context, use_request_context
 from .conversation_tools import (
     set_conversation_topic,
     get_conversation_topic_tool_for_responses_api,
@@ -150,24 +156,19 @@ REQUIRES_VERIFICATION_TOOLS = {
 }
 
 
-def execute_tool_call(
-    tool_name: str, 
+def _check_verification(
+    tool_name: str,
     arguments: Dict[str, Any],
-    current_child_login: Optional[str] = None
-) -> Dict[str, Any]:
+    current_child_login: Optional[str],
+    request_context: Optional[RequestContext]
+) -> Optional[Dict[str, Any]]:
     """
-    Выполняет вызов функции с автоматической проверкой верификации.
-    
-    Args:
-        tool_name: Имя функции (например "get_branches")
-        arguments: Аргументы функции
-        current_child_login: Текущий выбранный ребёнок (из контекста сессии)
+    Проверяет верификацию для tools с личными данными и подставляет логин.
     
     Returns:
-        Результат выполнения функции
+        None — можно выполнять функцию (arguments подготовлены),
+        иначе ответ для модели (нужна верификация или выбор ребёнка)
     """
-    logger.info(f"Выполнение tool call: {tool_name} с аргументами: {arguments}")
-    
     # === ПРОВЕРКА ВЕРИФИКАЦИИ ДЛЯ ЛИЧНЫХ ДАННЫХ ===
     if tool_name in REQUIRES_VERIFICATION_TOOLS:
         telegram_user_id = arguments.get("telegram_user_id")
@@ -175,10 +176,15 @@ def execute_tool_call(
         if telegram_user_id:
             logger.debug(f"Tool {tool_name} требует верификацию. Проверяем user_id={telegram_user_id}")
             
-            result = get_verified_login_with_context(
-                telegram_user_id, 
-                current_child_login
-            )
+            # Контекст годится, только если LLM передала id того же пользователя
+            context = request_context if request_context is not None and request_context.is_for(telegram_user_id) else None
+            if context is not None:
+                result = context.verified_login()
+            else:
+                result = get_verified_login_with_context(
+                    telegram_user_id, 
+                    current_child_login
+                )
             
             if result["status"] == "ok":
                 # ✅ Верифицирован — проверяем приоритет логина
@@ -186,7 +192,12 @@ def execute_tool_call(
                 
                 if explicit_login:
                     # Логин явно указан LLM — валидируем его
-                    if is_client_verified(telegram_user_id, explicit_login):
+                    if context is not None:
+                        login_verified = context.is_verified(explicit_login)
+                    else:
+                        login_verified = is_client_verified(telegram_user_id, explicit_login)
+                    
+                    if login_verified:
                         # Используем явно указанный логин (не перезаписываем)
                         logger.info(f"✅ Использован явный логин: {explicit_login} для user {telegram_user_id}")
                     else:
@@ -232,6 +243,37 @@ def execute_tool_call(
                     "message": result["message"]
                 }
     
+    return None
+
+
+def execute_tool_call(
+    tool_name: str, 
+    arguments: Dict[str, Any],
+    current_child_login: Optional[str] = None,
+    request_context: Optional[RequestContext] = None
+) -> Dict[str, Any]:
+    """
+    Выполняет вызов функции с автоматической проверкой верификации.
+    
+    Args:
+        tool_name: Имя функции (например "get_branches")
+        arguments: Аргументы функции
+        current_child_login: Текущий выбранный ребёнок (из контекста сессии)
+        request_context: Контекст сообщения — верификация и данные клиента
+            берутся из него, а не проверяются заново для каждого tool call
+    
+    Returns:
+        Результат выполнения функции
+    """
+    logger.info(f"Выполнение tool call: {tool_name} с аргументами: {arguments}")
+    
+    if request_context is None:
+        request_context = get_request_context()
+    
+    early_result = _check_verification(tool_name, arguments, current_child_login, request_context)
+    if early_result is not None:
+        return early_result
+    
     # === ОБЫЧНОЕ ВЫПОЛНЕНИЕ ===
     if tool_name not in TOOL_FUNCTIONS:
         error_msg = f"Неизвестная функция: {tool_name}"
@@ -240,17 +282,173 @@ def execute_tool_call(
     
     try:
         func = TOOL_FUNCTIONS[tool_name]
-        result = func(**arguments)
+        with use_request_context(request_context) if request_context is not None else nullcontext():
+            result = func(**arguments)
+            if asyncio.iscoroutine(result):
+                # Async-tool из синхронного кода (поток без event loop) — бот
+                # вызывает такие tools через execute_tool_call_async
+                result = asyncio.run(result)
         logger.info(f"Tool call {tool_name} выполнен успешно")
         return result
-    except TypeError as e:
-        error_msg = f"Ошибка аргументов для {tool_name}: {e}"
-        logger.error(error_msg)
-        return {"error": error_msg}
     except Exception as e:
-        error_msg = f"Ошибка выполнения {tool_name}: {e}"
+        return _tool_error(tool_name, e)
+
+
+def _tool_error(tool_name: str, error: Exception) -> Dict[str, Any]:
+    """Ответ модели при исключении внутри tool."""
+    if isinstance(error, TypeError):
+        error_msg = f"Ошибка аргументов для {tool_name}: {error}"
+        logger.error(error_msg)
+    else:
+        error_msg = f"Ошибка выполнения {tool_name}: {error}"
         logger.error(error_msg, exc_info=True)
-        return {"error": error_msg}
+    return {"error": error_msg}
+
+
+# --- Асинхронное выполнение tool calls ---
+
+# Таймаут одного tool call (секунды); для tools с внешними HTTP-запросами — свой
+# (create_pyrus_task только ставит задачу в очередь и укладывается в общий)
+TOOL_TIMEOUT_DEFAULT = 20.0
+TOOL_TIMEOUTS: Dict[str, float] = {}
+
+# Tools, меняющие состояние, от которого зависят следующие вызовы той же
+# итерации (выбор ребёнка, верификация, тема диалога). Они выполняются строго
+# по очереди, независимые вызовы между ними — параллельно
+SEQUENTIAL_TOOLS = {
+    "save_verification",
+    "reset_verification",
+    "set_active_child",
+    "set_conversation_topic",
+}
+
+# Пул потоков для синхронных tools (файлы 1С, блокирующие HTTP-клиенты)
+TOOL_MAX_WORKERS = 8
+_thread_pool: Optional[ThreadPoolExecutor] = None
+
+
+def _get_thread_pool() -> ThreadPoolExecutor:
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+    return _thread_pool
+
+
+async def _execute_async_tool(
+    tool_name: str,
+    arguments: Dict[str, Any],
+    current_child_login: Optional[str],
+    request_context: Optional[RequestContext]
+) -> Dict[str, Any]:
+    """execute_tool_call для tools, реализованных как корутины."""
+    logger.info(f"Выполнение tool call: {tool_name} с аргументами: {arguments}")
+    
+    early_result = _check_verification(tool_name, arguments, current_child_login, request_context)
+    if early_result is not None:
+        return early_result
+    
+    try:
+        with use_request_context(request_context) if request_context is not None else nullcontext():
+            result = await TOOL_FUNCTIONS[tool_name](**arguments)
+        logger.info(f"Tool call {tool_name} выполнен успешно")
+        return result
+    except Exception as e:
+        return _tool_error(tool_name, e)
+
+
+async def execute_tool_call_async(
+    tool_name: str,
+    arguments: Dict[str, Any],
+    current_child_login: Optional[str] = None,
+    request_context: Optional[RequestContext] = None
+) -> Dict[str, Any]:
+    """
+    То же, что execute_tool_call, но не блокирует event loop.
+    
+    Async-tools выполняются напрямую, синхронные — в пуле потоков
+    (RequestContext переносится в поток вместе с contextvars).
+    Вызов ограничен таймаутом из TOOL_TIMEOUTS.
+    """
+    if request_context is None:
+        request_context = get_request_context()
+    
+    timeout = TOOL_TIMEOUTS.get(tool_name, TOOL_TIMEOUT_DEFAULT)
+    func = TOOL_FUNCTIONS.get(tool_name)
+    try:
+        if asyncio.iscoroutinefunction(func):
+            call = _execute_async_tool(tool_name, arguments, current_child_login, request_context)
+        else:
+            loop = asyncio.get_running_loop()
+            sync_call = functools.partial(
+                execute_tool_call, tool_name, arguments, current_child_login, request_context
+            )
+            call = loop.run_in_executor(_get_thread_pool(), contextvars.copy_context().run, sync_call)
+        return await asyncio.wait_for(call, timeout=timeout)
+    except asyncio.TimeoutError:
+        # Поток синхронного tool не прерывается, но модель больше его не ждёт
+        logger.error(f"Tool call {tool_name} не завершился за {timeout:g} с")
+        return {
+            "success": False,
+            "error": f"Превышено время выполнения {tool_name}",
+            "message": "Сервис отвечает слишком долго. Попробуйте ещё раз чуть позже."
+        }
+
+
+async def execute_tool_calls(
+    tool_calls: List[Dict[str, Any]],
+    current_child_login: Optional[str] = None,
+    request_context: Optional[RequestContext] = None
+) -> List[Dict[str, Any]]:
+    """
+    Выполняет все tool calls одной итерации модели.
+    
+    Независимые вызовы идут параллельно, вызовы из SEQUENTIAL_TOOLS —
+    по одному в порядке, заданном моделью (следующие вызовы видят
+    выбранного ребёнка и свежую верификацию).
+    
+    Returns:
+        Результаты в порядке tool_calls (как ожидает format_tool_results_for_api)
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(tool_calls)
+    parallel: List[int] = []
+    
+    async def run_parallel():
+        calls = [
+            execute_tool_call_async(tool_calls[i]["name"], tool_calls[i]["arguments"], current_child_login, request_context)
+            for i in parallel
+        ]
+        for i, result in zip(parallel, await asyncio.gather(*calls)):
+            results[i] = result
+        parallel.clear()
+    
+    for i, tc in enumerate(tool_calls):
+        if "_error" in tc:
+            # Аргументы не распарсились — возвращаем ошибку как результат tool call
+            logger.warning(f"Tool {tc['name']} имеет ошибку парсинга: {tc['_error'][:100]}")
+            results[i] = {
+                "success": False,
+                "error": tc["_error"],
+                "message": "Не удалось обработать запрос. Попробуйте сформулировать короче."
+            }
+            continue
+        
+        if tc["name"] not in SEQUENTIAL_TOOLS:
+            parallel.append(i)
+            continue
+        
+        if parallel:
+            await run_parallel()
+        result = await execute_tool_call_async(tc["name"], tc["arguments"], current_child_login, request_context)
+        results[i] = result
+        
+        if tc["name"] == "set_active_child" and result.get("success") and result.get("login"):
+            current_child_login = result["login"]
+            if request_context is not None:
+                request_context.set_current_child(current_child_login)
+    
+    if parallel:
+        await run_parallel()
+    return results
 
 
 def parse_tool_calls_from_response(response) -> List[Dict[str, Any]]:
@@ -0,0 +1,337 @@
+"""
+Векторный индекс базы знаний на NumPy — лёгкая замена ChromaDB для поиска.
+
+База — несколько тысяч чанков, а каждый запрос шёл через клиент Chroma
+(SQLite + HNSW) в отдельном потоке. NumpyVectorIndex держит все эмбеддинги
+одной непрерывной матрицей с нормированными строками: top-k — это одно
+умножение матрицы на вектор и argpartition, поиск точный (без HNSW).
+
+Файлы в директории базы рядом с коллекцией Chroma:
+    kb_vectors.npy         — полные эмбеддинги float32 (строки нормированы);
+    kb_chunks.json         — id, тексты и метаданные чанков в том же порядке;
+    kb_search_vectors.npz  — сжатая матрица для двухэтапного поиска (если включён).
+
+Двухэтапный поиск (search_dtype/search_dims): в памяти держится только
+сжатая матрица — первые search_dims измерений (эмбеддинги
+text-embedding-3 обучены как «матрёшка»: начало вектора после нормировки
+само является эмбеддингом) в int8 или float16. По ней отбираются
+rescore_candidates кандидатов, которые затем точно пересчитываются по
+полным векторам. Полные векторы остаются в kb_vectors.npy: строки
+кандидатов читаются из файла (pread, а не mmap — иначе страницы файла
+постепенно оседают в RSS процесса).
+
+Индекс только для чтения: база по-прежнему собирается в Chroma (из неё
+копируются чанки при инкрементальном обновлении), а файлы индекса
+записываются рядом. Методы query/get/count повторяют нужную часть
+интерфейса коллекции Chroma, поэтому индекс подставляется вместо неё
+(в том числе в tools.kb_search.hybrid_search).
+"""
+
+import json
+import os
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+VECTORS_FILE = 'kb_vectors.npy'
+CHUNKS_FILE = 'kb_chunks.json'
+SEARCH_VECTORS_FILE = 'kb_search_vectors.npz'
+
+VECTOR_DTYPES = ('float32', 'float16', 'int8')
+
+# Сколько кандидатов первого этапа пересчитывать по полным векторам
+RESCORE_CANDIDATES = 50
+
+# int8 и float16 умножаются блоками, переведёнными во float32 (у NumPy нет BLAS
+# для этих типов); блок ~1 МБ остаётся в кэше процессора. Перевод float16 в NumPy
+# медленный — int8 при вчетверо меньшей памяти почти не уступает float32
+# (см. scripts/bench_kb_quantization.py)
+_BLOCK_BYTES = 2 ** 20
+
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+
+def quantize(matrix: np.ndarray, dtype: str = 'int8', dims: Optional[int] = None):
+    """
+    Сжатая матрица первого этапа поиска.
+
+    Векторы обрезаются до dims измерений и нормируются заново, затем
+    переводятся в dtype; для int8 — симметрично, со своим масштабом
+    у каждого измерения.
+
+    Returns:
+        (матрица, масштабы измерений для int8 или None)
+    """
+    if dims and dims < matrix.shape[1]:
+        matrix = _normalize(np.asarray(matrix[:, :dims], dtype=np.float32))
+    if dtype != 'int8':
+        return np.ascontiguousarray(matrix, dtype=dtype), None
+    scales = np.abs(matrix).max(axis=0).astype(np.float32) / 127
+    scales[scales == 0] = 1.0
+    quantized = np.clip(np.rint(matrix / scales), -127, 127).astype(np.int8)
+    return np.ascontiguousarray(quantized), scales
+
+
+def _matvec(matrix: np.ndarray, vector: np.ndarray) -> np.ndarray:
+    if matrix.dtype == np.float32:
+        return matrix @ vector
+    rows = max(64, _BLOCK_BYTES // (matrix.shape[1] * 4))
+    scores = np.empty(matrix.shape[0], dtype=np.float32)
+    for start in range(0, matrix.shape[0], rows):
+        block = matrix[start:start + rows]
+        scores[start:start + len(block)] = block.astype(np.float32) @ vector
+    return scores
+
+
+class _VectorFile:
+    """Матрица в .npy-файле, строки читаются по запросу."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            self._offset = f.tell()
+        if fortran_order or len(shape) != 2:
+            raise ValueError(f"{path}: ожидается двумерная C-матрица")
+        self.path = path
+        self.shape = shape
+        self.dtype = dtype
+        self.ndim = 2
+        self._row_bytes = shape[1] * dtype.itemsize
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def __getitem__(self, positions):
+        if np.isscalar(positions):
+            return self[[positions]][0]
+        data = b''.join(
+            os.pread(self._fd, self._row_bytes, self._offset + int(position) * self._row_bytes)
+            for position in positions
+        )
+        return np.frombuffer(data, dtype=self.dtype).reshape(len(positions), self.shape[1])
+
+    def __del__(self):
+        fd = getattr(self, '_fd', None)
+        if fd is not None:
+            os.close(fd)
+
+
+def _top(scores: np.ndarray, n: int) -> np.ndarray:
+    if n < len(scores):
+        top = np.argpartition(-scores, n - 1)[:n]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+class NumpyVectorIndex:
+    """Чанки базы знаний: матрица эмбеддингов + тексты и метаданные."""
+
+    def __init__(self, ids: List[str], documents: List[str], metadatas: List[Dict[str, Any]], matrix: np.ndarray,
+                 rescore_candidates: int = RESCORE_CANDIDATES):
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.matrix = matrix  # полные float32; при двухэтапном поиске — _VectorFile
+        self.rescore_candidates = rescore_candidates
+        self.search_matrix: Optional[np.ndarray] = None
+        self.search_scales: Optional[np.ndarray] = None
+        self._positions = {item_id: position for position, item_id in enumerate(ids)}
+
+    @property
+    def search_dtype(self) -> str:
+        return str((self.search_matrix if self.search_matrix is not None else self.matrix).dtype)
+
+    @property
+    def search_dims(self) -> int:
+        return (self.search_matrix if self.search_matrix is not None else self.matrix).shape[1]
+
+    def set_search(self, dtype: str = 'float32', dims: Optional[int] = None, source: Optional[np.ndarray] = None):
+        """
+        Включает двухэтапный поиск (float32 без обрезки — обычный точный поиск).
+
+        source — полные векторы, если self.matrix читается из файла.
+        """
+        if dtype == 'float32' and (not dims or dims >= self.matrix.shape[1]):
+            self.search_matrix = self.search_scales = None
+        else:
+            self.search_matrix, self.search_scales = quantize(self.matrix if source is None else source, dtype, dims)
+
+    @classmethod
+    def from_embeddings(
+        cls,
+        ids: Sequence[str],
+        documents: Sequence[str],
+        metadatas: Sequence[Optional[Dict[str, Any]]],
+        embeddings: Sequence[Sequence[float]],
+        dtype: str = 'float32',
+        dims: Optional[int] = None,
+    ) -> 'NumpyVectorIndex':
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if matrix.ndim != 2:
+            matrix = matrix.reshape(len(ids), -1)
+        index = cls(list(ids), list(documents), [metadata or {} for metadata in metadatas],
+                    np.ascontiguousarray(_normalize(matrix), dtype=np.float32))
+        index.set_search(dtype, dims)
+        return index
+
+    @classmethod
+    def from_collection(cls, collection, dtype: str = 'float32', batch_size: int = 500,
+                        dims: Optional[int] = None) -> 'NumpyVectorIndex':
+        """Индекс по всем чанкам коллекции Chroma (для базы, собранной без файлов индекса)."""
+        data = {"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+        total = collection.count()
+        for offset in range(0, total, batch_size):
+            batch = collection.get(include=["documents", "metadatas", "embeddings"], limit=batch_size, offset=offset)
+            for key in data:
+                data[key].extend(batch[key])
+        return cls.from_embeddings(data["ids"], data["documents"], data["metadatas"], data["embeddings"], dtype, dims)
+
+    def save(self, kb_path: str):
+        """Атомарно записывает файлы индекса в директорию базы."""
+        vectors_path = os.path.join(kb_path, VECTORS_FILE)
+        chunks_path = os.path.join(kb_path, CHUNKS_FILE)
+        with open(f"{vectors_path}.tmp", 'wb') as f:
+            np.save(f, self.matrix)
+        with open(f"{chunks_path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump({'ids': self.ids, 'documents': self.documents, 'metadatas': self.metadatas},
+                      f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(f"{vectors_path}.tmp", vectors_path)
+        os.replace(f"{chunks_path}.tmp", chunks_path)
+        if self.search_matrix is not None:
+            self._save_search(kb_path)
+
+    def _save_search(self, kb_path: str):
+        path = os.path.join(kb_path, SEARCH_VECTORS_FILE)
+        arrays = {'matrix': self.search_matrix}
+        if self.search_scales is not None:
+            arrays['scales'] = self.search_scales
+        with open(f"{path}.tmp", 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(f"{path}.tmp", path)
+
+    def _load_search(self, kb_path: str, dtype: str, dims: Optional[int]) -> bool:
+        try:
+            with np.load(os.path.join(kb_path, SEARCH_VECTORS_FILE)) as data:
+                matrix = data['matrix']
+                scales = data['scales'] if 'scales' in data else None
+        except (OSError, ValueError, KeyError):
+            return False
+        expected_dims = min(dims or self.matrix.shape[1], self.matrix.shape[1])
+        if str(matrix.dtype) != dtype or matrix.shape != (self.matrix.shape[0], expected_dims):
+            return False
+        self.search_matrix, self.search_scales = matrix, scales
+        return True
+
+    @classmethod
+    def load(cls, kb_path: Optional[str], dtype: str = 'float32', dims: Optional[int] = None,
+             rescore_candidates: int = RESCORE_CANDIDATES) -> Optional['NumpyVectorIndex']:
+        """
+        Индекс из директории базы или None (файлов нет или они не согласованы).
+
+        Сжатая матрица с другими dtype/dims пересчитывается из полных
+        векторов и сохраняется.
+        """
+        if not kb_path:
+            return None
+        vectors_path = os.path.join(kb_path, VECTORS_FILE)
+        try:
+            # При двухэтапном поиске полные векторы остаются на диске. float32
+            # с dims не меньше размерности векторов — обычный точный поиск
+            # (как в set_search), матрица тогда нужна в памяти целиком
+            matrix = _VectorFile(vectors_path)
+            two_stage = dtype != 'float32' or bool(dims and dims < matrix.shape[1])
+            if not two_stage:
+                matrix = np.load(vectors_path)
+            with open(os.path.join(kb_path, CHUNKS_FILE), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if matrix.ndim != 2 or matrix.dtype != np.float32 or matrix.shape[0] != len(data['ids']):
+                return None
+            index = cls(data['ids'], data['documents'], data['metadatas'], matrix, rescore_candidates)
+        except (OSError, ValueError, KeyError):
+            return None
+        if two_stage and not index._load_search(kb_path, dtype, dims):
+            index.set_search(dtype, dims, source=np.load(vectors_path, mmap_mode='r'))
+            if index.search_matrix is not None:
+                try:
+                    index._save_search(kb_path)
+                except OSError:
+                    pass
+        return index
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Векторы, которые держатся в памяти (полная матрица на mmap не считается)."""
+        if self.search_matrix is None:
+            return self.matrix.nbytes
+        return self.search_matrix.nbytes + (self.search_scales.nbytes if self.search_scales is not None else 0)
+
+    def search(self, query_embedding: Sequence[float], n: int, rescore: bool = True):
+        """
+        (позиции, косинусная близость) n ближайших чанков по убыванию близости.
+
+        rescore=False — только первый этап (для оценки потерь сжатия);
+        близость тогда приблизительная.
+        """
+        n = min(n, len(self.ids))
+        if n <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        query_vector = query_vector / (np.linalg.norm(query_vector) or 1.0)
+        if self.search_matrix is None:
+            scores = self.matrix @ query_vector
+            top = _top(scores, n)
+            return top, scores[top]
+
+        coarse_vector = query_vector[:self.search_matrix.shape[1]]
+        coarse_vector = coarse_vector / (np.linalg.norm(coarse_vector) or 1.0)
+        if self.search_scales is not None:
+            coarse_vector = coarse_vector * self.search_scales
+        coarse = _matvec(self.search_matrix, coarse_vector)
+        if not rescore:
+            top = _top(coarse, n)
+            return top, coarse[top]
+        candidates = np.sort(_top(coarse, max(n, self.rescore_candidates)))  # по порядку — последовательное чтение mmap
+        exact = np.asarray(self.matrix[candidates], dtype=np.float32) @ query_vector
+        best = _top(exact, n)
+        return candidates[best], exact[best]
+
+    def _columns(self, positions, include: Sequence[str]) -> Dict[str, Any]:
+        result: Dict[str, Any] = {'ids': [self.ids[p] for p in positions]}
+        result['documents'] = [self.documents[p] for p in positions] if 'documents' in include else None
+        result['metadatas'] = [self.metadatas[p] for p in positions] if 'metadatas' in include else None
+        result['embeddings'] = [np.array(self.matrix[p], dtype=np.float32) for p in positions] if 'embeddings' in include else None
+        return result
+
+    def query(self, query_embeddings: Sequence[Sequence[float]], n_results: int = 10,
+              include: Sequence[str] = ('documents', 'metadatas', 'distances')) -> Dict[str, Any]:
+        """Как Collection.query: по списку на каждый запрос; distances — косинусное расстояние."""
+        result: Dict[str, Any] = {'ids': [], 'documents': [], 'metadatas': [], 'embeddings': [], 'distances': []}
+        for query_embedding in query_embeddings:
+            positions, scores = self.search(query_embedding, n_results)
+            columns = self._columns(positions, include)
+            columns['distances'] = (1.0 - scores).tolist() if 'distances' in include else None
+            for key, value in columns.items():
+                result[key].append(value)
+        for key in ('documents', 'metadatas', 'embeddings', 'distances'):
+            if key not in include:
+                result[key] = None
+        return result
+
+    def get(self, ids: Optional[Sequence[str]] = None, include: Sequence[str] = ('documents', 'metadatas'),
+            limit: Optional[int] = None, offset: int = 0) -> Dict[str, Any]:
+        """Как Collection.get: чанки по id (неизвестные пропускаются) или все по порядку."""
+        if ids is not None:
+            positions = [self._positions[item_id] for item_id in ids if item_id in self._positions]
+        else:
+            end = len(self.ids) if limit is None else offset + limit
+            positions = list(range(offset, min(end, len(self.ids))))
+        return self._columns(positions, include)
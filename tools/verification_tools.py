@@ -2,10 +2,17 @@
 Инструменты для управления верификацией клиентов.
 Хранят связки telegram_user_id → [client_logins] для предотвращения повторной верификации.
 Поддержка нескольких детей у одного родителя (один telegram_id → много логинов).
+
+Верификации читаются из файла один раз за жизнь процесса (там же — миграция
+старого формата) и дальше живут в памяти. Изменения сохраняются отложенно:
+несколько изменений подряд дают одну атомарную запись файла.
 """
 
+import atexit
+import copy
 import json
 import os
+import threading
 from typing import Optional, Dict, List, Any
 from datetime import datetime, timedelta
 import logging
@@ -18,6 +25,25 @@ VERIFICATIONS_FILE = os.path.join('data', 'verified_clients.json')
 # Срок действия верификации (дни). None = бессрочно
 VERIFICATION_EXPIRY_DAYS = 90  # 3 месяца
 
+# Задержка записи изменений на диск (секунды): изменения за это время
+# объединяются в одну запись файла
+VERIFICATIONS_SAVE_DELAY = 2.0
+
+# Повтор неудавшейся записи: пауза удваивается, но не больше этого значения (секунды)
+VERIFICATIONS_SAVE_RETRY_MAX = 300.0
+
+# Кэш верификаций (загружается один раз) и состояние отложенной записи.
+# Изменения словаря и его сериализация идут под _verifications_lock
+_verifications_cache: Optional[Dict] = None
+_verifications_lock = threading.RLock()
+_save_timer: Optional[threading.Timer] = None
+_save_failures = 0
+
+# Версия верификаций (растёт при каждом изменении) и счётчики работы с файлом —
+# по ним RequestContext понимает, что закэшированный результат устарел
+_verifications_version = 0
+_file_stats = {'reads': 0, 'writes': 0}
+
 
 def _migrate_old_format(data: Dict) -> Dict:
     """
@@ -78,15 +104,16 @@ def _migrate_old_format(data: Dict) -> Dict:
     return migrated
 
 
-def _load_verifications() -> Dict:
-    """Загрузить верификации из файла с автоматической миграцией"""
+def _read_verifications_file() -> Dict:
+    """Читает файл верификаций и при необходимости мигрирует старый формат."""
+    _file_stats['reads'] += 1
     # Создаём директорию, если не существует
     os.makedirs(os.path.dirname(VERIFICATIONS_FILE), exist_ok=True)
     
     if not os.path.exists(VERIFICATIONS_FILE):
         logger.info(f"Файл верификаций {VERIFICATIONS_FILE} не найден, создаём пустой")
         # Инициализируем пустой файл
-        _save_verifications({})
+        _write_verifications_file({})
         return {}
     
     try:
@@ -96,7 +123,7 @@ def _load_verifications() -> Dict:
             # Если файл пустой — инициализируем
             if not content:
                 logger.info(f"Файл верификаций {VERIFICATIONS_FILE} пустой, инициализируем")
-                _save_verifications({})
+                _write_verifications_file({})
                 return {}
             
             data = json.loads(content)
@@ -112,32 +139,143 @@ def _load_verifications() -> Dict:
             logger.info("Обнаружен старый формат верификаций, выполняется миграция...")
             data = _migrate_old_format(data)
             # Сохраняем мигрированные данные
-            _save_verifications(data)
+            _write_verifications_file(data)
             logger.info("Миграция верификаций завершена успешно")
         
         return data
     except json.JSONDecodeError as e:
         logger.error(f"Ошибка парсинга JSON верификаций: {e}. Создаём новый файл.")
         # Если файл повреждён — создаём новый
-        _save_verifications({})
+        _write_verifications_file({})
         return {}
     except Exception as e:
+        # Файл есть, но не читается (EACCES, EIO, сбой сетевого диска): пустой
+        # словарь в кэше выдал бы всех клиентов за неверифицированных, а первое
+        # сохранение затёрло бы файл — пусть повторит следующий вызов
         logger.error(f"Ошибка загрузки верификаций: {e}")
-        return {}
+        raise
 
 
-def _save_verifications(verifications: Dict) -> bool:
-    """Сохранить верификации в файл"""
+def _write_verifications_file(verifications: Dict) -> bool:
+    """Атомарно записывает верификации в файл (временный файл + rename)."""
+    tmp_path = f"{VERIFICATIONS_FILE}.tmp"
+    _file_stats['writes'] += 1
     try:
         os.makedirs(os.path.dirname(VERIFICATIONS_FILE), exist_ok=True)
-        with open(VERIFICATIONS_FILE, 'w', encoding='utf-8') as f:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
             json.dump(verifications, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, VERIFICATIONS_FILE)
         return True
     except Exception as e:
         logger.error(f"Ошибка сохранения верификаций: {e}")
         return False
 
 
+def _load_verifications() -> Dict:
+    """
+    Верификации из памяти процесса (файл читается только при первом вызове).
+    
+    Если файл не прочитался, исключение пробрасывается, а кэш остаётся
+    пустым (None) — следующий вызов попробует снова.
+    
+    Возвращается общий словарь: изменять его можно только под
+    _verifications_lock и с последующим вызовом _save_verifications().
+    """
+    global _verifications_cache
+    if _verifications_cache is None:
+        with _verifications_lock:
+            if _verifications_cache is None:
+                _verifications_cache = _read_verifications_file()
+    return _verifications_cache
+
+
+def _save_verifications(verifications: Dict) -> None:
+    """
+    Сохранить верификации: обновляет кэш и планирует запись файла.
+    
+    Запись откладывается на VERIFICATIONS_SAVE_DELAY секунд, чтобы
+    объединить несколько изменений; при завершении процесса несохранённые
+    изменения записываются сразу (flush_verifications).
+    """
+    global _verifications_cache, _verifications_version
+    with _verifications_lock:
+        _verifications_cache = verifications
+        _verifications_version += 1
+        _schedule_flush(VERIFICATIONS_SAVE_DELAY)
+
+
+def _schedule_flush(delay: float):
+    """Запускает таймер записи, если он ещё не запущен (вызывать под _verifications_lock)."""
+    global _save_timer
+    if _save_timer is None:
+        _save_timer = threading.Timer(delay, flush_verifications)
+        _save_timer.daemon = True
+        _save_timer.start()
+
+
+def flush_verifications() -> bool:
+    """Записывает несохранённые изменения верификаций на диск."""
+    global _save_timer, _save_failures
+    with _verifications_lock:
+        timer, _save_timer = _save_timer, None
+        if timer is None:
+            return True
+        timer.cancel()
+        # Копию делаем под локом, пишем в файл уже без него
+        data = copy.deepcopy(_verifications_cache)
+    if _write_verifications_file(data):
+        with _verifications_lock:
+            _save_failures = 0
+        return True
+    # Не удалось записать (например, диск заполнен) — повторим позже с растущей
+    # паузой; данные не менялись, поэтому версию не трогаем
+    with _verifications_lock:
+        _save_failures += 1
+        delay = min(VERIFICATIONS_SAVE_RETRY_MAX, VERIFICATIONS_SAVE_DELAY * 2 ** _save_failures)
+        logger.warning(f"Запись верификаций не удалась ({_save_failures} раз подряд), повтор через {delay:g} с")
+        _schedule_flush(delay)
+    return False
+
+
+def _get_user_logins(telegram_user_id: int) -> Optional[List[str]]:
+    """
+    Копия списка логинов пользователя, снятая под _verifications_lock.
+    
+    Returns:
+        None, если записи пользователя нет, иначе список логинов (может быть пустым)
+    """
+    with _verifications_lock:
+        user_data = _load_verifications().get(str(telegram_user_id))
+        if user_data is None:
+            return None
+        return list(user_data.get('logins', []))
+
+
+def load_verification_store() -> int:
+    """
+    Загружает верификации при старте бота (с миграцией старого формата).
+    
+    Returns:
+        Количество пользователей с верификациями
+    """
+    return len(_load_verifications())
+
+
+def verifications_version() -> int:
+    """Номер версии верификаций: меняется при каждом сохранении."""
+    return _verifications_version
+
+
+def get_verification_file_stats() -> Dict[str, int]:
+    """Сколько раз с начала работы процесса читался и записывался файл верификаций."""
+    return dict(_file_stats)
+
+
+atexit.register(flush_verifications)
+
+
 def save_verification(telegram_user_id: int, client_login: str) -> str:
     """
     Сохранить верификацию клиента. Добавляет логин в список, если его там ещё нет.
@@ -175,38 +313,37 @@ def save_verification(telegram_user_id: int, client_login: str) -> str:
         logger.error(f"save_verification: {error_msg} telegram_user={telegram_user_id}")
         return error_msg
     
-    verifications = _load_verifications()
-    user_key = str(telegram_user_id)
-    
-    # Получаем или создаём запись пользователя
-    if user_key not in verifications:
-        verifications[user_key] = {
-            'logins': [],
-            'verifications': {}
+    with _verifications_lock:
+        verifications = _load_verifications()
+        user_key = str(telegram_user_id)
+        
+        # Получаем или создаём запись пользователя
+        if user_key not in verifications:
+            verifications[user_key] = {
+                'logins': [],
+                'verifications': {}
+            }
+        
+        user_data = verifications[user_key]
+        
+        # Добавляем логин в список, если его там ещё нет
+        if client_login not in user_data['logins']:
+            user_data['logins'].append(client_login)
+            logger.info(f"✅ Добавлен новый логин: telegram_user={telegram_user_id}, login={client_login}")
+        else:
+            logger.info(f"ℹ️ Логин уже в списке: telegram_user={telegram_user_id}, login={client_login}")
+        
+        # Сохраняем/обновляем timestamp верификации
+        user_data['verifications'][client_login] = {
+            'verified_at': datetime.now().isoformat()
         }
-    
-    user_data = verifications[user_key]
-    
-    # Добавляем логин в список, если его там ещё нет
-    if client_login not in user_data['logins']:
-        user_data['logins'].append(client_login)
-        logger.info(f"✅ Добавлен новый логин: telegram_user={telegram_user_id}, login={client_login}")
-    else:
-        logger.info(f"ℹ️ Логин уже в списке: telegram_user={telegram_user_id}, login={client_login}")
-    
-    # Сохраняем/обновляем timestamp верификации
-    user_data['verifications'][client_login] = {
-        'verified_at': datetime.now().isoformat()
-    }
-    
-    if _save_verifications(verifications):
         logins_count = len(user_data['logins'])
-        if logins_count > 1:
-            return f"✅ Верификация сохранена для логина {client_login} (всего детей: {logins_count})"
-        else:
-            return f"✅ Верификация сохранена для логина {client_login}"
+        _save_verifications(verifications)
+    
+    if logins_count > 1:
+        return f"✅ Верификация сохранена для логина {client_login} (всего детей: {logins_count})"
     else:
-        return "❌ Ошибка сохранения верификации"
+        return f"✅ Верификация сохранена для логина {client_login}"
 
 
 def is_client_verified(telegram_user_id: int, client_login: str) -> bool:
@@ -220,47 +357,64 @@ def is_client_verified(telegram_user_id: int, client_login: str) -> bool:
     Returns:
         True если верификация актуальна, False иначе
     """
-    verifications = _load_verifications()
-    user_key = str(telegram_user_id)
-    
-    if user_key not in verifications:
-        logger.debug(f"Верификация НЕ найдена для telegram_user={telegram_user_id}")
-        return False
-    
-    user_data = verifications[user_key]
-    
-    # Проверяем наличие логина в списке
-    if client_login not in user_data.get('logins', []):
-        logger.debug(f"Логин {client_login} НЕ найден в списке верифицированных для telegram_user={telegram_user_id}")
-        return False
-    
-    # Проверяем срок действия (если установлен)
-    if VERIFICATION_EXPIRY_DAYS is not None:
-        verification_info = user_data.get('verifications', {}).get(client_login, {})
-        verified_at_str = verification_info.get('verified_at')
+    with _verifications_lock:
+        verifications = _load_verifications()
+        user_key = str(telegram_user_id)
         
-        if verified_at_str:
-            try:
-                verified_at = datetime.fromisoformat(verified_at_str)
-                expiry_date = verified_at + timedelta(days=VERIFICATION_EXPIRY_DAYS)
-                
-                if datetime.now() > expiry_date:
-                    logger.info(f"Верификация истекла для telegram_user={telegram_user_id}, login={client_login}")
-                    # Удаляем устаревшую верификацию конкретного логина
-                    user_data['logins'].remove(client_login)
-                    del user_data['verifications'][client_login]
-                    
-                    # Если у пользователя не осталось верификаций, удаляем всю запись
-                    if not user_data['logins']:
-                        del verifications[user_key]
+        if user_key not in verifications:
+            logger.debug(f"Верификация НЕ найдена для telegram_user={telegram_user_id}")
+            return False
+        
+        user_data = verifications[user_key]
+        
+        # Проверяем наличие логина в списке
+        if client_login not in user_data.get('logins', []):
+            logger.debug(f"Логин {client_login} НЕ найден в списке верифицированных для telegram_user={telegram_user_id}")
+            return False
+        
+        # Проверяем срок действия (если установлен)
+        if VERIFICATION_EXPIRY_DAYS is not None:
+            verification_info = user_data.get('verifications', {}).get(client_login, {})
+            verified_at_str = verification_info.get('verified_at')
+            
+            if verified_at_str:
+                try:
+                    verified_at = datetime.fromisoformat(verified_at_str)
+                    expiry_date = verified_at + timedelta(days=VERIFICATION_EXPIRY_DAYS)
                     
-                    _save_verifications(verifications)
-                    return False
-            except ValueError:
-                logger.warning(f"Некорректная дата верификации: {verified_at_str}")
+                    if datetime.now() > expiry_date:
+                        logger.info(f"Верификация истекла для telegram_user={telegram_user_id}, login={client_login}")
+                        # Удаляем устаревшую верификацию конкретного логина
+                        user_data['logins'].remove(client_login)
+                        del user_data['verifications'][client_login]
+                        
+                        # Если у пользователя не осталось верификаций, удаляем всю запись
+                        if not user_data['logins']:
+                            del verifications[user_key]
+                        
+                        _save_verifications(verifications)
+                        return False
+                except ValueError:
+                    logger.warning(f"Некорректная дата верификации: {verified_at_str}")
+        
+        logger.info(f"✅ Верификация найдена и актуальна: telegram_user={telegram_user_id}, login={client_login}")
+        return True
+
+
+def get_verified_logins(telegram_user_id: int) -> List[str]:
+    """
+    Актуальные логины пользователя (истёкшие верификации при этом удаляются).
     
-    logger.info(f"✅ Верификация найдена и актуальна: telegram_user={telegram_user_id}, login={client_login}")
-    return True
+    Args:
+        telegram_user_id: ID пользователя в Telegram
+    
+    Returns:
+        Список логинов с неистёкшей верификацией
+    """
+    with _verifications_lock:
+        user_data = _load_verifications().get(str(telegram_user_id), {})
+        logins = list(user_data.get('logins', []))
+        return [login for login in logins if is_client_verified(telegram_user_id, login)]
 
 
 def check_verification(telegram_user_id: int, client_login: str) -> str:
@@ -292,42 +446,41 @@ def reset_verification(telegram_user_id: int, client_login: Optional[str] = None
     Returns:
         Сообщение о результате
     """
-    verifications = _load_verifications()
-    user_key = str(telegram_user_id)
-    
-    if user_key not in verifications:
-        return "ℹ️ Верификация не найдена"
-    
-    user_data = verifications[user_key]
-    
-    # Если указан конкретный логин - удаляем только его
-    if client_login:
-        if client_login in user_data.get('logins', []):
-            user_data['logins'].remove(client_login)
-            if client_login in user_data.get('verifications', {}):
-                del user_data['verifications'][client_login]
-            
-            # Если это был последний логин - удаляем всю запись пользователя
-            if not user_data['logins']:
-                del verifications[user_key]
-                logger.info(f"Верификация сброшена полностью для telegram_user={telegram_user_id} (последний логин {client_login})")
-                result_msg = f"✅ Верификация сброшена для логина {client_login}"
+    with _verifications_lock:
+        verifications = _load_verifications()
+        user_key = str(telegram_user_id)
+        
+        if user_key not in verifications:
+            return "ℹ️ Верификация не найдена"
+        
+        user_data = verifications[user_key]
+        
+        # Если указан конкретный логин - удаляем только его
+        if client_login:
+            if client_login in user_data.get('logins', []):
+                user_data['logins'].remove(client_login)
+                if client_login in user_data.get('verifications', {}):
+                    del user_data['verifications'][client_login]
+                
+                # Если это был последний логин - удаляем всю запись пользователя
+                if not user_data['logins']:
+                    del verifications[user_key]
+                    logger.info(f"Верификация сброшена полностью для telegram_user={telegram_user_id} (последний логин {client_login})")
+                    result_msg = f"✅ Верификация сброшена для логина {client_login}"
+                else:
+                    logger.info(f"Верификация сброшена для telegram_user={telegram_user_id}, login={client_login} (осталось логинов: {len(user_data['logins'])})")
+                    result_msg = f"✅ Верификация сброшена для логина {client_login} (осталось детей: {len(user_data['logins'])})"
             else:
-                logger.info(f"Верификация сброшена для telegram_user={telegram_user_id}, login={client_login} (осталось логинов: {len(user_data['logins'])})")
-                result_msg = f"✅ Верификация сброшена для логина {client_login} (осталось детей: {len(user_data['logins'])})"
+                return f"ℹ️ Логин {client_login} не найден в списке верификаций"
         else:
-            return f"ℹ️ Логин {client_login} не найден в списке верификаций"
-    else:
-        # Удаляем все верификации пользователя
-        logins_count = len(user_data.get('logins', []))
-        del verifications[user_key]
-        logger.info(f"Все верификации сброшены для telegram_user={telegram_user_id} (было логинов: {logins_count})")
-        result_msg = f"✅ Все верификации сброшены (было детей: {logins_count})"
-    
-    if _save_verifications(verifications):
+            # Удаляем все верификации пользователя
+            logins_count = len(user_data.get('logins', []))
+            del verifications[user_key]
+            logger.info(f"Все верификации сброшены для telegram_user={telegram_user_id} (было логинов: {logins_count})")
+            result_msg = f"✅ Все верификации сброшены (было детей: {logins_count})"
+        
+        _save_verifications(verifications)
         return result_msg
-    else:
-        return "❌ Ошибка сброса верификации"
 
 
 def get_all_verifications() -> str:
@@ -337,43 +490,44 @@ def get_all_verifications() -> str:
     Returns:
         Строка со списком верификаций
     """
-    verifications = _load_verifications()
-    
-    if not verifications:
-        return "📋 Верификации отсутствуют"
-    
-    total_users = len(verifications)
-    total_logins = sum(len(data.get('logins', [])) for data in verifications.values())
-    
-    lines = [f"📋 Всего пользователей: {total_users}"]
-    lines.append(f"📋 Всего верифицированных логинов: {total_logins}\n")
-    
-    for telegram_id, data in verifications.items():
-        logins = data.get('logins', [])
-        verifications_data = data.get('verifications', {})
+    with _verifications_lock:
+        verifications = _load_verifications()
         
-        lines.append(f"👤 Telegram ID: {telegram_id}")
-        lines.append(f"   👶 Детей: {len(logins)}")
+        if not verifications:
+            return "📋 Верификации отсутствуют"
         
-        for login in logins:
-            verification_info = verifications_data.get(login, {})
-            verified_at = verification_info.get('verified_at', 'N/A')
+        total_users = len(verifications)
+        total_logins = sum(len(data.get('logins', [])) for data in verifications.values())
+        
+        lines = [f"📋 Всего пользователей: {total_users}"]
+        lines.append(f"📋 Всего верифицированных логинов: {total_logins}\n")
+        
+        for telegram_id, data in verifications.items():
+            logins = data.get('logins', [])
+            verifications_data = data.get('verifications', {})
             
-            if verified_at != 'N/A':
-                try:
-                    dt = datetime.fromisoformat(verified_at)
-                    verified_at_str = dt.strftime('%d.%m.%Y %H:%M')
-                except:
-                    verified_at_str = verified_at
-            else:
-                verified_at_str = 'N/A'
+            lines.append(f"👤 Telegram ID: {telegram_id}")
+            lines.append(f"   👶 Детей: {len(logins)}")
+            
+            for login in logins:
+                verification_info = verifications_data.get(login, {})
+                verified_at = verification_info.get('verified_at', 'N/A')
+                
+                if verified_at != 'N/A':
+                    try:
+                        dt = datetime.fromisoformat(verified_at)
+                        verified_at_str = dt.strftime('%d.%m.%Y %H:%M')
+                    except:
+                        verified_at_str = verified_at
+                else:
+                    verified_at_str = 'N/A'
+                
+                lines.append(f"   • Логин: {login}")
+                lines.append(f"     Дата: {verified_at_str}")
             
-            lines.append(f"   • Логин: {login}")
-            lines.append(f"     Дата: {verified_at_str}")
+            lines.append("")  # Пустая строка между пользователями
         
-        lines.append("")  # Пустая строка между пользователями
-    
-    return '\n'.join(lines)
+        return '\n'.join(lines)
 
 
 # === Новые функции для автоматического определения логина ===
@@ -397,17 +551,15 @@ def get_verified_login_with_context(
             "message": str
         }
     """
-    verifications = _load_verifications()
-    user_key = str(telegram_user_id)
+    logins = _get_user_logins(telegram_user_id)
     
     # Проверка 1: Есть ли верификация?
-    if user_key not in verifications:
+    if logins is None:
         return {
             "status": "not_verified",
             "message": "Необходимо пройти верификацию по номеру телефона."
         }
     
-    logins = verifications[user_key].get('logins', [])
     
     if not logins:
         return {
@@ -441,13 +593,12 @@ def get_verified_login_with_context(
             }
     
     # Проверка 4: Нужен выбор ребёнка — загружаем имена
-    from .client_tools import load_clients
-    clients = load_clients()
+    from .client_tools import get_client_by_login
     
     children = []
     for login in logins:
         if is_client_verified(telegram_user_id, login):
-            client = next((c for c in clients if c.get('login') == login), None)
+            client = get_client_by_login(login)
             if client:
                 student = client.get('student', {})
                 children.append({
@@ -494,18 +645,15 @@ def get_client_context(telegram_user_id: int) -> Dict[str, Any]:
             "message": str
         }
     """
-    verifications = _load_verifications()
-    user_key = str(telegram_user_id)
+    logins = _get_user_logins(telegram_user_id)
     
     # Шаг 1: Проверка верификации
-    if user_key not in verifications:
+    if logins is None:
         return {
             "is_verified": False,
             "message": "Клиент не верифицирован. Предложите верификацию по номеру телефона или логину."
         }
     
-    user_data = verifications[user_key]
-    logins = user_data.get('logins', [])
     
     if not logins:
         return {
@@ -561,16 +709,14 @@ def set_active_child(telegram_user_id: int, child_identifier: str) -> Dict[str,
     Returns:
         Результат установки
     """
-    verifications = _load_verifications()
-    user_key = str(telegram_user_id)
+    logins = _get_user_logins(telegram_user_id)
     
-    if user_key not in verifications:
+    if logins is None:
         return {
             "success": False,
             "message": "Верификация не найдена"
         }
     
-    logins = verifications[user_key].get('logins', [])
     
     if not logins:
         return {
@@ -578,8 +724,7 @@ def set_active_child(telegram_user_id: int, child_identifier: str) -> Dict[str,
             "message": "Нет верифицированных детей"
         }
     
-    from .client_tools import load_clients
-    clients = load_clients()
+    from .client_tools import get_client_by_login
     
     # Пытаемся найти ребёнка по идентификатору
     selected_login = None
@@ -597,7 +742,7 @@ def set_active_child(telegram_user_id: int, child_identifier: str) -> Dict[str,
     # Вариант 3: Это имя ребёнка (поиск по имени)
     else:
         for login in logins:
-            client = next((c for c in clients if c.get('login') == login), None)
+            client = get_client_by_login(login)
             if client:
                 student = client.get('student', {})
                 # Полное ФИО
@@ -611,7 +756,7 @@ def set_active_child(telegram_user_id: int, child_identifier: str) -> Dict[str,
     
     if selected_login:
         # Находим имя для подтверждения
-        client = next((c for c in clients if c.get('login') == selected_login), None)
+        client = get_client_by_login(selected_login)
         if client:
             student = client.get('student', {})
             child_name = f"{student.get('last_name', '')} {student.get('first_name', '')}".strip()
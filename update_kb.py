@@ -7,6 +7,9 @@ from datetime import datetime
 from dotenv import load_dotenv
 
 # Запускает обновление базы знаний как one-shot процесс под systemd
+# (по умолчанию инкрементально; --full — пересобрать базу целиком).
+# bot.py не импортируется: сборка — в tools/kb_builder.py, а запущенный бот
+# сам подхватывает новую версию по файлу-указателю (KB_RELOAD_POLL_SECONDS)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -14,10 +17,10 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 load_dotenv()
 
 try:
-    # Импортируем из основного бота готовую функцию обновления
-    from bot import update_vector_store_telegram
+    import openai
+    from tools.kb_builder import KBBuildConfig, update_knowledge_base
 except Exception as e:
-    print(f"❌ Не удалось импортировать update_vector_store_telegram из bot.py: {e}")
+    print(f"❌ Не удалось импортировать сборку базы знаний (tools/kb_builder.py): {e}")
     sys.exit(1)
 
 
@@ -55,7 +58,15 @@ def send_telegram_notification(message: str):
 async def main() -> int:
     try:
         logging.info("--- One-shot обновление базы знаний (systemd) ---")
-        result = await update_vector_store_telegram()
+        config = KBBuildConfig.from_env()
+        if not config.folder_id or not os.getenv("OPENAI_API_KEY"):
+            logging.error("❌ GOOGLE_DRIVE_FOLDER_ID или OPENAI_API_KEY не найдены в .env")
+            return 1
+        client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        try:
+            result = await update_knowledge_base(client, config, full_rebuild="--full" in sys.argv[1:])
+        finally:
+            await client.close()
         
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
@@ -63,7 +74,10 @@ async def main() -> int:
             added = result.get('added_chunks', 'N/A')
             total = result.get('total_chunks', 'N/A')
             
-            logging.info("✅ Обновление завершено успешно: added=%s total=%s", added, total)
+            logging.info(
+                "✅ Обновление завершено успешно: mode=%s added=%s total=%s embedded=%s",
+                result.get('mode'), added, total, result.get('embedded_chunks')
+            )
             
             # Отправляем уведомление админу
             message = (
@@ -73,6 +87,13 @@ async def main() -> int:
                 f"➕ Добавлено чанков: {added}\n"
                 f"📊 Всего в базе: {total}"
             )
+            if result.get("mode") == "unchanged":
+                message += "\n♻️ Файлы не изменились, база не пересобиралась"
+            elif result.get("mode") == "incremental":
+                message += (
+                    f"\n🔁 Изменено файлов: {result.get('changed_files', 0)}, удалено: {result.get('removed_files', 0)}"
+                    f"\n🧮 Эмбеддингов запрошено: {result.get('embedded_chunks', 0)}"
+                )
             send_telegram_notification(message)
             
             return 0